@@ -2,13 +2,85 @@
 智能体编排器
 负责 FSM 状态管理、智能体路由、上下文打包和 LLM 调用
 """
+import contextvars
 import os
+import queue
+import socket
+import threading
 import time
 from typing import Dict, List, Optional, Tuple
-from openai import OpenAI
-from config import STATE_AGENT_MAPPING, AGENT_DISPLAY_NAMES, OPENAI_CONFIG
+from openai import APIStatusError, RateLimitError
+from config import (
+    STATE_AGENT_MAPPING, AGENT_DISPLAY_NAMES, OPENAI_CONFIG, FALLBACK_PROVIDER_CONFIGS, STREAM_RETRY_CONFIG
+)
 from prompt_manager import prompt_manager
 from db import db
+from response_cache import response_cache
+from markdown_compactor import markdown_compactor
+from single_flight import single_flight
+from rate_limiter import rate_limiter, LLMOverloadedError, LLMCancelledError
+from stream_registry import CancelToken
+from llm_providers import LLMProvider, ProviderPool, HedgePolicy
+from metrics import metrics
+from usage_tracker import usage_tracker
+from tracing import tracer, traced
+from logger import get_logger, preview
+
+logger = get_logger('orchestrator')
+
+# LLM 调用失败时返回给用户的提示前缀（这类回复不应写入缓存）
+LLM_ERROR_PREFIX = "抱歉，我遇到了一些问题无法回复"
+EMPTY_RESPONSE_FALLBACK = "抱歉，我暂时无法生成回复。请稍后再试或换个方式提问。"
+
+
+class ProvidersUnavailableError(Exception):
+    """所有提供商都处于熔断状态（或本次调用中均已失败）"""
+    pass
+
+
+class LLMStreamError(Exception):
+    """流式调用在重试和续写后仍然失败（partial 为已输出的内容）"""
+    
+    def __init__(self, message: str, partial: str = ""):
+        super().__init__(message)
+        self.partial = partial
+
+
+def _abort_stream(stream):
+    """
+    关闭流式响应，另一线程中阻塞的读取立即返回
+
+    只关闭响应对象不会打断正在 recv 的线程（首 token 之前卡住时会一直等到提供商发来数据），
+    因此先关闭底层 socket
+    """
+    try:
+        network_stream = stream.response.extensions.get('network_stream')
+        sock = network_stream.get_extra_info('socket') if network_stream is not None else None
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+    except Exception:
+        pass
+    try:
+        stream.close()
+    except Exception:
+        pass
+
+
+class _StreamAttempt:
+    """对冲中的一路流式请求（供另一线程取消）"""
+    
+    def __init__(self, index: int):
+        self.index = index
+        self.provider = None
+        self.stream = None
+        self.cancelled = threading.Event()
+    
+    def cancel(self):
+        """取消该路请求：关闭上游连接，阻塞中的读取会立即返回"""
+        self.cancelled.set()
+        stream = self.stream
+        if stream is not None:
+            _abort_stream(stream)
 
 
 class AgentOrchestrator:
@@ -25,37 +97,55 @@ class AgentOrchestrator:
         if not self.api_key:
             raise ValueError("未设置 API Key，请在 api_config.json 中配置或设置 OPENAI_API_KEY 环境变量")
         
-        # 构建 client 参数（只包含 OpenAI 客户端支持的参数）
-        client_kwargs = {
+        # 主提供商 + 备用提供商（按顺序故障转移），每个提供商各有一个客户端和熔断器
+        provider_configs = [{
+            'name': OPENAI_CONFIG.get('provider', 'openai'),
             'api_key': self.api_key,
-            'timeout': OPENAI_CONFIG.get('timeout', 60),
-        }
-        
-        # 添加自定义 base_url（如果有）
-        if OPENAI_CONFIG.get('base_url'):
-            client_kwargs['base_url'] = OPENAI_CONFIG['base_url']
-        
-        print(f"🔧 初始化 OpenAI 客户端")
-        print(f"   Base URL: {client_kwargs.get('base_url', 'default')}")
-        print(f"   Model: {OPENAI_CONFIG.get('model')}")
-        
-        try:
-            self.client = OpenAI(**client_kwargs)
-        except Exception as e:
-            print(f"❌ OpenAI 客户端初始化失败: {e}")
-            print(f"   请检查 openai 和 httpx 版本是否匹配")
-            raise
-            
-        self.model = OPENAI_CONFIG['model']
-        self.temperature = OPENAI_CONFIG['temperature']
-        self.max_tokens = OPENAI_CONFIG['max_tokens']
+            'base_url': OPENAI_CONFIG.get('base_url'),
+            'model': OPENAI_CONFIG['model'],
+            'temperature': OPENAI_CONFIG['temperature'],
+            'max_tokens': OPENAI_CONFIG['max_tokens'],
+            'rate_limit': OPENAI_CONFIG.get('rate_limit'),
+        }] + FALLBACK_PROVIDER_CONFIGS
+        
+        providers = []
+        for provider_config in provider_configs:
+            print(f"🔧 初始化 OpenAI 客户端 [{provider_config['name']}]")
+            print(f"   Base URL: {provider_config.get('base_url') or 'default'}")
+            print(f"   Model: {provider_config['model']}")
+            try:
+                providers.append(LLMProvider(
+                    provider_config,
+                    timeout=OPENAI_CONFIG.get('timeout', 60),
+                    rate_limits=rate_limiter.limits_for(provider_config.get('rate_limit'))
+                ))
+            except Exception as e:
+                print(f"❌ OpenAI 客户端初始化失败: {e}")
+                print(f"   请检查 openai 和 httpx 版本是否匹配")
+                raise
+        self.pool = ProviderPool(providers)
+        
+        # 主提供商的参数（缓存键、请求合并键按主提供商计算）
+        primary = self.pool.primary
+        self.client = primary.client
+        self.model = primary.model
+        self.temperature = primary.temperature
+        self.max_tokens = primary.max_tokens
         self.max_retries = OPENAI_CONFIG['max_retries']
+        self.provider = primary.name
+        self.rate_limits = primary.rate_limits
+        self.hedging = HedgePolicy()
+        self.max_resumes = STREAM_RETRY_CONFIG.get('max_resumes', 2)
+        self.overlap_window = STREAM_RETRY_CONFIG.get('overlap_window', 200)
+        self.resume_instruction = STREAM_RETRY_CONFIG['resume_instruction']
     
+    @traced('agent.process_message')
     def process_message(
         self,
         session_id: str,
         user_message: str,
-        session_data: Dict
+        session_data: Dict,
+        priority: str = 'interactive'
     ) -> Tuple[str, str]:
         """
         处理用户消息的主入口
@@ -64,6 +154,7 @@ class AgentOrchestrator:
             session_id: 会话 ID
             user_message: 用户消息
             session_data: 会话数据（包含 current_state, chat_history 等）
+            priority: LLM 调度优先级（'interactive' 或 'background'）
         
         Returns:
             (assistant_response, new_state): AI 回复和新的状态
@@ -74,8 +165,8 @@ class AgentOrchestrator:
         # 注意：不包含 GUIDE_PENDING_PLAN，因为需要让 guidance_agent 自己判断场景二/场景三
         chapter_states = ['INTRODUCTION', 'REVIEW', 'METHOD', 'RESULT', 'DISCUSSION', 'CONTROL_ROUTING']
         if current_state in chapter_states and user_message:
-            print(f"🔄 检测到新问题，从状态 {current_state} 重新进行路由判断")
-            return self._handle_control_routing(session_id, user_message, session_data)
+            logger.debug('routing.reroute', '🔄 检测到新问题，重新进行路由判断', state=current_state)
+            return self._handle_control_routing(session_id, user_message, session_data, priority)
         
         # 1. 根据状态获取对应的智能体
         agent_name = self._get_agent_by_state(current_state)
@@ -91,28 +182,24 @@ class AgentOrchestrator:
             system_prompt=system_prompt,
             context=context,
             user_message=user_message,
-            chat_history=session_data.get('session_data', {}).get('chat_history', [])
+            chat_history=session_data.get('session_data', {}).get('chat_history', []),
+            priority=priority,
+            tags=self.usage_tags(session_data, agent_name)
         )
         
-        # 🔍 调试：打印 LLM 响应
-        print(f"\n{'='*60}")
-        print(f"🤖 智能体 [{AGENT_DISPLAY_NAMES.get(agent_name, agent_name)}] 响应:")
-        print(f"{'='*60}")
-        print(f"响应长度: {len(assistant_response)} 字符")
-        if len(assistant_response) < 200:
-            print(f"响应内容: {assistant_response}")
-        else:
-            print(f"响应前200字: {assistant_response[:200]}...")
-        print(f"{'='*60}\n")
+        logger.info(
+            'agent.responded', f"🤖 智能体 [{AGENT_DISPLAY_NAMES.get(agent_name, agent_name)}] 已响应",
+            agent=agent_name, chars=len(assistant_response), preview=preview(assistant_response)
+        )
         
         # 🔍 检查空响应
         if not assistant_response or len(assistant_response.strip()) == 0:
-            print(f"⚠️  警告：智能体返回了空响应！")
-            print(f"   当前状态: {current_state}")
-            print(f"   智能体: {agent_name}")
-            print(f"   用户消息: {user_message}")
+            logger.warning(
+                'agent.empty_response', '⚠️  智能体返回了空响应',
+                state=current_state, agent=agent_name, user_message=preview(user_message)
+            )
             # 返回友好提示而不是空字符串
-            assistant_response = "抱歉，我暂时无法生成回复。请稍后再试或换个方式提问。"
+            assistant_response = EMPTY_RESPONSE_FALLBACK
         
         # 🔍 检测场景三的特殊路由标记（guidance_agent专用）
         if agent_name == 'guidance' and current_state == 'GUIDE_PENDING_PLAN':
@@ -124,12 +211,12 @@ class AgentOrchestrator:
                 if json_match:
                     route_data = json.loads(json_match.group())
                     if route_data.get('route') == 'content_question':
-                        print("🔄 检测到场景三路由标记，自动转发到 control_routing")
+                        logger.debug('routing.content_question', '🔄 检测到场景三路由标记，自动转发到 control_routing')
                         # 直接调用 control_routing 处理用户的原始问题
                         # 注意：这里直接返回，不再返回包含JSON的guidance回复
-                        return self._handle_control_routing(session_id, user_message, session_data)
+                        return self._handle_control_routing(session_id, user_message, session_data, priority)
             except Exception as e:
-                print(f"⚠️  解析路由标记失败（可能不是场景三）: {e}")
+                logger.debug('routing.marker_parse_failed', '⚠️  解析路由标记失败（可能不是场景三）', error=str(e))
         
         # 5. 判断是否需要状态转换
         new_state = self._determine_next_state(
@@ -141,11 +228,13 @@ class AgentOrchestrator:
         
         return assistant_response, new_state
     
+    @traced('agent.control_routing')
     def _handle_control_routing(
         self,
         session_id: str,
         user_message: str,
-        session_data: Dict
+        session_data: Dict,
+        priority: str = 'interactive'
     ) -> Tuple[str, str]:
         """
         处理CONTROL_ROUTING状态：让control_agent决策路由
@@ -154,6 +243,7 @@ class AgentOrchestrator:
             session_id: 会话 ID
             user_message: 用户消息
             session_data: 会话数据
+            priority: LLM 调度优先级
         
         Returns:
             (assistant_response, new_state): AI 回复和新的状态
@@ -166,15 +256,12 @@ class AgentOrchestrator:
             system_prompt=control_prompt,
             context=context,
             user_message=f"用户问题：{user_message}\n\n请分析这个问题应该路由给哪个智能体。",
-            chat_history=[]
+            chat_history=[],
+            priority=priority,
+            tags=self.usage_tags(session_data, 'control')
         )
         
-        # 🔍 打印中控智能体的完整回复（用于调试）
-        print("\n" + "="*60)
-        print("🎯 中控智能体 (Control Agent) 路由决策：")
-        print("="*60)
-        print(routing_response)
-        print("="*60 + "\n")
+        logger.debug('routing.response', '🎯 中控智能体路由决策', preview=preview(routing_response))
         
         # 2. 解析路由决策（尝试从JSON中提取agent_name）
         import json
@@ -201,16 +288,17 @@ class AgentOrchestrator:
                         target_agent = routing_json.get('agent_name')
             
             if target_agent:
-                print(f"✅ 路由决策成功: {target_agent}")
+                logger.info('routing.decided', '✅ 路由决策成功', target=target_agent)
             else:
-                print(f"⚠️  JSON解析成功但未找到agent_name字段")
+                logger.warning('routing.missing_agent', '⚠️  JSON解析成功但未找到agent_name字段')
                 
         except Exception as e:
-            print(f"❌ 解析路由决策失败: {e}")
+            logger.warning('routing.parse_failed', '❌ 解析路由决策失败', error=str(e))
         
         # 3. 如果无法解析，默认使用general智能体
         if not target_agent:
-            print("⚠️  无法解析路由决策，使用general作为默认")
+            logger.warning('routing.default_general', '⚠️  无法解析路由决策，使用general作为默认',
+                           preview=preview(routing_response))
             target_agent = 'general'
         
         # 3.5 标准化agent名称：移除_agent后缀（如果存在）
@@ -218,7 +306,7 @@ class AgentOrchestrator:
         if target_agent.endswith('_agent'):
             original_target = target_agent
             target_agent = target_agent.replace('_agent', '')
-            print(f"🔄 标准化agent名称: {original_target} -> {target_agent}")
+            logger.debug('routing.normalized', '🔄 标准化agent名称', original=original_target, target=target_agent)
         
         # 4. 构建context时，包含agent_inquiry_status信息
         context_with_status = self._build_context_with_agent_status(session_data, target_agent)
@@ -229,7 +317,9 @@ class AgentOrchestrator:
             system_prompt=target_prompt,
             context=context_with_status,
             user_message=user_message,
-            chat_history=session_data.get('session_data', {}).get('chat_history', [])
+            chat_history=session_data.get('session_data', {}).get('chat_history', []),
+            priority=priority,
+            tags=self.usage_tags(session_data, target_agent)
         )
         
         # 6. 更新agent_inquiry_status：标记该智能体已被询问
@@ -269,6 +359,26 @@ class AgentOrchestrator:
         # 6. 直接返回子智能体的回答（不再审核）
         return assistant_response, new_state
     
+    def usage_tags(self, session_data: Optional[Dict], agent_name: str) -> Dict:
+        """
+        构建 LLM 用量记录的标签
+        
+        Args:
+            session_data: 会话数据（可为 None）
+            agent_name: 发起调用的智能体
+        
+        Returns:
+            dict: agent / state / session_id / user_id / prompt_version
+        """
+        session_data = session_data or {}
+        return {
+            'agent': agent_name,
+            'state': session_data.get('current_state'),
+            'session_id': session_data.get('session_id'),
+            'user_id': session_data.get('user_id'),
+            'prompt_version': prompt_manager.default_version,
+        }
+    
     def _get_agent_by_state(self, state: str) -> str:
         """
         根据 FSM 状态获取对应的智能体名称
@@ -283,11 +393,12 @@ class AgentOrchestrator:
         
         if not agent_name:
             # 如果没有映射，使用通用智能体
-            print(f"⚠️  未知状态 {state}，使用通用智能体")
+            logger.warning('agent.unknown_state', '⚠️  未知状态，使用通用智能体', state=state)
             return 'general_agent'
         
         return agent_name
     
+    @traced('agent.build_context')
     def _build_context(self, session_data: Dict) -> str:
         """
         构建上下文信息
@@ -308,28 +419,25 @@ class AgentOrchestrator:
         paper_path = session_data.get('paper_path')
         markdown_path = session_data.get('markdown_path')
         
-        print(f"📋 构建上下文 - paper_path: {paper_path}")
-        print(f"📋 构建上下文 - markdown_path: {markdown_path}")
-        
         if paper_path:
             context_parts.append(f"📄 论文文件: {paper_path}")
         
-        # 2. Markdown 内容（如果已转换）
+        # 2. Markdown 内容（如果已转换；去掉图片标记、参考文献、页眉页脚等之后的精简版本）
         if markdown_path and os.path.exists(markdown_path):
             try:
-                with open(markdown_path, 'r', encoding='utf-8') as f:
-                    markdown_content = f.read()
-                    content_length = len(markdown_content)
-                    print(f"📋 读取到 Markdown 内容，长度: {content_length} 字符")
-                    # 截取前 50000 字符作为上下文（增加到 5 倍，约 50KB）
-                    if len(markdown_content) > 50000:
-                        markdown_content = markdown_content[:50000] + "\n\n... (内容过长，已截断)"
-                    context_parts.append(f"📝 论文内容:\n{markdown_content}")
+                markdown_content = markdown_compactor.load_context(markdown_path)
+                logger.debug('context.built', '📋 构建上下文', paper_path=paper_path,
+                             markdown_path=markdown_path, markdown_chars=len(markdown_content))
+                # 截取前 50000 字符作为上下文（增加到 5 倍，约 50KB）
+                if len(markdown_content) > 50000:
+                    markdown_content = markdown_content[:50000] + "\n\n... (内容过长，已截断)"
+                context_parts.append(f"📝 论文内容:\n{markdown_content}")
             except Exception as e:
-                print(f"⚠️  读取 Markdown 失败: {e}")
+                logger.warning('context.markdown_read_failed', '⚠️  读取 Markdown 失败',
+                               markdown_path=markdown_path, error=str(e))
         else:
             if markdown_path:
-                print(f"⚠️  Markdown 文件不存在: {markdown_path}")
+                logger.warning('context.markdown_missing', '⚠️  Markdown 文件不存在', markdown_path=markdown_path)
         
         # 3. 上下文包（从 session_data 中读取）
         session_dict = session_data.get('session_data', {})
@@ -347,6 +455,7 @@ class AgentOrchestrator:
         
         return "\n\n".join(context_parts) if context_parts else "暂无上下文信息"
     
+    @traced('agent.build_context')
     def _build_context_with_agent_status(self, session_data: Dict, target_agent: str) -> str:
         """
         构建包含智能体询问状态的上下文
@@ -378,10 +487,8 @@ class AgentOrchestrator:
             status_text += "✅ 用户已询问过此模块，请使用「常规模式」输出！\n"
         status_text += "============================="
         
-        print(f"\n🔍 智能体状态检测:")
-        print(f"   目标智能体: {target_agent}")
-        print(f"   是否首次询问: {is_first_inquiry}")
-        print(f"   当前状态记录: {agent_inquiry_status}")
+        logger.debug('context.inquiry_status', '🔍 智能体状态检测', target=target_agent,
+                     first_inquiry=is_first_inquiry, inquiry_status=agent_inquiry_status)
         
         return f"{base_context}{status_text}"
     
@@ -410,31 +517,95 @@ class AgentOrchestrator:
         # 保存回数据库
         db.update_session(session_id, session_data=session_dict)
         
-        print(f"✅ 已更新 {agent_name} 的询问状态为：已询问")
-    
-    def _call_llm(
+        logger.debug('agent.inquiry_recorded', '✅ 已更新智能体的询问状态为：已询问', agent=agent_name)
+
+    def deterministic_cache_info(
+        self,
+        session_data: Dict,
+        agent_name: str,
+        prompt_fingerprint: str,
+        prompt_version: Optional[str] = None,
+        uses_chat_history: bool = True
+    ) -> Optional[Dict]:
+        """
+        计算确定性生成（只依赖论文和 Prompt）的共享缓存信息
+
+        只有生成用到的会话内容都还没有个性化（上下文中没有阅读计划、上下文包；
+        用到聊天历史时聊天历史为空）时，生成结果才只取决于论文本身，可以在不同会话间复用。
+
+        Args:
+            session_data: 会话数据
+            agent_name: 智能体名称（或 'mindmap' 等内置任务名）
+            prompt_fingerprint: Prompt 内容指纹
+            prompt_version: Prompt 版本
+            uses_chat_history: 生成时是否带上聊天历史（思维导图等以空历史生成的任务传 False）
+
+        Returns:
+            dict: 可直接传给 response_cache.set 的参数（含 cache_key），不可缓存时返回 None
+        """
+        session_dict = session_data.get('session_data', {})
+        # 阅读计划和上下文包会进入 _build_context 构建的上下文
+        if session_dict.get('reading_plan') or session_dict.get('context_packages'):
+            return None
+        if uses_chat_history and session_dict.get('chat_history'):
+            return None
+
+        paper_hash = response_cache.file_digest(session_data.get('markdown_path'))
+        if not paper_hash:
+            return None
+
+        prompt_version = prompt_version or prompt_manager.default_version
+        cache_key = response_cache.make_key(
+            paper_hash=paper_hash,
+            agent=agent_name,
+            prompt_version=prompt_version,
+            prompt_fingerprint=prompt_fingerprint,
+            model=self.model,
+            params={'temperature': self.temperature, 'max_tokens': self.max_tokens,
+                    'compaction': markdown_compactor.fingerprint}
+        )
+        return {
+            'cache_key': cache_key,
+            'agent': agent_name,
+            'prompt_version': prompt_version,
+            'prompt_fingerprint': prompt_fingerprint,
+            'paper_hash': paper_hash,
+            'model': self.model,
+        }
+
+    @staticmethod
+    def is_error_response(response: str) -> bool:
+        """判断回复是否为调用失败时的提示文本"""
+        text = (response or '').strip()
+        return not text or text.startswith(LLM_ERROR_PREFIX) or text == EMPTY_RESPONSE_FALLBACK
+
+    def _build_messages(
         self,
         system_prompt: str,
         context: str,
         user_message: str,
-        chat_history: List[Dict]
-    ) -> str:
+        chat_history: List[Dict],
+        model: Optional[str] = None
+    ) -> List[Dict]:
         """
-        调用 OpenAI API（带重试机制）
+        构建发送给 LLM 的消息列表
         
         Args:
             system_prompt: 系统 Prompt（智能体的角色定义）
             context: 上下文信息
             user_message: 用户消息
             chat_history: 历史对话
+            model: 目标模型（决定消息格式），默认使用主提供商的模型
         
         Returns:
-            assistant_response: AI 回复
+            messages: OpenAI 格式的消息列表
         """
         # 检查是否是 Gemini 模型
-        is_gemini = 'gemini' in self.model.lower()
+        is_gemini = 'gemini' in (model or self.model).lower()
+        
+        # 历史对话只保留最近 10 轮，避免超长
+        recent_history = chat_history[-20:] if len(chat_history) > 20 else chat_history
         
-        # 构建消息列表
         if is_gemini:
             # Gemini 不支持 system 角色，需要特殊处理
             # 将 system prompt 和 context 合并到第一条 user 消息中
@@ -443,9 +614,6 @@ class AgentOrchestrator:
                 system_content += f"\n\n以下是当前会话的上下文信息：\n\n{context}"
             
             messages = []
-            
-            # 添加历史对话（只保留最近 10 轮）
-            recent_history = chat_history[-20:] if len(chat_history) > 20 else chat_history
             for msg in recent_history:
                 role = msg.get("role", "user")
                 # Gemini 只支持 user 和 model (assistant)
@@ -462,46 +630,184 @@ class AgentOrchestrator:
                 "role": "user",
                 "content": combined_user_message
             })
-        else:
-            # OpenAI 标准格式
-            messages = [
-                {
-                    "role": "system",
-                    "content": system_prompt
-                }
-            ]
-            
-            # 添加上下文（作为系统消息）
-            if context:
-                messages.append({
-                    "role": "system",
-                    "content": f"以下是当前会话的上下文信息：\n\n{context}"
-                })
-            
-            # 添加历史对话（只保留最近 10 轮，避免超长）
-            recent_history = chat_history[-20:] if len(chat_history) > 20 else chat_history
-            for msg in recent_history:
-                messages.append({
-                    "role": msg.get("role", "user"),
-                    "content": msg.get("content", "")
-                })
-            
-            # 添加当前用户消息
+            return messages
+        
+        # OpenAI 标准格式
+        messages = [
+            {
+                "role": "system",
+                "content": system_prompt
+            }
+        ]
+        
+        # 添加上下文（作为系统消息）
+        if context:
             messages.append({
-                "role": "user",
-                "content": user_message
+                "role": "system",
+                "content": f"以下是当前会话的上下文信息：\n\n{context}"
+            })
+        
+        for msg in recent_history:
+            messages.append({
+                "role": msg.get("role", "user"),
+                "content": msg.get("content", "")
             })
         
+        # 添加当前用户消息
+        messages.append({
+            "role": "user",
+            "content": user_message
+        })
+        return messages
+    
+    def _flight_key(self, messages: List[Dict], mode: str) -> str:
+        """计算请求合并键：模型、参数和消息完全相同的请求视为同一次生成"""
+        return single_flight.make_key(
+            mode=mode,
+            model=self.model,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            messages=messages
+        )
+    
+    def _call_llm(
+        self,
+        system_prompt: str,
+        context: str,
+        user_message: str,
+        chat_history: List[Dict],
+        priority: str = 'interactive',
+        tags: Optional[Dict] = None,
+        cancelled: Optional[CancelToken] = None
+    ) -> str:
+        """
+        调用 OpenAI API（带重试和故障转移机制）
+        
+        没有历史对话的确定性请求（导读报告、思维导图、路由决策）会经过 single-flight 合并，
+        并发的相同请求只触发一次生成。
+        
+        Args:
+            system_prompt: 系统 Prompt（智能体的角色定义）
+            context: 上下文信息
+            user_message: 用户消息
+            chat_history: 历史对话
+            priority: LLM 调度优先级（'interactive' 或 'background'）
+            tags: 用量标签（见 usage_tags）
+            cancelled: 取消信号；取消后立即返回（抛出 LLMCancelledError），不等待进行中的请求
+        
+        Returns:
+            assistant_response: AI 回复
+        
+        Raises:
+            LLMOverloadedError: 调用队列已饱和
+            LLMCancelledError: 已取消
+        """
+        def build_messages(model):
+            return self._build_messages(system_prompt, context, user_message, chat_history, model)
+        
+        def call():
+            with tracer.span('llm.call', agent=(tags or {}).get('agent'), priority=priority):
+                if single_flight.should_coalesce(chat_history):
+                    # 合并的调用可能还有其他请求在等待结果：本请求取消时只是不再等待，不中止生成
+                    return single_flight.run(
+                        self._flight_key(build_messages(self.model), 'call'),
+                        lambda: self._complete_with_retry(build_messages, priority, tags),
+                        is_failure=self.is_error_response
+                    )
+                return self._complete_with_retry(build_messages, priority, tags, cancelled)
+        
+        if cancelled is None:
+            return call()
+        return self._run_cancellable(call, cancelled)
+    
+    @staticmethod
+    def _run_cancellable(fn, cancelled: CancelToken, discard=None):
+        """
+        在后台线程中执行阻塞调用，取消时立即返回
+        
+        请求在响应到达前无法中途关闭：取消后调用在后台继续完成，结果交给 discard 处理（如关闭流），
+        排队和退避阶段的取消由 fn 自己处理
+        
+        Raises:
+            LLMCancelledError: 调用完成前已取消
+        """
+        done = threading.Event()
+        lock = threading.Lock()
+        outcome = {}
+        
+        def run():
+            try:
+                result = fn()
+            except BaseException as e:
+                with lock:
+                    outcome['error'] = e
+            else:
+                with lock:
+                    abandoned = outcome.get('abandoned', False)
+                    outcome['result'] = result
+                if abandoned and discard is not None:
+                    discard(result)
+            finally:
+                done.set()
+                unregister()
+        
+        unregister = cancelled.on_cancel(done.set)
+        # 复制上下文：后台线程中的 span 挂到当前链路下
+        threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True).start()
+        done.wait()
+        with lock:
+            if 'error' in outcome:
+                raise outcome['error']
+            if 'result' not in outcome:
+                outcome['abandoned'] = True
+                raise LLMCancelledError("调用已取消")
+            return outcome['result']
+    
+    def _complete_with_retry(
+        self,
+        build_messages,
+        priority: str = 'interactive',
+        tags: Optional[Dict] = None,
+        cancelled: Optional[CancelToken] = None
+    ) -> str:
+        """
+        执行非流式补全请求（带重试机制）
+        
+        每次尝试都从提供商池中选择提供商：主提供商熔断或本次调用已失败时，
+        自动转移到下一个可用的备用提供商。调用结束后记录一条用量。
+        
+        Args:
+            build_messages: 按目标模型构建消息列表的函数
+            priority: LLM 调度优先级
+            tags: 用量标签（见 usage_tags）
+            cancelled: 取消信号（排队和退避期间取消时抛出 LLMCancelledError）
+        
+        Returns:
+            assistant_response: AI 回复，所有重试都失败时返回错误提示
+        """
+        failed = []
+        call_started = time.time()
+        
         # 重试逻辑
         for attempt in range(self.max_retries):
+            provider = self.pool.select(exclude=failed)
+            if provider is None:
+                logger.error('llm.providers_unavailable', '❌ 所有 LLM 提供商均处于熔断状态')
+                return f"{LLM_ERROR_PREFIX}。模型服务暂时不可用，请稍后再试。"
+            
+            messages = build_messages(provider.model)
+            estimated_tokens = rate_limiter.estimate_tokens(messages, provider.max_tokens)
+            started = time.time()
             try:
-                # 调用 OpenAI API
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    temperature=self.temperature,
-                    max_tokens=self.max_tokens
-                )
+                # 调用 OpenAI API（先在限流器中排队）
+                with rate_limiter.slot(provider.name, provider.rate_limits, estimated_tokens, priority, cancelled):
+                    started = time.time()
+                    response = provider.client.chat.completions.create(
+                        model=provider.model,
+                        messages=messages,
+                        temperature=provider.temperature,
+                        max_tokens=provider.max_tokens
+                    )
                 
                 # 检查响应是否有效
                 if not response.choices or len(response.choices) == 0:
@@ -513,123 +819,575 @@ class AgentOrchestrator:
                 if assistant_response is None:
                     raise ValueError("API 返回的内容为 None")
                 
+                self._record_success(provider, time.time() - started)
+                usage_tracker.record(
+                    tags, provider.name, provider.model, 'call', 'success',
+                    latency=time.time() - call_started,
+                    usage=usage_tracker.parse_usage(getattr(response, 'usage', None)),
+                    retries=attempt,
+                    prompt_text=self._prompt_text(messages),
+                    completion_text=assistant_response
+                )
                 return assistant_response
             
+            except (LLMOverloadedError, LLMCancelledError):
+                # 排队饱和或已取消：直接交给调用方，不再重试
+                provider.breaker.cancel()
+                raise
+            
             except Exception as e:
-                print(f"❌ OpenAI API 调用失败 (尝试 {attempt + 1}/{self.max_retries}): {e}")
-                print(f"   模型: {self.model}")
-                print(f"   消息数量: {len(messages)}")
+                logger.warning(
+                    'llm.call_failed', '❌ OpenAI API 调用失败', attempt=attempt + 1, max_retries=self.max_retries,
+                    provider=provider.name, model=provider.model, messages=len(messages), error=str(e)
+                )
+                self._record_failure(provider, e, time.time() - started)
+                if provider.name not in failed:
+                    failed.append(provider.name)
                 
                 if attempt < self.max_retries - 1:
-                    # 指数退避
-                    wait_time = 2 ** attempt
-                    print(f"⏳ 等待 {wait_time} 秒后重试...")
-                    time.sleep(wait_time)
+                    wait_time = self._retry_delay(e, attempt, provider)
+                    if any(p.name not in failed for p in self.pool.providers):
+                        # 还有未尝试的提供商：立即转移，不再等待
+                        wait_time = 0
+                    if wait_time:
+                        logger.info('llm.retry_wait', '⏳ 等待后重试', seconds=round(wait_time, 1))
+                        rate_limiter.sleep(wait_time, cancelled)
                 else:
                     # 所有重试都失败
-                    return f"抱歉，我遇到了一些问题无法回复。请稍后再试。\n\n错误详情：{str(e)}"
+                    usage_tracker.record(
+                        tags, provider.name, provider.model, 'call', 'error',
+                        latency=time.time() - call_started,
+                        retries=attempt,
+                        prompt_text=self._prompt_text(messages)
+                    )
+                    return f"{LLM_ERROR_PREFIX}。请稍后再试。\n\n错误详情：{str(e)}"
+    
+    def _retry_delay(self, error: Exception, attempt: int, provider: LLMProvider) -> float:
+        """
+        计算重试等待时间
+        
+        提供商返回 429 时按 Retry-After 暂停该提供商（所有 worker 共享），
+        其余错误使用带全抖动的指数退避，避免多个 worker 同步重试。
+        """
+        if isinstance(error, RateLimitError):
+            retry_after = None
+            try:
+                retry_after = float(error.response.headers.get('retry-after'))
+            except (AttributeError, TypeError, ValueError):
+                pass
+            retry_after = retry_after or rate_limiter.backoff_delay(attempt + 1, base=2.0)
+            rate_limiter.penalize(provider.name, retry_after)
+            return retry_after + rate_limiter.backoff_delay(0)
+        return rate_limiter.backoff_delay(attempt)
+    
+    @staticmethod
+    def _is_provider_fault(error: Exception) -> bool:
+        """错误是否由提供商一侧引起（请求本身有误的 4xx 不计入熔断统计）"""
+        if isinstance(error, APIStatusError):
+            return error.status_code >= 500 or error.status_code in (408, 409, 429)
+        return True
+    
+    @staticmethod
+    def _prompt_text(messages: List[Dict]) -> str:
+        """消息列表的全部文本（提供商未返回用量时用于估算 prompt token 数）"""
+        return "\n".join(msg.get('content') or '' for msg in messages)
+    
+    def _record_success(self, provider: LLMProvider, latency: float):
+        provider.breaker.record_success(latency)
+        metrics.inc('llm_calls_total', provider=provider.name, outcome='success')
+        tracer.current_span().set_attribute('provider', provider.name)
+    
+    def _record_failure(self, provider: LLMProvider, error: Exception, latency: float):
+        tracer.current_span().add_event('llm.attempt_failed', provider=provider.name, error=type(error).__name__)
+        if self._is_provider_fault(error):
+            provider.breaker.record_failure(latency)
+            metrics.inc('llm_calls_total', provider=provider.name, outcome='error')
+        else:
+            provider.breaker.cancel()
+            metrics.inc('llm_calls_total', provider=provider.name, outcome='client_error')
     
     def _call_llm_stream(
         self,
         system_prompt: str,
         context: str,
         user_message: str,
-        chat_history: List[Dict]
+        chat_history: List[Dict],
+        priority: str = 'interactive',
+        tags: Optional[Dict] = None,
+        cancelled: Optional[CancelToken] = None
     ):
         """
         调用 OpenAI API（流式输出）
         
+        可合并的请求（见 _call_llm）由一个 leader 实际生成，其余并发请求先收到已生成的
+        片段，再跟随实时输出。
+        
         Args:
             system_prompt: 系统 Prompt（智能体的角色定义）
             context: 上下文信息
             user_message: 用户消息
             chat_history: 历史对话
+            priority: LLM 调度优先级
+            tags: 用量标签（见 usage_tags）
+            cancelled: 取消信号；排队、退避、等待首 token 和输出期间取消都会立即结束
         
         Yields:
             str: 流式输出的文本片段
-        """
-        # 检查是否是 Gemini 模型
-        is_gemini = 'gemini' in self.model.lower()
         
-        # 构建消息列表（与非流式方法相同）
-        if is_gemini:
-            system_content = system_prompt
-            if context:
-                system_content += f"\n\n以下是当前会话的上下文信息：\n\n{context}"
-            
-            messages = []
-            recent_history = chat_history[-20:] if len(chat_history) > 20 else chat_history
-            for msg in recent_history:
-                role = msg.get("role", "user")
-                if role == "assistant":
-                    role = "model"
-                messages.append({
-                    "role": role,
-                    "content": msg.get("content", "")
-                })
-            
-            combined_user_message = f"{system_content}\n\n用户问题：{user_message}"
-            messages.append({
-                "role": "user",
-                "content": combined_user_message
-            })
+        Raises:
+            LLMOverloadedError: 调用队列已饱和
+            LLMCancelledError: 已取消
+            LLMStreamError: 重试和续写后仍然失败（错误提示不会混入回复内容）
+        """
+        def build_messages(model):
+            return self._build_messages(system_prompt, context, user_message, chat_history, model)
+        
+        if single_flight.should_coalesce(chat_history):
+            chunks = single_flight.stream(
+                self._flight_key(build_messages(self.model), 'stream'),
+                lambda flight_cancelled: self._stream_with_hedging(build_messages, priority, tags, flight_cancelled),
+                cancelled=cancelled
+            )
         else:
-            messages = [
-                {
-                    "role": "system",
-                    "content": system_prompt
-                }
-            ]
+            chunks = self._stream_with_hedging(build_messages, priority, tags, cancelled)
+        
+        # 生成器中的 span 不设为当前 span，只在取下一个片段期间生效
+        span = tracer.span('llm.stream', activate=False, agent=(tags or {}).get('agent'), priority=priority).start()
+        error = None
+        partial = ""
+        try:
+            for chunk in tracer.iterate(span, chunks):
+                if not partial:
+                    span.add_event('first_token')
+                partial += chunk
+                yield chunk
+            if cancelled is not None and cancelled.is_set():
+                # 合并的请求（leader 或 follower）取消时只是本请求的输出提前结束，生成可能仍在为其他请求进行
+                raise LLMCancelledError("调用已取消")
             
-            if context:
-                messages.append({
-                    "role": "system",
-                    "content": f"以下是当前会话的上下文信息：\n\n{context}"
-                })
+        except (LLMOverloadedError, LLMCancelledError) as e:
+            error = e
+            raise
+        
+        except Exception as e:
+            error = e
+            logger.error('llm.stream_failed', '❌ 流式 API 调用失败', model=self.model,
+                         partial_chars=len(partial), error=str(e))
+            raise LLMStreamError(f"{LLM_ERROR_PREFIX}。请稍后再试。", partial=partial) from e
+        
+        finally:
+            chunks.close()
+            span.set_attribute('chars', len(partial))
+            span.end(error)
+    
+    def _stream_with_hedging(
+        self,
+        build_messages,
+        priority: str = 'interactive',
+        tags: Optional[Dict] = None,
+        cancelled: Optional[CancelToken] = None
+    ):
+        """
+        带对冲的流式补全
+        
+        首 token 超过对冲延迟（该提供商近期首 token 耗时的分位数）仍未到达、且对冲预算允许时，
+        向另一个提供商（没有其他可用提供商时为同一个）再发一个请求。先产出 token 的一路胜出，
+        另一路立即取消。两路请求各在一个线程中读取，通过队列汇总。
+        
+        Args:
+            build_messages: 按目标模型构建消息列表的函数
+            priority: LLM 调度优先级
+            tags: 用量标签（每一路请求各记录一条用量）
+            cancelled: 取消信号（两路请求都会收到，见 _stream_completion）
+        
+        Yields:
+            str: 胜出一路的文本片段
+        """
+        if not self.hedging.enabled:
+            yield from self._stream_completion(build_messages, priority, tags=tags, cancelled=cancelled)
+            return
+        
+        estimated_tokens = rate_limiter.estimate_tokens(build_messages(self.model), self.max_tokens)
+        # 对冲请求在输家被取消前基本只消耗 prompt token
+        hedge_tokens = estimated_tokens - min(self.max_tokens, rate_limiter.expected_completion_tokens)
+        events = queue.Queue()
+        attempts = []
+        
+        def start(avoid=None):
+            attempt = _StreamAttempt(len(attempts))
+            attempts.append(attempt)
             
-            recent_history = chat_history[-20:] if len(chat_history) > 20 else chat_history
-            for msg in recent_history:
-                messages.append({
-                    "role": msg.get("role", "user"),
-                    "content": msg.get("content", "")
-                })
+            def pump():
+                chunks = self._stream_completion(build_messages, priority, avoid=avoid, attempt=attempt, tags=tags,
+                                                 cancelled=cancelled)
+                try:
+                    for text in chunks:
+                        if attempt.cancelled.is_set():
+                            break
+                        events.put(('chunk', attempt.index, text))
+                    events.put(('done', attempt.index, None))
+                except BaseException as e:
+                    events.put(('error', attempt.index, e))
+                finally:
+                    chunks.close()
             
-            messages.append({
-                "role": "user",
-                "content": user_message
-            })
+            # 复制上下文：对冲线程中的 span 挂到当前链路下
+            threading.Thread(target=contextvars.copy_context().run, args=(pump,), daemon=True).start()
+            return attempt
+        
+        primary = start()
+        deadline = time.time() + self.hedging.delay_for(self.pool.primary)
+        hedge_decided = False
+        hedge_reserved = False
+        winner = None
+        finished = set()
+        last_error = None
         
         try:
-            # 调用 OpenAI API (流式)
-            stream = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=self.temperature,
-                max_tokens=self.max_tokens,
-                stream=True  # 启用流式输出
-            )
-            
-            # 逐块返回内容
-            for chunk in stream:
-                # 检查 chunk 是否有 choices
-                if not chunk.choices or len(chunk.choices) == 0:
+            while True:
+                timeout = None
+                if not hedge_decided:
+                    timeout = max(0.0, deadline - time.time())
+                try:
+                    kind, index, payload = events.get(timeout=timeout)
+                except queue.Empty:
+                    hedge_decided = True
+                    if cancelled is not None and cancelled.is_set():
+                        # 已取消：主请求随即结束，不再发起对冲
+                        continue
+                    if self.hedging.try_acquire(estimated_tokens, hedge_tokens):
+                        hedge_reserved = True
+                        provider_name = primary.provider.name if primary.provider else self.provider
+                        logger.info('llm.hedge_started', '🪁 首 token 超过对冲延迟，发起对冲请求', provider=provider_name)
+                        start(avoid=[provider_name] if self.hedging.prefer_alternate else None)
+                    else:
+                        metrics.inc('llm_hedge_total', outcome='budget_denied')
                     continue
                 
-                # 检查 delta 是否有 content
-                delta = chunk.choices[0].delta
-                if hasattr(delta, 'content') and delta.content is not None:
-                    yield delta.content
-            
-        except Exception as e:
-            print(f"❌ 流式 API 调用失败: {e}")
-            print(f"   模型: {self.model}")
-            yield f"\n\n抱歉，我遇到了一些问题无法回复。请稍后再试。\n\n错误详情：{str(e)}"
+                if winner is None:
+                    if kind == 'chunk':
+                        winner = index
+                        hedge_decided = True
+                        for attempt in attempts:
+                            if attempt.index != winner:
+                                attempt.cancel()
+                        if len(attempts) > 1:
+                            outcome = 'hedge_won' if winner else 'primary_won'
+                            metrics.inc('llm_hedge_total', outcome=outcome,
+                                        provider=attempts[winner].provider.name)
+                    else:
+                        # 一路在产出 token 前就结束了（失败时内部已尝试过所有提供商）
+                        finished.add(index)
+                        if kind == 'error':
+                            last_error = payload
+                        if len(finished) < len(attempts):
+                            continue
+                        if last_error is not None:
+                            raise last_error
+                        return
+                
+                if index != winner:
+                    continue
+                if kind == 'chunk':
+                    yield payload
+                elif kind == 'done':
+                    return
+                else:
+                    raise payload
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+            extra = hedge_tokens if len(attempts) > 1 else 0
+            if extra:
+                metrics.inc('llm_hedge_tokens_total', extra)
+            # 结算 try_acquire 时预留的对冲预算
+            self.hedging.record(estimated_tokens, extra if hedge_reserved else 0, reserved=hedge_reserved)
+    
+    def _stream_completion(
+        self,
+        build_messages,
+        priority: str = 'interactive',
+        avoid: Optional[List[str]] = None,
+        attempt: Optional[_StreamAttempt] = None,
+        tags: Optional[Dict] = None,
+        cancelled: Optional[CancelToken] = None
+    ):
+        """
+        执行流式补全请求（整个流式输出期间占用一个并发名额）
+        
+        - 收到首个片段之前失败：优先转移到尚未尝试的提供商，否则带抖动退避后重试，
+          最多 max_retries 次
+        - 已输出部分内容后中断：发起续写请求（携带已生成的内容），从中断处继续输出，
+          最多 max_resumes 次；续写开头与已输出内容重复的部分会被去掉
+        
+        Args:
+            build_messages: 按目标模型构建消息列表的函数
+            priority: LLM 调度优先级
+            avoid: 首次选择时优先避开的提供商（对冲请求避开主请求所用的提供商）
+            attempt: 对冲中的一路请求，被取消时静默结束且不计入熔断统计
+            tags: 用量标签（见 usage_tags）；整个流式调用（含重试和续写）记录一条用量
+            cancelled: 取消信号；取消时关闭上游连接（首 token 之前阻塞的读取也会立即返回），
+                排队和退避中的等待立即结束
+        
+        Yields:
+            str: 流式输出的文本片段
+        
+        Raises:
+            ProvidersUnavailableError: 没有可用的提供商
+            LLMCancelledError: 已取消
+        """
+        failed = []
+        last_error = None
+        generated = ""
+        failures = 0
+        resumes = 0
+        # 用量统计：各次尝试的 token 用量累加，提供商未返回用量的尝试按字符数估算
+        call_started = time.time()
+        usage = {'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0}
+        usage_estimated = False
+        first_token = None
+        provider = None
+        outcome = 'error'
+        
+        
+        try:
+            while True:
+                if cancelled is not None and cancelled.is_set():
+                    outcome = 'cancelled'
+                    raise LLMCancelledError("调用已取消")
+                if failed:
+                    provider = self.pool.select(exclude=failed)
+                elif avoid:
+                    provider = self.pool.select(exclude=avoid, reason='hedge')
+                else:
+                    provider = self.pool.select()
+                if provider is None:
+                    if last_error is not None:
+                        raise last_error
+                    raise ProvidersUnavailableError("所有 LLM 提供商均处于熔断状态")
+                
+                messages = build_messages(provider.model)
+                if generated:
+                    messages = self._continuation_messages(messages, generated, provider)
+                    metrics.inc('llm_stream_resumes_total', provider=provider.name)
+                estimated_tokens = rate_limiter.estimate_tokens(messages, provider.max_tokens)
+                started = time.time()
+                received = False
+                # 续写时先缓存开头一段，用于去掉与已输出内容重复的部分
+                head = "" if generated else None
+                sent = False
+                attempt_usage = None
+                attempt_text = ""
+                try:
+                    with rate_limiter.slot(provider.name, provider.rate_limits, estimated_tokens, priority, cancelled):
+                        started = time.time()
+                        # 调用 OpenAI API (流式)
+                        extra_kwargs = {}
+                        if provider.stream_usage:
+                            # 最后一个片段附带本次调用的 token 用量
+                            extra_kwargs['stream_options'] = {'include_usage': True}
+                        def create():
+                            return provider.client.chat.completions.create(
+                                model=provider.model,
+                                messages=messages,
+                                temperature=provider.temperature,
+                                max_tokens=provider.max_tokens,
+                                stream=True,  # 启用流式输出
+                                **extra_kwargs
+                            )
+                        
+                        if cancelled is None:
+                            stream = create()
+                        else:
+                            # 提供商在返回响应头之前卡住时 create 会一直阻塞：取消后不再等待，晚到的流直接关闭
+                            stream = self._run_cancellable(create, cancelled, discard=lambda late: late.close())
+                        sent = True
+                        if attempt is not None:
+                            attempt.provider = provider
+                            attempt.stream = stream
+                            if attempt.cancelled.is_set():
+                                stream.close()
+                        unregister = cancelled.on_cancel(lambda: _abort_stream(stream)) if cancelled is not None else None
+                        
+                        try:
+                            # 逐块返回内容
+                            for chunk in stream:
+                                if getattr(chunk, 'usage', None):
+                                    attempt_usage = usage_tracker.parse_usage(chunk.usage)
+                                
+                                # 检查 chunk 是否有 choices
+                                if not chunk.choices or len(chunk.choices) == 0:
+                                    continue
+                                
+                                # 检查 delta 是否有 content
+                                delta = chunk.choices[0].delta
+                                if hasattr(delta, 'content') and delta.content is not None:
+                                    if not received:
+                                        # 流式调用以首 token 耗时判断提供商是否健康
+                                        received = True
+                                        ttft = time.time() - started
+                                        provider.record_ttft(ttft)
+                                        self._record_success(provider, ttft)
+                                        if first_token is None:
+                                            first_token = time.time() - call_started
+                                    
+                                    content = delta.content
+                                    attempt_text += content
+                                    if head is not None:
+                                        head += content
+                                        if len(head) < self.overlap_window:
+                                            continue
+                                        content = self._trim_overlap(generated, head)
+                                        head = None
+                                    if content:
+                                        generated += content
+                                        yield content
+                            if cancelled is not None and cancelled.is_set():
+                                # 连接被取消信号关闭，读取提前结束
+                                raise LLMCancelledError("调用已取消")
+                        finally:
+                            # 调用方停止读取（客户端断开、取消）时立即关闭上游连接，提供商随之停止生成
+                            if unregister is not None:
+                                unregister()
+                            stream.close()
+                    
+                    if head:
+                        content = self._trim_overlap(generated, head)
+                        generated += content
+                        yield content
+                    if not received:
+                        self._record_success(provider, time.time() - started)
+                    outcome = 'success'
+                    return
+                
+                except LLMOverloadedError:
+                    provider.breaker.cancel()
+                    if not failures and not resumes:
+                        # 从未发出请求：不记录用量
+                        outcome = 'overloaded'
+                    raise
+                
+                except LLMCancelledError:
+                    if not received:
+                        provider.breaker.cancel()
+                    outcome = 'cancelled'
+                    raise
+                
+                except GeneratorExit:
+                    # 客户端提前断开，不代表提供商异常
+                    if not received:
+                        provider.breaker.cancel()
+                    outcome = 'cancelled'
+                    raise
+                
+                except Exception as e:
+                    if cancelled is not None and cancelled.is_set():
+                        # 取消信号关闭连接导致的读取异常
+                        if not received:
+                            provider.breaker.cancel()
+                        outcome = 'cancelled'
+                        raise LLMCancelledError("调用已取消") from e
+                    
+                    if attempt is not None and attempt.cancelled.is_set():
+                        # 对冲输家被取消（关闭连接导致的读取异常），不算提供商故障
+                        if not received:
+                            provider.breaker.cancel()
+                        outcome = 'cancelled'
+                        return
+                    
+                    if (not sent and provider.stream_usage and isinstance(e, APIStatusError)
+                            and e.status_code == 400 and 'stream_options' in str(e)):
+                        # 提供商不支持 stream_options：关闭后重新请求，不计入失败
+                        logger.warning('llm.stream_usage_unsupported', '⚠️  提供商不支持 stream_options，流式用量改为估算',
+                                       provider=provider.name)
+                        provider.stream_usage = False
+                        provider.breaker.cancel()
+                        continue
+                    
+                    last_error = e
+                    if head:
+                        # 续写缓存中的内容已经生成，保留下来供下一次续写
+                        content = self._trim_overlap(generated, head)
+                        generated += content
+                        yield content
+                    
+                    if received:
+                        provider.breaker.record_failure(time.time() - started)
+                        metrics.inc('llm_calls_total', provider=provider.name, outcome='stream_error')
+                    else:
+                        self._record_failure(provider, e, time.time() - started)
+                    
+                    if generated:
+                        resumes += 1
+                        logger.warning('llm.stream_interrupted', '⚠️  流式输出中断', provider=provider.name,
+                                       generated_chars=len(generated), error=str(e))
+                        if resumes > self.max_resumes:
+                            raise
+                        logger.info('llm.stream_resume', '🔁 发起续写请求', resumes=resumes, max_resumes=self.max_resumes)
+                    else:
+                        failures += 1
+                        logger.warning('llm.stream_attempt_failed', '❌ 流式 API 调用失败', attempt=failures,
+                                       max_retries=self.max_retries, provider=provider.name, error=str(e))
+                        if failures >= self.max_retries:
+                            raise
+                    
+                    if provider.name not in failed:
+                        failed.append(provider.name)
+                    if all(p.name in failed for p in self.pool.providers):
+                        # 所有提供商都已尝试过：退避后重试
+                        wait_time = self._retry_delay(e, failures + resumes - 1, provider)
+                        logger.info('llm.retry_wait', '⏳ 等待后重试', seconds=round(wait_time, 1))
+                        try:
+                            rate_limiter.sleep(wait_time, cancelled)
+                        except LLMCancelledError:
+                            outcome = 'cancelled'
+                            raise
+                
+                finally:
+                    if sent:
+                        if attempt_usage is None:
+                            usage_estimated = True
+                            attempt_usage = {
+                                'prompt_tokens': usage_tracker.estimate_tokens(self._prompt_text(messages)),
+                                'cached_tokens': 0,
+                                'completion_tokens': usage_tracker.estimate_tokens(attempt_text),
+                            }
+                        for key in usage:
+                            usage[key] += attempt_usage[key]
+        finally:
+            if outcome != 'overloaded':
+                usage_tracker.record(
+                    tags, provider.name if provider else None, provider.model if provider else None,
+                    'stream', outcome,
+                    latency=time.time() - call_started,
+                    usage=usage,
+                    ttft=first_token,
+                    retries=failures,
+                    resumes=resumes,
+                    estimated=usage_estimated
+                )
+    
+    def _continuation_messages(self, messages: List[Dict], generated: str, provider: LLMProvider) -> List[Dict]:
+        """在原始消息后追加已生成的部分回复和续写指令"""
+        return messages + [
+            {"role": "model" if provider.is_gemini else "assistant", "content": generated},
+            {"role": "user", "content": self.resume_instruction},
+        ]
+    
+    def _trim_overlap(self, generated: str, head: str) -> str:
+        """去掉续写开头与已输出内容末尾重复的部分"""
+        window = min(len(generated), len(head), self.overlap_window)
+        for size in range(window, 7, -1):
+            if head.startswith(generated[-size:]):
+                return head[size:]
+        return head
     
     def process_message_stream(
         self,
         session_id: str,
         user_message: str,
-        session_data: Dict
+        session_data: Dict,
+        cancelled: Optional[CancelToken] = None
     ):
         """
         处理用户消息（流式输出版本）
@@ -638,9 +1396,13 @@ class AgentOrchestrator:
             session_id: 会话 ID
             user_message: 用户消息
             session_data: 会话数据
+            cancelled: 取消信号（停止生成、客户端断开），传给其中的每次 LLM 调用
         
         Yields:
             dict: 包含 content 和 state 的字典
+        
+        Raises:
+            LLMCancelledError: 生成被取消（包括先完整收集回复、尚未输出任何内容的阶段）
         """
         current_state = session_data.get('current_state', 'GUIDE_PENDING_REPORT')
         
@@ -648,7 +1410,7 @@ class AgentOrchestrator:
         chapter_states = ['INTRODUCTION', 'REVIEW', 'METHOD', 'RESULT', 'DISCUSSION', 'CONTROL_ROUTING']
         if current_state in chapter_states and user_message:
             # 流式版本：逐字返回
-            for chunk_data in self._handle_control_routing_stream(session_id, user_message, session_data):
+            for chunk_data in self._handle_control_routing_stream(session_id, user_message, session_data, cancelled):
                 yield chunk_data
             return
         
@@ -665,7 +1427,9 @@ class AgentOrchestrator:
                 system_prompt=system_prompt,
                 context=context,
                 user_message=user_message,
-                chat_history=session_data.get('session_data', {}).get('chat_history', [])
+                chat_history=session_data.get('session_data', {}).get('chat_history', []),
+                tags=self.usage_tags(session_data, agent_name),
+                cancelled=cancelled
             ):
                 full_response += chunk
             
@@ -677,13 +1441,13 @@ class AgentOrchestrator:
                 if json_match:
                     route_data = json.loads(json_match.group())
                     if route_data.get('route') == 'content_question':
-                        print("🔄 检测到场景三路由标记，自动转发到 control_routing")
+                        logger.debug('routing.content_question', '🔄 检测到场景三路由标记，自动转发到 control_routing')
                         # 直接流式输出真正的答案，不输出 guidance 的响应（包含JSON）
-                        for chunk_data in self._handle_control_routing_stream(session_id, user_message, session_data):
+                        for chunk_data in self._handle_control_routing_stream(session_id, user_message, session_data, cancelled):
                             yield chunk_data
                         return
             except Exception as e:
-                print(f"⚠️  解析路由标记失败: {e}")
+                logger.debug('routing.marker_parse_failed', '⚠️  解析路由标记失败（可能不是场景三）', error=str(e))
             
             # 如果没有路由标记，正常流式输出 guidance 的响应
             for i, char in enumerate(full_response):
@@ -702,7 +1466,9 @@ class AgentOrchestrator:
             system_prompt=system_prompt,
             context=context,
             user_message=user_message,
-            chat_history=session_data.get('session_data', {}).get('chat_history', [])
+            chat_history=session_data.get('session_data', {}).get('chat_history', []),
+            tags=self.usage_tags(session_data, agent_name),
+            cancelled=cancelled
         ):
             full_response += chunk
             yield {'content': chunk, 'done': False}
@@ -749,7 +1515,8 @@ class AgentOrchestrator:
         self,
         session_id: str,
         user_message: str,
-        session_data: Dict
+        session_data: Dict,
+        cancelled: Optional[CancelToken] = None
     ):
         """
         处理CONTROL_ROUTING状态（流式版本）
@@ -758,6 +1525,7 @@ class AgentOrchestrator:
             session_id: 会话 ID
             user_message: 用户消息
             session_data: 会话数据
+            cancelled: 取消信号（路由决策和目标智能体的调用都会立即结束）
         
         Yields:
             dict: 包含 content 和 state 的字典
@@ -770,14 +1538,12 @@ class AgentOrchestrator:
             system_prompt=control_prompt,
             context=context,
             user_message=f"用户问题：{user_message}\n\n请分析这个问题应该路由给哪个智能体。",
-            chat_history=[]
+            chat_history=[],
+            tags=self.usage_tags(session_data, 'control'),
+            cancelled=cancelled
         )
         
-        print("\n" + "="*60)
-        print("🎯 中控智能体 (Control Agent) 路由决策：")
-        print("="*60)
-        print(routing_response)
-        print("="*60 + "\n")
+        logger.debug('routing.response', '🎯 中控智能体路由决策', preview=preview(routing_response))
         
         # 2. 解析路由决策
         import json
@@ -801,12 +1567,13 @@ class AgentOrchestrator:
                         target_agent = routing_json.get('agent_name')
             
             if target_agent:
-                print(f"✅ 路由决策成功: {target_agent}")
+                logger.info('routing.decided', '✅ 路由决策成功', target=target_agent)
         except Exception as e:
-            print(f"❌ 解析路由决策失败: {e}")
+            logger.warning('routing.parse_failed', '❌ 解析路由决策失败', error=str(e))
         
         if not target_agent:
-            print("⚠️  无法解析路由决策，使用general作为默认")
+            logger.warning('routing.default_general', '⚠️  无法解析路由决策，使用general作为默认',
+                           preview=preview(routing_response))
             target_agent = 'general'
         
         # 标准化agent名称
@@ -827,7 +1594,9 @@ class AgentOrchestrator:
             system_prompt=target_prompt,
             context=context_with_status,
             user_message=user_message,
-            chat_history=session_data.get('session_data', {}).get('chat_history', [])
+            chat_history=session_data.get('session_data', {}).get('chat_history', []),
+            tags=self.usage_tags(session_data, target_agent),
+            cancelled=cancelled
         ):
             full_response += chunk
             yield {'content': chunk, 'done': False}
@@ -869,6 +1638,7 @@ class AgentOrchestrator:
         # 6. 发送完成信号
         yield {'done': True, 'state': new_state, 'full_response': full_response}
     
+    @traced('agent.determine_next_state')
     def _determine_next_state(
         self,
         current_state: str,
@@ -893,15 +1663,14 @@ class AgentOrchestrator:
         """
         # 简化的状态转换逻辑（可以根据实际需求扩展）
         
-        print(f"🔄 状态转换判断 - 当前状态: {current_state}")
-        print(f"🔄 用户消息: '{user_message}'")
-        print(f"🔄 助手回复长度: {len(assistant_response)} 字符")
+        logger.debug('fsm.evaluate', '🔄 状态转换判断', state=current_state, user_message_chars=len(user_message),
+                     user_message=preview(user_message), response_chars=len(assistant_response))
         
         # 1. GUIDE_PENDING_REPORT: 等待用户上传论文或提问
         if current_state == 'GUIDE_PENDING_REPORT':
             # 如果已经有论文，并且是空消息触发（首次自动触发）
             if session_data.get('paper_path') and user_message == '':
-                print("🔄 检测到首次自动触发（空消息），转到 GUIDE_PENDING_PLAN 等待用户回应")
+                logger.debug('fsm.decision', '🔄 检测到首次自动触发（空消息），转到 GUIDE_PENDING_PLAN 等待用户回应')
                 # 生成初始报告后，转到 GUIDE_PENDING_PLAN，等待用户回复兴趣点
                 return 'GUIDE_PENDING_PLAN'
             
@@ -909,7 +1678,7 @@ class AgentOrchestrator:
             if session_data.get('paper_path') and user_message != '':
                 # 检测是否是内容性问题（场景三） - 这部分逻辑已经在 process_message 中处理
                 # 如果执行到这里，说明是场景一或场景二，应该生成阅读路径后转到 CONTROL_ROUTING
-                print("🔄 用户回复了目标/背景信息，保持在 GUIDE_PENDING_PLAN")
+                logger.debug('fsm.decision', '🔄 用户回复了目标/背景信息，保持在 GUIDE_PENDING_PLAN')
                 return 'GUIDE_PENDING_PLAN'
             
             return current_state
@@ -918,13 +1687,13 @@ class AgentOrchestrator:
         if current_state == 'GUIDE_PENDING_PLAN':
             # 如果是第一次进入这个状态（空消息），等待用户回复
             if user_message == '':
-                print("🔄 第一次进入 GUIDE_PENDING_PLAN（导读报告已生成），等待用户回复")
+                logger.debug('fsm.decision', '🔄 第一次进入 GUIDE_PENDING_PLAN（导读报告已生成），等待用户回复')
                 return current_state
             
             # 如果用户已回复，检测是否已生成阅读计划
             if user_message != '':
                 # 生成了个性化阅读路径或沙漏式阅读法后，转到 CONTROL_ROUTING
-                print("🔄 用户已回复目标信息，引导智能体应生成路径，转到 CONTROL_ROUTING")
+                logger.debug('fsm.decision', '🔄 用户已回复目标信息，引导智能体应生成路径，转到 CONTROL_ROUTING')
                 return 'CONTROL_ROUTING'
             
             return current_state
@@ -953,10 +1722,10 @@ class AgentOrchestrator:
         """
         try:
             db.update_session(session_id, current_state=new_state)
-            print(f"✅ 会话 {session_id} 状态已更新为 {new_state}")
+            logger.info('fsm.forced', '✅ 会话状态已更新', session_id=session_id, state=new_state)
             return True
         except Exception as e:
-            print(f"❌ 状态转换失败: {e}")
+            logger.error('fsm.force_failed', '❌ 状态转换失败', session_id=session_id, error=str(e))
             return False
 
 
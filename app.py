@@ -2,31 +2,170 @@
 Reading Agent Flask 应用
 主应用文件
 """
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, render_template, request, jsonify, session, g
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import ClosingIterator
 import os
-from config import FLASK_CONFIG, UPLOAD_CONFIG, LOCAL_PAPERS_CONFIG
+import hashlib
+import json
+import queue
+import threading
+import time
+from pathlib import Path
+from config import FLASK_CONFIG, UPLOAD_CONFIG, LOCAL_PAPERS_CONFIG, JOB_QUEUE_CONFIG
 from db import db
 from prompt_manager import prompt_manager
-from agent_orchestrator import orchestrator
+from response_cache import response_cache
+from agent_orchestrator import orchestrator, LLMStreamError
+from rate_limiter import rate_limiter, LLMOverloadedError, LLMCancelledError
+from metrics import metrics
+from tracing import tracer
+from logger import get_logger
+from profiling import profiler, ProfilingMiddleware
+from usage_tracker import usage_tracker, GROUP_COLUMNS
+from stream_registry import stream_registry, DONE, CANCELLED, FAILED
+from job_queue import job_queue, job_summary, PDF_CONVERSION
+from markdown_store import markdown_store
+from resumable_upload import resumable_uploads, UploadError
+from conversion_worker import markdown_output_path, start_embedded_workers
 
-# PDF 转换器（使用 MinerU API）
+# PDF 转换器（文字型 PDF 本地提取，扫描件和公式较多的 PDF 使用 MinerU API）
 try:
     from pdf_converter import pdf_converter
     PDF_CONVERTER_AVAILABLE = pdf_converter is not None
     if PDF_CONVERTER_AVAILABLE:
-        print("✅ PDF 转换器加载成功（MinerU API）")
+        print("✅ PDF 转换器加载成功")
     else:
-        print("⚠️  PDF 转换器未配置，请在 api_config.json 中填写 pdf_converter.api_token")
+        print("⚠️  PDF 转换器未配置，请在 api_config.json 中填写 pdf_converter.api_token，或安装 pypdf 启用本地提取")
 except ImportError as e:
     print(f"⚠️  PDF 转换器加载失败: {e}")
     print("    如需启用，请运行: pip install requests")
     PDF_CONVERTER_AVAILABLE = False
 
+logger = get_logger('app')
+
+# 开发环境可在 Web 进程内执行转换任务；生产环境单独运行 python conversion_worker.py
+# （python app.py 启动时，本地提取进程池的子进程会以 __mp_main__ 重新导入本文件，子进程中不启动）
+if PDF_CONVERTER_AVAILABLE and JOB_QUEUE_CONFIG.get('embedded_workers', 0) > 0 and __name__ != '__mp_main__':
+    start_embedded_workers(pdf_converter, JOB_QUEUE_CONFIG['embedded_workers'])
+
 # 创建 Flask 应用
 app = Flask(__name__)
 app.config.update(FLASK_CONFIG)
 
+# 请求匹配到的路由模板在 WSGI environ 中的键（供 InFlightMiddleware 作为指标标签）
+ROUTE_ENVIRON_KEY = 'reading_agent.route'
+
+class InFlightMiddleware:
+    """
+    统计本 worker 进行中的请求数和累计占用时长（用于评估 worker 饱和度），
+    以及按路由、方法和状态码区分的请求数与耗时直方图
+    
+    流式响应在输出结束（连接关闭）后才计为完成；监控接口本身不计入
+    """
+    
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.in_flight = 0
+        self._lock = threading.Lock()
+    
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path == '/metrics' or path.startswith('/api/metrics'):
+            return self.wsgi_app(environ, start_response)
+        
+        started = time.time()
+        status = {'code': '500'}
+        self._change(1)
+        
+        def capture_status(status_line, headers, exc_info=None):
+            status['code'] = status_line.split(' ', 1)[0]
+            return start_response(status_line, headers, exc_info)
+        
+        def finished():
+            self._change(-1)
+            elapsed = time.time() - started
+            # 路由由 before_request 写入 environ；未匹配任何路由（404）时统一记为 <unmatched>，避免标签数量失控
+            labels = {
+                'method': environ.get('REQUEST_METHOD', ''),
+                'route': environ.get(ROUTE_ENVIRON_KEY, '<unmatched>'),
+                'status': status['code'],
+            }
+            metrics.inc('http_requests_total', **labels)
+            metrics.inc('http_request_seconds_total', elapsed)
+            metrics.observe('http_request_duration_seconds', elapsed, **labels)
+        
+        try:
+            return ClosingIterator(self.wsgi_app(environ, capture_status), finished)
+        except BaseException:
+            finished()
+            raise
+    
+    def _change(self, delta):
+        with self._lock:
+            self.in_flight += delta
+            in_flight = self.in_flight
+        metrics.set_gauge('http_requests_in_flight', in_flight)
+
+# 按需剖析（未配置令牌时不挂载）；放在 InFlightMiddleware 内层，剖析范围是应用本身和响应输出
+if profiler.enabled:
+    app.wsgi_app = ProfilingMiddleware(app.wsgi_app, profiler)
+app.wsgi_app = InFlightMiddleware(app.wsgi_app)
+
+@app.before_request
+def record_request_route():
+    """记录匹配到的路由模板（指标按路由模板而不是具体路径区分）"""
+    if request.url_rule is not None:
+        request.environ[ROUTE_ENVIRON_KEY] = request.url_rule.rule
+
+@app.before_request
+def start_request_trace():
+    """为每个请求创建链路追踪的根 span（静态文件和监控接口不追踪）"""
+    if not tracer.enabled or request.path.startswith(('/static', '/api/metrics', '/metrics')):
+        return
+    route = request.url_rule.rule if request.url_rule else request.path
+    g.trace_span = tracer.start_trace(
+        f"{request.method} {route}",
+        **{'http.method': request.method, 'http.target': request.path}
+    ).start()
+
+@app.after_request
+def record_trace_status(response):
+    span = g.get('trace_span')
+    if span is not None:
+        span.set_attribute('http.status_code', response.status_code)
+    return response
+
+@app.teardown_request
+def end_request_trace(error=None):
+    span = g.pop('trace_span', None)
+    if span is not None:
+        span.end(error)
+
+# 流式回复中途失败时，保存到聊天记录的部分回复末尾追加的标记
+STREAM_INTERRUPTED_MARKER = "\n\n（回复因服务中断未完成）"
+# 用户停止生成或断开连接时，保存到聊天记录的部分回复末尾追加的标记
+STREAM_CANCELLED_MARKER = "\n\n（已停止生成）"
+
+# 流式输出长时间没有内容时发送保活注释的间隔（秒）
+SSE_KEEPALIVE_SECONDS = 5
+
+def save_cancelled_response(session_id, partial):
+    """保存被取消的流式回复（只保存已生成的部分，并追加取消标记）"""
+    if not partial.strip():
+        return
+    try:
+        db.update_chat_history(session_id, {'role': 'assistant', 'content': partial + STREAM_CANCELLED_MARKER})
+    except Exception:
+        logger.exception('chat.save_cancelled_failed', '⚠️  保存已取消的回复失败')
+
+def overloaded_response(error):
+    """LLM 调用队列饱和时的统一响应（503 + Retry-After）"""
+    response = jsonify({'success': False, 'error': str(error), 'retry_after': error.retry_after})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(int(error.retry_after))
+    return response
+
 # ========== 页面路由 ==========
 
 @app.route('/')
@@ -57,52 +196,61 @@ def get_sessions():
             'sessions': sessions
         })
     except Exception as e:
-        print(f"获取会话列表失败: {e}")
+        logger.exception('api.list_sessions_failed', '❌ 获取会话列表失败')
         return jsonify({'success': False, 'error': str(e)}), 500
 
+OSS_CONFIG_DIR = Path(__file__).parent / 'config' / 'oss'
+OSS_REGION_MAP = {
+    '华东2（上海）': 'oss-cn-shanghai',
+    '华北2（北京）': 'oss-cn-beijing',
+    '华东1（杭州）': 'oss-cn-hangzhou',
+    '华南1（深圳）': 'oss-cn-shenzhen'
+}
+_oss_config_cache = {'key': None, 'config': None}
+
+
+def load_oss_config():
+    """读取OSS配置（按两个配置文件的修改时间缓存，修改配置后自动重新读取）"""
+    info_path = OSS_CONFIG_DIR / 'info'
+    access_key_path = OSS_CONFIG_DIR / 'AccessKey.csv'
+    key = (info_path.stat().st_mtime_ns, access_key_path.stat().st_mtime_ns)
+    if _oss_config_cache['key'] == key:
+        return _oss_config_cache['config']
+    
+    # 读取bucket信息
+    with open(info_path, 'r', encoding='utf-8') as f:
+        info_lines = f.readlines()
+        bucket = info_lines[0].split('：')[1].strip()
+        region = info_lines[1].split('：')[1].strip()
+    
+    # 读取AccessKey
+    with open(access_key_path, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+        access_key_id, access_key_secret = lines[1].strip().split(',')
+    
+    # 生成OSS endpoint
+    endpoint = f"https://{OSS_REGION_MAP.get(region, 'oss-cn-shanghai')}.aliyuncs.com"
+    
+    config = {
+        'accessKeyId': access_key_id,
+        'accessKeySecret': access_key_secret,
+        'bucket': bucket,
+        'region': region,
+        'endpoint': endpoint
+    }
+    _oss_config_cache.update(key=key, config=config)
+    return config
+
 @app.route('/api/oss-config', methods=['GET'])
 def get_oss_config():
     """获取OSS配置信息供前端直传使用"""
     try:
-        # 读取OSS配置
-        import json
-        from pathlib import Path
-        
-        config_dir = Path(__file__).parent / 'config' / 'oss'
-        
-        # 读取bucket信息
-        with open(config_dir / 'info', 'r', encoding='utf-8') as f:
-            info_lines = f.readlines()
-            bucket = info_lines[0].split('：')[1].strip()
-            region = info_lines[1].split('：')[1].strip()
-        
-        # 读取AccessKey
-        with open(config_dir / 'AccessKey.csv', 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-            access_key_id, access_key_secret = lines[1].strip().split(',')
-        
-        # 生成OSS endpoint
-        region_map = {
-            '华东2（上海）': 'oss-cn-shanghai',
-            '华北2（北京）': 'oss-cn-beijing',
-            '华东1（杭州）': 'oss-cn-hangzhou',
-            '华南1（深圳）': 'oss-cn-shenzhen'
-        }
-        
-        endpoint = f"https://{region_map.get(region, 'oss-cn-shanghai')}.aliyuncs.com"
-        
         return jsonify({
             'success': True,
-            'config': {
-                'accessKeyId': access_key_id,
-                'accessKeySecret': access_key_secret,
-                'bucket': bucket,
-                'region': region,
-                'endpoint': endpoint
-            }
+            'config': load_oss_config()
         })
     except Exception as e:
-        print(f"获取OSS配置失败: {e}")
+        logger.exception('api.oss_config_failed', '❌ 获取OSS配置失败')
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/session/<session_id>', methods=['GET'])
@@ -119,12 +267,26 @@ def get_session(session_id):
             'session': session_data
         })
     except Exception as e:
-        print(f"获取会话失败: {e}")
+        logger.exception('api.get_session_failed', '❌ 获取会话失败')
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def submit_conversion(session_id, title, payload):
+    """
+    提交 Markdown 转换任务，返回任务摘要（转换功能未启用时返回 None）
+    
+    启用 Markdown 存储时结果按内容保存（同名论文不会互相覆盖，同一份 PDF 不会重复转换）
+    """
+    if not PDF_CONVERTER_AVAILABLE:
+        logger.warning('upload.converter_disabled', '⚠️  PDF 转换功能未启用')
+        return None
+    if not markdown_store.enabled:
+        payload['output_path'] = str(markdown_output_path(title))
+    job_id = job_queue.enqueue(PDF_CONVERSION, payload, session_id=session_id)
+    return job_summary(job_queue.get(job_id))
+
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
-    """接收前端上传到OSS后的URL并转换为 Markdown"""
+    """接收前端上传到OSS后的URL，创建会话并提交 Markdown 转换任务（立即返回，转换在后台进行）"""
     try:
         data = request.get_json()
         
@@ -147,41 +309,129 @@ def upload_file():
         if not title:
             title = pdf_url.split('/')[-1].replace('.pdf', '')
         
-        # 转换 PDF 为 Markdown
-        markdown_path = None
-        if PDF_CONVERTER_AVAILABLE:
-            try:
-                markdown_filename = title.replace(' ', '_') + '.md'
-                markdown_output = UPLOAD_CONFIG['markdown_folder'] / markdown_filename
-                # 直接使用OSS URL进行转换
-                markdown_path = pdf_converter.convert_pdf_to_markdown(
-                    pdf_url=pdf_url,  # 直接传递URL
-                    output_path=str(markdown_output)
-                )
-                print(f"✅ PDF 转换为 Markdown: {markdown_path}")
-            except Exception as e:
-                print(f"⚠️  PDF 转 Markdown 失败（将继续）: {e}")
-                # 转换失败不影响会话创建
-        else:
-            print("⚠️  PDF 转换功能未启用")
-        
-        # 创建会话
+        # 创建会话（Markdown 转换完成后由 worker 写回 markdown_path）
         session_id = db.create_session(
             user_id=user_id,
             title=title,
             paper_path=pdf_url,  # 保存OSS URL而非本地路径
-            markdown_path=markdown_path
+            markdown_path=None
+        )
+        
+        # 提交转换任务（直接使用OSS URL进行转换）
+        conversion = submit_conversion(session_id, title, {'pdf_url': pdf_url})
+        
+        return jsonify({
+            'success': True,
+            'session_id': session_id,
+            'title': title,
+            'pdf_url': pdf_url,
+            'has_markdown': False,
+            'status': 'converting' if conversion else 'ready',
+            'conversion': conversion,
+            'poll_interval_ms': JOB_QUEUE_CONFIG.get('client_poll_interval_ms', 2000)
+        })
+    except Exception as e:
+        logger.exception('api.upload_failed', '❌ 上传文件失败')
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# ========== 分块上传（断线续传） ==========
+
+def upload_error_response(e):
+    return jsonify({'success': False, 'error': str(e), **e.details}), e.status
+
+@app.route('/api/uploads', methods=['POST'])
+def initiate_upload():
+    """创建分块上传（同一文件有未完成的上传时返回该上传，客户端只需补传 missing 中的区间）"""
+    if not resumable_uploads.enabled:
+        return jsonify({'success': False, 'error': '分块上传未启用'}), 404
+    try:
+        data = request.get_json() or {}
+        upload = resumable_uploads.initiate(
+            user_id=data.get('user_id'),
+            filename=data.get('filename', ''),
+            size=data.get('size'),
+            sha256=data.get('sha256'),
+            fingerprint=data.get('fingerprint')
         )
+        return jsonify({'success': True, 'upload': upload})
+    except UploadError as e:
+        return upload_error_response(e)
+    except Exception as e:
+        logger.exception('api.upload_initiate_failed', '❌ 创建上传失败')
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    """查询上传状态（已接收字节数、缺失的区间）"""
+    if not resumable_uploads.enabled:
+        return jsonify({'success': False, 'error': '分块上传未启用'}), 404
+    try:
+        return jsonify({'success': True, 'upload': resumable_uploads.status(upload_id)})
+    except UploadError as e:
+        return upload_error_response(e)
+    except Exception as e:
+        logger.exception('api.upload_status_failed', '❌ 查询上传状态失败')
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+def put_upload_chunk(upload_id):
+    """写入一个分块：请求体为原始字节，写入 ?offset= 处（需要 Content-Length）"""
+    if not resumable_uploads.enabled:
+        return jsonify({'success': False, 'error': '分块上传未启用'}), 404
+    try:
+        offset = request.args.get('offset', type=int)
+        if offset is None:
+            return jsonify({'success': False, 'error': '缺少 offset'}), 400
+        if request.content_length is None:
+            return jsonify({'success': False, 'error': '缺少 Content-Length'}), 411
+        upload = resumable_uploads.write_chunk(upload_id, offset, request.stream, request.content_length)
+        return jsonify({'success': True, 'upload': upload})
+    except UploadError as e:
+        return upload_error_response(e)
+    except Exception as e:
+        logger.exception('api.upload_chunk_failed', '❌ 写入分块失败')
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    """完成上传：校验 SHA-256，创建会话并提交 Markdown 转换任务（重复调用返回同一个会话）"""
+    if not resumable_uploads.enabled:
+        return jsonify({'success': False, 'error': '分块上传未启用'}), 404
+    try:
+        data = request.get_json(silent=True) or {}
+        upload = resumable_uploads.complete(upload_id)
+        title = data.get('title') or upload['filename'].rsplit('.', 1)[0]
+        pdf_url = f"/uploads/{os.path.basename(upload['path'])}"
+        
+        session_id = upload['session_id']
+        if session_id and db.get_session(session_id):
+            # 客户端没收到上次的响应而重试：返回已创建的会话
+            conversion = job_summary(job_queue.latest_for_session(session_id, PDF_CONVERSION))
+        else:
+            session_id = db.create_session(
+                user_id=upload['user_id'],
+                title=title,
+                paper_path=upload['path'],
+                markdown_path=None
+            )
+            resumable_uploads.attach_session(upload_id, session_id)
+            conversion = submit_conversion(session_id, title, {'pdf_path': upload['path']})
         
         return jsonify({
             'success': True,
             'session_id': session_id,
             'title': title,
             'pdf_url': pdf_url,
-            'has_markdown': markdown_path is not None
+            'sha256': upload['sha256'],
+            'has_markdown': False,
+            'status': 'converting' if conversion else 'ready',
+            'conversion': conversion,
+            'poll_interval_ms': JOB_QUEUE_CONFIG.get('client_poll_interval_ms', 2000)
         })
+    except UploadError as e:
+        return upload_error_response(e)
     except Exception as e:
-        print(f"上传文件失败: {e}")
+        logger.exception('api.upload_complete_failed', '❌ 完成上传失败')
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/chat', methods=['POST'])
@@ -215,8 +465,10 @@ def chat():
                 user_message=message,
                 session_data=session_data
             )
+        except LLMOverloadedError as e:
+            return overloaded_response(e)
         except Exception as e:
-            print(f"❌ 智能体处理失败: {e}")
+            logger.exception('chat.agent_failed', '❌ 智能体处理失败')
             return jsonify({
                 'success': False,
                 'error': f'智能体处理失败: {str(e)}'
@@ -229,7 +481,9 @@ def chat():
         # 如果状态变化，更新数据库
         if new_state != session_data['current_state']:
             db.update_session(session_id, current_state=new_state)
-            print(f"🔄 会话 {session_id} 状态: {session_data['current_state']} → {new_state}")
+            metrics.inc('fsm_transitions_total', from_state=session_data['current_state'], to_state=new_state)
+            logger.info('fsm.transition', '🔄 会话状态变化', session_id=session_id,
+                        from_state=session_data['current_state'], to_state=new_state)
         
         return jsonify({
             'success': True,
@@ -237,9 +491,124 @@ def chat():
             'current_state': new_state
         })
     except Exception as e:
-        print(f"处理对话失败: {e}")
+        logger.exception('api.chat_failed', '❌ 处理对话失败')
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def format_sse(seq, event):
+    """编码一个带 id 的 SSE 事件"""
+    return f"id: {seq}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+def sse_response(events):
+    """SSE 响应"""
+    return app.response_class(
+        events,
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+def run_chat_stream(publisher, session_id, message, session_data):
+    """
+    执行一次流式对话并把事件发布到流缓冲区（在后台线程中运行）
+    
+    聊天记录和状态由这里保存，因此与读取方的连接是否断开无关。
+    """
+    stream_id = publisher.stream_id
+    full_response = ""
+    final_state = session_data['current_state']
+    status = FAILED
+    chunks = None
+    started = time.time()
+    first_content_at = None
+    # 后台检查停止条件：排队、退避、等待首 token 等尚无片段输出的阶段也能立即停止
+    cancelled = stream_registry.watch(stream_id)
+    
+    try:
+        # 先告知前端流 ID（停止生成、断线重连时使用）
+        publisher.publish({'event': 'start', 'stream_id': stream_id})
+        
+        # 先保存用户消息
+        db.update_chat_history(session_id, {'role': 'user', 'content': message})
+        
+        # 流式处理消息
+        chunks = orchestrator.process_message_stream(
+            session_id=session_id,
+            user_message=message,
+            session_data=session_data,
+            cancelled=cancelled
+        )
+        stop_reason = None
+        try:
+            for chunk_data in chunks:
+                if cancelled.is_set():
+                    stop_reason = cancelled.reason
+                    break
+                if chunk_data.get('done'):
+                    # 流结束
+                    final_state = chunk_data.get('state', final_state)
+                    if 'full_response' in chunk_data:
+                        full_response = chunk_data['full_response']
+                    publisher.publish({'event': 'done', 'state': final_state})
+                else:
+                    # 流式内容
+                    content = chunk_data.get('content', '')
+                    if first_content_at is None and content:
+                        first_content_at = time.time()
+                        metrics.observe('chat_stream_first_content_seconds', first_content_at - started)
+                    full_response += content
+                    publisher.publish({'content': content})
+        except LLMCancelledError:
+            stop_reason = cancelled.reason
+        
+        if stop_reason:
+            # 用户点击停止生成，或客户端断开后超过宽限期无人重连：立即关闭上游，保存已生成的部分
+            chunks.close()
+            if stop_reason == 'user':
+                logger.info('chat.stream_stopped', '⏹️  流式输出已按请求停止', session_id=session_id,
+                            chars=len(full_response))
+            else:
+                logger.info('chat.stream_abandoned', '🔌 客户端断开后未重连，停止生成', session_id=session_id,
+                            chars=len(full_response))
+            save_cancelled_response(session_id, full_response)
+            metrics.inc('chat_stream_cancel_total', reason=stop_reason)
+            status = CANCELLED
+            publisher.publish({'event': 'cancelled'})
+            return
+        
+        # 保存助手消息
+        db.update_chat_history(session_id, {'role': 'assistant', 'content': full_response})
+        status = DONE
+        
+        # 更新状态
+        if final_state != session_data['current_state']:
+            db.update_session(session_id, current_state=final_state)
+            metrics.inc('fsm_transitions_total', from_state=session_data['current_state'], to_state=final_state)
+            logger.info('fsm.transition', '🔄 会话状态变化', session_id=session_id,
+                        from_state=session_data['current_state'], to_state=final_state)
+        
+    except LLMOverloadedError as e:
+        logger.warning('chat.overloaded', '⚠️  LLM 调用队列饱和', error=str(e))
+        publisher.publish({'error': str(e), 'retry_after': e.retry_after})
+    except LLMStreamError as e:
+        # 重试和续写都失败：错误提示只发给前端，不写入聊天记录；已输出的部分标记为未完成后保存
+        logger.error('chat.stream_generation_failed', '❌ 流式生成失败', session_id=session_id,
+                     partial_chars=len(e.partial), error=str(e.__cause__ or e))
+        if e.partial.strip():
+            db.update_chat_history(session_id, {
+                'role': 'assistant',
+                'content': e.partial + STREAM_INTERRUPTED_MARKER
+            })
+        publisher.publish({'error': str(e), 'partial': bool(e.partial)})
+    except Exception as e:
+        logger.exception('chat.stream_failed', '❌ 流式处理失败')
+        publisher.publish({'error': f"处理失败: {str(e)}"})
+    finally:
+        cancelled.stop_watching()
+        metrics.observe('chat_stream_duration_seconds', time.time() - started, status=status)
+        publisher.close(status)
+
 @app.route('/api/chat/stream', methods=['POST'])
 def chat_stream():
     """处理对话请求（流式输出）"""
@@ -264,72 +633,162 @@ def chat_stream():
                 'error': '智能体编排器未初始化'
             }), 500
         
+        # 生成在后台线程中进行，与本次连接解耦：断线后可凭 stream_id + Last-Event-ID 重连续看
+        stream_id = stream_registry.start(session_id)
+        publisher = stream_registry.publisher(stream_id)
+        # 后台生成记入本次请求的链路（请求返回后链路等生成结束再导出）
+        generate_span = tracer.span('chat.generate', activate=False, stream_id=stream_id).start()
+        threading.Thread(
+            target=profiler.bind(tracer.run_in_span),
+            args=(generate_span, run_chat_stream, publisher, session_id, message, session_data),
+            daemon=True
+        ).start()
+        
         def generate():
-            """SSE 生成器"""
-            import json
-            full_response = ""
-            final_state = session_data['current_state']
-            
+            """SSE 生成器（读取本进程发布器的事件）"""
+            last_heartbeat = time.time()
+            last_write = time.time()
             try:
-                # 先保存用户消息
-                db.update_chat_history(session_id, {'role': 'user', 'content': message})
-                
-                # 流式处理消息
-                for chunk_data in orchestrator.process_message_stream(
-                    session_id=session_id,
-                    user_message=message,
-                    session_data=session_data
-                ):
-                    if chunk_data.get('done'):
-                        # 流结束
-                        final_state = chunk_data.get('state', final_state)
-                        if 'full_response' in chunk_data:
-                            full_response = chunk_data['full_response']
-                        yield f"data: {json.dumps({'event': 'done', 'state': final_state}, ensure_ascii=False)}\n\n"
+                while True:
+                    try:
+                        seq, event = publisher.local.get(timeout=stream_registry.heartbeat_interval)
+                    except queue.Empty:
+                        seq, event = None, None
                     else:
-                        # 流式内容
-                        content = chunk_data.get('content', '')
-                        full_response += content
-                        yield f"data: {json.dumps({'content': content}, ensure_ascii=False)}\n\n"
-                
-                # 保存助手消息
-                db.update_chat_history(session_id, {'role': 'assistant', 'content': full_response})
-                
-                # 更新状态
-                if final_state != session_data['current_state']:
-                    db.update_session(session_id, current_state=final_state)
-                    print(f"🔄 会话 {session_id} 状态: {session_data['current_state']} → {final_state}")
-                
-            except Exception as e:
-                print(f"❌ 流式处理失败: {e}")
-                error_msg = f"处理失败: {str(e)}"
-                yield f"data: {json.dumps({'error': error_msg}, ensure_ascii=False)}\n\n"
-        
-        return app.response_class(
-            generate(),
-            mimetype='text/event-stream',
-            headers={
-                'Cache-Control': 'no-cache',
-                'X-Accel-Buffering': 'no'
-            }
-        )
+                        if seq is None:
+                            return
+                        yield format_sse(seq, event)
+                        last_write = time.time()
+                    
+                    now = time.time()
+                    if now - last_heartbeat >= stream_registry.heartbeat_interval:
+                        stream_registry.touch_reader(stream_id)
+                        last_heartbeat = now
+                    if now - last_write >= SSE_KEEPALIVE_SECONDS:
+                        # 保活注释：长时间没有输出时也能及时发现客户端断开
+                        yield ": keepalive\n\n"
+                        last_write = now
+            except GeneratorExit:
+                # 客户端断开：本连接立即结束、释放 worker；生成继续进行，宽限期内无人重连才取消
+                logger.info('chat.stream_disconnected', '🔌 客户端已断开，等待重连', stream_id=stream_id,
+                            grace_seconds=stream_registry.disconnect_grace_seconds)
+                raise
+        
+        return sse_response(generate())
     
     except Exception as e:
-        print(f"流式对话失败: {e}")
+        logger.exception('api.chat_stream_failed', '❌ 流式对话失败')
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/chat/stream/<stream_id>', methods=['GET'])
+def chat_stream_resume(stream_id):
+    """断线重连：补发 Last-Event-ID 之后的事件，再跟随实时输出（不会触发新的 LLM 调用）"""
+    try:
+        stream_info = stream_registry.get_stream(stream_id)
+        if not stream_info:
+            return jsonify({'success': False, 'error': '流不存在或已过期'}), 404
+        
+        try:
+            last_event_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0)
+        except ValueError:
+            return jsonify({'success': False, 'error': 'Last-Event-ID 无效'}), 400
+        
+        logger.info('chat.stream_resumed', '🔁 流重连，从断点之后继续', stream_id=stream_id, last_event_id=last_event_id)
+        metrics.inc('chat_stream_resume_total')
+        
+        def generate():
+            for seq, event in stream_registry.follow(stream_id, last_event_id):
+                if seq is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield format_sse(seq, event)
+        
+        return sse_response(generate())
+    except Exception as e:
+        logger.exception('api.chat_stream_resume_failed', '❌ 流式重连失败')
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/chat/cancel', methods=['POST'])
+def chat_cancel():
+    """停止生成：标记取消，持有该流的 worker 会关闭上游并保存已生成的部分"""
+    try:
+        data = request.get_json() or {}
+        session_id = data.get('session_id')
+        stream_id = data.get('stream_id')
+        
+        if not session_id:
+            return jsonify({'success': False, 'error': '缺少必要参数'}), 400
+        
+        cancelled = stream_registry.request_cancel(session_id, stream_id)
+        return jsonify({'success': True, 'cancelled': cancelled})
+    except Exception as e:
+        logger.exception('api.chat_stop_failed', '❌ 停止生成失败')
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/convert-to-markdown', methods=['POST'])
 def convert_to_markdown():
-    """PDF 转 Markdown（兼容接口，实际在上传时已完成）"""
+    """
+    PDF 转 Markdown：返回会话的转换任务状态
+    
+    上传的论文在 /api/upload 时已提交转换任务；本地论文（没有对应 Markdown 的 PDF）在这里提交，
+    结果保存在 Markdown 存储中（未启用存储时输出到 PDF 同目录），之后的会话和本地论文列表直接使用。
+    转换在后台进行，进度通过 /api/conversion/<session_id> 查询。
+    """
     try:
-        # 这个接口主要是为了兼容前端，实际转换在上传时已完成
-        # 直接返回成功
+        data = request.get_json(silent=True) or {}
+        session_id = data.get('session_id')
+        if not session_id:
+            return jsonify({'success': True, 'message': '未指定会话', 'conversion': None})
+        
+        session_data = db.get_session(session_id)
+        if not session_data:
+            return jsonify({'success': False, 'error': '会话不存在'}), 404
+        
+        job = job_queue.latest_for_session(session_id, PDF_CONVERSION)
+        paper_path = session_data.get('paper_path')
+        if (job is None and not session_data.get('markdown_path') and PDF_CONVERTER_AVAILABLE
+                and paper_path and os.path.exists(paper_path)):
+            job_id = job_queue.enqueue(PDF_CONVERSION, {'pdf_path': paper_path}, session_id=session_id)
+            job = job_queue.get(job_id)
+        
         return jsonify({
             'success': True,
-            'message': 'PDF已在上传时转换为Markdown'
+            'has_markdown': bool(session_data.get('markdown_path')),
+            'conversion': job_summary(job),
+            'poll_interval_ms': JOB_QUEUE_CONFIG.get('client_poll_interval_ms', 2000)
         })
     except Exception as e:
-        print(f"转换接口调用失败: {e}")
+        logger.exception('api.convert_failed', '❌ 转换接口调用失败')
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/conversion/<session_id>', methods=['GET'])
+def get_conversion_status(session_id):
+    """
+    查询会话的 Markdown 转换进度（前端轮询）
+    
+    status: queued / running / succeeded / failed；没有转换任务时为 none
+    """
+    try:
+        job = job_queue.latest_for_session(session_id, PDF_CONVERSION)
+        if job is None:
+            session_data = db.get_session(session_id)
+            if not session_data:
+                return jsonify({'success': False, 'error': '会话不存在'}), 404
+            return jsonify({
+                'success': True,
+                'status': 'none',
+                'has_markdown': bool(session_data.get('markdown_path')),
+                'conversion': None
+            })
+        
+        return jsonify({
+            'success': True,
+            'status': job['status'],
+            'has_markdown': job['status'] == 'succeeded',
+            'conversion': job_summary(job)
+        })
+    except Exception as e:
+        logger.exception('api.conversion_status_failed', '❌ 获取转换进度失败')
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/generate-mindmap', methods=['POST'])
@@ -364,7 +823,7 @@ def generate_mindmap():
         cached_mindmap = session_dict.get('mindmap_outline')
         
         if cached_mindmap:
-            print("✅ 返回缓存的思维导图")
+            logger.info('mindmap.cached', '✅ 返回缓存的思维导图', session_id=session_id)
             return jsonify({
                 'success': True,
                 'markdown': cached_mindmap,
@@ -409,6 +868,25 @@ def generate_mindmap():
         
         # 构建上下文
         from agent_orchestrator import orchestrator
+        
+        # 检查跨会话共享缓存（同一篇论文、同一 Prompt 的大纲可直接复用）
+        cache_info = orchestrator.deterministic_cache_info(
+            session_data,
+            agent_name='mindmap',
+            prompt_fingerprint=hashlib.sha256(mindmap_prompt.encode('utf-8')).hexdigest(),
+            uses_chat_history=False  # 以空聊天历史生成，导读报告写入的历史不影响结果
+        )
+        shared_mindmap = response_cache.get(cache_info['cache_key']) if cache_info else None
+        if shared_mindmap:
+            logger.info('mindmap.shared_cache', '✅ 返回共享缓存的思维导图', session_id=session_id)
+            session_dict['mindmap_outline'] = shared_mindmap
+            db.update_session(session_id, session_data=session_dict)
+            return jsonify({
+                'success': True,
+                'markdown': shared_mindmap,
+                'from_cache': True
+            })
+        
         context = orchestrator._build_context(session_data)
         
         # 调用 LLM 生成大纲
@@ -417,8 +895,11 @@ def generate_mindmap():
                 system_prompt=mindmap_prompt,
                 context=context,
                 user_message="请为这篇论文生成思维导图大纲",
-                chat_history=[]
+                chat_history=[],
+                priority='background',
+                tags=orchestrator.usage_tags(session_data, 'mindmap')
             )
+            generation_failed = orchestrator.is_error_response(mindmap_outline)
             
             # 清理可能的多余内容（只保留 Markdown 标题）
             lines = mindmap_outline.split('\n')
@@ -431,11 +912,15 @@ def generate_mindmap():
             
             mindmap_outline = '\n'.join(cleaned_lines).strip()
             
+            # 写入共享缓存（失败的生成不缓存）
+            if cache_info and mindmap_outline and not generation_failed:
+                response_cache.set(response=mindmap_outline, **cache_info)
+            
             # 缓存到数据库
             session_dict['mindmap_outline'] = mindmap_outline
             db.update_session(session_id, session_data=session_dict)
             
-            print("✅ 思维导图大纲生成成功")
+            logger.info('mindmap.generated', '✅ 思维导图大纲生成成功', session_id=session_id)
             
             return jsonify({
                 'success': True,
@@ -443,15 +928,17 @@ def generate_mindmap():
                 'from_cache': False
             })
             
+        except LLMOverloadedError as e:
+            return overloaded_response(e)
         except Exception as e:
-            print(f"❌ 生成思维导图失败: {e}")
+            logger.exception('mindmap.generate_failed', '❌ 生成思维导图失败')
             return jsonify({
                 'success': False,
                 'error': f'生成失败: {str(e)}'
             }), 500
         
     except Exception as e:
-        print(f"思维导图接口失败: {e}")
+        logger.exception('api.mindmap_failed', '❌ 思维导图接口失败')
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/proactive-summary', methods=['POST'])
@@ -484,11 +971,34 @@ def proactive_summary():
         
         # 使用空消息触发导读报告
         try:
-            assistant_response, new_state = orchestrator.process_message(
-                session_id=session_id,
-                user_message='',  # 空消息触发导读
-                session_data=session_data
-            )
+            # 初始导读报告只取决于论文和 Prompt，先查跨会话共享缓存
+            cache_info = None
+            if session_data['current_state'] == 'GUIDE_PENDING_REPORT':
+                cache_info = orchestrator.deterministic_cache_info(
+                    session_data,
+                    agent_name='guidance',
+                    prompt_fingerprint=prompt_manager.get_prompt_fingerprint('guidance')
+                )
+            cached_report = response_cache.get(cache_info['cache_key']) if cache_info else None
+            
+            if cached_report:
+                logger.info('summary.shared_cache', '✅ 返回共享缓存的导读报告', session_id=session_id)
+                assistant_response = cached_report
+                new_state = orchestrator._determine_next_state(
+                    current_state=session_data['current_state'],
+                    user_message='',
+                    assistant_response=assistant_response,
+                    session_data=session_data
+                )
+            else:
+                assistant_response, new_state = orchestrator.process_message(
+                    session_id=session_id,
+                    user_message='',  # 空消息触发导读
+                    session_data=session_data,
+                    priority='background'
+                )
+                if cache_info and not orchestrator.is_error_response(assistant_response):
+                    response_cache.set(response=assistant_response, **cache_info)
             
             # 重要：保存导读报告到会话历史
             # 注意：空消息不保存为user消息，只保存assistant的回复
@@ -497,7 +1007,9 @@ def proactive_summary():
             # 更新会话状态
             if new_state != session_data['current_state']:
                 db.update_session(session_id, current_state=new_state)
-                print(f"🔄 导读报告生成后状态更新: {session_data['current_state']} → {new_state}")
+                metrics.inc('fsm_transitions_total', from_state=session_data['current_state'], to_state=new_state)
+                logger.info('fsm.transition', '🔄 导读报告生成后状态更新', session_id=session_id,
+                            from_state=session_data['current_state'], to_state=new_state)
             
             return jsonify({
                 'success': True,
@@ -507,15 +1019,17 @@ def proactive_summary():
                     'questions': []  # 可以根据需要扩展
                 }
             })
+        except LLMOverloadedError as e:
+            return overloaded_response(e)
         except Exception as e:
-            print(f"❌ 生成导读报告失败: {e}")
+            logger.exception('summary.generate_failed', '❌ 生成导读报告失败')
             return jsonify({
                 'success': False,
                 'error': f'生成失败: {str(e)}'
             }), 500
         
     except Exception as e:
-        print(f"导读报告接口失败: {e}")
+        logger.exception('api.summary_failed', '❌ 导读报告接口失败')
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/local-papers', methods=['GET'])
@@ -529,16 +1043,20 @@ def get_local_papers():
         
         # 扫描 PDF 文件
         for pdf_file in local_papers_folder.glob('*.pdf'):
-            # 检查是否有对应的 Markdown 文件
+            # 检查是否有对应的 Markdown：同目录下的 .md，或之前转换过、保存在 Markdown 存储中
+            # （列表只按快速键查询，不计算 PDF 哈希；转换时会记录快速键）
             md_file = pdf_file.with_suffix('.md')
-            has_markdown = md_file.exists()
+            if md_file.exists():
+                markdown_path = str(md_file)
+            else:
+                markdown_path = markdown_store.lookup(markdown_store.stat_key_for_file(pdf_file))
             
             papers.append({
                 'filename': pdf_file.name,
                 'title': pdf_file.stem,  # 文件名不含扩展名
                 'path': str(pdf_file),
-                'has_markdown': has_markdown,
-                'markdown_path': str(md_file) if has_markdown else None,
+                'has_markdown': markdown_path is not None,
+                'markdown_path': markdown_path,
                 'size': pdf_file.stat().st_size,
                 'type': 'pdf'
             })
@@ -566,7 +1084,7 @@ def get_local_papers():
             'count': len(papers)
         })
     except Exception as e:
-        print(f"获取本地论文列表失败: {e}")
+        logger.exception('api.local_papers_failed', '❌ 获取本地论文列表失败')
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/use-local-paper', methods=['POST'])
@@ -596,9 +1114,9 @@ def use_local_paper():
             paper_path = str(pdf_path)
             title = filename.replace('.pdf', '')
             
-            # 检查是否有对应的 Markdown
+            # 检查是否有对应的 Markdown（同目录下的 .md，或之前转换过、保存在 Markdown 存储中）
             md_path = pdf_path.with_suffix('.md')
-            markdown_path = str(md_path) if md_path.exists() else None
+            markdown_path = str(md_path) if md_path.exists() else markdown_store.lookup_file(pdf_path)
         
         # 再检查 Markdown
         elif filename.endswith('.md'):
@@ -630,7 +1148,7 @@ def use_local_paper():
             'has_pdf': paper_path is not None
         })
     except Exception as e:
-        print(f"使用本地论文失败: {e}")
+        logger.exception('api.use_local_paper_failed', '❌ 使用本地论文失败')
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/session/<session_id>', methods=['DELETE'])
@@ -644,9 +1162,144 @@ def delete_session(session_id):
         else:
             return jsonify({'success': False, 'error': '会话不存在'}), 404
     except Exception as e:
-        print(f"删除会话失败: {e}")
+        logger.exception('api.delete_session_failed', '❌ 删除会话失败')
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# ========== 监控 ==========
+
+@app.route('/api/metrics/jobs', methods=['GET'])
+def get_job_metrics():
+    """后台任务队列状态：各类型任务的排队 / 执行中 / 成功 / 失败数，以及 Markdown 存储的文档数和复用次数"""
+    try:
+        return jsonify({
+            'success': True,
+            'jobs': job_queue.stats(),
+            'markdown_store': markdown_store.stats() if markdown_store.enabled else None
+        })
+    except Exception as e:
+        logger.exception('api.job_metrics_failed', '❌ 获取任务队列状态失败')
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/metrics/llm', methods=['GET'])
+def llm_metrics():
+    """LLM 提供商状态：本 worker 的熔断器快照 + 所有 worker 汇总的故障转移/调用计数"""
+    try:
+        return jsonify({
+            'success': True,
+            'pid': os.getpid(),
+            'providers': orchestrator.pool.snapshot() if orchestrator else [],
+            'queue': rate_limiter.queue_stats(),
+            'metrics': metrics.collect('llm_'),
+        })
+    except Exception as e:
+        logger.exception('api.llm_metrics_failed', '❌ 获取 LLM 监控指标失败')
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/metrics/server', methods=['GET'])
+def server_metrics():
+    """服务端负载：所有 worker 的进行中请求数、请求累计占用时长、数据库事务与锁等待计数"""
+    try:
+        http_metrics = metrics.collect('http_')
+        db_metrics = metrics.collect('db_')
+        return jsonify({
+            'success': True,
+            'pid': os.getpid(),
+            'time': time.time(),
+            'metrics': {
+                'counters': {**http_metrics['counters'], **db_metrics['counters']},
+                'gauges': {**http_metrics['gauges'], **db_metrics['gauges']},
+            },
+        })
+    except Exception as e:
+        logger.exception('api.server_metrics_failed', '❌ 获取服务端监控指标失败')
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/metrics/usage', methods=['GET'])
+def llm_usage():
+    """
+    LLM 用量汇总（token 用量、耗时分位数）
+    
+    查询参数：
+    - group_by: 汇总维度，逗号分隔（默认 agent），可选 agent/state/session_id/user_id/prompt_version/provider/model/mode/outcome
+    - since / until: 时间范围（Unix 时间戳）
+    - 其他维度参数作为过滤条件，如 ?agent=method
+    """
+    try:
+        group_by = [col.strip() for col in request.args.get('group_by', 'agent').split(',') if col.strip()]
+        invalid = [col for col in group_by if col not in GROUP_COLUMNS]
+        if invalid:
+            return jsonify({'success': False, 'error': f'不支持的汇总维度: {", ".join(invalid)}'}), 400
+        
+        since = request.args.get('since', type=float)
+        until = request.args.get('until', type=float)
+        filters = {col: request.args[col] for col in GROUP_COLUMNS if col in request.args}
+        
+        return jsonify({
+            'success': True,
+            'group_by': group_by,
+            'rows': usage_tracker.rollup(group_by, since=since, until=until, filters=filters),
+        })
+    except Exception as e:
+        logger.exception('api.usage_failed', '❌ 获取 LLM 用量汇总失败')
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus 抓取接口：所有 worker 汇总后的计数器、瞬时值和直方图（文本格式）"""
+    try:
+        return app.response_class(metrics.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+    except Exception as e:
+        logger.exception('api.prometheus_failed', '❌ 导出 Prometheus 指标失败')
+        return app.response_class(f"# error: {e}\n", status=500, mimetype='text/plain')
+
+# ========== 性能剖析 ==========
+
+def profiling_authorized():
+    """剖析管理接口的鉴权（请求头 X-Profile-Token 与 PROFILING_TOKEN 一致）"""
+    return profiler.authorized(request.headers.get('X-Profile-Token'))
+
+@app.route('/api/admin/profiles', methods=['GET'])
+def list_profiles():
+    """列出所有 worker 保存的请求剖析结果（最新的在前）"""
+    if not profiler.enabled:
+        return jsonify({'success': False, 'error': '剖析功能未开启'}), 404
+    if not profiling_authorized():
+        return jsonify({'success': False, 'error': '无权访问'}), 403
+    return jsonify({'success': True, 'profiles': profiler.list_profiles()})
+
+@app.route('/api/admin/profiles/<profile_id>', methods=['GET'])
+def download_profile(profile_id):
+    """
+    下载剖析结果
+    
+    查询参数：
+    - format: prof（默认，pstats 二进制文件）或 text（按 sort 排序的前 limit 个函数）
+    - sort: text 格式的排序字段（默认 cumulative，可选 tottime / calls 等）
+    - limit: text 格式输出的函数数（默认 50）
+    """
+    if not profiler.enabled:
+        return jsonify({'success': False, 'error': '剖析功能未开启'}), 404
+    if not profiling_authorized():
+        return jsonify({'success': False, 'error': '无权访问'}), 403
+    path = profiler.profile_path(profile_id)
+    if path is None:
+        return jsonify({'success': False, 'error': '剖析结果不存在'}), 404
+    
+    if request.args.get('format') == 'text':
+        try:
+            text = profiler.render_text(
+                path,
+                sort=request.args.get('sort', 'cumulative'),
+                limit=request.args.get('limit', 50, type=int)
+            )
+        except KeyError as e:
+            return jsonify({'success': False, 'error': f'不支持的排序字段: {e}'}), 400
+        return app.response_class(text, content_type='text/plain; charset=utf-8')
+    
+    from flask import send_file
+    return send_file(str(path), mimetype='application/octet-stream', as_attachment=True,
+                     download_name=path.name)
+
 # ========== 静态文件服务 ==========
 
 @app.route('/uploads/<filename>')
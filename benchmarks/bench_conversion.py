@@ -0,0 +1,200 @@
+"""
+PDF 转换吞吐量基准
+启动模拟 MinerU 服务（fake_mineru_server.py），用真实的 PDFConverter 并发执行 N 个转换
+（上传 PDF → 创建任务 → 共享轮询线程等待 → 流式下载并解压结果 ZIP），统计每分钟完成数和耗时分位数
+
+默认关闭本地提取和 Markdown 存储，所有 PDF 都走 MinerU 流程；语料是 bench_local_extraction.py 生成的合成论文，
+每个转换使用不同的 PDF。模拟服务的排队时长、解析速度和各类错误都可以调整，用来观察轮询策略、连接池
+和重试行为在负载下的表现。
+
+用法：
+    python benchmarks/bench_conversion.py
+    python benchmarks/bench_conversion.py --conversions 100 --concurrency 16 --queue-seconds 3 --pages-per-second 5
+    python benchmarks/bench_conversion.py --source url --fail-rate 0.05 --status-error-rate 0.1
+    python benchmarks/bench_conversion.py --stuck-rate 0.1 --max-wait 20 --output benchmarks/results/conversion.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import re
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import requests
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT_DIR = BENCH_DIR.parent
+sys.path.insert(0, str(ROOT_DIR))
+sys.path.insert(0, str(BENCH_DIR))
+
+from bench_local_extraction import build_paper  # noqa: E402
+from fake_mineru_server import FakeMinerUServer  # noqa: E402
+
+VARIABLE_PARTS = re.compile(r'https?://\S+|[0-9a-f]{32}')
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(p * len(values)))], 2)
+
+
+def convert_one(converter, index: int, source: Dict, output_dir: Path) -> Dict:
+    """执行一个转换，返回 {'index', 'success', 'seconds', 'error'}"""
+    started = time.perf_counter()
+    result = {'index': index, 'pages': source['pages'], 'success': False, 'seconds': 0.0, 'error': None}
+    try:
+        converter.convert_pdf_to_markdown(pdf_path=source.get('path'), pdf_url=source.get('url'),
+                                          output_path=str(output_dir / f"paper-{index}.md"))
+        result['success'] = True
+    except Exception as e:
+        result['error'] = str(e)
+    result['seconds'] = time.perf_counter() - started
+    return result
+
+
+def summarize_errors(results: List[Dict]) -> Dict[str, int]:
+    """按错误信息归类（去掉任务 ID、URL 等变化的部分）"""
+    errors = {}
+    for result in results:
+        if result['error']:
+            key = VARIABLE_PARTS.sub('…', result['error'])[:80]
+            errors[key] = errors.get(key, 0) + 1
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PDF 转换吞吐量基准（模拟 MinerU 服务 + 真实 PDFConverter）')
+    parser.add_argument('--conversions', type=int, default=40, help='转换总数')
+    parser.add_argument('--concurrency', type=int, default=8, help='同时进行的转换数（相当于转换 worker 的并发数）')
+    parser.add_argument('--pages', default='4,8,16', help='合成论文的页数，逗号分隔，按顺序循环使用')
+    parser.add_argument('--source', choices=('upload', 'url'), default='upload',
+                        help='upload：传入本地路径，由转换器上传；url：预先上传，传入 URL')
+    parser.add_argument('--max-wait', type=float, default=None, help='单个任务的最长等待时间（秒，默认取配置）')
+    parser.add_argument('--local', action='store_true', help='保留本地提取（文字型 PDF 不走 MinerU）')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--queue-seconds', type=float, default=1.0, help='模拟服务的排队时长（秒）')
+    parser.add_argument('--pages-per-second', type=float, default=10.0, help='模拟服务的解析速度')
+    parser.add_argument('--images-per-page', type=int, default=0, help='结果 ZIP 中每页的图片数')
+    parser.add_argument('--create-error-rate', type=float, default=0.0)
+    parser.add_argument('--status-error-rate', type=float, default=0.0)
+    parser.add_argument('--download-error-rate', type=float, default=0.0)
+    parser.add_argument('--upload-error-rate', type=float, default=0.0)
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='任务解析失败的比例')
+    parser.add_argument('--stuck-rate', type=float, default=0.0, help='任务永不结束的比例（等到 --max-wait 超时）')
+    parser.add_argument('--verbose', action='store_true', help='显示转换器的逐条输出')
+    parser.add_argument('--output', help='结果 JSON 路径（不指定时只打印）')
+    args = parser.parse_args()
+
+    from local_extractor import local_extractor
+    from markdown_store import markdown_store
+    from pdf_converter import PDFConverter
+
+    # 每次运行都真实执行转换：不复用存储中的结果
+    markdown_store.enabled = False
+    local_extractor.enabled = args.local
+
+    server_config = {
+        'seed': args.seed,
+        'queue_seconds': args.queue_seconds,
+        'pages_per_second': args.pages_per_second,
+        'images_per_page': args.images_per_page,
+        'create_error_rate': args.create_error_rate,
+        'status_error_rate': args.status_error_rate,
+        'download_error_rate': args.download_error_rate,
+        'upload_error_rate': args.upload_error_rate,
+        'fail_rate': args.fail_rate,
+        'stuck_rate': args.stuck_rate,
+    }
+    page_counts = [int(value) for value in args.pages.split(',')]
+
+    with FakeMinerUServer(config=server_config) as server, tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        converter = PDFConverter(api_token='fake-token')
+        converter.base_url = server.base_url
+        converter.upload_url = server.upload_url
+        if args.max_wait:
+            converter.max_wait_seconds = args.max_wait
+
+        sources = []
+        for index in range(args.conversions):
+            path = workdir / f"paper-{index}.pdf"
+            pages = page_counts[index % len(page_counts)]
+            build_paper(path, pages, seed=args.seed + index)
+            source = {'pages': pages, 'path': str(path)}
+            if args.source == 'url':
+                with open(path, 'rb') as f:
+                    response = requests.post(server.upload_url, files={'fileToUpload': f},
+                                             data={'reqtype': 'fileupload'}, timeout=30)
+                response.raise_for_status()
+                source = {'pages': pages, 'url': response.text.strip()}
+            sources.append(source)
+        print(f"📚 合成语料: {len(sources)} 篇（{args.pages} 页循环），并发 {args.concurrency}，来源 {args.source}")
+        print(f"🧪 模拟 MinerU: 排队 {args.queue_seconds}s，{args.pages_per_second} 页/s，"
+              f"失败率 {args.fail_rate}，卡住 {args.stuck_rate}，最长等待 {converter.max_wait_seconds}s")
+
+        output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        started = time.perf_counter()
+        with output, ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            futures = [executor.submit(convert_one, converter, index, source, workdir)
+                       for index, source in enumerate(sources)]
+            results = [future.result() for future in futures]
+        elapsed = time.perf_counter() - started
+        server_stats = server.state.snapshot()['stats']
+
+    succeeded = [result['seconds'] for result in results if result['success']]
+    report = {
+        'conversions': args.conversions,
+        'concurrency': args.concurrency,
+        'source': args.source,
+        'server_config': server_config,
+        'seconds': round(elapsed, 2),
+        'succeeded': len(succeeded),
+        'failed': len(results) - len(succeeded),
+        'completions_per_minute': round(len(succeeded) / elapsed * 60, 1),
+        'latency_seconds': {
+            'p50': percentile(succeeded, 0.50),
+            'p95': percentile(succeeded, 0.95),
+            'p99': percentile(succeeded, 0.99),
+            'max': round(max(succeeded), 2) if succeeded else None,
+        },
+        'errors': summarize_errors(results),
+        'server': {
+            'status_requests': server_stats['status_requests'],
+            'polls_per_finished_task': server_stats['polls_per_finished_task'],
+            'max_active_tasks': server_stats['max_active_tasks'],
+            'uploads': server_stats['uploads'],
+            'downloads': server_stats['downloads'],
+            'errors_injected': server_stats['errors_injected'],
+        },
+    }
+
+    latency = report['latency_seconds']
+    print(f"\n{'完成':>6}{'失败':>6}{'总耗时':>10}{'每分钟完成':>12}{'p50':>9}{'p95':>9}{'p99':>9}")
+    print(f"{report['succeeded']:>6}{report['failed']:>6}{elapsed:>9.1f}s{report['completions_per_minute']:>12.1f}"
+          + ''.join(f"{value:>8.2f}s" if value is not None else f"{'-':>9}"
+                    for value in (latency['p50'], latency['p95'], latency['p99'])))
+    server_report = report['server']
+    print(f"\n📡 模拟服务: 状态查询 {server_report['status_requests']} 次"
+          f"（每个任务 {server_report['polls_per_finished_task']} 次），同时进行的任务峰值 {server_report['max_active_tasks']}，"
+          f"注入错误 {server_report['errors_injected']} 次")
+    for error, count in sorted(report['errors'].items(), key=lambda item: -item[1]):
+        print(f"   ❌ {count} × {error}")
+
+    if args.output:
+        output_path = Path(args.output)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 结果已保存: {output_path}")
+    return 0 if succeeded else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+"""
+本地 PDF 提取基准
+用合成的多页 PDF 语料测量本地提取在不同进程数下的吞吐量（页/秒），并检查并行结果与串行结果一致
+
+合成 PDF 只使用 PDF 标准字体（Helvetica / Helvetica-Bold），不依赖任何 PDF 生成库：
+第 1 页有大号标题，之后是带编号的章节标题（"3 Method"）、小节标题（"3.2 Setup"）和正文段落，
+段落和章节会跨页，用来检查按页码区间拆分后标题层级和段落衔接是否正确
+
+用法：
+    python benchmarks/bench_local_extraction.py
+    python benchmarks/bench_local_extraction.py --pages 40,120,240 --processes 1,2,4,8
+    python benchmarks/bench_local_extraction.py --pages-per-task 16 --output benchmarks/results/local-extraction.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT_DIR = BENCH_DIR.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+WORDS = ('model', 'reading', 'attention', 'document', 'retrieval', 'layer', 'student', 'context', 'evaluation',
+         'baseline', 'dataset', 'training', 'results', 'method', 'analysis', 'performance', 'paper', 'structure',
+         'section', 'language', 'learning', 'system', 'approach', 'feature', 'signal', 'benchmark', 'robust')
+SECTION_NAMES = ('Introduction', 'Related Work', 'Method', 'Experimental Setup', 'Results', 'Analysis',
+                 'Discussion', 'Limitations', 'Conclusion')
+
+PAGE_WIDTH, PAGE_HEIGHT = 612, 792
+MARGIN_TOP, MARGIN_BOTTOM, MARGIN_LEFT = 720, 72, 72
+BODY_SIZE, LEADING, CHARS_PER_LINE = 10, 12.5, 95
+
+
+def _escape(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def write_pdf(path: Path, pages):
+    """
+    写出只含文本的 PDF
+
+    Args:
+        pages: 每页的文本行列表 [(字体 'F1' 正文 / 'F2' 粗体, 字号, x, y, 文本), ...]
+    """
+    objects = [
+        '<< /Type /Catalog /Pages 2 0 R >>',
+        None,  # 页面树，页面对象编号确定后再填
+        '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>',
+        '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>',
+    ]
+    page_ids = []
+    for lines in pages:
+        stream = '\n'.join(f"BT /{font} {size} Tf 1 0 0 1 {x:.2f} {y:.2f} Tm ({_escape(text)}) Tj ET"
+                           for font, size, x, y, text in lines)
+        objects.append(f"<< /Length {len(stream.encode('latin-1'))} >>\nstream\n{stream}\nendstream")
+        content_id = len(objects)
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+                       f"/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents {content_id} 0 R >>")
+        page_ids.append(len(objects))
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{i} 0 R' for i in page_ids)}] /Count {len(page_ids)} >>"
+
+    output = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += f"{number} 0 obj\n{body}\nendobj\n".encode('latin-1')
+    xref = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode('latin-1')
+    for offset in offsets:
+        output += f"{offset:010d} 00000 n \n".encode('latin-1')
+    output += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode('latin-1')
+    path.write_bytes(bytes(output))
+
+
+def build_paper(path: Path, page_count: int, seed: int) -> int:
+    """生成一篇 page_count 页的合成论文，返回其中的标题数（含论文标题）"""
+    rng = random.Random(seed)
+    pages, lines = [], []
+    y = MARGIN_TOP
+    headings = 0
+
+    def new_page():
+        nonlocal lines, y
+        pages.append(lines)
+        lines, y = [], MARGIN_TOP
+
+    def emit(font, size, text, space_before=0.0):
+        nonlocal y
+        y -= space_before
+        if y < MARGIN_BOTTOM:
+            new_page()
+        lines.append((font, size, MARGIN_LEFT, y, text))
+        y -= size * 1.25
+
+    emit('F2', 20, f"A Synthetic Study of Long Document Reading {seed}")
+    headings += 1
+    section = 0
+    while len(pages) < page_count:
+        section += 1
+        emit('F2', 14, f"{section} {SECTION_NAMES[(section - 1) % len(SECTION_NAMES)]}", space_before=14)
+        headings += 1
+        for subsection in range(1, rng.randint(2, 4)):
+            emit('F2', 12, f"{section}.{subsection} {rng.choice(WORDS).title()} {rng.choice(WORDS)}",
+                 space_before=8)
+            headings += 1
+            for _ in range(rng.randint(2, 5)):
+                words = [rng.choice(WORDS) for _ in range(rng.randint(40, 110))]
+                text = ' '.join(words).capitalize() + '.'
+                y -= LEADING * 0.6
+                while text:
+                    cut = len(text) if len(text) <= CHARS_PER_LINE else text.rfind(' ', 0, CHARS_PER_LINE)
+                    line, text = text[:cut], text[cut:].lstrip()
+                    emit('F1', BODY_SIZE, line)
+                    y += BODY_SIZE * 1.25 - LEADING
+                if len(pages) >= page_count:
+                    break
+            if len(pages) >= page_count:
+                break
+    write_pdf(path, pages[:page_count])
+    return headings
+
+
+def run(extractor, path: Path, pages: int, repeat: int):
+    durations, markdown = [], ''
+    for _ in range(repeat):
+        started = time.perf_counter()
+        markdown = extractor.extract(path, pages=pages)
+        durations.append(time.perf_counter() - started)
+    return min(durations), markdown
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地 PDF 提取基准（按页码区间并行）')
+    parser.add_argument('--pages', default='20,80,160', help='语料中各篇论文的页数，逗号分隔')
+    parser.add_argument('--processes', default=None, help='要对比的进程数，逗号分隔（默认 1 到 CPU 核数的 2 的幂）')
+    parser.add_argument('--pages-per-task', type=int, default=None, help='每个任务的页数（默认取配置）')
+    parser.add_argument('--repeat', type=int, default=2, help='每个组合重复次数（取最快一次）')
+    parser.add_argument('--output', help='结果 JSON 路径（不指定时只打印）')
+    args = parser.parse_args()
+
+    from local_extractor import LocalExtractor, PdfReader
+    if PdfReader is None:
+        print("❌ 未安装 pypdf，无法运行本地提取基准")
+        return 1
+
+    cpus = os.cpu_count() or 1
+    if args.processes:
+        process_counts = [int(value) for value in args.processes.split(',')]
+    else:
+        process_counts = sorted({1, cpus} | {2 ** i for i in range(1, 6) if 2 ** i < cpus})
+    page_counts = [int(value) for value in args.pages.split(',')]
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        corpus = []
+        for index, page_count in enumerate(page_counts):
+            path = Path(workdir) / f"paper-{page_count}.pdf"
+            headings = build_paper(path, page_count, seed=index + 1)
+            corpus.append((path, page_count, headings))
+        total_pages = sum(page_counts)
+        print(f"📚 合成语料: {len(corpus)} 篇，共 {total_pages} 页；CPU 核数 {cpus}")
+
+        # 串行基准：单进程、整份 PDF 一个任务
+        serial = LocalExtractor()
+        serial.processes = 1
+        reference = {}
+        for path, page_count, headings in corpus:
+            _, markdown = run(serial, path, None, 1)
+            reference[path] = markdown
+            found = sum(1 for line in markdown.splitlines() if line.startswith('#'))
+            if found != headings:
+                print(f"⚠️  {path.name}: 识别到 {found} 个标题，实际 {headings} 个")
+        serial.shutdown()
+
+        print(f"\n{'进程数':<8}{'每任务页数':>10}{'耗时':>10}{'页/秒':>10}{'加速比':>8}{'结果一致':>10}")
+        baseline = None
+        for processes in process_counts:
+            extractor = LocalExtractor()
+            extractor.processes = processes
+            if args.pages_per_task:
+                extractor.pages_per_task = args.pages_per_task
+            run(extractor, corpus[0][0], corpus[0][1], 1)  # 预热：创建进程池
+            elapsed, identical = 0.0, True
+            for path, page_count, _ in corpus:
+                seconds, markdown = run(extractor, path, page_count, args.repeat)
+                elapsed += seconds
+                identical = identical and markdown == reference[path]
+            extractor.shutdown()
+            baseline = baseline or elapsed
+            result = {
+                'processes': processes,
+                'pages_per_task': extractor.pages_per_task,
+                'seconds': round(elapsed, 3),
+                'pages_per_second': round(total_pages / elapsed, 1),
+                'speedup': round(baseline / elapsed, 2),
+                'identical_to_serial': identical,
+            }
+            results.append(result)
+            print(f"{processes:<8}{result['pages_per_task']:>10}{elapsed:>9.2f}s{result['pages_per_second']:>10.1f}"
+                  f"{result['speedup']:>7.2f}x{'✅' if identical else '❌':>9}")
+
+    if args.output:
+        output_path = Path(args.output)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump({'cpus': cpus, 'pages': page_counts, 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 结果已保存: {output_path}")
+    return 0 if all(result['identical_to_serial'] for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,183 @@
+"""
+MinerU 结果 ZIP 处理的内存基准
+对比旧实现（整个 ZIP 读入内存再解压）和流式实现（边下载边写入临时文件、只解压需要的成员）的峰值内存
+
+本地启动一个 HTTP 服务提供合成的结果 ZIP（一个 Markdown + 若干张不可压缩的“页面图片”），
+每种实现在独立的子进程中运行，互不影响，统计：
+- tracemalloc 峰值：Python 对象分配的峰值（下载内容、BytesIO 等）
+- 峰值 RSS 增量：子进程最大常驻内存相对于开始处理前的增量（Linux / macOS）
+
+用法：
+    python benchmarks/bench_zip_memory.py
+    python benchmarks/bench_zip_memory.py --images 120 --image-kb 500 --repeat 3
+    python benchmarks/bench_zip_memory.py --output benchmarks/results/zip-memory.json
+"""
+import argparse
+import io
+import json
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT_DIR = BENCH_DIR.parent
+
+VARIANTS = ('legacy', 'streamed', 'streamed+images')
+
+
+def build_zip(path: Path, images: int, image_kb: int, markdown_kb: int, seed: int = 42):
+    """生成与 MinerU 结果结构相同的 ZIP：<id>/full.md、<id>/images/*.jpg、<id>/layout.json"""
+    rng = random.Random(seed)
+    paragraph = '本文提出了一种用于长文档理解的分层检索方法，并在多个基准上验证了其有效性。' * 4
+    lines = []
+    while sum(len(line) for line in lines) < markdown_kb * 1024 // 3:
+        lines.append(f"## 第 {len(lines) + 1} 节\n\n{paragraph}\n\n![](images/page_{len(lines) % max(images, 1)}.jpg)\n")
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('result/full.md', '\n'.join(lines), compress_type=zipfile.ZIP_DEFLATED)
+        archive.writestr('result/layout.json', json.dumps({'pages': images}), compress_type=zipfile.ZIP_DEFLATED)
+        for index in range(images):
+            # 随机字节不可压缩，与 JPEG 的实际情况一致
+            archive.writestr(f'result/images/page_{index}.jpg', rng.randbytes(image_kb * 1024))
+
+
+def serve_file(path: Path):
+    """在随机端口上提供文件下载，返回 (server, url)"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            size = path.stat().st_size
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/zip')
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            with open(path, 'rb') as f:
+                while True:
+                    chunk = f.read(64 * 1024)
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/full.zip"
+
+
+def _legacy_extract(url: str) -> str:
+    """旧实现：response.content 读入整个 ZIP，BytesIO 解压 Markdown"""
+    import requests
+    response = requests.get(url, timeout=60)
+    response.raise_for_status()
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zip_file:
+        markdown_file = [f for f in zip_file.namelist() if f.endswith(('.md', '.markdown'))][0]
+        with zip_file.open(markdown_file) as md_file:
+            return md_file.read().decode('utf-8')
+
+
+def _max_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为 KB，macOS 为字节
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def run_child(variant: str, url: str, repeat: int) -> dict:
+    """子进程：执行一种实现并输出内存统计"""
+    sys.path.insert(0, str(ROOT_DIR))
+    import requests  # noqa: F401  预先导入，避免导入开销计入 RSS 增量
+    from pdf_converter import PDFConverter
+    converter = PDFConverter(api_token='bench')
+
+    baseline_rss = _max_rss_mb()
+    tracemalloc.start()
+    durations = []
+    chars = 0
+    with tempfile.TemporaryDirectory() as scratch:
+        for index in range(repeat):
+            started = time.perf_counter()
+            if variant == 'legacy':
+                content = _legacy_extract(url)
+            elif variant == 'streamed':
+                content = converter._download_and_extract_markdown(url)
+            else:
+                target = Path(scratch) / str(index)
+                target.mkdir()
+                content = converter._download_and_extract_markdown(url, target)
+            durations.append(time.perf_counter() - started)
+            chars = len(content or '')
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'variant': variant,
+        'markdown_chars': chars,
+        'tracemalloc_peak_mb': round(peak / (1024 * 1024), 2),
+        'rss_increase_mb': round(max(0.0, _max_rss_mb() - baseline_rss), 2),
+        'seconds_avg': round(sum(durations) / len(durations), 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MinerU 结果 ZIP 处理的内存基准')
+    parser.add_argument('--images', type=int, default=60, help='ZIP 中的图片数量')
+    parser.add_argument('--image-kb', type=int, default=400, help='每张图片的大小（KB）')
+    parser.add_argument('--markdown-kb', type=int, default=300, help='Markdown 的大致大小（KB）')
+    parser.add_argument('--repeat', type=int, default=3, help='每种实现重复处理的次数')
+    parser.add_argument('--variants', default=','.join(VARIANTS), help='要运行的实现，逗号分隔')
+    parser.add_argument('--output', help='结果 JSON 路径（不指定时只打印）')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(args.child, args.url, args.repeat)))
+        return 0
+
+    with tempfile.TemporaryDirectory() as workdir:
+        zip_path = Path(workdir) / 'full.zip'
+        build_zip(zip_path, args.images, args.image_kb, args.markdown_kb)
+        zip_mb = zip_path.stat().st_size / (1024 * 1024)
+        server, url = serve_file(zip_path)
+        print(f"📦 合成结果 ZIP: {zip_mb:.1f} MB（{args.images} 张图片 × {args.image_kb} KB）")
+
+        results = []
+        try:
+            for variant in args.variants.split(','):
+                output = subprocess.run(
+                    [sys.executable, __file__, '--child', variant, '--url', url, '--repeat', str(args.repeat)],
+                    capture_output=True, text=True, cwd=str(ROOT_DIR), check=True,
+                ).stdout.strip().splitlines()[-1]
+                results.append(json.loads(output))
+        finally:
+            server.shutdown()
+
+    print(f"\n{'实现':<18}{'tracemalloc 峰值':>18}{'RSS 增量':>12}{'平均耗时':>12}")
+    for result in results:
+        print(f"{result['variant']:<18}{result['tracemalloc_peak_mb']:>15.2f} MB"
+              f"{result['rss_increase_mb']:>9.2f} MB{result['seconds_avg'] * 1000:>9.1f} ms")
+
+    if args.output:
+        output_path = Path(args.output)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'zip_mb': round(zip_mb, 2),
+                'params': {k: v for k, v in vars(args).items() if k not in ('child', 'url', 'output')},
+                'results': results,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 结果已保存: {output_path}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
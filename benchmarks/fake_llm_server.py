@@ -0,0 +1,487 @@
+"""
+模拟 LLM 服务（OpenAI 兼容接口）
+用于在没有真实 API Key、没有网络的环境下对智能体编排器做可复现的压测和基准测试
+
+- POST /v1/chat/completions：支持流式（SSE）和非流式，返回 usage（流式需 stream_options.include_usage）
+- GET  /v1/models：模型列表
+- GET  /_fake/stats：请求数、注入的错误、并发峰值、token 合计等统计
+- POST /_fake/config：运行时修改参数（JSON，字段同 DEFAULT_CONFIG）
+- POST /_fake/reset：清空统计和确定性计数
+
+可配置首 token 耗时、输出速度、错误注入（请求失败 / 输出中途断开 / 首 token 卡顿），
+以及按规则返回的脚本化回复（中控智能体的路由 JSON、导读智能体的 {"route": "content_question"} 标记、思维导图大纲）。
+相同的请求序列在相同的 seed 下得到相同的回复、延迟和错误。
+
+用法：
+    python benchmarks/fake_llm_server.py --port 8001 --ttft 0.5 --tps 80 --error-rate 0.05
+
+    # 让应用使用模拟服务
+    API_CONFIG_PATH=benchmarks/api_config.fake.json python app.py
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_CONFIG = {
+    'seed': 42,
+    'ttft': 0.3,  # 首 token 耗时（秒）
+    'ttft_jitter': 0.2,  # 首 token 耗时的随机浮动比例（±）
+    'tokens_per_second': 80,  # 输出速度
+    'chunk_tokens': 4,  # 每个流式片段包含的 token 数
+    'chars_per_token': 2.0,  # 与 RATE_LIMIT_CONFIG 的估算口径一致
+    'completion_tokens': 300,  # 默认回复长度（不超过请求的 max_tokens）
+    'error_rate': 0.0,  # 请求直接失败的比例
+    'error_status': 500,  # 失败时返回的状态码（429 会附带 Retry-After）
+    'retry_after': 1,
+    'midstream_error_rate': 0.0,  # 流式输出中途断开连接的比例
+    'stall_rate': 0.0,  # 首 token 卡顿的比例（用于验证对冲请求）
+    'stall_seconds': 10.0,
+    'script': None,  # 脚本规则（None 时使用 DEFAULT_RULES）
+}
+
+# 路由关键词 -> 中控智能体返回的 agent_name
+ROUTE_KEYWORDS = [
+    ('引言', 'introduction_agent'),
+    ('综述', 'review_agent'),
+    ('文献', 'review_agent'),
+    ('方法', 'method_agent'),
+    ('样本', 'method_agent'),
+    ('结果', 'result_agent'),
+    ('数据', 'result_agent'),
+    ('讨论', 'discussion_agent'),
+    ('局限', 'discussion_agent'),
+    ('概念', 'concept_agent'),
+    ('什么是', 'concept_agent'),
+]
+
+MINDMAP_OUTLINE = """# 论文标题
+## 研究背景
+### 研究问题
+### 研究意义
+## 研究方法
+### 研究对象
+### 数据收集
+### 分析方法
+## 研究结果
+### 主要发现
+## 讨论与结论
+### 理论贡献
+### 研究局限"""
+
+# 默认脚本：按顺序匹配，第一条命中的规则生效
+# match 支持 system_contains / user_contains（字符串或列表，列表表示任一命中）/ model
+# response 中的 {user} 会替换为用户问题；未给出 response 时生成默认长度的回复
+DEFAULT_RULES = [
+    *[
+        {
+            'match': {'system_contains': '中控智能体', 'user_contains': keyword},
+            'response': json.dumps({'agent_name': agent_name}),
+        }
+        for keyword, agent_name in ROUTE_KEYWORDS
+    ],
+    {'match': {'system_contains': '中控智能体'}, 'response': json.dumps({'agent_name': 'general_agent'})},
+    {
+        'match': {'system_contains': '文献导读智能体', 'user_contains': ['？', '?']},
+        'response': '{"route": "content_question", "user_question": "{user}"}',
+    },
+    {'match': {'user_contains': '思维导图'}, 'response': MINDMAP_OUTLINE},
+]
+
+# 默认回复的语料（按请求哈希选取起点，保证确定性）
+CORPUS = [
+    "这篇论文围绕研究问题展开，首先回顾了相关领域的已有研究。",
+    "作者采用准实验设计，对两组样本进行了前后测对比。",
+    "结果显示实验组在主要指标上显著优于对照组。",
+    "需要注意的是，样本量较小，结论的外部效度有限。",
+    "你可以先关注作者如何界定核心概念，再看测量工具是否与之对应。",
+    "讨论部分将研究发现与已有理论联系起来，并提出了实践建议。",
+    "建议对照原文第三节，检查数据分析方法是否与研究假设匹配。",
+    "从研究设计的角度看，控制变量的选择直接影响因果推断的可信度。",
+]
+
+
+class FakeLLMState:
+    """模拟服务的配置、确定性计数和统计（线程安全）"""
+
+    def __init__(self, config: Optional[Dict] = None):
+        self.config = dict(DEFAULT_CONFIG)
+        self.config.update(config or {})
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._occurrences = {}
+            self.stats = {
+                'requests': 0,
+                'streams': 0,
+                'errors_injected': 0,
+                'midstream_aborts': 0,
+                'stalls': 0,
+                'client_disconnects': 0,
+                'active': 0,
+                'max_active': 0,
+                'prompt_tokens': 0,
+                'completion_tokens': 0,
+            }
+
+    def update(self, changes: Dict):
+        with self._lock:
+            for key, value in changes.items():
+                if key in DEFAULT_CONFIG:
+                    self.config[key] = value
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {'config': dict(self.config), 'stats': dict(self.stats)}
+
+    def count(self, key: str, value: int = 1):
+        with self._lock:
+            self.stats[key] += value
+
+    def enter(self):
+        with self._lock:
+            self.stats['active'] += 1
+            self.stats['max_active'] = max(self.stats['max_active'], self.stats['active'])
+
+    def leave(self):
+        with self._lock:
+            self.stats['active'] -= 1
+
+    def rng_for(self, request_key: str) -> random.Random:
+        """同一请求第 N 次出现时使用固定的随机序列（重试得到不同的结果，整体仍可复现）"""
+        with self._lock:
+            occurrence = self._occurrences.get(request_key, 0)
+            self._occurrences[request_key] = occurrence + 1
+            seed = self.config['seed']
+        return random.Random(f"{seed}:{request_key}:{occurrence}")
+
+
+def split_prompt(messages: List[Dict]) -> Tuple[str, str]:
+    """
+    拆出系统提示词和用户问题
+
+    Gemini 格式的请求没有 system 消息，系统提示词拼接在最后一条用户消息的“用户问题：”之前
+    """
+    system = "\n".join(m.get('content') or '' for m in messages if m.get('role') == 'system')
+    user = next((m.get('content') or '' for m in reversed(messages) if m.get('role') == 'user'), '')
+    if not system and '用户问题：' in user:
+        system, user = user.rsplit('用户问题：', 1)
+    return system, user
+
+
+def match_rule(rules: List[Dict], model: str, system: str, user: str) -> Optional[Dict]:
+    """返回第一条命中的脚本规则"""
+    def contains(text, needles):
+        if isinstance(needles, str):
+            needles = [needles]
+        return any(needle in text for needle in needles)
+
+    for rule in rules:
+        match = rule.get('match', {})
+        if 'model' in match and match['model'] != model:
+            continue
+        if 'system_contains' in match and not contains(system, match['system_contains']):
+            continue
+        if 'user_contains' in match and not contains(user, match['user_contains']):
+            continue
+        return rule
+    return None
+
+
+def tokenize(text: str, chars_per_token: float) -> List[str]:
+    """按固定字符数切分为“token”（与限流器的估算口径一致）"""
+    size = max(1, int(round(chars_per_token)))
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    """OpenAI 兼容接口的请求处理"""
+
+    protocol_version = 'HTTP/1.1'
+    state: FakeLLMState = None  # 由 FakeLLMServer 注入
+
+    def log_message(self, format, *args):
+        pass  # 压测时不逐条打印访问日志
+
+    # ========== 路由 ==========
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self._send_json(200, {'object': 'list', 'data': [{'id': 'fake-model', 'object': 'model'}]})
+        elif self.path.startswith('/_fake/stats'):
+            self._send_json(200, self.state.snapshot())
+        else:
+            self._send_json(404, {'error': {'message': 'not found'}})
+
+    def do_POST(self):
+        try:
+            body = self._read_json()
+        except ValueError:
+            self._send_json(400, {'error': {'message': 'invalid json', 'type': 'invalid_request_error'}})
+            return
+
+        if self.path.startswith('/_fake/config'):
+            self.state.update(body)
+            self._send_json(200, self.state.snapshot())
+        elif self.path.startswith('/_fake/reset'):
+            self.state.reset()
+            self._send_json(200, self.state.snapshot())
+        elif self.path.rstrip('/').endswith('/chat/completions'):
+            self.state.enter()
+            try:
+                self._chat_completions(body)
+            finally:
+                self.state.leave()
+        else:
+            self._send_json(404, {'error': {'message': 'not found'}})
+
+    # ========== 补全 ==========
+
+    def _chat_completions(self, body: Dict):
+        config = self.state.snapshot()['config']
+        messages = body.get('messages') or []
+        model = body.get('model', 'fake-model')
+        stream = bool(body.get('stream'))
+        include_usage = bool((body.get('stream_options') or {}).get('include_usage'))
+
+        request_key = hashlib.sha1(
+            json.dumps([model, messages], ensure_ascii=False, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+        rng = self.state.rng_for(request_key)
+        self.state.count('requests')
+
+        # 请求直接失败
+        if rng.random() < config['error_rate']:
+            self.state.count('errors_injected')
+            status = int(config['error_status'])
+            headers = {'Retry-After': str(config['retry_after'])} if status == 429 else {}
+            self._send_json(status, {'error': {'message': f'injected error {status}', 'type': 'server_error'}}, headers)
+            return
+
+        system, user = split_prompt(messages)
+        rule = match_rule(config['script'] or DEFAULT_RULES, model, system, user) or {}
+        text = rule.get('response')
+        if text is None:
+            text = self._generate_text(request_key, config)
+        else:
+            # {user} 可能位于 JSON 字符串中，按 JSON 转义
+            text = text.replace('{user}', json.dumps(user.strip(), ensure_ascii=False)[1:-1])
+
+        chars_per_token = config['chars_per_token']
+        tokens = tokenize(text, chars_per_token)
+        finish_reason = 'stop'
+        max_tokens = body.get('max_tokens')
+        if max_tokens and len(tokens) > max_tokens:
+            tokens = tokens[:max_tokens]
+            finish_reason = 'length'
+        prompt_tokens = int(sum(len(m.get('content') or '') for m in messages) / chars_per_token)
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': len(tokens),
+            'total_tokens': prompt_tokens + len(tokens),
+        }
+
+        ttft = rule.get('ttft', config['ttft'])
+        ttft *= 1 + config['ttft_jitter'] * (2 * rng.random() - 1)
+        if rng.random() < config['stall_rate']:
+            self.state.count('stalls')
+            ttft = config['stall_seconds']
+        tokens_per_second = rule.get('tokens_per_second', config['tokens_per_second'])
+        abort_at = None
+        if stream and rng.random() < config['midstream_error_rate']:
+            abort_at = rng.randint(1, max(1, len(tokens) - 1))
+
+        completion_id = f"chatcmpl-fake-{request_key[:12]}"
+        created = int(time.time())
+        if not stream:
+            time.sleep(ttft + len(tokens) / tokens_per_second)
+            self.state.count('prompt_tokens', prompt_tokens)
+            self.state.count('completion_tokens', len(tokens))
+            self._send_json(200, {
+                'id': completion_id,
+                'object': 'chat.completion',
+                'created': created,
+                'model': model,
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': ''.join(tokens)},
+                    'finish_reason': finish_reason,
+                }],
+                'usage': usage,
+            })
+            return
+
+        self.state.count('streams')
+        self.state.count('prompt_tokens', prompt_tokens)
+        self._stream(completion_id, created, model, tokens, ttft, tokens_per_second,
+                     config['chunk_tokens'], finish_reason, usage if include_usage else None, abort_at)
+
+    def _stream(self, completion_id, created, model, tokens, ttft, tokens_per_second,
+                chunk_tokens, finish_reason, usage, abort_at):
+        """SSE 流式输出（分块传输编码：中途断开时客户端会收到不完整响应错误）"""
+        def event(choices, usage=None):
+            payload = {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': created,
+                'model': model,
+                'choices': choices,
+            }
+            if usage is not None:
+                payload['usage'] = usage
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        sent = 0
+        try:
+            time.sleep(ttft)
+            self._write_chunk(event([{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}]))
+            for start in range(0, len(tokens), chunk_tokens):
+                if abort_at is not None and start >= abort_at:
+                    # 模拟上游连接中途断开：不发送结束块直接关闭
+                    self.state.count('midstream_aborts')
+                    self.close_connection = True
+                    return
+                if start:
+                    time.sleep(chunk_tokens / tokens_per_second)
+                piece = tokens[start:start + chunk_tokens]
+                self._write_chunk(event([{'index': 0, 'delta': {'content': ''.join(piece)}, 'finish_reason': None}]))
+                sent += len(piece)
+            self._write_chunk(event([{'index': 0, 'delta': {}, 'finish_reason': finish_reason}]))
+            if usage is not None:
+                self._write_chunk(event([], usage))
+            self._write_chunk("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端取消（停止生成、对冲输家）
+            self.state.count('client_disconnects')
+            self.close_connection = True
+        finally:
+            self.state.count('completion_tokens', sent)
+
+    # ========== 工具方法 ==========
+
+    def _generate_text(self, request_key: str, config: Dict) -> str:
+        """按请求哈希从语料中确定性地拼出默认长度的回复"""
+        target_chars = int(config['completion_tokens'] * config['chars_per_token'])
+        index = int(request_key[:8], 16) % len(CORPUS)
+        parts, length = [], 0
+        while length < target_chars:
+            sentence = CORPUS[index % len(CORPUS)]
+            parts.append(sentence)
+            length += len(sentence)
+            index += 1
+        return ''.join(parts)[:target_chars]
+
+    def _read_json(self) -> Dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        return json.loads(raw.decode('utf-8')) if raw else {}
+
+    def _send_json(self, status: int, payload: Dict, headers: Optional[Dict] = None):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _write_chunk(self, text: str):
+        data = text.encode('utf-8')
+        self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+
+class FakeLLMServer:
+    """可在进程内启动的模拟服务（基准测试脚本使用）"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, config: Optional[Dict] = None):
+        self.state = FakeLLMState(config)
+        handler = type('BoundFakeLLMHandler', (FakeLLMHandler,), {'state': self.state})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> 'FakeLLMServer':
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='模拟 LLM 服务（OpenAI 兼容接口）')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--seed', type=int, default=DEFAULT_CONFIG['seed'])
+    parser.add_argument('--ttft', type=float, default=DEFAULT_CONFIG['ttft'], help='首 token 耗时（秒）')
+    parser.add_argument('--ttft-jitter', type=float, default=DEFAULT_CONFIG['ttft_jitter'])
+    parser.add_argument('--tps', type=float, default=DEFAULT_CONFIG['tokens_per_second'], help='每秒输出 token 数')
+    parser.add_argument('--chunk-tokens', type=int, default=DEFAULT_CONFIG['chunk_tokens'])
+    parser.add_argument('--completion-tokens', type=int, default=DEFAULT_CONFIG['completion_tokens'])
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=DEFAULT_CONFIG['error_status'])
+    parser.add_argument('--midstream-error-rate', type=float, default=0.0)
+    parser.add_argument('--stall-rate', type=float, default=0.0)
+    parser.add_argument('--stall-seconds', type=float, default=DEFAULT_CONFIG['stall_seconds'])
+    parser.add_argument('--script', help='脚本规则 JSON 文件（规则列表，格式同 DEFAULT_RULES）')
+    args = parser.parse_args()
+
+    config = {
+        'seed': args.seed,
+        'ttft': args.ttft,
+        'ttft_jitter': args.ttft_jitter,
+        'tokens_per_second': args.tps,
+        'chunk_tokens': args.chunk_tokens,
+        'completion_tokens': args.completion_tokens,
+        'error_rate': args.error_rate,
+        'error_status': args.error_status,
+        'midstream_error_rate': args.midstream_error_rate,
+        'stall_rate': args.stall_rate,
+        'stall_seconds': args.stall_seconds,
+    }
+    if args.script:
+        with open(args.script, 'r', encoding='utf-8') as f:
+            config['script'] = json.load(f)
+
+    server = FakeLLMServer(args.host, args.port, config)
+    print(f"🧪 模拟 LLM 服务已启动: {server.base_url}")
+    print(f"   首 token {args.ttft}s，{args.tps} token/s，错误率 {args.error_rate}，中途断开 {args.midstream_error_rate}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
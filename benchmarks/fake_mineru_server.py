@@ -0,0 +1,524 @@
+"""
+模拟 MinerU 服务
+用于在没有 MinerU Token、没有网络的环境下对 PDF 转换流程（上传 → 创建任务 → 轮询 → 下载结果 ZIP）做可复现的压测
+
+- POST /api/v4/extract/task：创建解析任务（请求体 {"url", "is_ocr", "enable_formula"}，返回 data.task_id）
+- GET  /api/v4/extract/task/<task_id>：任务状态，依次经过 pending（排队）→ running（extract_progress 逐页推进）
+  → done（full_zip_url）或 failed（err_msg）
+- GET  /_fake/results/<task_id>.zip：结果 ZIP（<task_id>/full.md、images/*.jpg、layout.json，与 MinerU 结构相同）
+- POST /_fake/upload：catbox 兼容的临时文件上传（表单字段 fileToUpload），响应正文为文件 URL
+- GET / HEAD /_fake/files/<file_id>/<文件名>：下载上传的文件（带 ETag，Markdown 存储可按 ETag 复用结果）
+- GET  /_fake/stats：任务数、各接口请求数、注入的错误、同时进行的任务峰值等统计
+- POST /_fake/config：运行时修改参数（JSON，字段同 DEFAULT_CONFIG）
+- POST /_fake/reset：清空任务、上传的文件和统计
+
+任务状态由创建后经过的时间决定（不需要后台线程）：排队 queue_seconds 秒，之后按 pages_per_second 逐页解析。
+页数从 PDF 内容中统计（读取任务 URL 指向的文件，上传到本服务的文件直接从内存读取），读取失败时任务失败。
+相同的任务序列在相同的 seed 下得到相同的排队时长和错误。
+
+用法：
+    python benchmarks/fake_mineru_server.py --port 8002 --queue-seconds 2 --pages-per-second 5 --fail-rate 0.05
+
+    # 让应用使用模拟服务（benchmarks/api_config.fake.json 中的 pdf_converter 指向 127.0.0.1:8002）
+    API_CONFIG_PATH=benchmarks/api_config.fake.json python app.py
+"""
+import argparse
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+import zipfile
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+DEFAULT_CONFIG = {
+    'seed': 42,
+    'queue_seconds': 1.0,  # 排队时长（秒）
+    'queue_jitter': 0.5,  # 排队时长的随机浮动比例（±）
+    'pages_per_second': 10.0,  # 解析速度
+    'default_pages': 12,  # 无法从 PDF 中统计页数时使用
+    'markdown_chars_per_page': 2000,  # 结果 Markdown 每页的字符数
+    'images_per_page': 0,  # 结果 ZIP 中每页的图片数
+    'image_kb': 50,
+    'fetch_source': True,  # 创建任务时读取 PDF（统计页数，读取失败时任务失败）
+    'require_token': True,  # 缺少 Authorization: Bearer 时返回 401
+    'create_error_rate': 0.0,  # 创建任务直接返回 500 的比例
+    'status_error_rate': 0.0,  # 查询状态返回 500 的比例
+    'download_error_rate': 0.0,  # 下载结果 ZIP 返回 500 的比例
+    'upload_error_rate': 0.0,  # 上传文件返回 500 的比例
+    'fail_rate': 0.0,  # 任务在解析过程中失败的比例
+    'stuck_rate': 0.0,  # 任务一直停在最后一页、永不结束的比例（验证等待超时）
+}
+
+TASK_PATH = re.compile(r'^/api/v4/extract/task/?$')
+TASK_STATUS_PATH = re.compile(r'^/api/v4/extract/task/([\w-]+)$')
+RESULT_PATH = re.compile(r'^/_fake/results/([\w-]+)\.zip$')
+FILE_PATH = re.compile(r'^/_fake/files/([\w-]+)/[^/]+$')
+PAGE_OBJECT = re.compile(rb'/Type\s*/Page(?![a-zA-Z])')
+
+PARAGRAPH = ('This section describes the proposed method and its evaluation on several long document benchmarks. '
+             'The results show consistent improvements over strong baselines across all settings. ')
+
+
+def count_pdf_pages(data: bytes) -> int:
+    """粗略统计 PDF 页数（页面对象个数，不解析交叉引用表和对象流）"""
+    return len(PAGE_OBJECT.findall(data))
+
+
+class FakeTask:
+    """一个解析任务：各阶段的时间点在创建时确定"""
+
+    def __init__(self, task_id: str, url: str, pages: int, created: float, queue_seconds: float,
+                 pages_per_second: float, outcome: str, error: Optional[str] = None):
+        self.task_id = task_id
+        self.url = url
+        self.pages = max(1, pages)
+        self.created = created
+        self.running_at = created + queue_seconds
+        self.seconds_per_page = 1.0 / max(pages_per_second, 0.001)
+        self.finished_at = self.running_at + self.pages * self.seconds_per_page
+        self.outcome = outcome  # done / failed / stuck
+        self.error = error
+        self.polls = 0
+        self.zip_data = None
+        if outcome == 'failed':
+            if error is None:
+                # 解析到中途失败
+                self.error = 'failed to parse pdf'
+                self.finished_at = self.running_at + self.pages * self.seconds_per_page / 2
+            else:
+                # 读取文件失败：第一次查询就返回 failed
+                self.finished_at = created
+
+    def status(self, now: float) -> Dict:
+        """按当前时间计算的任务状态（MinerU /task/<id> 响应中的 data）"""
+        data = {'task_id': self.task_id, 'err_msg': ''}
+        if self.finished_at_or_never() <= now:
+            if self.outcome == 'failed':
+                data.update(state='failed', err_msg=self.error)
+            else:
+                data.update(state='done', full_zip_url=None)  # 由处理请求的 handler 填入完整地址
+            return data
+        if now < self.running_at:
+            data['state'] = 'pending'
+            return data
+        extracted = int((now - self.running_at) / self.seconds_per_page)
+        data['state'] = 'running'
+        data['extract_progress'] = {
+            'extracted_pages': min(max(extracted, 0), self.pages - 1),
+            'total_pages': self.pages,
+            'start_time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        return data
+
+    def finished_at_or_never(self) -> float:
+        return float('inf') if self.outcome == 'stuck' else self.finished_at
+
+    @property
+    def finished(self) -> bool:
+        return time.monotonic() >= self.finished_at_or_never()
+
+
+class FakeMinerUState:
+    """模拟服务的配置、任务、上传的文件和统计（线程安全）"""
+
+    def __init__(self, config: Optional[Dict] = None):
+        self.config = dict(DEFAULT_CONFIG)
+        self.config.update(config or {})
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._occurrences = {}
+            self.tasks = {}
+            self.files = {}
+            self.stats = {
+                'uploads': 0,
+                'upload_bytes': 0,
+                'tasks_created': 0,
+                'status_requests': 0,
+                'downloads': 0,
+                'download_bytes': 0,
+                'source_fetch_errors': 0,
+                'errors_injected': 0,
+                'unauthorized': 0,
+                'max_active_tasks': 0,
+            }
+
+    def update(self, changes: Dict):
+        with self._lock:
+            for key, value in changes.items():
+                if key in DEFAULT_CONFIG:
+                    self.config[key] = value
+
+    def snapshot(self) -> Dict:
+        now = time.monotonic()
+        with self._lock:
+            stats = dict(self.stats)
+            states = {}
+            for task in self.tasks.values():
+                state = task.status(now)['state']
+                states[state] = states.get(state, 0) + 1
+            stats['tasks_by_state'] = states
+            polls = [task.polls for task in self.tasks.values() if task.finished]
+            stats['polls_per_finished_task'] = round(sum(polls) / len(polls), 2) if polls else None
+            return {'config': dict(self.config), 'stats': stats}
+
+    def count(self, key: str, value: int = 1):
+        with self._lock:
+            self.stats[key] += value
+
+    def rng_for(self, request_key: str) -> random.Random:
+        """同一请求第 N 次出现时使用固定的随机序列（重试得到不同的结果，整体仍可复现）"""
+        with self._lock:
+            occurrence = self._occurrences.get(request_key, 0)
+            self._occurrences[request_key] = occurrence + 1
+            seed = self.config['seed']
+        return random.Random(f"{seed}:{request_key}:{occurrence}")
+
+    def add_task(self, task: FakeTask):
+        now = time.monotonic()
+        with self._lock:
+            self.tasks[task.task_id] = task
+            self.stats['tasks_created'] += 1
+            active = sum(1 for t in self.tasks.values() if now < t.finished_at_or_never())
+            self.stats['max_active_tasks'] = max(self.stats['max_active_tasks'], active)
+
+    def get_task(self, task_id: str) -> Optional[FakeTask]:
+        with self._lock:
+            return self.tasks.get(task_id)
+
+    def add_file(self, data: bytes) -> str:
+        file_id = uuid.uuid4().hex
+        with self._lock:
+            self.files[file_id] = data
+            self.stats['uploads'] += 1
+            self.stats['upload_bytes'] += len(data)
+        return file_id
+
+    def get_file(self, file_id: str) -> Optional[bytes]:
+        with self._lock:
+            return self.files.get(file_id)
+
+
+def build_result_zip(task: FakeTask, config: Dict) -> bytes:
+    """生成与 MinerU 结构相同的结果 ZIP（内容由任务 ID 决定）"""
+    rng = random.Random(task.task_id)
+    images = config['images_per_page']
+    chars = config['markdown_chars_per_page']
+    paragraph = (PARAGRAPH * (chars // len(PARAGRAPH) + 1))[:chars]
+    sections = [f"# Fake MinerU Result {task.task_id}\n"]
+    for page in range(1, task.pages + 1):
+        sections.append(f"## Page {page}\n\n{paragraph}\n")
+        sections.extend(f"![](images/page_{page}_{index}.jpg)\n" for index in range(images))
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr(f'{task.task_id}/full.md', '\n'.join(sections), compress_type=zipfile.ZIP_DEFLATED)
+        archive.writestr(f'{task.task_id}/layout.json', json.dumps({'pages': task.pages}),
+                         compress_type=zipfile.ZIP_DEFLATED)
+        for page in range(1, task.pages + 1):
+            for index in range(images):
+                # 随机字节不可压缩，与 JPEG 的实际情况一致
+                archive.writestr(f'{task.task_id}/images/page_{page}_{index}.jpg',
+                                 rng.randbytes(config['image_kb'] * 1024))
+    return buffer.getvalue()
+
+
+class FakeMinerUHandler(BaseHTTPRequestHandler):
+    """MinerU 接口和临时文件服务的请求处理"""
+
+    protocol_version = 'HTTP/1.1'
+    state: FakeMinerUState = None  # 由 FakeMinerUServer 注入
+
+    def log_message(self, format, *args):
+        pass  # 压测时不逐条打印访问日志
+
+    # ========== 路由 ==========
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if TASK_STATUS_PATH.match(path):
+            self._task_status(TASK_STATUS_PATH.match(path).group(1))
+        elif RESULT_PATH.match(path):
+            self._download_result(RESULT_PATH.match(path).group(1))
+        elif FILE_PATH.match(path):
+            self._serve_file(FILE_PATH.match(path).group(1))
+        elif path.startswith('/_fake/stats'):
+            self._send_json(200, self.state.snapshot())
+        else:
+            self._send_json(404, {'code': -1, 'msg': 'not found'})
+
+    def do_HEAD(self):
+        path = self.path.split('?', 1)[0]
+        if FILE_PATH.match(path):
+            self._serve_file(FILE_PATH.match(path).group(1), head=True)
+        else:
+            self._send_bytes(404, b'', 'text/plain', head=True)
+
+    def do_POST(self):
+        path = self.path.split('?', 1)[0]
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+
+        if path.startswith('/_fake/upload'):
+            self._upload(raw)
+            return
+        try:
+            body = json.loads(raw.decode('utf-8')) if raw else {}
+        except ValueError:
+            self._send_json(400, {'code': -1, 'msg': 'invalid json'})
+            return
+
+        if path.startswith('/_fake/config'):
+            self.state.update(body)
+            self._send_json(200, self.state.snapshot())
+        elif path.startswith('/_fake/reset'):
+            self.state.reset()
+            self._send_json(200, self.state.snapshot())
+        elif TASK_PATH.match(path):
+            self._create_task(body)
+        else:
+            self._send_json(404, {'code': -1, 'msg': 'not found'})
+
+    # ========== MinerU 接口 ==========
+
+    def _create_task(self, body: Dict):
+        if not self._authorized():
+            return
+        url = body.get('url')
+        if not url:
+            self._send_json(400, {'code': -1, 'msg': 'url is required'})
+            return
+        rng = self.state.rng_for(f"create:{url}")
+        config = dict(self.state.config)
+        if rng.random() < config['create_error_rate']:
+            self.state.count('errors_injected')
+            self._send_json(500, {'code': -500, 'msg': 'internal error (injected)'})
+            return
+
+        pages, error = config['default_pages'], None
+        if config['fetch_source']:
+            try:
+                pages = count_pdf_pages(self._fetch_source(url)) or config['default_pages']
+            except Exception as e:
+                self.state.count('source_fetch_errors')
+                error = f'failed to read file: {e}'
+
+        roll = rng.random()
+        if error:
+            outcome = 'failed'
+        elif roll < config['fail_rate']:
+            outcome = 'failed'
+        elif roll < config['fail_rate'] + config['stuck_rate']:
+            outcome = 'stuck'
+        else:
+            outcome = 'done'
+        queue_seconds = config['queue_seconds'] * (1 + rng.uniform(-1, 1) * config['queue_jitter'])
+        task = FakeTask(uuid.uuid4().hex, url, pages, time.monotonic(), max(queue_seconds, 0.0),
+                        config['pages_per_second'], outcome, error)
+        self.state.add_task(task)
+        self._send_json(200, {'code': 0, 'msg': 'ok', 'trace_id': uuid.uuid4().hex,
+                              'data': {'task_id': task.task_id}})
+
+    def _task_status(self, task_id: str):
+        if not self._authorized():
+            return
+        self.state.count('status_requests')
+        task = self.state.get_task(task_id)
+        if task is None:
+            self._send_json(404, {'code': -60012, 'msg': 'task not found'})
+            return
+        task.polls += 1
+        if self.state.rng_for(f"status:{task_id}").random() < self.state.config['status_error_rate']:
+            self.state.count('errors_injected')
+            self._send_json(500, {'code': -500, 'msg': 'internal error (injected)'})
+            return
+        data = task.status(time.monotonic())
+        if data['state'] == 'done':
+            data['full_zip_url'] = f"{self._origin()}/_fake/results/{task_id}.zip"
+        self._send_json(200, {'code': 0, 'msg': 'ok', 'trace_id': uuid.uuid4().hex, 'data': data})
+
+    def _download_result(self, task_id: str):
+        task = self.state.get_task(task_id)
+        if task is None or task.status(time.monotonic())['state'] != 'done':
+            self._send_bytes(404, b'not found', 'text/plain')
+            return
+        if self.state.rng_for(f"download:{task_id}").random() < self.state.config['download_error_rate']:
+            self.state.count('errors_injected')
+            self._send_bytes(500, b'internal error (injected)', 'text/plain')
+            return
+        if task.zip_data is None:
+            task.zip_data = build_result_zip(task, self.state.config)
+        self.state.count('downloads')
+        self.state.count('download_bytes', len(task.zip_data))
+        self._send_bytes(200, task.zip_data, 'application/zip')
+
+    def _fetch_source(self, url: str) -> bytes:
+        """读取任务的 PDF（上传到本服务的文件直接从内存读取）"""
+        match = FILE_PATH.match(urllib.parse.urlsplit(url).path)
+        if match:
+            data = self.state.get_file(match.group(1))
+            if data is not None:
+                return data
+        with urllib.request.urlopen(url, timeout=30) as response:
+            return response.read()
+
+    # ========== 临时文件服务 ==========
+
+    def _upload(self, raw: bytes):
+        if self.state.rng_for('upload').random() < self.state.config['upload_error_rate']:
+            self.state.count('errors_injected')
+            self._send_bytes(500, b'internal error (injected)', 'text/plain')
+            return
+        content_type = self.headers.get('Content-Type', '')
+        message = BytesParser(policy=policy.default).parsebytes(
+            f'Content-Type: {content_type}\r\n\r\n'.encode('latin-1') + raw)
+        upload = None
+        if message.is_multipart():
+            for part in message.iter_parts():
+                if part.get_param('name', header='content-disposition') == 'fileToUpload':
+                    upload = part
+                    break
+        if upload is None:
+            self._send_bytes(400, b'fileToUpload is required', 'text/plain')
+            return
+        filename = re.sub(r'[^\w.-]', '_', upload.get_filename() or 'upload.pdf')
+        file_id = self.state.add_file(upload.get_payload(decode=True) or b'')
+        self._send_bytes(200, f"{self._origin()}/_fake/files/{file_id}/{filename}".encode('utf-8'), 'text/plain')
+
+    def _serve_file(self, file_id: str, head: bool = False):
+        data = self.state.get_file(file_id)
+        if data is None:
+            self._send_bytes(404, b'not found', 'text/plain', head=head)
+            return
+        etag = f'"{hashlib.sha1(data).hexdigest()}"'
+        self._send_bytes(200, data, 'application/pdf', head=head, headers={'ETag': etag})
+
+    # ========== 工具 ==========
+
+    def _authorized(self) -> bool:
+        if not self.state.config['require_token']:
+            return True
+        token = self.headers.get('Authorization', '')
+        if token.startswith('Bearer ') and token[len('Bearer '):].strip():
+            return True
+        self.state.count('unauthorized')
+        self._send_json(401, {'code': 'A0202', 'msg': 'token error'})
+        return False
+
+    def _origin(self) -> str:
+        host = self.headers.get('Host') or '%s:%s' % self.server.server_address[:2]
+        return f"http://{host}"
+
+    def _send_json(self, status: int, payload: Dict):
+        self._send_bytes(status, json.dumps(payload, ensure_ascii=False).encode('utf-8'), 'application/json')
+
+    def _send_bytes(self, status: int, data: bytes, content_type: str, head: bool = False,
+                    headers: Optional[Dict] = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if not head:
+            self.wfile.write(data)
+
+
+class FakeMinerUServer:
+    """可在进程内启动的模拟服务（基准测试脚本使用）"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, config: Optional[Dict] = None):
+        self.state = FakeMinerUState(config)
+        handler = type('BoundFakeMinerUHandler', (FakeMinerUHandler,), {'state': self.state})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def origin(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def base_url(self) -> str:
+        """PDFConverter 的 base_url"""
+        return f"{self.origin}/api/v4/extract"
+
+    @property
+    def upload_url(self) -> str:
+        """PDFConverter 的 upload_url"""
+        return f"{self.origin}/_fake/upload"
+
+    def start(self) -> 'FakeMinerUServer':
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='模拟 MinerU 服务（解析任务接口 + 临时文件上传）')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8002)
+    parser.add_argument('--seed', type=int, default=DEFAULT_CONFIG['seed'])
+    parser.add_argument('--queue-seconds', type=float, default=DEFAULT_CONFIG['queue_seconds'], help='排队时长（秒）')
+    parser.add_argument('--queue-jitter', type=float, default=DEFAULT_CONFIG['queue_jitter'])
+    parser.add_argument('--pages-per-second', type=float, default=DEFAULT_CONFIG['pages_per_second'], help='解析速度')
+    parser.add_argument('--images-per-page', type=int, default=DEFAULT_CONFIG['images_per_page'])
+    parser.add_argument('--image-kb', type=int, default=DEFAULT_CONFIG['image_kb'])
+    parser.add_argument('--create-error-rate', type=float, default=0.0)
+    parser.add_argument('--status-error-rate', type=float, default=0.0)
+    parser.add_argument('--download-error-rate', type=float, default=0.0)
+    parser.add_argument('--upload-error-rate', type=float, default=0.0)
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='任务解析失败的比例')
+    parser.add_argument('--stuck-rate', type=float, default=0.0, help='任务永不结束的比例')
+    args = parser.parse_args()
+
+    config = {
+        'seed': args.seed,
+        'queue_seconds': args.queue_seconds,
+        'queue_jitter': args.queue_jitter,
+        'pages_per_second': args.pages_per_second,
+        'images_per_page': args.images_per_page,
+        'image_kb': args.image_kb,
+        'create_error_rate': args.create_error_rate,
+        'status_error_rate': args.status_error_rate,
+        'download_error_rate': args.download_error_rate,
+        'upload_error_rate': args.upload_error_rate,
+        'fail_rate': args.fail_rate,
+        'stuck_rate': args.stuck_rate,
+    }
+
+    server = FakeMinerUServer(args.host, args.port, config)
+    print(f"🧪 模拟 MinerU 服务已启动: {server.base_url}")
+    print(f"   上传接口 {server.upload_url}")
+    print(f"   排队 {args.queue_seconds}s，{args.pages_per_second} 页/s，失败率 {args.fail_rate}，卡住 {args.stuck_rate}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
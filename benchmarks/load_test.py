@@ -0,0 +1,465 @@
+"""
+端到端压测脚本
+模拟多名学生并发使用应用：选择本地论文 → 导读报告 → 思维导图 → 多轮流式问答，LLM 由本地模拟服务提供
+
+统计每个接口的 p50/p95/p99 总耗时、流式问答的 p50/p95/p99 首 token 耗时、吞吐量和错误率，
+以及服务端的数据库慢事务（锁等待）和 worker 饱和度。结果保存为 JSON，可与之前的结果对比发现性能回退。
+
+用法：
+    # 自动启动模拟 LLM 服务和应用（有 gunicorn 时用 gunicorn 多 worker 启动）
+    python benchmarks/load_test.py --students 40 --concurrency 10 --questions 3
+
+    # 压测已经在运行的应用（应用需指向模拟服务：API_CONFIG_PATH=benchmarks/api_config.fake.json）
+    python benchmarks/load_test.py --url http://127.0.0.1:5000 --capacity 5
+
+    # 与之前的结果对比，p95 变慢超过 10% 时返回非零退出码
+    python benchmarks/load_test.py --compare benchmarks/results/baseline.json --fail-on-regression
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import requests
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT_DIR = BENCH_DIR.parent
+RESULTS_DIR = BENCH_DIR / 'results'
+sys.path.insert(0, str(BENCH_DIR))
+
+from fake_llm_server import FakeLLMServer  # noqa: E402
+
+# 学生提问（覆盖模拟服务的各条路由规则）
+QUESTIONS = [
+    "这篇论文的研究方法是什么？",
+    "结果部分的数据应该怎么看？",
+    "作者在讨论部分提到了哪些局限？",
+    "文献综述部分的研究空白是什么？",
+    "什么是准实验设计？",
+    "能帮我总结一下这篇论文吗",
+]
+
+ENDPOINTS = ('use_local_paper', 'proactive_summary', 'generate_mindmap', 'chat_stream')
+
+
+class Recorder:
+    """线程安全的请求结果记录"""
+
+    def __init__(self):
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def add(self, endpoint: str, ok: bool, status: Optional[int], latency: float,
+            ttft: Optional[float] = None, error: Optional[str] = None):
+        with self._lock:
+            self.samples.append({
+                'endpoint': endpoint,
+                'ok': ok,
+                'status': status,
+                'latency': latency,
+                'ttft': ttft,
+                'error': error,
+            })
+
+
+class MetricsSampler(threading.Thread):
+    """定期读取 /api/metrics/server，记录所有 worker 的进行中请求数"""
+
+    def __init__(self, base_url: str, interval: float):
+        super().__init__(daemon=True)
+        self.base_url = base_url
+        self.interval = interval
+        self.in_flight = []
+        self.stopped = threading.Event()
+
+    def fetch(self) -> Optional[Dict]:
+        try:
+            response = requests.get(f"{self.base_url}/api/metrics/server", timeout=5)
+            return response.json().get('metrics')
+        except (requests.RequestException, ValueError):
+            return None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            snapshot = self.fetch()
+            if snapshot:
+                series = snapshot['gauges'].get('http_requests_in_flight', {})
+                self.in_flight.append(sum(series.values()))
+
+
+def counter_total(snapshot: Optional[Dict], name: str) -> float:
+    if not snapshot:
+        return 0.0
+    return sum(snapshot['counters'].get(name, {}).values())
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(p * len(values)))
+    return round(values[index] * 1000, 1)
+
+
+# ========== 学生会话 ==========
+
+def run_student(base_url: str, index: int, args, paper: str, recorder: Recorder):
+    """一名学生的完整流程"""
+    rng = random.Random(f"{args.seed}:{index}")
+    user_id = f"loadtest-{index}"
+    http = requests.Session()
+
+    def think():
+        if args.think_time:
+            time.sleep(rng.uniform(0, args.think_time))
+
+    def post_json(endpoint, path, payload):
+        started = time.time()
+        try:
+            response = http.post(f"{base_url}{path}", json=payload, timeout=args.timeout)
+            data = response.json()
+            ok = response.status_code == 200 and data.get('success', False)
+            recorder.add(endpoint, ok, response.status_code, time.time() - started,
+                         error=None if ok else str(data.get('error'))[:200])
+            return data if ok else None
+        except (requests.RequestException, ValueError) as e:
+            recorder.add(endpoint, False, None, time.time() - started, error=str(e)[:200])
+            return None
+
+    created = post_json('use_local_paper', '/api/use-local-paper', {'user_id': user_id, 'filename': paper})
+    if not created:
+        return
+    session_id = created['session_id']
+
+    try:
+        think()
+        post_json('proactive_summary', '/api/proactive-summary', {'session_id': session_id})
+        think()
+        post_json('generate_mindmap', '/api/generate-mindmap', {'session_id': session_id})
+
+        for _ in range(args.questions):
+            think()
+            chat_stream(http, base_url, user_id, session_id, rng.choice(QUESTIONS), args.timeout, recorder)
+    finally:
+        try:
+            http.delete(f"{base_url}/api/session/{session_id}", timeout=args.timeout)
+        except requests.RequestException:
+            pass
+
+
+def chat_stream(http, base_url: str, user_id: str, session_id: str, message: str,
+                timeout: float, recorder: Recorder):
+    """发起一次流式问答，记录首个内容片段和结束事件的耗时"""
+    started = time.time()
+    ttft = None
+    try:
+        with http.post(
+            f"{base_url}/api/chat/stream",
+            json={'user_id': user_id, 'session_id': session_id, 'message': message},
+            stream=True,
+            timeout=timeout
+        ) as response:
+            if response.status_code != 200:
+                recorder.add('chat_stream', False, response.status_code, time.time() - started,
+                             error=response.text[:200])
+                return
+            for line in response.iter_lines():
+                if not line.startswith(b'data: '):
+                    continue
+                event = json.loads(line[6:].decode('utf-8'))
+                if 'content' in event and ttft is None:
+                    ttft = time.time() - started
+                elif event.get('event') == 'done':
+                    recorder.add('chat_stream', True, 200, time.time() - started, ttft)
+                    return
+                elif 'error' in event or event.get('event') == 'cancelled':
+                    recorder.add('chat_stream', False, 200, time.time() - started, ttft,
+                                 error=str(event.get('error', 'cancelled'))[:200])
+                    return
+            recorder.add('chat_stream', False, 200, time.time() - started, ttft, error='stream ended without done')
+    except (requests.RequestException, ValueError) as e:
+        recorder.add('chat_stream', False, None, time.time() - started, ttft, error=str(e)[:200])
+
+
+# ========== 启动被测应用 ==========
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_app(args, llm_base_url: str):
+    """启动指向模拟服务的应用，返回 (进程, base_url, 并发容量, 临时配置文件)"""
+    with open(BENCH_DIR / 'api_config.fake.json', 'r', encoding='utf-8') as f:
+        api_config = json.load(f)
+    for name in (api_config['api_provider'], *api_config.get('fallback_providers', [])):
+        api_config[name]['base_url'] = llm_base_url
+    config_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False, encoding='utf-8')
+    json.dump(api_config, config_file)
+    config_file.close()
+
+    port = free_port()
+    env = dict(os.environ, API_CONFIG_PATH=config_file.name)
+    if shutil.which('gunicorn') and not args.no_gunicorn:
+        command = ['gunicorn', '--workers', str(args.workers), '--timeout', '300',
+                   '--bind', f'127.0.0.1:{port}', 'app:app']
+        capacity = args.workers
+    else:
+        # 没有 gunicorn 时使用多线程开发服务器（没有固定的并发容量）
+        command = [sys.executable, '-c',
+                   f"from app import app; app.run(host='127.0.0.1', port={port}, threaded=True, use_reloader=False)"]
+        capacity = None
+
+    log = open(args.app_log, 'a', encoding='utf-8') if args.app_log else subprocess.DEVNULL
+    process = subprocess.Popen(command, cwd=str(ROOT_DIR), env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"应用启动失败（退出码 {process.returncode}），可用 --app-log 查看日志")
+        try:
+            requests.get(f"{base_url}/api/local-papers", timeout=2)
+            return process, base_url, capacity, config_file.name
+        except requests.RequestException:
+            time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError("应用启动超时")
+
+
+# ========== 汇总与对比 ==========
+
+def summarize(recorder: Recorder, wall: float) -> Dict:
+    endpoints = {}
+    for endpoint in ENDPOINTS:
+        samples = [s for s in recorder.samples if s['endpoint'] == endpoint]
+        if not samples:
+            continue
+        latencies = [s['latency'] for s in samples]
+        ttfts = [s['ttft'] for s in samples if s['ttft'] is not None]
+        errors = [s for s in samples if not s['ok']]
+        status_counts = {}
+        for s in samples:
+            key = str(s['status'])
+            status_counts[key] = status_counts.get(key, 0) + 1
+        endpoints[endpoint] = {
+            'requests': len(samples),
+            'errors': len(errors),
+            'error_rate': round(len(errors) / len(samples), 4),
+            'status_counts': status_counts,
+            'p50_latency_ms': percentile(latencies, 0.5),
+            'p95_latency_ms': percentile(latencies, 0.95),
+            'p99_latency_ms': percentile(latencies, 0.99),
+            'p50_ttft_ms': percentile(ttfts, 0.5),
+            'p95_ttft_ms': percentile(ttfts, 0.95),
+            'p99_ttft_ms': percentile(ttfts, 0.99),
+            'sample_errors': sorted({s['error'] for s in errors if s['error']})[:5],
+        }
+
+    total = len(recorder.samples)
+    failed = sum(1 for s in recorder.samples if not s['ok'])
+    return {
+        'endpoints': endpoints,
+        'overall': {
+            'requests': total,
+            'errors': failed,
+            'error_rate': round(failed / total, 4) if total else None,
+            'wall_seconds': round(wall, 2),
+            'requests_per_second': round(total / wall, 2) if wall else None,
+        },
+    }
+
+
+def compare(result: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """与基线对比，返回超过阈值的回退项"""
+    regressions = []
+    print(f"\n📊 与基线对比（{baseline['meta'].get('timestamp')}，commit {baseline['meta'].get('commit')}）")
+    for endpoint, current in result['endpoints'].items():
+        base = baseline['endpoints'].get(endpoint)
+        if not base:
+            continue
+        for key in ('p95_latency_ms', 'p95_ttft_ms'):
+            if current.get(key) is None or not base.get(key):
+                continue
+            change = current[key] / base[key] - 1
+            mark = '❌' if change > threshold else '  '
+            print(f"   {mark} {endpoint:<18} {key:<15} {base[key]:>9.1f} → {current[key]:>9.1f} ({change:+.1%})")
+            if change > threshold:
+                regressions.append(f"{endpoint}.{key} {change:+.1%}")
+        if current['error_rate'] > base['error_rate'] + 0.01:
+            regressions.append(f"{endpoint}.error_rate {base['error_rate']} → {current['error_rate']}")
+
+    base_rps = baseline['overall'].get('requests_per_second')
+    rps = result['overall'].get('requests_per_second')
+    if base_rps and rps:
+        change = rps / base_rps - 1
+        print(f"   {'❌' if change < -threshold else '  '} {'overall':<18} {'rps':<15} {base_rps:>9.2f} → {rps:>9.2f} ({change:+.1%})")
+        if change < -threshold:
+            regressions.append(f"overall.requests_per_second {change:+.1%}")
+    return regressions
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=str(ROOT_DIR),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='端到端压测（本地模拟 LLM）')
+    parser.add_argument('--url', help='已在运行的应用地址（不指定时自动启动）')
+    parser.add_argument('--students', type=int, default=20, help='模拟学生总数')
+    parser.add_argument('--concurrency', type=int, default=10, help='同时在线的学生数')
+    parser.add_argument('--questions', type=int, default=3, help='每名学生的流式提问次数')
+    parser.add_argument('--think-time', type=float, default=0.5, help='两步之间的最长思考时间（秒）')
+    parser.add_argument('--paper', help='使用的本地论文文件名（默认取 /api/local-papers 的第一篇）')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workers', type=int, default=5, help='自动启动时的 gunicorn worker 数')
+    parser.add_argument('--no-gunicorn', action='store_true', help='自动启动时使用多线程开发服务器')
+    parser.add_argument('--capacity', type=int, help='压测已有应用时的并发容量（sync worker 数），用于计算饱和度')
+    parser.add_argument('--app-log', help='自动启动时应用日志的输出文件')
+    parser.add_argument('--llm-ttft', type=float, default=0.3)
+    parser.add_argument('--llm-tps', type=float, default=80)
+    parser.add_argument('--llm-completion-tokens', type=int, default=300)
+    parser.add_argument('--llm-error-rate', type=float, default=0.0)
+    parser.add_argument('--llm-midstream-error-rate', type=float, default=0.0)
+    parser.add_argument('--sample-interval', type=float, default=0.5, help='服务端指标采样间隔（秒）')
+    parser.add_argument('--output', help='结果 JSON 路径（默认 benchmarks/results/load-<时间>.json）')
+    parser.add_argument('--compare', help='对比的基线结果 JSON')
+    parser.add_argument('--regression-threshold', type=float, default=0.1)
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args()
+
+    llm_server = None
+    process = None
+    config_path = None
+    if args.url:
+        base_url = args.url.rstrip('/')
+        capacity = args.capacity
+    else:
+        llm_server = FakeLLMServer(config={
+            'seed': args.seed,
+            'ttft': args.llm_ttft,
+            'tokens_per_second': args.llm_tps,
+            'completion_tokens': args.llm_completion_tokens,
+            'error_rate': args.llm_error_rate,
+            'midstream_error_rate': args.llm_midstream_error_rate,
+        }).start()
+        print(f"🧪 模拟 LLM 服务: {llm_server.base_url}")
+        process, base_url, capacity, config_path = start_app(args, llm_server.base_url)
+        print(f"🚀 应用已启动: {base_url}（{'gunicorn ' + str(capacity) + ' workers' if capacity else '开发服务器'}）")
+
+    try:
+        paper = args.paper
+        if not paper:
+            papers = requests.get(f"{base_url}/api/local-papers", timeout=10).json().get('papers', [])
+            if not papers:
+                raise RuntimeError("local_papers/ 中没有可用的论文")
+            paper = papers[0]['filename']
+
+        recorder = Recorder()
+        sampler = MetricsSampler(base_url, args.sample_interval)
+        before = sampler.fetch()
+        sampler.start()
+
+        print(f"🏃 {args.students} 名学生，并发 {args.concurrency}，每人提问 {args.questions} 次，论文: {paper}")
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            futures = [
+                pool.submit(run_student, base_url, index, args, paper, recorder)
+                for index in range(args.students)
+            ]
+        wall = time.time() - started
+        for future in futures:
+            if future.exception():
+                print(f"⚠️  模拟学生异常退出: {future.exception()}")
+
+        sampler.stopped.set()
+        sampler.join()
+        after = sampler.fetch()
+    finally:
+        if process:
+            process.terminate()
+            process.wait(timeout=30)
+        if config_path:
+            os.unlink(config_path)
+
+    result = summarize(recorder, wall)
+    transactions = counter_total(after, 'db_transactions_total') - counter_total(before, 'db_transactions_total')
+    transaction_seconds = (counter_total(after, 'db_transaction_seconds_total')
+                           - counter_total(before, 'db_transaction_seconds_total'))
+    result['db'] = {
+        'transactions': int(transactions),
+        'avg_transaction_ms': round(transaction_seconds / transactions * 1000, 2) if transactions else None,
+        'slow_transactions': int(counter_total(after, 'db_slow_transactions_total')
+                                 - counter_total(before, 'db_slow_transactions_total')),
+        'lock_errors': int(counter_total(after, 'db_lock_errors_total')
+                           - counter_total(before, 'db_lock_errors_total')),
+    }
+    busy_seconds = (counter_total(after, 'http_request_seconds_total')
+                    - counter_total(before, 'http_request_seconds_total'))
+    in_flight = sampler.in_flight
+    result['workers'] = {
+        'capacity': capacity,
+        'max_in_flight': max(in_flight) if in_flight else None,
+        'avg_in_flight': round(sum(in_flight) / len(in_flight), 2) if in_flight else None,
+        # 平均占用率：请求累计占用时长 / (容量 × 压测时长)
+        'utilization': round(busy_seconds / (capacity * wall), 3) if capacity and wall else None,
+        'saturated_fraction': (round(sum(1 for n in in_flight if n >= capacity) / len(in_flight), 3)
+                               if capacity and in_flight else None),
+    }
+    if llm_server:
+        result['llm'] = llm_server.state.snapshot()['stats']
+        llm_server.stop()
+    result['meta'] = {
+        'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'commit': git_commit(),
+        'args': vars(args),
+        'paper': paper,
+    }
+
+    print("\n📈 压测结果")
+    for endpoint, stats in result['endpoints'].items():
+        ttft = f"，首 token p50/p95/p99 {stats['p50_ttft_ms']}/{stats['p95_ttft_ms']}/{stats['p99_ttft_ms']} ms" \
+            if stats['p50_ttft_ms'] is not None else ''
+        print(f"   {endpoint:<18} {stats['requests']:>5} 次，错误率 {stats['error_rate']:.1%}，"
+              f"耗时 p50/p95/p99 {stats['p50_latency_ms']}/{stats['p95_latency_ms']}/{stats['p99_latency_ms']} ms{ttft}")
+    overall = result['overall']
+    print(f"   吞吐量 {overall['requests_per_second']} 请求/秒，总错误率 {overall['error_rate']}")
+    print(f"   数据库: {result['db']}")
+    print(f"   Worker: {result['workers']}")
+
+    output = Path(args.output) if args.output else RESULTS_DIR / f"load-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"💾 结果已保存: {output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.regression_threshold)
+        if regressions:
+            print(f"⚠️  发现 {len(regressions)} 项性能回退: {', '.join(regressions)}")
+            if args.fail_on_regression:
+                sys.exit(1)
+        else:
+            print("✅ 没有超过阈值的性能回退")
+
+
+if __name__ == '__main__':
+    main()
@@ -11,8 +11,8 @@ BASE_DIR = Path(__file__).resolve().parent
 
 # ========== 加载 API 配置 ==========
 def load_api_config():
-    """从 api_config.json 加载 API 配置"""
-    api_config_path = BASE_DIR / 'api_config.json'
+    """从 api_config.json 加载 API 配置（可用环境变量 API_CONFIG_PATH 指定其他文件，如压测用的本地模拟服务配置）"""
+    api_config_path = Path(os.environ.get('API_CONFIG_PATH') or BASE_DIR / 'api_config.json')
     
     if not api_config_path.exists():
         print("⚠️  api_config.json 不存在，使用默认配置")
@@ -50,7 +50,8 @@ API_CONFIG_DATA = load_api_config()
 DATABASE_CONFIG = {
     'db_path': BASE_DIR / 'data' / 'sessions.db',
     'timeout': 10.0,  # 连接超时时间（秒）
-    'check_same_thread': False  # 允许多线程访问（Flask需要）
+    'check_same_thread': False,  # 允许多线程访问（Flask需要）
+    'slow_transaction_seconds': 0.1,  # 事务耗时超过该值时计为慢事务（监控锁等待）
 }
 
 # ========== 文件上传配置 ==========
@@ -61,18 +62,160 @@ UPLOAD_CONFIG = {
     'max_file_size': 20 * 1024 * 1024,  # 20MB
 }
 
+# ========== 分块上传配置 ==========
+# PDF 分块上传到 uploads/（断线后只需补传缺失的部分），上传状态保存在 SQLite 中，所有 worker 共享
+RESUMABLE_UPLOAD_CONFIG = {
+    'enabled': os.environ.get('RESUMABLE_UPLOAD', 'true').lower() == 'true',
+    'db_path': BASE_DIR / 'data' / 'uploads.db',
+    'partial_folder': BASE_DIR / 'uploads' / '.partial',  # 未完成的上传
+    'chunk_size': 1024 * 1024,  # 建议客户端使用的分块大小（弱网下分块越小，断线后重传越少）
+    'max_chunk_size': 8 * 1024 * 1024,  # 单次请求的最大字节数
+    'max_file_size': UPLOAD_CONFIG['max_file_size'],
+    'expire_seconds': 24 * 3600,  # 未完成的上传保留时长（每次收到分块后顺延）
+    'completing_timeout': 300,  # 完成上传（校验哈希、移动文件）超过该时长未结束时视为进程已崩溃，恢复为可继续上传
+}
+
 # ========== 本地论文配置 ==========
 LOCAL_PAPERS_CONFIG = {
     'local_papers_folder': BASE_DIR / 'local_papers',  # 系统提供的本地论文
     'allowed_extensions': {'pdf'}
 }
 
+# ========== PDF 转换配置 ==========
+# MinerU 连接与任务轮询（API Token 等在 api_config.json 的 pdf_converter 中配置）
+PDF_CONVERTER_CONFIG = {
+    'http_pool_size': 10,  # 复用的 HTTP 连接数上限（与并发转换数相当即可）
+    'poll_min_interval': 1.0,  # 任务状态查询的最短间隔（秒）
+    'poll_max_interval': 15.0,  # 任务状态查询的最长间隔（秒）
+    'poll_no_progress_max_interval': 5.0,  # 还不知道本任务的解析速度（排队中、首次看到页数进度）时的最长间隔，避免冷启动预估过长
+    'poll_backoff': 1.5,  # 无法预估剩余时间时，查询间隔的增长倍数
+    'poll_parallelism': 4,  # 同时发出的状态查询数
+    'max_status_errors': 3,  # 连续查询失败超过该次数时判定任务失败
+    'initial_seconds_per_page': 2.0,  # 尚无观测数据时，预估的每页解析耗时（秒）
+    'estimate_smoothing': 0.3,  # 耗时观测值的指数平滑系数
+    # 结果 ZIP 边下载边写入临时文件，只解压需要的文件
+    'zip_spool_bytes': 1024 * 1024,  # 临时文件在内存中保留的上限，超过后转存磁盘
+    'max_zip_bytes': 200 * 1024 * 1024,  # 结果 ZIP 的大小上限
+    'max_markdown_bytes': 20 * 1024 * 1024,  # 解压后 Markdown 的大小上限
+    'max_artifact_bytes': 20 * 1024 * 1024,  # 单个附带文件（图片等）解压后的大小上限，超过的跳过
+    'max_artifacts_total_bytes': 200 * 1024 * 1024,  # 附带文件解压后的总大小上限，超过后不再解压
+    'artifact_extensions': ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.svg', '.json'),  # 保存的附带文件类型
+}
+
+# ========== 本地 PDF 提取配置 ==========
+# 文字型 PDF 在本地用 pypdf 解析（不上传 PDF、不调用 MinerU），扫描件和公式较多的 PDF 交给 MinerU
+LOCAL_EXTRACTION_CONFIG = {
+    'enabled': os.environ.get('LOCAL_PDF_EXTRACTION', 'true').lower() == 'true',
+    'processes': int(os.environ.get('LOCAL_EXTRACTION_PROCESSES', '0')),  # 解析进程数（CPU 密集型），0 表示 CPU 核数
+    'pages_per_task': 8,  # 页数较多的 PDF 按该页数拆分成多个任务并行提取
+    'timeout': 120,  # 单份 PDF 解析的超时时间（秒）
+    'max_pdf_bytes': 100 * 1024 * 1024,  # 通过 URL 提交的 PDF 需要先下载到本地，超过该大小的直接交给 MinerU
+    'sample_pages': 6,  # 文本密度检查抽样的页数
+    'min_chars_per_page': 100,  # 非空白字符数达到该值的页面算作有文字的页面
+    'min_text_page_ratio': 0.75,  # 有文字的页面比例低于该值时视为扫描件
+    'max_garbled_ratio': 0.02,  # 乱码字符（缺少字符映射的字体）比例上限
+    'max_formula_ratio': 0.03,  # 数学符号比例上限，超过时视为公式较多，交给 MinerU
+    'heading_size_ratio': 1.15,  # 字号达到正文字号的该倍数时识别为标题
+}
+
+# ========== Markdown 存储配置 ==========
+# 转换结果按内容寻址保存，同一份 PDF（内容哈希或 OSS ETag 相同）只转换一次
+MARKDOWN_STORE_CONFIG = {
+    'enabled': True,
+    'root': BASE_DIR / 'markdown' / 'store',
+    'db_path': BASE_DIR / 'data' / 'markdown_store.db',
+    'keep_artifacts': True,  # 同时保存 MinerU 结果中的图片、版面 JSON 等附带文件
+}
+
+# ========== Markdown 精简配置 ==========
+# 写入 LLM 上下文前去掉图片标记、表格 HTML、参考文献、页眉页脚等（原 Markdown 不变，精简结果按内容缓存）
+MARKDOWN_COMPACTION_CONFIG = {
+    'enabled': os.environ.get('MARKDOWN_COMPACTION', 'true').lower() == 'true',
+    'root': BASE_DIR / 'markdown' / 'compact',
+    # 启用的处理步骤（按固定顺序执行）
+    'passes': ['strip_images', 'collapse_tables', 'split_references', 'dedupe_furniture', 'normalize_whitespace'],
+    'furniture_min_repeats': 3,  # 在分页处（页码附近）出现次数达到该值的短行视为页眉页脚（行尾的页码忽略）
+    'furniture_max_chars': 80,  # 页眉页脚的最大长度
+    'reference_headings': ['references', 'reference', 'bibliography', 'works cited', 'literature cited',
+                           '参考文献', '引用文献', '文献'],
+    'chars_per_token': 2.0,  # 估算 token 数，与 RATE_LIMIT_CONFIG 的口径一致
+}
+
 # ========== Prompt 配置 ==========
 PROMPT_CONFIG = {
     'prompt_folder': BASE_DIR / 'prompts',
     'default_prompt_set': 'v1.0'  # 默认使用的 prompt 版本
 }
 
+# ========== 响应缓存配置 ==========
+# 按（论文哈希, 智能体, Prompt 版本, 模型, 参数）缓存确定性生成结果，所有 worker 共享
+RESPONSE_CACHE_CONFIG = {
+    'enabled': True,
+    'db_path': BASE_DIR / 'data' / 'response_cache.db',
+    'ttl_seconds': 7 * 24 * 3600,  # 条目有效期（秒）
+    'max_entries': 2000,  # 超过后按最近访问时间（LRU）淘汰
+}
+
+# ========== 请求合并（single-flight）配置 ==========
+# 并发的相同 LLM 请求只由一个 leader 实际生成，其余请求（可跨 worker）跟随其结果
+SINGLE_FLIGHT_CONFIG = {
+    'enabled': True,
+    'db_path': BASE_DIR / 'data' / 'single_flight.db',
+    'stateless_only': True,  # 只合并没有历史对话的请求（导读报告、思维导图、路由决策）
+    'lease_seconds': 30,  # leader 租约时长，超时未续约视为 leader 已失效
+    'poll_interval': 0.1,  # follower 轮询间隔（秒）
+    'flush_interval': 0.05,  # leader 将流式片段写入共享日志的间隔（秒）
+    'result_ttl_seconds': 15,  # 生成完成后，结果继续供晚到的相同请求复用的时长
+    'member_check_interval': 1.0,  # 发起流式生成的请求取消或断开后，检查是否还有 follower 在跟随的间隔（秒）
+    'retention_seconds': 3600,  # 旧记录的保留时长
+}
+
+# ========== LLM 限流与调度配置 ==========
+# 令牌桶（每分钟请求数 / 每分钟 token 数）+ 优先级队列，所有 worker 共享
+# 各提供商可在 api_config.json 的提供商配置中用同名字段覆盖 requests_per_minute 等限额
+RATE_LIMIT_CONFIG = {
+    'enabled': True,
+    'db_path': BASE_DIR / 'data' / 'rate_limiter.db',
+    'requests_per_minute': 60,
+    'tokens_per_minute': 400000,
+    'max_concurrent': 10,  # 同时进行中的 LLM 调用上限
+    'max_queue_size': 50,  # 排队请求上限，超过后直接拒绝
+    'background_queue_share': 0.5,  # 队列占用超过该比例时拒绝后台任务（思维导图、导读报告）
+    'max_wait_seconds': 30,  # 排队等待上限（秒）
+    'chars_per_token': 2.0,  # 估算 prompt token 数时每个 token 对应的字符数
+    'expected_completion_tokens': 1500,  # 预估的输出 token 数（不超过 max_tokens）
+    'lease_seconds': 600,  # 并发占位的最长持有时间，防止进程异常退出后占位不释放
+}
+
+# ========== 流式输出登记配置 ==========
+# 记录进行中的 /api/chat/stream 输出，用于跨 worker 取消（停止生成按钮）和断线重连
+STREAM_REGISTRY_CONFIG = {
+    'db_path': BASE_DIR / 'data' / 'streams.db',
+    'cancel_check_interval': 0.25,  # 生成过程中检查取消标记和读取方断开的间隔（秒）
+    'retention_seconds': 3600,  # 已结束记录的保留时长
+    'buffer_ttl_seconds': 300,  # 流结束后事件缓冲继续保留、可供重连补发的时长
+    'flush_interval': 0.05,  # 生成方批量写入事件缓冲的间隔（秒）
+    'poll_interval': 0.1,  # 重连读取方轮询新事件的间隔（秒）
+    'heartbeat_interval': 1.0,  # 生成方 / 读取方心跳间隔（秒）
+    'producer_stale_seconds': 10,  # 生成方心跳超时后视为生成中断
+    'disconnect_grace_seconds': 20,  # 所有读取方断开后等待重连的宽限期，超时取消生成
+}
+
+# ========== 后台任务队列配置 ==========
+# PDF 转 Markdown 等耗时任务由 Web 进程入队，独立进程（python conversion_worker.py）执行
+JOB_QUEUE_CONFIG = {
+    'db_path': BASE_DIR / 'data' / 'jobs.db',
+    'lease_seconds': 60,  # 任务租约时长，worker 超过该时长未续约视为已退出，任务重新排队
+    'heartbeat_interval': 10,  # worker 续约间隔（秒）
+    'max_attempts': 3,  # 每个任务最多尝试次数
+    'retry_backoff_seconds': 10,  # 重试的基础等待时间，每次失败后翻倍
+    'poll_interval': 1.0,  # 队列为空时 worker 的轮询间隔（秒）
+    'worker_concurrency': int(os.environ.get('CONVERSION_WORKER_CONCURRENCY', '4')),  # 每个 worker 进程并发执行的任务数（等待 MinerU 时不占用 CPU）
+    'embedded_workers': int(os.environ.get('CONVERSION_EMBEDDED_WORKERS', '0')),  # 开发环境：在 Web 进程内启动的执行线程数
+    'retention_seconds': 7 * 24 * 3600,  # 已结束任务记录的保留时长
+    'client_poll_interval_ms': 2000,  # 前端轮询转换进度的间隔（毫秒）
+}
+
 # ========== Flask 应用配置 ==========
 FLASK_CONFIG = {
     'SECRET_KEY': os.environ.get('SECRET_KEY', 'reading-agent-dev-secret-key-change-in-production'),
@@ -81,6 +224,22 @@ FLASK_CONFIG = {
 }
 
 # ========== OpenAI API 配置 ==========
+def _provider_config(name, provider_data):
+    """将 api_config.json 中的单个提供商配置整理为客户端参数"""
+    return {
+        'name': name,
+        'api_key': provider_data.get('api_key'),
+        'base_url': provider_data.get('base_url', 'https://api.openai.com/v1'),
+        'model': provider_data.get('model', 'gpt-4o'),
+        'temperature': float(provider_data.get('temperature', 0.7)),
+        'max_tokens': int(provider_data.get('max_tokens', 2000)),
+        'rate_limit': {
+            key: provider_data[key]
+            for key in ('requests_per_minute', 'tokens_per_minute', 'max_concurrent')
+            if key in provider_data
+        },
+    }
+
 # 获取当前使用的 API 提供商配置
 CURRENT_PROVIDER = API_CONFIG_DATA.get('api_provider', 'openai')
 CURRENT_API_CONFIG = API_CONFIG_DATA.get(CURRENT_PROVIDER, {})
@@ -95,10 +254,116 @@ OPENAI_CONFIG = {
     'max_retries': 3,  # 最大重试次数
     'timeout': 60,  # 请求超时（秒）
     'api_version': CURRENT_API_CONFIG.get('api_version'),  # Azure 专用
+    'provider': CURRENT_PROVIDER,
+    # 提供商级限额（未配置时使用 RATE_LIMIT_CONFIG 中的默认值）
+    'rate_limit': _provider_config(CURRENT_PROVIDER, CURRENT_API_CONFIG)['rate_limit'],
 }
 # 注意：不要添加 proxies 等参数，OpenAI SDK v1.0+ 不支持
 # 如需代理，请使用环境变量: HTTP_PROXY, HTTPS_PROXY, NO_PROXY
 
+# ========== 多提供商故障转移配置 ==========
+# 主提供商为 api_provider，fallback_providers 中列出的提供商按顺序作为备用
+# 未配置 api_key 的备用提供商会被跳过
+FALLBACK_PROVIDERS = [
+    name for name in API_CONFIG_DATA.get('fallback_providers', [])
+    if name != CURRENT_PROVIDER and API_CONFIG_DATA.get(name, {}).get('api_key')
+]
+FALLBACK_PROVIDER_CONFIGS = [
+    _provider_config(name, API_CONFIG_DATA.get(name, {}))
+    for name in FALLBACK_PROVIDERS
+]
+
+# 熔断器配置（每个提供商一个熔断器）
+CIRCUIT_BREAKER_CONFIG = {
+    'window_size': 20,  # 统计最近 N 次调用
+    'min_calls': 5,  # 窗口内调用数少于该值时不触发熔断
+    'failure_rate_threshold': 0.5,  # 错误率（含慢调用）超过该值时熔断
+    'slow_call_seconds': 30,  # 超过该耗时（非流式总耗时 / 流式首 token 耗时）视为慢调用
+    'open_seconds': 30,  # 熔断后等待多久进入半开状态
+    'half_open_max_probes': 1,  # 半开状态允许同时进行的探测请求数
+}
+
+# 流式输出的重试与续写配置
+STREAM_RETRY_CONFIG = {
+    'max_resumes': 2,  # 已输出部分内容后连接中断时，最多发起几次续写请求
+    'overlap_window': 200,  # 续写开头与已输出内容的重叠检测范围（字符）
+    'resume_instruction': '你的上一条回复因网络中断被截断了。请从中断处直接继续输出，'
+                          '不要重复已经输出的内容，也不要添加任何说明。',
+}
+
+# 流式请求对冲（hedging）配置：首 token 迟迟未到时向备用（或同一）提供商再发一个请求，先出 token 者胜出
+HEDGING_CONFIG = {
+    'enabled': False,
+    'percentile': 0.95,  # 对冲延迟取该提供商近期首 token 耗时的分位数
+    'min_samples': 20,  # 样本不足时使用 default_delay_seconds
+    'default_delay_seconds': 8.0,
+    'min_delay_seconds': 2.0,
+    'max_delay_seconds': 15.0,
+    'ttft_window': 200,  # 每个提供商保留的首 token 耗时样本数
+    'window_size': 100,  # 统计对冲比例和 token 开销的最近流式请求数
+    'max_hedge_rate': 0.1,  # 对冲请求数占流式请求数的比例上限
+    'max_token_overhead': 0.1,  # 对冲额外消耗的 token 占总估算 token 的比例上限
+    'prefer_alternate': True,  # 优先把对冲请求发给另一个提供商
+}
+
+# ========== LLM 用量记录配置 ==========
+# 每次 LLM 调用追加一条用量记录（token、首 token 耗时、总耗时、重试次数 + 智能体/状态/会话/用户标签）
+USAGE_CONFIG = {
+    'enabled': True,
+    'db_path': BASE_DIR / 'data' / 'usage.db',
+    'stream_include_usage': True,  # 流式请求附带 stream_options.include_usage（提供商不支持时自动关闭）
+    'chars_per_token': 2.0,  # 提供商未返回用量时估算 token 数
+}
+
+# ========== 日志配置 ==========
+# 结构化日志（logger.py）：按级别过滤、高频事件采样、经队列异步输出
+LOGGING_CONFIG = {
+    'level': os.environ.get('LOG_LEVEL', 'INFO'),  # DEBUG 时输出上下文构建、路由判断等详细诊断信息
+    'format': os.environ.get('LOG_FORMAT', 'text'),  # 'text' 或 'json'
+    'queue_size': 10000,  # 输出队列上限，队列满时丢弃日志（不阻塞请求）
+    'payload_previews': os.environ.get('LOG_PAYLOADS', '0') == '1',  # 是否记录用户消息和模型回复的内容预览
+    'preview_chars': 200,
+    # 高频事件的采样比例（未列出的事件全部输出；WARNING 及以上不采样）
+    'sample_rates': {
+        'agent.responded': 0.1,
+        'db.session_updated': 0.1,
+        'prompt.loaded': 0.1,
+        'single_flight.joined': 0.1,
+    },
+}
+
+# ========== 链路追踪配置 ==========
+# 记录请求各阶段（数据库、上下文构建、Prompt 加载、LLM 调用）的耗时树，设置环境变量 TRACING_ENABLED=1 开启
+TRACING_CONFIG = {
+    'enabled': os.environ.get('TRACING_ENABLED', '0') == '1',  # 关闭时 span 为空操作
+    'sample_rate': 1.0,  # 请求采样比例
+    'exporter': 'file',  # 'file'：OTLP/JSON 写入 traces_dir；'log'：链路树写入日志；'none'：只记录慢链路
+    'traces_dir': BASE_DIR / 'data' / 'traces',
+    'slow_trace_seconds': 5.0,  # 超过该耗时的链路按 slow_trace_log_rate 采样写入日志（WARNING）
+    'slow_trace_log_rate': 0.1,
+    'service_name': 'reading-agent',
+    'max_spans_per_trace': 500,
+}
+
+# ========== 性能剖析配置 ==========
+# 按需剖析单个请求：请求头 X-Profile（或查询参数 __profile）等于 token 时记录该请求的 cProfile
+PROFILING_CONFIG = {
+    'token': os.environ.get('PROFILING_TOKEN', ''),  # 为空时关闭剖析功能（不挂载中间件）
+    'profiles_dir': BASE_DIR / 'data' / 'profiles',
+    'max_files': 50,  # 最多保留的剖析结果数（超出时删除最旧的）
+    'max_concurrent': 1,  # 每个进程同时剖析的请求数上限
+}
+
+# ========== 监控指标配置 ==========
+# 每个 worker 进程把自己的指标写入 metrics_dir/<pid>.json，读取时跨进程汇总
+METRICS_CONFIG = {
+    'metrics_dir': BASE_DIR / 'data' / 'metrics',
+    'flush_interval': 1.0,  # 指标落盘的最小间隔（秒）
+    # 直方图默认分桶上界（秒）
+    'histogram_buckets': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+    'prometheus_namespace': 'reading_agent_',  # /metrics 接口输出的指标名称前缀
+}
+
 # ========== 智能体映射配置 ==========
 # FSM 状态到智能体的映射
 STATE_AGENT_MAPPING = {
@@ -134,6 +399,7 @@ def ensure_directories():
         UPLOAD_CONFIG['markdown_folder'],
         LOCAL_PAPERS_CONFIG['local_papers_folder'],
         PROMPT_CONFIG['prompt_folder'],
+        METRICS_CONFIG['metrics_dir'],
     ]
     
     for directory in directories:
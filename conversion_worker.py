@@ -0,0 +1,176 @@
+"""
+PDF 转 Markdown 后台 worker
+从任务队列（job_queue）领取转换任务执行，完成后把 markdown_path 写回会话
+
+用法：
+    python conversion_worker.py                   # 按 JOB_QUEUE_CONFIG['worker_concurrency'] 并发执行
+    python conversion_worker.py --concurrency 4   # 指定并发数
+    python conversion_worker.py --once            # 处理完当前排队的任务后退出
+
+可以同时运行多个 worker 进程（同一台机器，共享 data/jobs.db 和 markdown 目录）。
+收到 SIGTERM / SIGINT 后不再领取新任务，等正在执行的任务结束后退出；
+被强制结束时，任务租约过期后会由其他 worker 重新执行。
+"""
+import argparse
+import signal
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+from config import JOB_QUEUE_CONFIG, UPLOAD_CONFIG
+from db import db
+from job_queue import job_queue, PDF_CONVERSION
+from logger import get_logger
+
+logger = get_logger('conversion_worker')
+
+# 清理过期任务记录的间隔（秒）
+CLEANUP_INTERVAL = 3600
+
+
+def markdown_output_path(title: str) -> Path:
+    """上传论文的 Markdown 输出路径（与原先同步转换时的命名一致）"""
+    return UPLOAD_CONFIG['markdown_folder'] / (title.replace(' ', '_') + '.md')
+
+
+class ConversionWorker:
+    """转换任务执行器：每个执行线程循环领取并执行任务"""
+
+    def __init__(self, converter, concurrency: Optional[int] = None, worker_id: Optional[str] = None):
+        self.converter = converter
+        self.concurrency = concurrency or JOB_QUEUE_CONFIG.get('worker_concurrency', 2)
+        self.worker_id = worker_id or job_queue.default_worker_id()
+        self.poll_interval = JOB_QUEUE_CONFIG.get('poll_interval', 1.0)
+        self.heartbeat_interval = JOB_QUEUE_CONFIG.get('heartbeat_interval', 10)
+        self.stop_event = threading.Event()
+        self._threads = []
+
+    def start(self, once: bool = False, daemon: bool = False):
+        """启动执行线程"""
+        for index in range(self.concurrency):
+            # 由第一个执行线程顺带清理过期任务记录
+            thread = threading.Thread(target=self._run_loop, args=(once, index == 0), daemon=daemon,
+                                      name=f"conversion-worker-{index}")
+            thread.start()
+            self._threads.append(thread)
+        logger.info('worker.started', '🛠️  转换 worker 已启动', worker_id=self.worker_id,
+                    concurrency=self.concurrency)
+
+    def stop(self):
+        """不再领取新任务（正在执行的任务继续完成）"""
+        self.stop_event.set()
+
+    def join(self):
+        for thread in self._threads:
+            # 带超时的 join，主线程仍能及时响应信号
+            while thread.is_alive():
+                thread.join(timeout=1.0)
+
+    def _run_loop(self, once: bool, cleanup: bool):
+        last_cleanup = 0.0
+        while not self.stop_event.is_set():
+            try:
+                job = job_queue.claim([PDF_CONVERSION], self.worker_id)
+            except Exception as e:
+                logger.exception('worker.claim_failed', '❌ 领取任务失败', error=str(e))
+                self.stop_event.wait(self.poll_interval)
+                continue
+
+            if job is None:
+                if once:
+                    return
+                if cleanup and time.monotonic() - last_cleanup > CLEANUP_INTERVAL:
+                    last_cleanup = time.monotonic()
+                    removed = job_queue.cleanup()
+                    if removed:
+                        logger.info('worker.cleanup', '🧹 清理过期任务记录', removed=removed)
+                self.stop_event.wait(self.poll_interval)
+                continue
+
+            self.process(job)
+
+    def process(self, job: Dict):
+        """执行一个转换任务"""
+        job_id = job['job_id']
+        payload = job['payload']
+        logger.info('worker.job_started', '🔄 开始转换', job_id=job_id, session_id=job['session_id'],
+                    attempt=job['attempts'])
+
+        # 转换过程中定期续约（MinerU 排队时可能长时间没有进度更新）
+        finished = threading.Event()
+
+        def keep_alive():
+            while not finished.wait(self.heartbeat_interval):
+                if not job_queue.heartbeat(job_id, self.worker_id):
+                    logger.warning('worker.lease_lost', '⚠️  任务租约已丢失', job_id=job_id)
+                    return
+
+        heartbeat = threading.Thread(target=keep_alive, daemon=True)
+        heartbeat.start()
+        try:
+            markdown_path = self.converter.convert_pdf_to_markdown(
+                pdf_url=payload.get('pdf_url'),
+                pdf_path=payload.get('pdf_path'),
+                output_path=payload.get('output_path'),
+                progress_callback=lambda progress, message: job_queue.update_progress(
+                    job_id, self.worker_id, progress, message),
+            )
+        except (FileNotFoundError, ValueError) as e:
+            # 参数或文件问题，重试也不会成功
+            job_queue.fail(job_id, self.worker_id, str(e), retry=False)
+            return
+        except Exception as e:
+            job_queue.fail(job_id, self.worker_id, str(e))
+            return
+        finally:
+            finished.set()
+
+        try:
+            if job['session_id']:
+                db.update_session(job['session_id'], markdown_path=markdown_path)
+            job_queue.complete(job_id, self.worker_id, {'markdown_path': markdown_path})
+        except Exception as e:
+            logger.exception('worker.attach_failed', '❌ 写回会话失败', job_id=job_id, error=str(e))
+            job_queue.fail(job_id, self.worker_id, f"写回会话失败: {e}")
+
+
+def start_embedded_workers(converter, concurrency: int) -> ConversionWorker:
+    """
+    在当前进程中以后台线程执行转换任务（开发环境使用，免去单独启动 worker 进程）
+
+    生产环境请单独运行 python conversion_worker.py
+    """
+    worker = ConversionWorker(converter, concurrency=concurrency)
+    worker.start(daemon=True)
+    return worker
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='PDF 转 Markdown 后台 worker')
+    parser.add_argument('--concurrency', type=int, default=None, help='并发执行的任务数')
+    parser.add_argument('--once', action='store_true', help='处理完当前排队的任务后退出')
+    args = parser.parse_args(argv)
+
+    from pdf_converter import pdf_converter
+    if pdf_converter is None:
+        print("❌ PDF 转换器不可用（请在 api_config.json 中配置 pdf_converter.api_token，或安装 pypdf 启用本地提取）")
+        return 1
+
+    worker = ConversionWorker(pdf_converter, concurrency=args.concurrency)
+
+    def handle_signal(signum, frame):
+        logger.info('worker.stopping', '🛑 收到退出信号，等待进行中的任务完成', signal=signum)
+        worker.stop()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    worker.start(once=args.once)
+    worker.join()
+    logger.info('worker.stopped', '👋 转换 worker 已退出', worker_id=worker.worker_id)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,23 +2,53 @@
 数据库操作模块
 使用 SQLite 存储会话数据
 """
+import functools
 import sqlite3
 import json
+import time
 import uuid
 from datetime import datetime
 from contextlib import contextmanager
 from config import DATABASE_CONFIG
+from metrics import metrics
+from tracing import traced
+from logger import get_logger
+
+logger = get_logger('db')
+
+
+def instrumented(operation: str):
+    """装饰器：数据库操作记录为链路 span（db.<operation>），并按操作名记录耗时直方图"""
+    def decorator(func):
+        traced_func = traced(f'db.{operation}')(func)
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.time()
+            try:
+                return traced_func(*args, **kwargs)
+            finally:
+                metrics.observe('db_operation_duration_seconds', time.time() - started, operation=operation)
+        return wrapper
+    return decorator
 
 class DatabaseManager:
     """数据库管理器 - 处理所有数据库操作"""
     
     def __init__(self):
         self.db_path = DATABASE_CONFIG['db_path']
+        self.slow_transaction_seconds = DATABASE_CONFIG.get('slow_transaction_seconds', 0.1)
         self._init_database()
     
     @contextmanager
     def get_connection(self):
-        """获取数据库连接的上下文管理器"""
+        """
+        获取数据库连接的上下文管理器
+        
+        记录事务耗时：超过 slow_transaction_seconds 的事务计为慢事务（通常是在等待其他 worker 的写锁），
+        等锁超时（database is locked）单独计数
+        """
+        started = time.time()
         conn = sqlite3.connect(
             str(self.db_path),
             timeout=DATABASE_CONFIG['timeout'],
@@ -30,9 +60,17 @@ class DatabaseManager:
             conn.commit()
         except Exception as e:
             conn.rollback()
+            if isinstance(e, sqlite3.OperationalError) and 'locked' in str(e):
+                metrics.inc('db_lock_errors_total')
             raise e
         finally:
             conn.close()
+            elapsed = time.time() - started
+            metrics.inc('db_transactions_total')
+            metrics.inc('db_transaction_seconds_total', elapsed)
+            metrics.observe('db_transaction_duration_seconds', elapsed)
+            if elapsed >= self.slow_transaction_seconds:
+                metrics.inc('db_slow_transactions_total')
     
     def _init_database(self):
         """初始化数据库表"""
@@ -69,6 +107,7 @@ class DatabaseManager:
     
     # ========== CRUD 操作 ==========
     
+    @instrumented('create_session')
     def create_session(self, user_id, title, paper_path=None, markdown_path=None):
         """
         创建新会话
@@ -112,9 +151,10 @@ class DatabaseManager:
                 json.dumps(initial_data, ensure_ascii=False)
             ))
         
-        print(f"✅ 创建新会话: {session_id} (用户: {user_id})")
+        logger.info('db.session_created', '✅ 创建新会话', session_id=session_id, user_id=user_id)
         return session_id
     
+    @instrumented('get_user_sessions')
     def get_user_sessions(self, user_id):
         """
         获取用户的所有会话列表
@@ -137,6 +177,7 @@ class DatabaseManager:
             rows = cursor.fetchall()
             return [dict(row) for row in rows]
     
+    @instrumented('get_session')
     def get_session(self, session_id):
         """
         获取单个会话的完整信息
@@ -163,6 +204,7 @@ class DatabaseManager:
                 return session
             return None
     
+    @instrumented('update_session')
     def update_session(self, session_id, **kwargs):
         """
         更新会话信息
@@ -198,8 +240,9 @@ class DatabaseManager:
                 WHERE session_id = ?
             ''', values)
             
-            print(f"✅ 更新会话: {session_id}")
+            logger.info('db.session_updated', '✅ 更新会话', session_id=session_id)
     
+    @instrumented('update_chat_history')
     def update_chat_history(self, session_id, new_message):
         """
         向会话添加新的聊天消息
@@ -217,6 +260,7 @@ class DatabaseManager:
         
         self.update_session(session_id, session_data=session_data)
     
+    @instrumented('delete_session')
     def delete_session(self, session_id):
         """
         删除会话
@@ -233,7 +277,7 @@ class DatabaseManager:
             success = cursor.rowcount > 0
             
             if success:
-                print(f"✅ 删除会话: {session_id}")
+                logger.info('db.session_deleted', '✅ 删除会话', session_id=session_id)
             
             return success
 
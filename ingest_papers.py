@@ -0,0 +1,253 @@
+"""
+批量导入论文
+扫描目录中的 PDF，并发转换为 Markdown（写在 PDF 旁边，/api/local-papers 即显示为已转换），
+并为每篇论文生成元数据、章节索引和精简效果（<文件名>.meta.json）
+
+用法：
+    python ingest_papers.py                          # 导入 local_papers/
+    python ingest_papers.py ~/reading-list -c 8      # 指定目录和并发数
+    python ingest_papers.py --recursive --dry-run    # 包含子目录，只列出需要处理的文件
+    python ingest_papers.py --force                  # 重新转换所有 PDF（覆盖已有的 Markdown）
+
+可重复执行、可中断续跑：
+- 元数据中记录 PDF 的 SHA-256，PDF 未变化（修改时间和大小相同，或内容哈希相同）且 Markdown 存在时跳过
+- 转换结果按内容保存在 Markdown 存储中，中断前已完成的转换再次执行时直接复用
+- Markdown 和元数据都先写临时文件再替换，中断不会留下写了一半的文件
+- 已有 Markdown 但没有元数据的论文（如手动整理的 Markdown）不会被覆盖，只补充元数据
+"""
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+from config import LOCAL_PAPERS_CONFIG
+from markdown_store import markdown_store
+from markdown_compactor import markdown_compactor
+
+METADATA_SUFFIX = '.meta.json'
+METADATA_VERSION = 1
+
+# 处理结果（CONVERT / PENDING 为计划中的动作，--dry-run 时输出 PENDING）
+CONVERT = 'convert'
+PENDING = 'pending'
+CONVERTED = 'converted'
+REUSED = 'reused'
+INDEXED = 'indexed'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+def metadata_path(pdf_path: Path) -> Path:
+    return pdf_path.with_name(pdf_path.stem + METADATA_SUFFIX)
+
+
+def load_metadata(pdf_path: Path) -> Optional[Dict]:
+    path = metadata_path(pdf_path)
+    if not path.exists():
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def build_section_index(markdown: str) -> List[Dict]:
+    """章节索引：每个标题的层级、标题文字和在 Markdown 中的字符偏移"""
+    sections = []
+    offset = 0
+    in_code = False
+    for line in markdown.splitlines(keepends=True):
+        stripped = line.strip()
+        if stripped.startswith('```'):
+            in_code = not in_code
+        elif not in_code and stripped.startswith('#'):
+            level = len(stripped) - len(stripped.lstrip('#'))
+            title = stripped[level:].strip()
+            if 1 <= level <= 6 and title:
+                sections.append({'level': level, 'title': title, 'offset': offset})
+        offset += len(line)
+    return sections
+
+
+def count_pages(pdf_path: Path) -> Optional[int]:
+    try:
+        from pypdf import PdfReader
+        return len(PdfReader(str(pdf_path)).pages)
+    except Exception:
+        return None
+
+
+def _atomic_write_text(path: Path, content: str):
+    tmp = path.with_name(f".{path.name}.tmp")
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+class PaperIngester:
+    """批量导入：逐篇判断是否需要转换，并发执行"""
+
+    def __init__(self, converter, concurrency: int = 4, force: bool = False, dry_run: bool = False):
+        self.converter = converter
+        self.concurrency = max(1, concurrency)
+        self.force = force
+        self.dry_run = dry_run
+        self.stop_event = threading.Event()
+
+    @staticmethod
+    def scan(directory: Path, recursive: bool = False) -> List[Path]:
+        pattern = '**/*.pdf' if recursive else '*.pdf'
+        return sorted(path for path in directory.glob(pattern)
+                      if path.is_file() and not path.name.startswith('.'))
+
+    def plan(self, pdf_path: Path) -> str:
+        """
+        判断一篇论文需要做什么：SKIPPED（已是最新）、INDEXED（只补元数据）、CONVERT（需要转换）
+
+        PDF 的修改时间和大小与元数据一致时直接判断，否则计算内容哈希比较
+        """
+        md_path = pdf_path.with_suffix('.md')
+        if self.force or not md_path.exists():
+            return CONVERT
+        metadata = load_metadata(pdf_path)
+        if metadata is None:
+            return INDEXED
+        stat = pdf_path.stat()
+        if metadata.get('mtime_ns') == stat.st_mtime_ns and metadata.get('size') == stat.st_size:
+            return SKIPPED
+        if metadata.get('sha256') == markdown_store.key_for_file(pdf_path).split(':', 1)[1]:
+            return SKIPPED
+        return CONVERT
+
+    def ingest(self, pdf_path: Path) -> Dict:
+        """处理一篇论文，返回 {'file', 'status', 'seconds', 'error'}"""
+        started = time.time()
+        result = {'file': str(pdf_path), 'status': SKIPPED, 'seconds': 0.0, 'error': None}
+        if self.stop_event.is_set():
+            result['status'] = CANCELLED
+            return result
+        try:
+            action = self.plan(pdf_path)
+            if action == SKIPPED:
+                return result
+            if self.dry_run:
+                result['status'] = PENDING if action == CONVERT else action
+                return result
+
+            md_path = pdf_path.with_suffix('.md')
+            engine = None
+            if action == CONVERT:
+                from pdf_converter import ENGINE_STORE
+                tmp = md_path.with_name(f".{md_path.name}.tmp")
+                # 转换器报告结果来源（复用存储 / 本地提取 / MinerU），不需要预先查询存储
+                _, engine = self.converter.convert_with_engine(pdf_path=str(pdf_path), output_path=str(tmp))
+                os.replace(tmp, md_path)
+                result['status'] = REUSED if engine == ENGINE_STORE else CONVERTED
+            else:
+                result['status'] = INDEXED
+            self._write_metadata(pdf_path, md_path, engine, time.time() - started)
+        except Exception as e:
+            result['status'] = FAILED
+            result['error'] = str(e)
+        result['seconds'] = round(time.time() - started, 2)
+        return result
+
+    @staticmethod
+    def _write_metadata(pdf_path: Path, md_path: Path, engine: Optional[str], seconds: float):
+        with open(md_path, 'r', encoding='utf-8') as f:
+            markdown = f.read()
+        sections = build_section_index(markdown)
+        compaction = markdown_compactor.compact_file(md_path)['report'] if markdown_compactor.enabled else None
+        title = next((section['title'] for section in sections if section['level'] == 1), pdf_path.stem)
+        stat = pdf_path.stat()
+        previous = load_metadata(pdf_path) or {}
+        metadata = {
+            'version': METADATA_VERSION,
+            'source': pdf_path.name,
+            'markdown': md_path.name,
+            'title': title,
+            'sha256': markdown_store.key_for_file(pdf_path).split(':', 1)[1],
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'pages': count_pages(pdf_path),
+            'markdown_chars': len(markdown),
+            'sections': sections,
+            # LLM 上下文使用的精简版本：token 估算和减少的比例、移出正文的参考文献条数
+            'compaction': {key: compaction[key] for key in ('tokens', 'compact_tokens', 'reduction', 'references')}
+            if compaction else None,
+            'engine': engine or previous.get('engine'),
+            'conversion_seconds': round(seconds, 2) if engine else previous.get('conversion_seconds'),
+            'ingested_at': datetime.now().isoformat(timespec='seconds'),
+        }
+        _atomic_write_text(metadata_path(pdf_path), json.dumps(metadata, ensure_ascii=False, indent=2))
+
+    def run(self, pdf_paths: List[Path]) -> List[Dict]:
+        """并发处理（最多 concurrency 篇同时转换），按完成顺序输出进度"""
+        results = []
+        total = len(pdf_paths)
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='ingest') as executor:
+            futures = {executor.submit(self.ingest, path): path for path in pdf_paths}
+            for done, future in enumerate(as_completed(futures), start=1):
+                result = future.result()
+                results.append(result)
+                icon = {CONVERTED: '✅', REUSED: '♻️ ', INDEXED: '🗂️ ', SKIPPED: '⏭️ ',
+                        FAILED: '❌', CANCELLED: '🛑'}.get(result['status'], '📝')
+                detail = f"：{result['error']}" if result['error'] else ''
+                print(f"[{done}/{total}] {icon} {result['status']:<9} {Path(result['file']).name}"
+                      f"（{result['seconds']} 秒）{detail}", flush=True)
+        return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='批量导入论文：PDF 并发转换为 Markdown，并生成元数据和章节索引')
+    parser.add_argument('directory', nargs='?', default=str(LOCAL_PAPERS_CONFIG['local_papers_folder']),
+                        help='论文目录（默认 local_papers/）')
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help='同时转换的论文数')
+    parser.add_argument('-r', '--recursive', action='store_true', help='包含子目录')
+    parser.add_argument('--force', action='store_true', help='重新转换所有 PDF（覆盖已有的 Markdown）')
+    parser.add_argument('--dry-run', action='store_true', help='只列出需要处理的文件，不转换')
+    args = parser.parse_args(argv)
+
+    directory = Path(args.directory).expanduser()
+    if not directory.is_dir():
+        print(f"❌ 目录不存在: {directory}")
+        return 1
+
+    converter = None
+    if not args.dry_run:
+        from pdf_converter import pdf_converter as converter
+        if converter is None:
+            print("❌ PDF 转换器不可用（请在 api_config.json 中配置 pdf_converter.api_token，或安装 pypdf 启用本地提取）")
+            return 1
+
+    pdf_paths = PaperIngester.scan(directory, args.recursive)
+    print(f"📚 {directory}: 共 {len(pdf_paths)} 个 PDF，并发数 {args.concurrency}")
+    ingester = PaperIngester(converter, args.concurrency, force=args.force, dry_run=args.dry_run)
+
+    def handle_signal(signum, frame):
+        print("🛑 收到退出信号，等待进行中的转换完成（再次执行即可继续）", flush=True)
+        ingester.stop_event.set()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    started = time.time()
+    results = ingester.run(pdf_paths)
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    summary = '，'.join(f"{status} {count}" for status, count in sorted(counts.items())) or '无'
+    print(f"\n📊 完成（{time.time() - started:.1f} 秒）：{summary}")
+    return 1 if counts.get(FAILED) or counts.get(CANCELLED) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,354 @@
+"""
+后台任务队列模块
+基于 SQLite 的持久化任务队列，Web 进程入队、独立的 worker 进程（conversion_worker.py）领取执行
+
+任务状态：queued → running → succeeded / failed
+- 领取任务在一个写事务中完成（BEGIN IMMEDIATE），多个 worker 进程不会领到同一个任务
+- 执行中的任务持有租约（lease_seconds），worker 定期续约；worker 崩溃后租约过期，任务重新排队
+- 失败的任务按指数退避重试，超过 max_attempts 后标记为 failed
+- 进度（0~1）和进度说明写在任务行上，前端按会话轮询（单行主键 / 索引查询，开销很小）
+- 任务记录在进程重启后依然保留，已结束的任务保留 retention_seconds 后清理
+"""
+import json
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+from config import JOB_QUEUE_CONFIG
+from metrics import metrics
+from logger import get_logger
+
+logger = get_logger('job_queue')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+# 转换任务类型
+PDF_CONVERSION = 'pdf_to_markdown'
+
+# 等待执行耗时直方图的分桶上界（秒）
+WAIT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+class JobQueue:
+    """跨进程的持久化任务队列"""
+
+    def __init__(self):
+        self.db_path = JOB_QUEUE_CONFIG['db_path']
+        self.lease_seconds = JOB_QUEUE_CONFIG.get('lease_seconds', 60)
+        self.max_attempts = JOB_QUEUE_CONFIG.get('max_attempts', 3)
+        self.retry_backoff_seconds = JOB_QUEUE_CONFIG.get('retry_backoff_seconds', 10)
+        self.retention_seconds = JOB_QUEUE_CONFIG.get('retention_seconds', 7 * 24 * 3600)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._init_database()
+
+    @contextmanager
+    def get_connection(self, immediate: bool = False):
+        """
+        获取数据库连接的上下文管理器
+
+        Args:
+            immediate: 是否在事务开始时就获取写锁（领取任务等“先读后写”的操作需要）
+        """
+        conn = sqlite3.connect(
+            str(self.db_path),
+            timeout=10.0,
+            check_same_thread=False,
+            isolation_level=None
+        )
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+            yield conn
+            conn.execute('COMMIT')
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise e
+        finally:
+            conn.close()
+
+    def _init_database(self):
+        """初始化任务表"""
+        conn = sqlite3.connect(str(self.db_path), timeout=10.0)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    session_id TEXT,
+                    status TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    progress REAL NOT NULL DEFAULT 0,
+                    message TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL,
+                    worker_id TEXT,
+                    lease_until REAL,
+                    run_after REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_jobs_pending
+                ON jobs(status, kind, run_after)
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_jobs_session
+                ON jobs(session_id, created_at)
+            ''')
+            conn.commit()
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _row_to_job(row) -> Dict:
+        job = dict(row)
+        job['payload'] = json.loads(job['payload']) if job['payload'] else {}
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    @staticmethod
+    def default_worker_id() -> str:
+        """worker 标识：主机名:进程号"""
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    # ========== 入队与查询 ==========
+
+    def enqueue(self, kind: str, payload: Dict, session_id: Optional[str] = None,
+                max_attempts: Optional[int] = None) -> str:
+        """
+        添加任务
+
+        Args:
+            kind: 任务类型，如 PDF_CONVERSION
+            payload: 任务参数（可 JSON 序列化）
+            session_id: 关联的会话 ID（用于按会话查询进度）
+            max_attempts: 最多尝试次数，默认使用配置
+
+        Returns:
+            job_id: 任务 ID
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.get_connection() as conn:
+            conn.execute('''
+                INSERT INTO jobs (job_id, kind, session_id, status, payload, progress, message,
+                                  attempts, max_attempts, run_after, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, 0, ?, 0, ?, ?, ?, ?)
+            ''', (job_id, kind, session_id, QUEUED, json.dumps(payload, ensure_ascii=False),
+                  '排队中', max_attempts or self.max_attempts, now, now, now))
+        metrics.inc('jobs_enqueued_total', kind=kind)
+        logger.info('job.enqueued', '📥 任务已入队', job_id=job_id, kind=kind, session_id=session_id)
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """按 ID 获取任务"""
+        with self.get_connection() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def latest_for_session(self, session_id: str, kind: Optional[str] = None) -> Optional[Dict]:
+        """会话最近的一个任务（没有时返回 None）"""
+        query = 'SELECT * FROM jobs WHERE session_id = ?'
+        params = [session_id]
+        if kind:
+            query += ' AND kind = ?'
+            params.append(kind)
+        query += ' ORDER BY created_at DESC LIMIT 1'
+        with self.get_connection() as conn:
+            row = conn.execute(query, params).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def stats(self) -> Dict:
+        """各类型、各状态的任务数，以及最早的排队任务已等待的时长"""
+        now = time.time()
+        with self.get_connection() as conn:
+            rows = conn.execute('''
+                SELECT kind, status, COUNT(*) AS count, MIN(created_at) AS oldest
+                FROM jobs GROUP BY kind, status
+            ''').fetchall()
+        result = {}
+        for row in rows:
+            entry = result.setdefault(row['kind'], {QUEUED: 0, RUNNING: 0, SUCCEEDED: 0, FAILED: 0})
+            entry[row['status']] = row['count']
+            if row['status'] == QUEUED:
+                entry['oldest_queued_seconds'] = round(now - row['oldest'], 1)
+        return result
+
+    # ========== 领取与执行 ==========
+
+    def claim(self, kinds: List[str], worker_id: str) -> Optional[Dict]:
+        """
+        领取一个可执行的任务（没有时返回 None）
+
+        可执行：排队中且已到重试时间，或执行中但租约已过期（原 worker 已退出）。
+        租约过期且已用完尝试次数的任务直接标记为 failed。
+        """
+        now = time.time()
+        placeholders = ','.join('?' * len(kinds))
+        with self.get_connection(immediate=True) as conn:
+            expired = conn.execute(f'''
+                SELECT job_id, kind, attempts, max_attempts FROM jobs
+                WHERE status = ? AND lease_until < ? AND kind IN ({placeholders})
+            ''', (RUNNING, now, *kinds)).fetchall()
+            for row in expired:
+                if row['attempts'] >= row['max_attempts']:
+                    conn.execute('''
+                        UPDATE jobs SET status = ?, error = ?, message = ?, finished_at = ?, updated_at = ?
+                        WHERE job_id = ?
+                    ''', (FAILED, 'worker 租约过期', '转换失败', now, now, row['job_id']))
+                    metrics.inc('jobs_finished_total', kind=row['kind'], status=FAILED)
+                else:
+                    conn.execute('UPDATE jobs SET status = ?, run_after = ?, updated_at = ? WHERE job_id = ?',
+                                 (QUEUED, now, now, row['job_id']))
+                logger.warning('job.lease_expired', '⚠️  任务租约过期（worker 可能已退出）',
+                               job_id=row['job_id'], attempts=row['attempts'])
+
+            row = conn.execute(f'''
+                SELECT * FROM jobs
+                WHERE status = ? AND run_after <= ? AND kind IN ({placeholders})
+                ORDER BY run_after, created_at LIMIT 1
+            ''', (QUEUED, now, *kinds)).fetchone()
+            if row is None:
+                return None
+            conn.execute('''
+                UPDATE jobs SET status = ?, attempts = attempts + 1, worker_id = ?, lease_until = ?,
+                                started_at = ?, message = ?, error = NULL, updated_at = ?
+                WHERE job_id = ?
+            ''', (RUNNING, worker_id, now + self.lease_seconds, now, '开始处理', now, row['job_id']))
+
+        job = self._row_to_job(row)
+        job.update(status=RUNNING, attempts=job['attempts'] + 1, worker_id=worker_id)
+        metrics.observe('job_queue_wait_seconds', now - job['run_after'], buckets=WAIT_BUCKETS, kind=job['kind'])
+        return job
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        """
+        续约（worker 执行期间定期调用）
+
+        Returns:
+            bool: 任务是否仍由该 worker 持有（False 时应放弃执行结果）
+        """
+        now = time.time()
+        with self.get_connection() as conn:
+            cursor = conn.execute('''
+                UPDATE jobs SET lease_until = ?, updated_at = ?
+                WHERE job_id = ? AND worker_id = ? AND status = ?
+            ''', (now + self.lease_seconds, now, job_id, worker_id, RUNNING))
+            return cursor.rowcount > 0
+
+    def update_progress(self, job_id: str, worker_id: str, progress: float, message: Optional[str] = None):
+        """更新执行进度（同时续约）"""
+        now = time.time()
+        with self.get_connection() as conn:
+            conn.execute('''
+                UPDATE jobs SET progress = ?, message = COALESCE(?, message), lease_until = ?, updated_at = ?
+                WHERE job_id = ? AND worker_id = ? AND status = ?
+            ''', (max(0.0, min(1.0, progress)), message, now + self.lease_seconds, now,
+                  job_id, worker_id, RUNNING))
+
+    def complete(self, job_id: str, worker_id: str, result: Optional[Dict] = None) -> bool:
+        """标记任务成功（任务已不由该 worker 持有时返回 False）"""
+        now = time.time()
+        with self.get_connection() as conn:
+            row = conn.execute('SELECT kind, started_at FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+            cursor = conn.execute('''
+                UPDATE jobs SET status = ?, result = ?, progress = 1, message = ?, lease_until = NULL,
+                                finished_at = ?, updated_at = ?
+                WHERE job_id = ? AND worker_id = ? AND status = ?
+            ''', (SUCCEEDED, json.dumps(result or {}, ensure_ascii=False), '已完成', now, now,
+                  job_id, worker_id, RUNNING))
+            owned = cursor.rowcount > 0
+        if owned:
+            metrics.inc('jobs_finished_total', kind=row['kind'], status=SUCCEEDED)
+            logger.info('job.succeeded', '✅ 任务完成', job_id=job_id, kind=row['kind'],
+                        seconds=round(now - row['started_at'], 1))
+        return owned
+
+    def fail(self, job_id: str, worker_id: str, error: str, retry: bool = True) -> str:
+        """
+        标记任务执行失败
+
+        Args:
+            retry: 是否允许重试（参数错误等不可恢复的失败传 False）
+
+        Returns:
+            str: 任务的新状态（queued 表示已安排重试）
+        """
+        now = time.time()
+        with self.get_connection(immediate=True) as conn:
+            row = conn.execute('SELECT kind, attempts, max_attempts FROM jobs WHERE job_id = ? AND worker_id = ?',
+                               (job_id, worker_id)).fetchone()
+            if row is None:
+                return FAILED
+            if retry and row['attempts'] < row['max_attempts']:
+                status = QUEUED
+                delay = self.retry_backoff_seconds * (2 ** (row['attempts'] - 1))
+                conn.execute('''
+                    UPDATE jobs SET status = ?, error = ?, message = ?, run_after = ?, lease_until = NULL,
+                                    updated_at = ?
+                    WHERE job_id = ?
+                ''', (QUEUED, error, f"第 {row['attempts']} 次尝试失败，{int(delay)} 秒后重试",
+                      now + delay, now, job_id))
+            else:
+                status = FAILED
+                conn.execute('''
+                    UPDATE jobs SET status = ?, error = ?, message = ?, lease_until = NULL,
+                                    finished_at = ?, updated_at = ?
+                    WHERE job_id = ?
+                ''', (FAILED, error, '转换失败', now, now, job_id))
+        if status == FAILED:
+            metrics.inc('jobs_finished_total', kind=row['kind'], status=FAILED)
+        logger.warning('job.failed', '⚠️  任务执行失败', job_id=job_id, kind=row['kind'],
+                       attempts=row['attempts'], next_status=status, error=error)
+        return status
+
+    def release(self, job_id: str, worker_id: str):
+        """归还未完成的任务（worker 正常退出时调用，任务立即重新排队，不计入尝试次数）"""
+        now = time.time()
+        with self.get_connection() as conn:
+            conn.execute('''
+                UPDATE jobs SET status = ?, attempts = MAX(attempts - 1, 0), worker_id = NULL,
+                                lease_until = NULL, run_after = ?, message = ?, updated_at = ?
+                WHERE job_id = ? AND worker_id = ? AND status = ?
+            ''', (QUEUED, now, '排队中', now, job_id, worker_id, RUNNING))
+
+    def cleanup(self) -> int:
+        """清理超过保留期的已结束任务"""
+        cutoff = time.time() - self.retention_seconds
+        with self.get_connection() as conn:
+            cursor = conn.execute('DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?',
+                                  (SUCCEEDED, FAILED, cutoff))
+            return cursor.rowcount
+
+
+def job_summary(job: Optional[Dict]) -> Optional[Dict]:
+    """返回给前端的任务信息（不含内部字段）"""
+    if job is None:
+        return None
+    return {
+        'job_id': job['job_id'],
+        'status': job['status'],
+        'progress': round(job['progress'], 3),
+        'message': job['message'],
+        'error': job['error'] if job['status'] == FAILED else None,
+        'attempts': job['attempts'],
+        'created_at': job['created_at'],
+        'finished_at': job['finished_at'],
+    }
+
+
+# 全局任务队列
+job_queue = JobQueue()
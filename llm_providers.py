@@ -0,0 +1,300 @@
+"""
+LLM 提供商池模块
+为主提供商和备用提供商分别维护 OpenAI 兼容客户端和熔断器，按可用性选择调用目标
+
+对冲策略（HedgePolicy）：流式请求的首 token 超过该提供商近期首 token 耗时的分位数仍未到达时，
+再发一个对冲请求；对冲比例和额外 token 开销都有上限
+
+熔断器状态：
+- closed：正常放行，统计最近 N 次调用的错误率（慢调用计为失败）
+- open：错误率超过阈值后熔断，open_seconds 内不再向该提供商发送请求
+- half_open：熔断到期后放行少量探测请求，成功则恢复 closed，失败则重新 open
+"""
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+from openai import OpenAI
+from config import CIRCUIT_BREAKER_CONFIG, HEDGING_CONFIG, USAGE_CONFIG
+from metrics import metrics
+from logger import get_logger
+
+logger = get_logger('providers')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# 指标中的状态编码
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    """单个提供商的熔断器（进程内）"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.window_size = CIRCUIT_BREAKER_CONFIG.get('window_size', 20)
+        self.min_calls = CIRCUIT_BREAKER_CONFIG.get('min_calls', 5)
+        self.failure_rate_threshold = CIRCUIT_BREAKER_CONFIG.get('failure_rate_threshold', 0.5)
+        self.slow_call_seconds = CIRCUIT_BREAKER_CONFIG.get('slow_call_seconds', 30)
+        self.open_seconds = CIRCUIT_BREAKER_CONFIG.get('open_seconds', 30)
+        self.half_open_max_probes = CIRCUIT_BREAKER_CONFIG.get('half_open_max_probes', 1)
+
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        self._outcomes = deque(maxlen=self.window_size)  # (success: bool, latency: float)
+        self._lock = threading.Lock()
+        self._publish()
+
+    def allow_request(self) -> bool:
+        """是否允许向该提供商发送请求（半开状态下会占用一个探测名额）"""
+        with self._lock:
+            if self.state == OPEN:
+                if time.time() - self.opened_at < self.open_seconds:
+                    return False
+                self._transition(HALF_OPEN)
+
+            if self.state == HALF_OPEN:
+                if self.probes_in_flight >= self.half_open_max_probes:
+                    return False
+                self.probes_in_flight += 1
+            return True
+
+    def record_success(self, latency: float):
+        """记录成功调用（耗时超过阈值时按慢调用计为失败）"""
+        if latency > self.slow_call_seconds:
+            logger.warning('llm.slow_call', '🐢 提供商慢调用', provider=self.name, seconds=round(latency, 1))
+            self._record(False, latency)
+        else:
+            self._record(True, latency)
+
+    def record_failure(self, latency: float = 0.0):
+        """记录失败调用"""
+        self._record(False, latency)
+
+    def cancel(self):
+        """请求未实际得到提供商的结果（排队被拒、调用方错误、客户端断开）：不计入统计，只归还探测名额"""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.probes_in_flight = max(0, self.probes_in_flight - 1)
+
+    def _record(self, success: bool, latency: float):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.probes_in_flight = max(0, self.probes_in_flight - 1)
+                if success:
+                    self._outcomes.clear()
+                    self._transition(CLOSED)
+                else:
+                    self._transition(OPEN)
+                return
+
+            self._outcomes.append((success, latency))
+            if self.state == CLOSED and len(self._outcomes) >= self.min_calls:
+                if self._failure_rate() >= self.failure_rate_threshold:
+                    self._transition(OPEN)
+
+    def _failure_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        failures = sum(1 for success, _ in self._outcomes if not success)
+        return failures / len(self._outcomes)
+
+    def _transition(self, new_state: str):
+        """状态切换（调用方需持有锁）"""
+        if new_state == self.state:
+            return
+        logger.warning('llm.circuit_transition', '🔌 提供商熔断器状态变化', provider=self.name,
+                       from_state=self.state, to_state=new_state)
+        metrics.inc('llm_circuit_transitions_total', provider=self.name,
+                    from_state=self.state, to_state=new_state)
+        self.state = new_state
+        if new_state == OPEN:
+            self.opened_at = time.time()
+            self.probes_in_flight = 0
+        self._publish()
+
+    def _publish(self):
+        metrics.set_gauge('llm_circuit_state', STATE_CODES[self.state], provider=self.name)
+
+    def snapshot(self) -> Dict:
+        """当前状态（用于监控接口）"""
+        with self._lock:
+            latencies = sorted(latency for _, latency in self._outcomes)
+            return {
+                'state': self.state,
+                'failure_rate': round(self._failure_rate(), 3),
+                'window_calls': len(self._outcomes),
+                'p50_latency': round(latencies[len(latencies) // 2], 3) if latencies else None,
+                'opened_at': self.opened_at or None,
+            }
+
+
+class LLMProvider:
+    """一个已配置的 LLM 提供商（客户端 + 模型参数 + 熔断器）"""
+
+    def __init__(self, config: Dict, timeout: float, rate_limits: Dict):
+        self.name = config['name']
+        self.model = config['model']
+        self.temperature = config['temperature']
+        self.max_tokens = config['max_tokens']
+        self.rate_limits = rate_limits
+
+        client_kwargs = {
+            'api_key': config['api_key'],
+            'timeout': timeout,
+            # 重试由编排器统一负责（带抖动退避并与限流器协同），关闭 SDK 内置重试
+            'max_retries': 0,
+        }
+        if config.get('base_url'):
+            client_kwargs['base_url'] = config['base_url']
+        self.base_url = client_kwargs.get('base_url', 'default')
+
+        self.client = OpenAI(**client_kwargs)
+        self.breaker = CircuitBreaker(self.name)
+        self._ttft_samples = deque(maxlen=HEDGING_CONFIG.get('ttft_window', 200))
+        # 流式请求是否附带 stream_options.include_usage（提供商拒绝该参数时关闭）
+        self.stream_usage = USAGE_CONFIG.get('stream_include_usage', True)
+
+    def record_ttft(self, seconds: float):
+        """记录一次流式调用的首 token 耗时"""
+        self._ttft_samples.append(seconds)
+
+    def ttft_percentile(self, percentile: float) -> Optional[float]:
+        """近期首 token 耗时的分位数，样本不足时返回 None"""
+        samples = sorted(self._ttft_samples)
+        if len(samples) < HEDGING_CONFIG.get('min_samples', 20):
+            return None
+        index = min(len(samples) - 1, int(percentile * len(samples)))
+        return samples[index]
+
+    @property
+    def is_gemini(self) -> bool:
+        return 'gemini' in self.model.lower()
+
+
+class ProviderPool:
+    """按优先顺序排列的提供商池"""
+
+    def __init__(self, providers: List[LLMProvider]):
+        self.providers = providers
+
+    @property
+    def primary(self) -> LLMProvider:
+        return self.providers[0]
+
+    def select(
+        self,
+        exclude: Optional[List[str]] = None,
+        allow_repeat: bool = True,
+        reason: Optional[str] = None
+    ) -> Optional[LLMProvider]:
+        """
+        选择下一个可用的提供商（按配置顺序，跳过熔断中的提供商）
+
+        Args:
+            exclude: 本次调用中已经失败过的提供商名称（有其他可选时跳过）
+            allow_repeat: 没有其他可选时是否允许再次选择 exclude 中的提供商
+            reason: 选中备用提供商时记录的原因（默认按 exclude 推断为 retry / circuit_open）
+
+        Returns:
+            LLMProvider: 可用的提供商，没有可用提供商时返回 None
+        """
+        exclude = exclude or []
+        preferred = [p for p in self.providers if p.name not in exclude]
+        fallback = [p for p in self.providers if p.name in exclude] if allow_repeat else []
+
+        for provider in preferred + fallback:
+            if provider.breaker.allow_request():
+                if provider is not self.primary:
+                    reason = reason or ('retry' if exclude else 'circuit_open')
+                    logger.info('llm.failover', '🔀 故障转移', from_provider=self.primary.name,
+                                to_provider=provider.name, reason=reason)
+                    metrics.inc('llm_failover_total', from_provider=self.primary.name,
+                                to_provider=provider.name, reason=reason)
+                return provider
+        return None
+
+    def snapshot(self) -> List[Dict]:
+        """所有提供商的熔断器状态"""
+        return [
+            dict(provider=p.name, model=p.model, **p.breaker.snapshot())
+            for p in self.providers
+        ]
+
+
+class HedgePolicy:
+    """流式请求对冲策略（进程内预算）"""
+
+    def __init__(self):
+        self.enabled = HEDGING_CONFIG.get('enabled', False)
+        self.percentile = HEDGING_CONFIG.get('percentile', 0.95)
+        self.default_delay = HEDGING_CONFIG.get('default_delay_seconds', 8.0)
+        self.min_delay = HEDGING_CONFIG.get('min_delay_seconds', 2.0)
+        self.max_delay = HEDGING_CONFIG.get('max_delay_seconds', 15.0)
+        self.window_size = HEDGING_CONFIG.get('window_size', 100)
+        self.max_hedge_rate = HEDGING_CONFIG.get('max_hedge_rate', 0.1)
+        self.max_token_overhead = HEDGING_CONFIG.get('max_token_overhead', 0.1)
+        self.prefer_alternate = HEDGING_CONFIG.get('prefer_alternate', True)
+
+        self._window = deque(maxlen=self.window_size)  # (tokens, hedge_tokens)
+        # 已发起、尚未结束的对冲（提供商卡顿时多个流式请求会同时申请，未结束的对冲也要计入预算）
+        self._pending_hedges = 0
+        self._pending_tokens = 0
+        self._pending_extra = 0
+        self._lock = threading.Lock()
+
+    def delay_for(self, provider: LLMProvider) -> float:
+        """等待首 token 多久后发起对冲"""
+        delay = provider.ttft_percentile(self.percentile)
+        if delay is None:
+            delay = self.default_delay
+        return min(self.max_delay, max(self.min_delay, delay))
+
+    def try_acquire(self, tokens: int, hedge_tokens: int) -> bool:
+        """
+        检查发起一次对冲是否仍在预算内，在预算内时预留（请求结束时由 record(..., reserved=True) 结算）
+
+        进行中的对冲按已发生计入；窗口未填满时按 window_size 折算，避免启动初期因样本太少而无法对冲。
+
+        Args:
+            tokens: 本次流式请求的估算 token 数
+            hedge_tokens: 对冲请求的估算额外 token 数
+        """
+        with self._lock:
+            calls = len(self._window) + self._pending_hedges + 1
+            hedged = sum(1 for _, extra in self._window if extra) + self._pending_hedges + 1
+            total_tokens = sum(t for t, _ in self._window) + self._pending_tokens + tokens
+            total_extra = sum(extra for _, extra in self._window) + self._pending_extra + hedge_tokens
+
+            scale = max(1.0, self.window_size / calls)
+            if hedged > self.max_hedge_rate * calls * scale:
+                return False
+            if total_extra > self.max_token_overhead * total_tokens * scale:
+                return False
+            self._pending_hedges += 1
+            self._pending_tokens += tokens
+            self._pending_extra += hedge_tokens
+            return True
+
+    def record(self, tokens: int, hedge_tokens: int = 0, reserved: bool = False):
+        """
+        记录一次已结束的流式请求
+
+        Args:
+            reserved: 是否发起过对冲（结算 try_acquire 时的预留，tokens / hedge_tokens 与申请时相同）
+        """
+        with self._lock:
+            if reserved:
+                self._pending_hedges -= 1
+                self._pending_tokens -= tokens
+                self._pending_extra -= hedge_tokens
+            self._window.append((tokens, hedge_tokens))
+            calls = len(self._window)
+            hedged = sum(1 for _, extra in self._window if extra)
+            total_tokens = sum(t for t, _ in self._window) or 1
+            total_extra = sum(extra for _, extra in self._window)
+        metrics.set_gauge('llm_hedge_rate', round(hedged / calls, 4))
+        metrics.set_gauge('llm_hedge_token_overhead', round(total_extra / total_tokens, 4))
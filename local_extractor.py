@@ -0,0 +1,122 @@
+"""
+本地 PDF 文本提取模块
+文字型 PDF 直接在本地解析为 Markdown（不上传 PDF、不调用 MinerU），扫描件和公式较多的 PDF 仍交给 MinerU
+
+- 基于纯 Python 的 pypdf（可选依赖，未安装时所有 PDF 都交给 MinerU）
+- 解析是 CPU 密集型的，在进程池中执行，不占用 Web / 转换进程的 GIL；页数较多的 PDF 按页码区间拆分并行提取
+- 版面解析在 pdf_layout 中（只依赖 pypdf），进程池以 forkserver 启动，不从多线程的 Web / 转换进程直接 fork
+- 先抽样检查文本密度（analyze）：有文字的页面比例过低（扫描件）、乱码或数学符号比例过高（公式较多）时交给 MinerU
+- 按字号识别标题：正文字号取字符数最多的字号，更大的字号从大到小依次对应 #、##、###、####；
+  加粗的编号行（如 "2.1 Method"）和中文编号行（如 "一、引言"）也识别为标题
+"""
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional
+from config import LOCAL_EXTRACTION_CONFIG
+from metrics import metrics
+from logger import get_logger
+from pdf_layout import (
+    PdfReader, ROUTE_LOCAL, ROUTE_MINERU,
+    analyze_pdf, build_markdown, extract_markdown, extract_page_lines,
+)
+
+logger = get_logger('local_extractor')
+
+# 本地提取耗时直方图的分桶上界（秒）
+EXTRACTION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+# ========== 进程池 ==========
+
+class LocalExtractor:
+    """在进程池中执行本地提取"""
+
+    def __init__(self):
+        self.enabled = LOCAL_EXTRACTION_CONFIG.get('enabled', True) and PdfReader is not None
+        self.processes = max(1, LOCAL_EXTRACTION_CONFIG.get('processes') or os.cpu_count() or 1)
+        self.pages_per_task = max(1, LOCAL_EXTRACTION_CONFIG.get('pages_per_task', 8))
+        self.timeout = LOCAL_EXTRACTION_CONFIG.get('timeout', 120)
+        self.max_pdf_bytes = LOCAL_EXTRACTION_CONFIG.get('max_pdf_bytes', 100 * 1024 * 1024)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # 首次使用时创建（gunicorn fork 出的 worker 中重新创建）
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                # 不直接 fork：Web / 转换进程是多线程的，fork 出的子进程可能继承其他线程持有的锁。
+                # forkserver 只预先导入 pdf_layout，子进程从这个单线程的服务进程 fork 出来
+                if 'forkserver' in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context('forkserver')
+                    context.set_forkserver_preload(['pdf_layout'])
+                else:
+                    context = multiprocessing.get_context('spawn')
+                self._executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=context)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _run(self, step: str, func, *args):
+        return self._run_many(step, func, [args])[0]
+
+    def _run_many(self, step: str, func, calls: List[tuple]) -> List:
+        """并发执行多次 func(*args)，按 calls 的顺序返回结果（整体超时为 self.timeout）"""
+        started = time.time()
+        executor = self._pool()
+        futures = [executor.submit(func, *args) for args in calls]
+        deadline = started + self.timeout
+        try:
+            return [future.result(timeout=max(0.0, deadline - time.time())) for future in futures]
+        except FutureTimeoutError:
+            # 卡住的子进程会一直占用进程池，直接终止整个进程池（下次使用时重建）
+            self._reset(executor, terminate=True)
+            raise TimeoutError(f"本地提取超时（超过 {self.timeout} 秒）")
+        except BrokenProcessPool:
+            self._reset(executor)
+            raise
+        finally:
+            for future in futures:
+                future.cancel()
+            metrics.observe('local_extraction_duration_seconds', time.time() - started,
+                            buckets=EXTRACTION_BUCKETS, step=step)
+
+    def _reset(self, executor: ProcessPoolExecutor, terminate: bool = False):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        if terminate:
+            for process in list((getattr(executor, '_processes', None) or {}).values()):
+                process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def analyze(self, pdf_path) -> Dict:
+        """抽样检查文本密度（见 analyze_pdf）"""
+        return self._run('analyze', analyze_pdf, str(pdf_path), LOCAL_EXTRACTION_CONFIG)
+
+    def extract(self, pdf_path, pages: Optional[int] = None) -> str:
+        """
+        提取整份 PDF 为 Markdown
+
+        提供页数（如 analyze 的结果）且超过 pages_per_task 时按页码区间拆分，各区间在进程池中并行提取，
+        合并后再统一识别标题和段落（正文字号、标题层级按全文统计，跨区间的段落照常接起来）
+        """
+        if not pages or pages <= self.pages_per_task:
+            return self._run('extract', extract_markdown, str(pdf_path), LOCAL_EXTRACTION_CONFIG)
+        ranges = [(str(pdf_path), start, min(start + self.pages_per_task, pages))
+                  for start in range(0, pages, self.pages_per_task)]
+        parts = self._run_many('extract', extract_page_lines, ranges)
+        return build_markdown([line for part in parts for line in part], LOCAL_EXTRACTION_CONFIG)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+# 全局本地提取器
+local_extractor = LocalExtractor()
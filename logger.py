@@ -0,0 +1,211 @@
+"""
+结构化日志模块
+替代请求热路径上的 print：带级别、高频事件按比例采样、经队列由后台线程输出（请求线程只做一次入队）
+
+- 每条日志由事件名（如 'llm.call_failed'）、可读消息和结构化字段组成
+- 输出格式：text（时间 + 级别 + 消息 + key=value）或 json（每行一个对象，便于日志系统解析）
+- 高频事件按 LOGGING_CONFIG['sample_rates'] 采样；WARNING 及以上级别不采样
+- 队列满时直接丢弃并计数（log_dropped_total），不会阻塞请求线程
+- 响应、用户消息等内容预览默认关闭（payload_previews），只记录长度
+- 在链路追踪中时自动带上 trace_id
+
+用法：
+    from logger import get_logger, preview
+    logger = get_logger('orchestrator')
+    logger.info('agent.responded', '🤖 智能体已响应', agent='method', chars=len(text), preview=preview(text))
+
+值为 None 的字段不输出。
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from typing import Dict, Optional
+from config import LOGGING_CONFIG
+from metrics import metrics
+from tracing import tracer, Span
+
+ROOT_LOGGER = 'reading_agent'
+
+_sample_rates: Dict[str, float] = LOGGING_CONFIG.get('sample_rates', {})
+_listener: Optional[logging.handlers.QueueListener] = None
+_configure_lock = threading.Lock()
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """非阻塞的队列处理器：队列满时丢弃日志"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc('log_dropped_total')
+
+    def prepare(self, record):
+        # 队列只在进程内使用，不需要序列化；格式化留给输出线程
+        return record
+
+
+class TextFormatter(logging.Formatter):
+    """文本格式：时间 级别 [模块] 消息 key=value ..."""
+
+    def format(self, record):
+        fields = getattr(record, 'fields', None) or {}
+        parts = [
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.created)),
+            f"{record.levelname:<7}",
+            f"[{record.name.rsplit('.', 1)[-1]}]",
+            record.getMessage(),
+        ]
+        parts.extend(f"{key}={_text_value(value)}" for key, value in fields.items())
+        trace_id = getattr(record, 'trace_id', None)
+        if trace_id:
+            parts.append(f"trace_id={trace_id}")
+        line = ' '.join(parts)
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """JSON 格式：每条日志一行"""
+
+    def format(self, record):
+        data = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': getattr(record, 'event', None),
+            'message': record.getMessage(),
+            'pid': record.process,
+        }
+        trace_id = getattr(record, 'trace_id', None)
+        if trace_id:
+            data['trace_id'] = trace_id
+        data.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def _text_value(value) -> str:
+    text = str(value)
+    if not text or any(c in text for c in ' \n"='):
+        return json.dumps(text, ensure_ascii=False)
+    return text
+
+
+def configure():
+    """配置根日志器和后台输出线程（首次获取日志器时自动调用；fork 后在子进程中重新启动输出线程）"""
+    global _listener
+    with _configure_lock:
+        if _listener is not None:
+            return
+        root = logging.getLogger(ROOT_LOGGER)
+        root.setLevel(LOGGING_CONFIG.get('level', 'INFO').upper())
+        root.propagate = False
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+
+        output = logging.StreamHandler(sys.stdout)
+        if LOGGING_CONFIG.get('format') == 'json':
+            output.setFormatter(JsonFormatter())
+        else:
+            output.setFormatter(TextFormatter())
+
+        log_queue = queue.Queue(maxsize=LOGGING_CONFIG.get('queue_size', 10000))
+        root.addHandler(_DroppingQueueHandler(log_queue))
+        _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+        _listener.start()
+
+
+def shutdown():
+    """输出队列中剩余的日志并停止输出线程"""
+    global _listener
+    with _configure_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def _after_fork():
+    # 输出线程不会随 fork 复制到子进程（如 gunicorn --preload），子进程需要重新配置
+    global _listener, _configure_lock
+    _configure_lock = threading.Lock()
+    if _listener is not None:
+        _listener = None
+        configure()
+
+
+atexit.register(shutdown)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+class StructuredLogger:
+    """带事件名和结构化字段的日志器"""
+
+    def __init__(self, name: str):
+        self._logger = logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+    def is_enabled(self, level: int) -> bool:
+        return self._logger.isEnabledFor(level)
+
+    def _log(self, level: int, event: str, message: str, fields: Dict, exc_info=False):
+        if not self._logger.isEnabledFor(level):
+            return
+        if level < logging.WARNING:
+            rate = _sample_rates.get(event)
+            if rate is not None and random.random() >= rate:
+                return
+        span = tracer.current_span()
+        self._logger.log(level, message, exc_info=exc_info, extra={
+            'event': event,
+            'fields': {key: value for key, value in fields.items() if value is not None},
+            'trace_id': span.trace.trace_id if isinstance(span, Span) else None,
+        })
+
+    def debug(self, event: str, message: str, **fields):
+        self._log(logging.DEBUG, event, message, fields)
+
+    def info(self, event: str, message: str, **fields):
+        self._log(logging.INFO, event, message, fields)
+
+    def warning(self, event: str, message: str, **fields):
+        self._log(logging.WARNING, event, message, fields)
+
+    def error(self, event: str, message: str, **fields):
+        self._log(logging.ERROR, event, message, fields)
+
+    def exception(self, event: str, message: str, **fields):
+        """ERROR 级别，附带当前异常的堆栈（在 except 块中调用）"""
+        self._log(logging.ERROR, event, message, fields, exc_info=True)
+
+
+def get_logger(name: str) -> StructuredLogger:
+    """
+    获取模块日志器
+
+    Args:
+        name: 模块名（输出时显示在 [ ] 中），如 'orchestrator'、'db'
+    """
+    configure()
+    return StructuredLogger(name)
+
+
+def preview(text: Optional[str]) -> Optional[str]:
+    """
+    内容预览：开启 payload_previews 时返回截断后的内容，否则返回 None（该字段不输出）
+
+    生产环境默认关闭，避免用户消息和模型回复进入日志系统
+    """
+    if not LOGGING_CONFIG.get('payload_previews') or text is None:
+        return None
+    limit = LOGGING_CONFIG.get('preview_chars', 200)
+    return text if len(text) <= limit else text[:limit] + '…'
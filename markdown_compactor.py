@@ -0,0 +1,460 @@
+"""
+Markdown 精简模块
+把转换得到的论文 Markdown 精简后再放入 LLM 上下文：同样的上下文窗口能容纳更多正文，token 消耗更少
+
+处理步骤（MARKDOWN_COMPACTION_CONFIG['passes'] 选择启用哪些，按以下固定顺序执行，代码块内的内容不处理）：
+- strip_images：去掉图片标记（![](images/xx.jpg)、<img>），有替代文字时保留替代文字
+- collapse_tables：HTML 表格和 Markdown 表格压缩为每行一条 "单元格 | 单元格" 的紧凑文本
+- split_references：参考文献章节移到单独的文件，正文只保留标题和条数
+- dedupe_furniture：去掉单独成行的页码，以及在页码附近（分页处）重复出现的页眉页脚（行尾的页码忽略，表格行不处理）
+- normalize_whitespace：去掉零宽字符、行尾空白、连续空白、只有符号的噪声行，连续空行合并为一个
+
+原 Markdown 不变。精简结果按（Markdown 内容哈希, 配置指纹）缓存在 root/<前 2 位>/<哈希>-<指纹>/ 下：
+compact.md（精简后的正文）、references.md（参考文献）、report.json（各步骤减少的字符数和 token 估算）
+
+用法（查看论文的精简效果）：
+    python markdown_compactor.py local_papers/                 # 目录下的所有 Markdown
+    python markdown_compactor.py markdown/paper.md --show      # 输出精简后的正文
+"""
+import argparse
+import hashlib
+import html
+import json
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from config import MARKDOWN_COMPACTION_CONFIG
+from metrics import metrics
+from logger import get_logger
+
+logger = get_logger('markdown_compactor')
+
+# 处理逻辑变化时递增，旧的缓存结果随之失效
+COMPACTION_VERSION = 2
+
+# 精简比例直方图的分桶上界（减少的 token 占比）
+REDUCTION_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.8)
+
+# 进程内缓存的精简结果数
+MEMORY_CACHE_SIZE = 32
+
+FENCE = ('```', '~~~')
+
+IMAGE_MARKDOWN = re.compile(r'!\[([^\]]*)\]\([^)]*\)')
+IMAGE_HTML = re.compile(r'<img\b[^>]*>', re.IGNORECASE)
+HTML_TABLE = re.compile(r'<table\b.*?</table>', re.IGNORECASE | re.DOTALL)
+HTML_ROW = re.compile(r'<tr\b[^>]*>(.*?)</tr>', re.IGNORECASE | re.DOTALL)
+HTML_CELL = re.compile(r'<t[dh]\b[^>]*>(.*?)</t[dh]>', re.IGNORECASE | re.DOTALL)
+HTML_TAG = re.compile(r'<[^>]+>')
+TABLE_SEPARATOR = re.compile(r'^\|?\s*:?-{3,}:?\s*(\|\s*:?-{3,}:?\s*)*\|?$')
+HEADING = re.compile(r'^(#{1,6})\s+(.*)$')
+# 标题前的编号：7.、7.1、A、一、
+HEADING_NUMBER = re.compile(r'^(?:(?:[0-9]+(?:\.[0-9]+)*|[A-Z])(?:\.\s*|\s+)|[一二三四五六七八九十]+、\s*)')
+REFERENCE_ENTRY = re.compile(r'^\s*(?:\[\d+\]|\d+[.)、]\s|[-*+]\s)')
+TRAILING_PAGE_NUMBER = re.compile(r'\d{1,4}$')
+PAGE_NUMBER = re.compile(r'^(?:[-–—]\s*)?(?:page\s*)?\d{1,4}(?:\s*(?:/|of)\s*\d{1,4})?(?:\s*[-–—])?$'
+                         r'|^第\s*\d+\s*页(?:\s*[,，/]?\s*共\s*\d+\s*页)?$', re.IGNORECASE)
+HORIZONTAL_RULE = re.compile(r'^(?:-{3,}|\*{3,}|_{3,}|(?:[-*_]\s){2,}[-*_])$')
+INVISIBLE = re.compile(r'[\u200b-\u200d\u2060\ufeff\x00-\x08\x0b\x0c\x0e-\x1f\x7f]')
+INLINE_SPACES = re.compile(r'(?<=\S)[ \t\u00a0\u3000]{2,}')
+BLANK_LINES = re.compile(r'\n{3,}')
+
+
+def estimate_tokens(text: str, chars_per_token: float = 2.0) -> int:
+    return int(len(text or '') / chars_per_token)
+
+
+def _segments(text: str) -> List[Tuple[bool, str]]:
+    """按代码块切分：[(是否代码块, 文本), ...]"""
+    segments, current, in_code = [], [], False
+    for line in text.splitlines(keepends=True):
+        if line.lstrip().startswith(FENCE):
+            if in_code:
+                current.append(line)
+                segments.append((True, ''.join(current)))
+                current, in_code = [], False
+                continue
+            if current:
+                segments.append((False, ''.join(current)))
+            current, in_code = [line], True
+            continue
+        current.append(line)
+    if current:
+        segments.append((in_code, ''.join(current)))
+    return segments
+
+
+def _map_prose(text: str, func) -> str:
+    """只对代码块以外的内容执行 func"""
+    return ''.join(segment if is_code else func(segment) for is_code, segment in _segments(text))
+
+
+def _prose_lines(text: str) -> List[Tuple[bool, str]]:
+    """逐行标记是否在代码块内：[(是否代码块, 行), ...]"""
+    return [(is_code, line) for is_code, segment in _segments(text)
+            for line in segment.splitlines(keepends=True)]
+
+
+# ========== 处理步骤 ==========
+
+def strip_images(text: str) -> str:
+    def replace(match):
+        alt = match.group(1).strip()
+        return f"[图：{alt}]" if alt else ''
+
+    return _map_prose(text, lambda prose: IMAGE_HTML.sub('', IMAGE_MARKDOWN.sub(replace, prose)))
+
+
+def _clean_cell(cell: str) -> str:
+    return ' '.join(html.unescape(HTML_TAG.sub(' ', cell)).split())
+
+
+def _collapse_html_table(match) -> str:
+    rows = []
+    for row in HTML_ROW.findall(match.group(0)):
+        cells = [_clean_cell(cell) for cell in HTML_CELL.findall(row)]
+        if any(cells):
+            rows.append(' | '.join(cells))
+    return '\n\n' + '\n'.join(rows) + '\n\n' if rows else '\n'
+
+
+def _collapse_pipe_tables(prose: str) -> str:
+    lines = []
+    for line in prose.splitlines(keepends=True):
+        stripped = line.strip()
+        if stripped.startswith('|') and stripped.endswith('|') and len(stripped) > 1:
+            if TABLE_SEPARATOR.match(stripped):
+                continue
+            cells = [cell.strip() for cell in stripped[1:-1].split('|')]
+            line = ' | '.join(cells) + '\n'
+        lines.append(line)
+    return ''.join(lines)
+
+
+def collapse_tables(text: str) -> str:
+    return _map_prose(text, lambda prose: _collapse_pipe_tables(HTML_TABLE.sub(_collapse_html_table, prose)))
+
+
+def _reference_heading_level(line: str, names) -> Optional[int]:
+    """参考文献标题的层级（不带 # 的单独一行记为 7），不是参考文献标题时返回 None"""
+    stripped = line.strip()
+    match = HEADING.match(stripped)
+    level, title = (len(match.group(1)), match.group(2)) if match else (7, stripped)
+    title = HEADING_NUMBER.sub('', title.strip('*_ ').rstrip(':：').strip())
+    return level if title.lower() in names else None
+
+
+def split_references(text: str, names) -> Tuple[str, str, int]:
+    """
+    把最后一个参考文献章节（到下一个同级或更高级标题为止）移出正文
+
+    Returns:
+        (正文, 参考文献, 条数)
+    """
+    names = {name.lower() for name in names}
+    lines = _prose_lines(text)
+    start, level = None, None
+    for index, (is_code, line) in enumerate(lines):
+        if not is_code:
+            found = _reference_heading_level(line, names)
+            if found is not None:
+                start, level = index, found
+    if start is None:
+        return text, '', 0
+
+    end = len(lines)
+    for index in range(start + 1, len(lines)):
+        is_code, line = lines[index]
+        match = HEADING.match(line.strip())
+        if not is_code and match and len(match.group(1)) <= level:
+            end = index
+            break
+
+    entries = [line for _, line in lines[start + 1:end] if line.strip()]
+    numbered = sum(1 for line in entries if REFERENCE_ENTRY.match(line))
+    if numbered:
+        count = numbered
+    else:
+        body = ''.join(line for _, line in lines[start + 1:end]).strip()
+        count = len([block for block in re.split(r'\n\s*\n', body) if block.strip()]) if body else 0
+    if not count:
+        return text, '', 0
+
+    heading = lines[start][1].rstrip('\n')
+    references = heading + '\n\n' + ''.join(line for _, line in lines[start + 1:end]).strip() + '\n'
+    note = f"{heading}\n\n（共 {count} 条参考文献，已移出正文）\n\n"
+    body = ''.join(line for _, line in lines[:start]) + note + ''.join(line for _, line in lines[end:])
+    return body, references, count
+
+
+def _furniture_key(line: str) -> str:
+    """页眉页脚的比较键：只忽略行尾的页码（"Journal of X 12" 与 "Journal of X 13" 相同）"""
+    return TRAILING_PAGE_NUMBER.sub('#', ' '.join(line.split())).lower()
+
+
+def _is_furniture_candidate(stripped: str, max_chars: int) -> bool:
+    # collapse_tables 产生的 "单元格 | 单元格" 行是表格内容，不是页眉页脚
+    return (6 <= len(stripped) <= max_chars and not stripped.startswith(('#', '|', '$', '!', '>'))
+            and ' | ' not in stripped and any(char.isalpha() for char in stripped))
+
+
+def _near_page_breaks(lines: List[Tuple[bool, str]], window: int) -> set:
+    """分页处（单独成行的页码或换页符）前后各 window 个非空行的下标"""
+    near = set()
+    for index, (is_code, line) in enumerate(lines):
+        if is_code or not (PAGE_NUMBER.match(line.strip()) or '\f' in line):
+            continue
+        for step in (-1, 1):
+            position, seen = index + step, 0
+            while 0 <= position < len(lines) and seen < window:
+                if lines[position][0]:
+                    break
+                if lines[position][1].strip():
+                    near.add(position)
+                    seen += 1
+                position += step
+    return near
+
+
+def dedupe_furniture(text: str, min_repeats: int = 3, max_chars: int = 80, window: int = 2) -> str:
+    """
+    去掉单独成行的页码，以及页眉页脚：在分页处（页码前后 window 个非空行内）重复出现至少 min_repeats 次的短行
+
+    Markdown 中只有页码能标出分页位置；没有页码时只按页码处理，正文中重复的短行（如表格行、公式编号）不受影响
+    """
+    lines = _prose_lines(text)
+    near = _near_page_breaks(lines, window)
+    counts = {}
+    for index in near:
+        stripped = lines[index][1].strip()
+        if _is_furniture_candidate(stripped, max_chars):
+            key = _furniture_key(stripped)
+            counts[key] = counts.get(key, 0) + 1
+
+    kept = []
+    for index, (is_code, line) in enumerate(lines):
+        stripped = line.strip()
+        if not is_code and stripped:
+            if PAGE_NUMBER.match(stripped):
+                continue
+            if (index in near and _is_furniture_candidate(stripped, max_chars)
+                    and counts[_furniture_key(stripped)] >= min_repeats):
+                continue
+        kept.append(line)
+    return ''.join(kept)
+
+
+def _is_noise(stripped: str) -> bool:
+    """只有符号、没有文字的行（OCR 噪声）；分隔线、表格行和公式保留"""
+    if not stripped or any(char.isalnum() for char in stripped):
+        return False
+    if HORIZONTAL_RULE.match(stripped) or stripped.startswith(('|', '>')) or '$' in stripped or '\\' in stripped:
+        return False
+    return True
+
+
+def _normalize_prose(prose: str) -> str:
+    lines = []
+    for line in INVISIBLE.sub('', prose).splitlines():
+        line = INLINE_SPACES.sub(' ', line.rstrip())
+        if _is_noise(line.strip()):
+            continue
+        lines.append(line)
+    return BLANK_LINES.sub('\n\n', '\n'.join(lines) + '\n')
+
+
+def normalize_whitespace(text: str) -> str:
+    return _map_prose(text, _normalize_prose).strip() + '\n'
+
+
+# 执行顺序
+PASSES = ('strip_images', 'collapse_tables', 'split_references', 'dedupe_furniture', 'normalize_whitespace')
+
+
+class MarkdownCompactor:
+    """按配置执行精简步骤，结果按内容缓存"""
+
+    def __init__(self):
+        self.enabled = MARKDOWN_COMPACTION_CONFIG.get('enabled', True)
+        self.root = Path(MARKDOWN_COMPACTION_CONFIG['root'])
+        configured = MARKDOWN_COMPACTION_CONFIG.get('passes', list(PASSES))
+        unknown = [name for name in configured if name not in PASSES]
+        if unknown:
+            logger.warning('compaction.unknown_passes', '⚠️  未知的 Markdown 精简步骤，已忽略', passes=unknown)
+        self.passes = [name for name in PASSES if name in configured]
+        self.furniture_min_repeats = MARKDOWN_COMPACTION_CONFIG.get('furniture_min_repeats', 3)
+        self.furniture_max_chars = MARKDOWN_COMPACTION_CONFIG.get('furniture_max_chars', 80)
+        self.reference_headings = list(MARKDOWN_COMPACTION_CONFIG.get('reference_headings', ['references', '参考文献']))
+        self.chars_per_token = MARKDOWN_COMPACTION_CONFIG.get('chars_per_token', 2.0)
+
+        # 进程内缓存：path -> (mtime_ns, size, 结果)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def fingerprint(self) -> str:
+        """影响精简结果的配置指纹（也用于响应缓存的键：精简方式变化后缓存的生成结果随之失效）"""
+        if not self.enabled:
+            return 'raw'
+        options = {
+            'version': COMPACTION_VERSION,
+            'passes': self.passes,
+            'furniture_min_repeats': self.furniture_min_repeats,
+            'furniture_max_chars': self.furniture_max_chars,
+            'reference_headings': sorted(name.lower() for name in self.reference_headings),
+        }
+        return hashlib.sha256(json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+    def compact(self, markdown: str) -> Tuple[str, str, Dict]:
+        """
+        精简 Markdown
+
+        Returns:
+            (精简后的正文, 参考文献（没有时为空字符串）, 报告)
+        """
+        text, references, reference_count = markdown, '', 0
+        saved = {}
+        for name in self.passes:
+            before = len(text)
+            if name == 'strip_images':
+                text = strip_images(text)
+            elif name == 'collapse_tables':
+                text = collapse_tables(text)
+            elif name == 'split_references':
+                text, references, reference_count = split_references(text, self.reference_headings)
+            elif name == 'dedupe_furniture':
+                text = dedupe_furniture(text, self.furniture_min_repeats, self.furniture_max_chars)
+            elif name == 'normalize_whitespace':
+                text = normalize_whitespace(text)
+            saved[name] = before - len(text)
+
+        tokens = estimate_tokens(markdown, self.chars_per_token)
+        compact_tokens = estimate_tokens(text, self.chars_per_token)
+        report = {
+            'version': COMPACTION_VERSION,
+            'passes': self.passes,
+            'chars': len(markdown),
+            'compact_chars': len(text),
+            'tokens': tokens,
+            'compact_tokens': compact_tokens,
+            'reduction': round(1 - compact_tokens / tokens, 3) if tokens else 0.0,
+            'saved_chars': saved,
+            'references': reference_count,
+        }
+        return text, references, report
+
+    def compact_file(self, markdown_path) -> Dict:
+        """
+        精简 Markdown 文件（结果按内容缓存，同一份 Markdown 只处理一次）
+
+        Returns:
+            {'text': 精简后的正文, 'report': 报告, 'compact_path': 路径, 'references_path': 路径或 None}
+        """
+        markdown_path = str(markdown_path)
+        stat = os.stat(markdown_path)
+        with self._lock:
+            cached = self._cache.get(markdown_path)
+            if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+                self._cache.move_to_end(markdown_path)
+                return cached[2]
+
+        with open(markdown_path, 'rb') as f:
+            raw = f.read()
+        digest = hashlib.sha256(raw).hexdigest()
+        directory = self.root / digest[:2] / f"{digest}-{self.fingerprint}"
+        report_path = directory / 'report.json'
+        references_path = directory / 'references.md'
+
+        if report_path.exists():
+            with open(report_path, 'r', encoding='utf-8') as f:
+                report = json.load(f)
+            with open(directory / 'compact.md', 'r', encoding='utf-8') as f:
+                text = f.read()
+            metrics.inc('markdown_compactions_total', result='cached')
+        else:
+            text, references, report = self.compact(raw.decode('utf-8', errors='replace'))
+            directory.mkdir(parents=True, exist_ok=True)
+            _atomic_write_text(directory / 'compact.md', text)
+            if references:
+                _atomic_write_text(references_path, references)
+            # report.json 最后写入：存在即表示该目录完整
+            _atomic_write_text(report_path, json.dumps(report, ensure_ascii=False, indent=2))
+            metrics.inc('markdown_compactions_total', result='computed')
+            metrics.observe('markdown_compaction_reduction_ratio', report['reduction'], buckets=REDUCTION_BUCKETS)
+            logger.info('compaction.done', '🗜️  Markdown 已精简', markdown_path=markdown_path,
+                        tokens=report['tokens'], compact_tokens=report['compact_tokens'],
+                        reduction=report['reduction'], references=report['references'])
+
+        result = {
+            'text': text,
+            'report': report,
+            'compact_path': str(directory / 'compact.md'),
+            'references_path': str(references_path) if references_path.exists() else None,
+        }
+        with self._lock:
+            self._cache[markdown_path] = (stat.st_mtime_ns, stat.st_size, result)
+            self._cache.move_to_end(markdown_path)
+            while len(self._cache) > MEMORY_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return result
+
+    def load_context(self, markdown_path) -> str:
+        """读取用于 LLM 上下文的论文内容：启用精简时返回精简后的正文，精简失败时返回原文"""
+        if self.enabled:
+            try:
+                return self.compact_file(markdown_path)['text']
+            except Exception as e:
+                logger.warning('compaction.failed', '⚠️  Markdown 精简失败，使用原文',
+                               markdown_path=str(markdown_path), error=str(e))
+        with open(markdown_path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+
+def _atomic_write_text(path: Path, content: str):
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+# 创建全局实例
+markdown_compactor = MarkdownCompactor()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='查看论文 Markdown 的精简效果（各步骤减少的字符数和 token 估算）')
+    parser.add_argument('paths', nargs='+', help='Markdown 文件或目录')
+    parser.add_argument('--show', action='store_true', help='输出精简后的正文')
+    args = parser.parse_args(argv)
+
+    files = []
+    for path in map(Path, args.paths):
+        files.extend(sorted(path.glob('*.md')) if path.is_dir() else [path])
+    if not files:
+        print("❌ 没有找到 Markdown 文件")
+        return 1
+
+    compactor = MarkdownCompactor()
+    compactor.enabled = True
+    print(f"{'文件':<40}{'原 token':>10}{'精简后':>10}{'减少':>8}{'参考文献':>10}")
+    total, compact_total = 0, 0
+    for path in files:
+        result = compactor.compact_file(path)
+        report = result['report']
+        total += report['tokens']
+        compact_total += report['compact_tokens']
+        print(f"{path.name[:38]:<40}{report['tokens']:>10}{report['compact_tokens']:>10}"
+              f"{report['reduction']:>8.1%}{report['references']:>10}")
+        if args.show:
+            print(result['text'])
+    if len(files) > 1 and total:
+        print(f"{'合计':<40}{total:>10}{compact_total:>10}{1 - compact_total / total:>8.1%}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
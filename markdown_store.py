@@ -0,0 +1,312 @@
+"""
+Markdown 存储模块
+按内容寻址保存 PDF 转换结果：同一份 PDF 只转换一次，多个会话引用同一份 Markdown
+
+- 来源键（source key）标识一份 PDF：
+  - sha256:<PDF 字节的 SHA-256>（本地文件）
+  - etag:<ETag>:<字节数>（OSS 等对象存储的 URL，用 HEAD 请求获取，无需下载）
+  - file:<路径>:<修改时间>:<字节数>（本地文件的快速键，避免每次都计算哈希）
+  一份文档可以有多个来源键（别名），任意一个命中即可复用
+- 文档按 Markdown 内容的 SHA-256 存放：root/<前 2 位>/<哈希>/document.md，
+  图片、版面 JSON 等附带文件放在同一目录下（Markdown 中的相对路径保持有效）；
+  内容相同的转换结果只保存一份
+- 索引保存在 SQLite 中（所有 worker 和转换进程共享）；会话只保存 Markdown 路径，删除会话不会删除文档
+"""
+import functools
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+from config import MARKDOWN_STORE_CONFIG
+from metrics import metrics
+from logger import get_logger
+
+logger = get_logger('markdown_store')
+
+DOCUMENT_NAME = 'document.md'
+
+# 计算文件哈希时每次读取的字节数
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+@functools.lru_cache(maxsize=256)
+def _content_key(path: str, stat_key: str) -> str:
+    """计算文件的内容键（stat_key 只用于缓存失效：文件修改后快速键变化，重新计算）"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return f"sha256:{digest.hexdigest()}"
+
+
+class MarkdownStore:
+    """内容寻址的 Markdown 存储"""
+
+    def __init__(self):
+        self.enabled = MARKDOWN_STORE_CONFIG.get('enabled', True)
+        self.root = Path(MARKDOWN_STORE_CONFIG['root'])
+        self.db_path = MARKDOWN_STORE_CONFIG['db_path']
+        if self.enabled:
+            self.root.mkdir(parents=True, exist_ok=True)
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._init_database()
+
+    @contextmanager
+    def get_connection(self):
+        """获取数据库连接的上下文管理器"""
+        conn = sqlite3.connect(
+            str(self.db_path),
+            timeout=10.0,
+            check_same_thread=False,
+            isolation_level=None
+        )
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute('BEGIN')
+            yield conn
+            conn.execute('COMMIT')
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise e
+        finally:
+            conn.close()
+
+    def _init_database(self):
+        """初始化文档表和来源键表"""
+        conn = sqlite3.connect(str(self.db_path), timeout=10.0)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS documents (
+                    digest TEXT PRIMARY KEY,
+                    markdown_bytes INTEGER NOT NULL,
+                    artifact_count INTEGER NOT NULL DEFAULT 0,
+                    source TEXT,
+                    created_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS source_keys (
+                    source_key TEXT PRIMARY KEY,
+                    digest TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_source_keys_digest ON source_keys(digest)')
+            conn.commit()
+        finally:
+            conn.close()
+
+    # ========== 来源键 ==========
+
+    @staticmethod
+    def key_for_file(path) -> str:
+        """本地文件的内容键（SHA-256；按快速键缓存，文件未变化时同一进程内不重复读取和计算）"""
+        return _content_key(os.path.abspath(path), MarkdownStore.stat_key_for_file(path))
+
+    @staticmethod
+    def stat_key_for_file(path) -> str:
+        """本地文件的快速键（路径 + 修改时间 + 大小，文件变化后自然失效）"""
+        stat = os.stat(path)
+        return f"file:{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}"
+
+    @staticmethod
+    def key_for_url(url: str, http=None, timeout: float = 10) -> Optional[str]:
+        """
+        URL 的内容键：HEAD 请求返回的 ETag + Content-Length（对象存储中同一对象的 ETag 随内容变化）
+
+        没有 ETag 或请求失败时返回 None（调用方应按未命中处理）
+        """
+        import requests
+        try:
+            response = (http or requests).head(url, timeout=timeout, allow_redirects=True)
+            response.raise_for_status()
+        except Exception as e:
+            logger.debug('store.head_failed', '⚠️  获取 ETag 失败', url=url, error=str(e))
+            return None
+        etag = (response.headers.get('ETag') or '').strip()
+        if etag.startswith('W/'):
+            # 弱 ETag 不保证字节一致
+            return None
+        etag = etag.strip('"')
+        size = response.headers.get('Content-Length')
+        if not etag or not size:
+            return None
+        return f"etag:{etag}:{size}"
+
+    # ========== 查询与保存 ==========
+
+    def document_path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest / DOCUMENT_NAME
+
+    def lookup(self, *source_keys: Optional[str]) -> Optional[str]:
+        """
+        按来源键查找已保存的 Markdown（依次尝试，返回第一个命中的文档路径；都未命中时返回 None）
+        """
+        if not self.enabled:
+            return None
+        return self._record(self._find(source_keys))
+
+    def lookup_file(self, pdf_path) -> Optional[str]:
+        """
+        按本地 PDF 查找 Markdown：先用快速键，未命中再计算内容哈希（命中后记录快速键）
+        """
+        if not self.enabled:
+            return None
+        stat_key = self.stat_key_for_file(pdf_path)
+        found = self._find([stat_key])
+        if found is None:
+            found = self._find([self.key_for_file(pdf_path)])
+            if found is not None:
+                self.add_keys(found[1], [stat_key])
+        return self._record(found)
+
+    def _find(self, source_keys: Iterable[Optional[str]]):
+        """查找第一个命中的来源键，返回 (来源键, 文档哈希, 路径) 或 None"""
+        keys = [key for key in source_keys if key]
+        if not keys:
+            return None
+        placeholders = ','.join('?' * len(keys))
+        with self.get_connection() as conn:
+            rows = conn.execute(f'SELECT source_key, digest FROM source_keys WHERE source_key IN ({placeholders})',
+                                keys).fetchall()
+            found = {row['source_key']: row['digest'] for row in rows}
+            for key in keys:
+                digest = found.get(key)
+                if digest is None:
+                    continue
+                path = self.document_path(digest)
+                if not path.exists():
+                    # 文件被手动删除，索引作废
+                    conn.execute('DELETE FROM source_keys WHERE digest = ?', (digest,))
+                    conn.execute('DELETE FROM documents WHERE digest = ?', (digest,))
+                    continue
+                conn.execute('UPDATE documents SET hits = hits + 1, last_used_at = ? WHERE digest = ?',
+                             (time.time(), digest))
+                return key, digest, str(path)
+        return None
+
+    @staticmethod
+    def _record(found) -> Optional[str]:
+        if found is None:
+            metrics.inc('markdown_store_lookups_total', result='miss')
+            return None
+        key, digest, path = found
+        metrics.inc('markdown_store_lookups_total', result='hit')
+        logger.info('store.hit', '♻️  复用已转换的 Markdown', source_key=key, digest=digest[:12])
+        return path
+
+    @contextmanager
+    def staging_dir(self):
+        """
+        临时目录：转换结果的附带文件先解压到这里，保存时直接移动到文档目录
+
+        位于存储目录下（与文档在同一文件系统，移动不需要复制），退出时删除
+        """
+        path = Path(tempfile.mkdtemp(prefix='.staging-', dir=self.root))
+        try:
+            yield path
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def put(self, markdown: str, source_keys: Iterable[Optional[str]] = (),
+            artifacts_dir: Optional[Path] = None, source: Optional[str] = None) -> str:
+        """
+        保存转换结果并登记来源键
+
+        Args:
+            markdown: Markdown 内容
+            source_keys: 该 PDF 的来源键（可多个，None 会被忽略）
+            artifacts_dir: 附带文件所在目录（如 staging_dir()），其中的文件按相对路径移动到文档目录，
+                           如 MinerU 结果中的 images/xxx.jpg
+            source: 来源说明（URL 或文件路径，仅用于排查）
+
+        Returns:
+            Markdown 文件路径（内容相同的结果返回同一路径）
+        """
+        data = markdown.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.document_path(digest)
+        directory = path.parent
+        directory.mkdir(parents=True, exist_ok=True)
+
+        artifact_count = 0
+        if artifacts_dir is not None:
+            for file in sorted(Path(artifacts_dir).rglob('*')):
+                if not file.is_file() or file.is_symlink():
+                    continue
+                target = directory / file.relative_to(artifacts_dir)
+                if target == path:
+                    continue
+                artifact_count += 1
+                if not target.exists():
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(file, target)
+        created = not path.exists()
+        if created:
+            _atomic_write(path, data)
+
+        now = time.time()
+        with self.get_connection() as conn:
+            conn.execute('''
+                INSERT INTO documents (digest, markdown_bytes, artifact_count, source, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(digest) DO UPDATE SET
+                    artifact_count = MAX(artifact_count, excluded.artifact_count),
+                    last_used_at = excluded.last_used_at
+            ''', (digest, len(data), artifact_count, source, now, now))
+            self._insert_keys(conn, digest, source_keys, now)
+        metrics.inc('markdown_store_writes_total', result='new' if created else 'duplicate')
+        logger.info('store.saved', '💾 Markdown 已保存到存储', digest=digest[:12], bytes=len(data),
+                    artifacts=artifact_count, duplicate=not created)
+        return str(path)
+
+    def add_keys(self, digest: str, source_keys: Iterable[Optional[str]]):
+        """为已保存的文档登记更多来源键"""
+        with self.get_connection() as conn:
+            self._insert_keys(conn, digest, source_keys, time.time())
+
+    @staticmethod
+    def _insert_keys(conn, digest: str, source_keys: Iterable[Optional[str]], now: float):
+        for key in source_keys:
+            if key:
+                conn.execute('''
+                    INSERT INTO source_keys (source_key, digest, created_at) VALUES (?, ?, ?)
+                    ON CONFLICT(source_key) DO UPDATE SET digest = excluded.digest
+                ''', (key, digest, now))
+
+    def stats(self) -> Dict:
+        """文档数、来源键数、总大小和累计命中次数"""
+        with self.get_connection() as conn:
+            documents = conn.execute('''
+                SELECT COUNT(*) AS count, COALESCE(SUM(markdown_bytes), 0) AS bytes, COALESCE(SUM(hits), 0) AS hits
+                FROM documents
+            ''').fetchone()
+            keys = conn.execute('SELECT COUNT(*) FROM source_keys').fetchone()[0]
+        return {
+            'documents': documents['count'],
+            'markdown_bytes': documents['bytes'],
+            'hits': documents['hits'],
+            'source_keys': keys,
+        }
+
+
+def _atomic_write(path: Path, content: bytes):
+    """先写临时文件再替换，并发写入同一文件时读取方不会看到写了一半的内容"""
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+# 全局 Markdown 存储
+markdown_store = MarkdownStore()
@@ -0,0 +1,261 @@
+"""
+监控指标模块
+进程内累计计数器、瞬时值和直方图，定期写入 metrics_dir/<pid>.json，读取时跨 gunicorn worker 汇总
+
+- 计数器（counter）：所有进程（包括已退出的进程）的值相加
+- 瞬时值（gauge）：只保留仍在运行的进程，并以 pid 标签区分
+- 直方图（histogram）：各分桶计数、总和与次数都是计数器，按计数器规则相加
+  （同名直方图在所有进程中须使用相同的分桶边界）
+
+render_prometheus 把汇总结果输出为 Prometheus 文本格式（/metrics 接口）
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional, Sequence
+from config import METRICS_CONFIG
+
+
+def _label_key(labels: Dict) -> str:
+    """标签字典 -> 稳定的字符串键"""
+    return json.dumps(labels, sort_keys=True, ensure_ascii=False)
+
+
+class MetricsRegistry:
+    """跨进程可汇总的指标注册表"""
+
+    def __init__(self):
+        self.metrics_dir = METRICS_CONFIG['metrics_dir']
+        self.flush_interval = METRICS_CONFIG.get('flush_interval', 1.0)
+        self._counters = {}  # name -> {label_key: value}
+        self._gauges = {}
+        self._histograms = {}  # name -> {label_key: {'buckets', 'counts', 'sum', 'count'}}
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+        self._dirty = False
+        self._timer = None
+        atexit.register(self.flush)
+
+    # ========== 记录 ==========
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """计数器累加"""
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+            self._dirty = True
+        self._maybe_flush()
+
+    def set_gauge(self, name: str, value: float, **labels):
+        """设置瞬时值"""
+        key = _label_key(labels)
+        with self._lock:
+            self._gauges.setdefault(name, {})[key] = value
+            self._dirty = True
+        self._maybe_flush()
+
+    def observe(self, name: str, value: float, buckets: Optional[Sequence[float]] = None, **labels):
+        """
+        直方图记录一个观测值
+
+        Args:
+            name: 指标名称（如 'http_request_duration_seconds'）
+            value: 观测值
+            buckets: 分桶上界（升序，不含 +Inf），默认使用 METRICS_CONFIG['histogram_buckets']
+            **labels: 标签
+        """
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            entry = series.get(key)
+            if entry is None:
+                bounds = list(buckets or METRICS_CONFIG['histogram_buckets'])
+                # counts 比 buckets 多一个 +Inf 桶；每个观测值只计入第一个满足 value <= 上界的桶
+                entry = series[key] = {'buckets': bounds, 'counts': [0] * (len(bounds) + 1),
+                                       'sum': 0.0, 'count': 0}
+            bounds = entry['buckets']
+            index = len(bounds)
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    index = i
+                    break
+            entry['counts'][index] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+            self._dirty = True
+        self._maybe_flush()
+
+    # ========== 落盘与汇总 ==========
+
+    def _maybe_flush(self):
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+        elif self._timer is None:
+            # 间隔内的更新由定时器补写，保证其他 worker 最终能读到
+            self._timer = threading.Timer(self.flush_interval, self._timer_flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _timer_flush(self):
+        self._timer = None
+        self.flush()
+
+    def flush(self):
+        """将本进程的指标写入文件（原子替换）"""
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = {
+                'pid': os.getpid(),
+                'updated_at': time.time(),
+                'counters': self._counters,
+                'gauges': self._gauges,
+                'histograms': self._histograms,
+            }
+            payload = json.dumps(snapshot, ensure_ascii=False)
+            self._dirty = False
+            self._last_flush = time.time()
+
+        path = self.metrics_dir / f"{os.getpid()}.json"
+        tmp_path = self.metrics_dir / f".{os.getpid()}.json.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # logger 模块依赖 metrics，延迟导入
+            from logger import get_logger
+            get_logger('metrics').warning('metrics.flush_failed', '⚠️  写入监控指标失败', path=str(path), error=str(e))
+
+    def collect(self, prefix: Optional[str] = None) -> Dict:
+        """
+        汇总所有进程的指标
+
+        Args:
+            prefix: 只返回名称以该前缀开头的指标
+
+        Returns:
+            dict: {'counters': {name: {label_key: value}}, 'gauges': {name: {label_key: value}},
+                   'histograms': {name: {label_key: {'buckets', 'counts', 'sum', 'count'}}}}
+        """
+        self.flush()
+        counters, gauges, histograms = {}, {}, {}
+
+        for path in self.metrics_dir.glob('*.json'):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            pid = snapshot.get('pid')
+            for name, series in snapshot.get('counters', {}).items():
+                if prefix and not name.startswith(prefix):
+                    continue
+                merged = counters.setdefault(name, {})
+                for key, value in series.items():
+                    merged[key] = merged.get(key, 0) + value
+
+            for name, series in snapshot.get('histograms', {}).items():
+                if prefix and not name.startswith(prefix):
+                    continue
+                merged = histograms.setdefault(name, {})
+                for key, entry in series.items():
+                    target = merged.get(key)
+                    if target is None:
+                        merged[key] = {'buckets': entry['buckets'], 'counts': list(entry['counts']),
+                                       'sum': entry['sum'], 'count': entry['count']}
+                    elif target['buckets'] == entry['buckets']:
+                        target['counts'] = [a + b for a, b in zip(target['counts'], entry['counts'])]
+                        target['sum'] += entry['sum']
+                        target['count'] += entry['count']
+                    # 分桶边界不同（修改配置前的旧进程文件）时无法合并，忽略
+
+            if not self._pid_alive(pid):
+                continue
+            for name, series in snapshot.get('gauges', {}).items():
+                if prefix and not name.startswith(prefix):
+                    continue
+                merged = gauges.setdefault(name, {})
+                for key, value in series.items():
+                    labels = json.loads(key)
+                    labels['pid'] = pid
+                    merged[_label_key(labels)] = value
+
+        return {'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+    def render_prometheus(self, prefix: Optional[str] = None) -> str:
+        """
+        汇总所有进程的指标并输出为 Prometheus 文本格式（0.0.4）
+
+        指标名称加上 METRICS_CONFIG['prometheus_namespace'] 前缀；瞬时值带 pid 标签
+        """
+        data = self.collect(prefix)
+        namespace = METRICS_CONFIG.get('prometheus_namespace', '')
+        lines = []
+
+        for name in sorted(data['counters']):
+            full_name = namespace + name
+            lines.append(f"# TYPE {full_name} counter")
+            for key, value in sorted(data['counters'][name].items()):
+                lines.append(f"{full_name}{_format_labels(json.loads(key))} {_format_value(value)}")
+
+        for name in sorted(data['gauges']):
+            full_name = namespace + name
+            lines.append(f"# TYPE {full_name} gauge")
+            for key, value in sorted(data['gauges'][name].items()):
+                lines.append(f"{full_name}{_format_labels(json.loads(key))} {_format_value(value)}")
+
+        for name in sorted(data['histograms']):
+            full_name = namespace + name
+            lines.append(f"# TYPE {full_name} histogram")
+            for key, entry in sorted(data['histograms'][name].items()):
+                labels = json.loads(key)
+                cumulative = 0
+                for bound, count in zip(entry['buckets'] + ['+Inf'], entry['counts']):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else _format_value(bound)
+                    lines.append(f"{full_name}_bucket{_format_labels(dict(labels, le=le))} {cumulative}")
+                lines.append(f"{full_name}_sum{_format_labels(labels)} {_format_value(entry['sum'])}")
+                lines.append(f"{full_name}_count{_format_labels(labels)} {entry['count']}")
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _pid_alive(pid) -> bool:
+        if not pid:
+            return False
+        if pid == os.getpid():
+            return True
+        try:
+            os.kill(pid, 0)
+            return True
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+
+
+def _format_labels(labels: Dict) -> str:
+    """标签字典 -> Prometheus 标签串（值中的反斜杠、双引号和换行需转义）"""
+    if not labels:
+        return ''
+    parts = []
+    for name, value in sorted(labels.items()):
+        value = '' if value is None else str(value)
+        value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# 全局指标注册表
+metrics = MetricsRegistry()
@@ -1,15 +1,271 @@
 """
 PDF 转 Markdown 模块
 使用 MinerU API 进行 PDF 到 Markdown 的转换
+
+- 所有 HTTP 请求复用同一个连接池（requests.Session），不再每次新建连接
+- 等待中的 MinerU 任务由一个轮询线程（TaskPoller）统一跟踪：多个转换同时进行时共用轮询线程，
+  查询间隔根据已观测到的解析速度自适应（小论文更早拿到结果，大论文不会被频繁查询）
+- 转换结果保存到内容寻址的 Markdown 存储（markdown_store）：同一份 PDF 再次转换时直接复用，不调用 MinerU
+- 保存结果后预先生成供 LLM 上下文使用的精简版本（markdown_compactor）
+- 文字型 PDF 由本地提取器（local_extractor）直接解析，不上传 PDF、不调用 MinerU；
+  扫描件和公式较多的 PDF 交给 MinerU，未配置 MinerU 时所有 PDF 都在本地提取
 """
+import posixpath
 import requests
+import shutil
+import tempfile
+import threading
 import time
 import zipfile
 import io
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, Dict
-import json
-from config import BASE_DIR
+from typing import Callable, Optional, Dict, Tuple
+from requests.adapters import HTTPAdapter
+from config import API_CONFIG_DATA, PDF_CONVERTER_CONFIG, MARKDOWN_STORE_CONFIG
+from metrics import metrics
+from markdown_store import markdown_store
+from markdown_compactor import markdown_compactor
+from local_extractor import local_extractor, ROUTE_LOCAL, ROUTE_MINERU
+from logger import get_logger
+
+logger = get_logger('pdf_converter')
+
+# 转换耗时直方图的分桶上界（秒）：转换包含上传、排队和轮询，通常在数十秒量级
+# 转换结果的来源（convert_with_engine 返回）
+ENGINE_STORE = 'store'  # 复用 Markdown 存储中已有的结果
+ENGINE_LOCAL = 'local'  # 本地提取
+ENGINE_MINERU = 'mineru'
+
+CONVERSION_BUCKETS = (1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600)
+
+# 下载和解压时每次处理的字节数
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class _TrackedTask:
+    """轮询器中一个等待完成的 MinerU 任务"""
+
+    def __init__(self, task_id: str, report: Optional[Callable[[float, str], None]],
+                 timeout: float, first_interval: float):
+        now = time.time()
+        self.task_id = task_id
+        self.report = report
+        self.started_at = now
+        self.deadline = now + timeout
+        self.timeout = timeout
+        self.interval = first_interval
+        self.next_poll_at = now + first_interval
+        self.state = 'submitted'
+        self.extracted_pages = 0
+        self.total_pages = 0
+        self.running_since = None  # 第一次观测到解析进度的时间
+        self.status_errors = 0
+        self.polls = 0
+        self.last_report = None
+        self.result = None
+        self.done = threading.Event()
+
+
+class TaskPoller:
+    """
+    MinerU 任务轮询器：一个后台线程同时跟踪所有等待中的任务
+
+    - 每轮只查询到期的任务，多个查询经线程池并发发出（共用 HTTP 连接池）
+    - 下次查询时间按预估的剩余时间决定（剩余时间的一半，限制在 [min_interval, max_interval]）：
+      有页数进度时按本任务的实际解析速度预估，否则按最近完成任务的平均每页耗时 / 平均总耗时预估；
+      无法预估或已超过预估时间时按 backoff 倍数逐渐拉长间隔；还不知道本任务的解析速度时间隔不超过 no_progress_max_interval
+    - 完成时间按“首次查询到完成的时间 - 上次间隔的一半”估计，观测值不计入轮询本身的延迟
+    - 进度只在状态或页数变化时回调，避免重复写入
+    """
+
+    def __init__(self, fetch_status: Callable[[str], Dict]):
+        self.fetch_status = fetch_status
+        self.min_interval = PDF_CONVERTER_CONFIG.get('poll_min_interval', 1.0)
+        self.max_interval = PDF_CONVERTER_CONFIG.get('poll_max_interval', 15.0)
+        self.no_progress_max_interval = PDF_CONVERTER_CONFIG.get('poll_no_progress_max_interval', 5.0)
+        self.backoff = PDF_CONVERTER_CONFIG.get('poll_backoff', 1.5)
+        self.parallelism = PDF_CONVERTER_CONFIG.get('poll_parallelism', 4)
+        self.max_status_errors = PDF_CONVERTER_CONFIG.get('max_status_errors', 3)
+        self.smoothing = PDF_CONVERTER_CONFIG.get('estimate_smoothing', 0.3)
+        # 观测到的解析耗时（指数平滑）
+        self.seconds_per_page = PDF_CONVERTER_CONFIG.get('initial_seconds_per_page', 2.0)
+        self.seconds_per_task = None
+        self._tasks: Dict[str, _TrackedTask] = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._executor = None
+
+    def wait(self, task_id: str, timeout: float,
+             report: Optional[Callable[[float, str], None]] = None) -> Dict:
+        """
+        跟踪任务直到完成、失败或超时（阻塞调用线程，查询由轮询线程进行）
+
+        Returns:
+            与原 _wait_for_completion 相同格式的结果：{"success": True, "data": ...} 或
+            {"success": False, "error": ..., "message": ...}
+        """
+        task = _TrackedTask(task_id, report, timeout, self.min_interval)
+        with self._cond:
+            self._tasks[task_id] = task
+            self._ensure_thread()
+            self._cond.notify()
+        metrics.set_gauge('pdf_conversion_tasks_tracked', len(self._tasks))
+        task.done.wait()
+        return task.result
+
+    def _ensure_thread(self):
+        # 线程在首次使用时启动（fork 出的子进程中线程不存在，会重新启动）
+        if self._thread is None or not self._thread.is_alive():
+            self._executor = ThreadPoolExecutor(max_workers=self.parallelism,
+                                                thread_name_prefix='mineru-status')
+            self._thread = threading.Thread(target=self._run, daemon=True, name='mineru-poller')
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    due = [t for t in self._tasks.values() if t.next_poll_at <= now]
+                    if due:
+                        break
+                    if self._tasks:
+                        self._cond.wait(min(t.next_poll_at for t in self._tasks.values()) - now)
+                    else:
+                        self._cond.wait()
+            try:
+                results = list(self._executor.map(self._fetch, due))
+            except Exception as e:
+                results = [{"success": False, "error": str(e)}] * len(due)
+            now = time.time()
+            for task, status_result in zip(due, results):
+                try:
+                    self._handle(task, status_result, now)
+                except Exception as e:
+                    logger.exception('mineru.poll_failed', '❌ 处理任务状态失败', task_id=task.task_id, error=str(e))
+                    self._finish(task, {"success": False, "error": "poll_error", "message": str(e)})
+
+    def _fetch(self, task: _TrackedTask) -> Dict:
+        task.polls += 1
+        result = self.fetch_status(task.task_id)
+        metrics.inc('mineru_status_requests_total', result='ok' if result.get("success") else 'error')
+        return result
+
+    def _handle(self, task: _TrackedTask, status_result: Dict, now: float):
+        if not status_result.get("success"):
+            task.status_errors += 1
+            logger.warning('mineru.status_failed', '⚠️  查询任务状态失败', task_id=task.task_id,
+                           errors=task.status_errors, error=status_result.get("error"))
+            if task.status_errors >= self.max_status_errors:
+                self._finish(task, status_result)
+                return
+        else:
+            task.status_errors = 0
+            task_data = status_result.get("data", {}).get("data", {})
+            if isinstance(task_data, dict):
+                state = task_data.get("state")
+                if state in ["done", "success"]:
+                    self._learn(task, now)
+                    self._finish(task, {"success": True, "data": task_data})
+                    return
+                if state == "failed":
+                    error_message = task_data.get("err_msg", "未知错误")
+                    self._finish(task, {
+                        "success": False,
+                        "error": "failed",
+                        "message": f"转换失败: {error_message}"
+                    })
+                    return
+                self._observe_progress(task, state, task_data, now)
+
+        if now >= task.deadline:
+            self._finish(task, {
+                "success": False,
+                "error": "timeout",
+                "message": f"任务处理超时（超过 {task.timeout:g} 秒）"
+            })
+            return
+        task.interval = self._next_interval(task, now)
+        task.next_poll_at = min(now + task.interval, task.deadline)
+
+    def _observe_progress(self, task: _TrackedTask, state: Optional[str], task_data: Dict, now: float):
+        task.state = state or task.state
+        extract_progress = task_data.get("extract_progress") or {}
+        total_pages = extract_progress.get("total_pages") or 0
+        if total_pages:
+            task.total_pages = total_pages
+            task.extracted_pages = extract_progress.get("extracted_pages") or 0
+            if task.running_since is None:
+                task.running_since = now
+
+        if task.report is None:
+            return
+        if task.total_pages:
+            progress = 0.1 + 0.8 * min(task.extracted_pages / task.total_pages, 1.0)
+            message = f'解析中（{task.extracted_pages}/{task.total_pages} 页）'
+        elif state == "pending":
+            progress, message = 0.1, '排队等待解析'
+        else:
+            return
+        if (progress, message) != task.last_report:
+            task.last_report = (progress, message)
+            task.report(progress, message)
+
+    @staticmethod
+    def _has_own_rate(task: _TrackedTask, now: float) -> bool:
+        """是否已能按本任务的实际解析速度预估（至少两次观测到页数进度）"""
+        return bool(task.extracted_pages and task.running_since is not None and now > task.running_since)
+
+    def _estimate_remaining(self, task: _TrackedTask, now: float) -> Optional[float]:
+        """预估任务的剩余时间（秒），无法预估时返回 None"""
+        if task.total_pages:
+            seconds_per_page = self.seconds_per_page
+            if self._has_own_rate(task, now):
+                # 本任务的实际解析速度（从第一次观测到进度算起，偏保守）
+                seconds_per_page = (now - task.running_since) / task.extracted_pages
+            return (task.total_pages - task.extracted_pages) * seconds_per_page
+        if self.seconds_per_task is not None:
+            return self.seconds_per_task - (now - task.started_at)
+        return None
+
+    def _next_interval(self, task: _TrackedTask, now: float) -> float:
+        remaining = self._estimate_remaining(task, now)
+        if remaining is None or remaining <= 0:
+            interval = task.interval * self.backoff
+        else:
+            interval = remaining / 2
+        # 还没有本任务的解析速度时预估只来自历史观测（进程刚启动时只有初始值），不可靠
+        max_interval = self.max_interval if self._has_own_rate(task, now) else self.no_progress_max_interval
+        return max(self.min_interval, min(max_interval, interval))
+
+    def _learn(self, task: _TrackedTask, now: float):
+        """
+        用完成的任务更新耗时观测值
+
+        任务在上次查询到本次查询之间完成，按区间中点估计完成时间，避免把轮询延迟计入耗时
+        """
+        finished_at = max(now - task.interval / 2, task.running_since or task.started_at)
+        duration = finished_at - task.started_at
+        alpha = self.smoothing
+        if self.seconds_per_task is None:
+            self.seconds_per_task = duration
+        else:
+            self.seconds_per_task = alpha * duration + (1 - alpha) * self.seconds_per_task
+        if task.total_pages:
+            per_page = (finished_at - (task.running_since or task.started_at)) / task.total_pages
+            self.seconds_per_page = alpha * per_page + (1 - alpha) * self.seconds_per_page
+
+    def _finish(self, task: _TrackedTask, result: Dict):
+        with self._cond:
+            self._tasks.pop(task.task_id, None)
+            remaining = len(self._tasks)
+        metrics.set_gauge('pdf_conversion_tasks_tracked', remaining)
+        logger.debug('mineru.task_finished', '📬 MinerU 任务结束', task_id=task.task_id,
+                     success=result.get("success"), polls=task.polls,
+                     seconds=round(time.time() - task.started_at, 1))
+        task.result = result
+        task.done.set()
 
 
 class PDFConverter:
@@ -22,23 +278,15 @@ class PDFConverter:
         Args:
             api_token: MinerU API Token，如果不提供则从配置读取
         """
-        # 从配置文件读取
-        config_path = BASE_DIR / 'api_config.json'
-        if config_path.exists():
-            with open(config_path, 'r', encoding='utf-8') as f:
-                config = json.load(f)
-                pdf_config = config.get('pdf_converter', {})
-                self.api_token = api_token or pdf_config.get('api_token', '')
-                self.base_url = pdf_config.get('base_url', 'https://mineru.net/api/v4/extract')
-                self.enable_ocr = pdf_config.get('enable_ocr', True)
-                self.enable_formula = pdf_config.get('enable_formula', False)
-                self.max_wait_seconds = pdf_config.get('max_wait_seconds', 90)
-        else:
-            self.api_token = api_token or ''
-            self.base_url = 'https://mineru.net/api/v4/extract'
-            self.enable_ocr = True
-            self.enable_formula = False
-            self.max_wait_seconds = 90
+        # 从 API 配置读取（api_config.json，或环境变量 API_CONFIG_PATH 指定的文件）
+        pdf_config = API_CONFIG_DATA.get('pdf_converter', {})
+        self.api_token = api_token or pdf_config.get('api_token', '')
+        self.base_url = pdf_config.get('base_url', 'https://mineru.net/api/v4/extract')
+        self.enable_ocr = pdf_config.get('enable_ocr', True)
+        self.enable_formula = pdf_config.get('enable_formula', False)
+        self.max_wait_seconds = pdf_config.get('max_wait_seconds', 90)
+        # catbox 兼容的临时文件上传接口（自建文件服务、压测用的模拟服务），未配置时使用 catbox.moe / transfer.sh
+        self.upload_url = pdf_config.get('upload_url')
         
         if not self.api_token:
             print("⚠️  MinerU API Token 未配置")
@@ -47,12 +295,30 @@ class PDFConverter:
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_token}"
         }
+        
+        # 复用连接的 HTTP 会话（认证头按请求传入，不会发给临时文件服务和 ZIP 下载地址）
+        pool_size = PDF_CONVERTER_CONFIG.get('http_pool_size', 10)
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+        
+        self.poller = TaskPoller(self._get_task_status)
+        
+        # 结果 ZIP 的处理上限
+        self.zip_spool_bytes = PDF_CONVERTER_CONFIG.get('zip_spool_bytes', 1024 * 1024)
+        self.max_zip_bytes = PDF_CONVERTER_CONFIG.get('max_zip_bytes', 200 * 1024 * 1024)
+        self.max_markdown_bytes = PDF_CONVERTER_CONFIG.get('max_markdown_bytes', 20 * 1024 * 1024)
+        self.max_artifact_bytes = PDF_CONVERTER_CONFIG.get('max_artifact_bytes', 20 * 1024 * 1024)
+        self.max_artifacts_total_bytes = PDF_CONVERTER_CONFIG.get('max_artifacts_total_bytes', 200 * 1024 * 1024)
+        self.artifact_extensions = tuple(PDF_CONVERTER_CONFIG.get('artifact_extensions', ('.jpg', '.jpeg', '.png')))
     
     def convert_pdf_to_markdown(
         self,
         pdf_path: str = None,
         pdf_url: str = None,
-        output_path: Optional[str] = None
+        output_path: Optional[str] = None,
+        progress_callback: Optional[Callable[[float, str], None]] = None
     ) -> str:
         """
         将 PDF 转换为 Markdown
@@ -61,6 +327,7 @@ class PDFConverter:
             pdf_path: PDF 文件路径（本地文件）
             pdf_url: PDF 文件URL（阿里云OSS等公网URL）
             output_path: 输出的 Markdown 文件路径（可选）
+            progress_callback: 进度回调 (进度 0~1, 说明)，后台任务用来上报转换进度（可选）
         
         Returns:
             markdown_path: 生成的 Markdown 文件路径
@@ -69,16 +336,52 @@ class PDFConverter:
             FileNotFoundError: PDF 文件不存在
             Exception: 转换失败
         """
+        return self.convert_with_engine(pdf_path, pdf_url, output_path, progress_callback)[0]
+    
+    def convert_with_engine(
+        self,
+        pdf_path: str = None,
+        pdf_url: str = None,
+        output_path: Optional[str] = None,
+        progress_callback: Optional[Callable[[float, str], None]] = None
+    ) -> Tuple[str, str]:
+        """
+        与 convert_pdf_to_markdown 相同，另外返回结果的来源：
+        ENGINE_STORE（复用存储中的结果）、ENGINE_LOCAL（本地提取）或 ENGINE_MINERU
+        
+        Returns:
+            (markdown_path, engine)
+        """
+        started = time.time()
+        outcome = 'error'
+        try:
+            result = self._convert(pdf_path, pdf_url, output_path, progress_callback)
+            outcome = 'success'
+            return result
+        finally:
+            metrics.observe('pdf_conversion_duration_seconds', time.time() - started,
+                            buckets=CONVERSION_BUCKETS, source='url' if pdf_url else 'file', outcome=outcome)
+    
+    def _convert(self, pdf_path: Optional[str], pdf_url: Optional[str], output_path: Optional[str],
+                 progress_callback: Optional[Callable[[float, str], None]] = None) -> Tuple[str, str]:
+        """
+        convert_with_engine 的实现（不含耗时统计）
+        
+        启用 Markdown 存储时，结果保存在存储中并返回存储路径；指定了 output_path 时另外复制一份到该路径并返回该路径
+        """
+        report = progress_callback or (lambda progress, message: None)
+        use_store = markdown_store.enabled
         # 如果提供了URL，直接使用
         if pdf_url:
             print(f"📤 使用提供的 PDF URL: {pdf_url}")
             final_pdf_url = pdf_url
+            source_keys = [markdown_store.key_for_url(pdf_url, self.http)] if use_store else []
             
             # 如果没有指定输出路径，从URL提取文件名
-            if output_path is None:
+            if output_path is None and not use_store:
                 filename = pdf_url.split('/')[-1].replace('.pdf', '.md')
                 output_path = Path(filename)
-            else:
+            elif output_path is not None:
                 output_path = Path(output_path)
         
         # 否则使用本地文件路径
@@ -88,14 +391,47 @@ class PDFConverter:
             if not pdf_path.exists():
                 raise FileNotFoundError(f"PDF 文件不存在: {pdf_path}")
             
+            # 先按快速键查询（未命中才计算内容哈希），保存结果时才需要完整的来源键
+            source_keys = []
+            
             # 如果没有指定输出路径，使用相同文件名
-            if output_path is None:
+            if output_path is None and not use_store:
                 output_path = pdf_path.with_suffix('.md')
-            else:
+            elif output_path is not None:
                 output_path = Path(output_path)
-            
+        
+        else:
+            raise ValueError("必须提供 pdf_path 或 pdf_url 参数之一")
+        
+        # 同一份 PDF 已转换过：直接复用，不调用 MinerU
+        if not use_store:
+            stored_path = None
+        elif pdf_url:
+            stored_path = markdown_store.lookup(*source_keys)
+        else:
+            stored_path = markdown_store.lookup_file(pdf_path)
+            if not stored_path:
+                # 内容哈希在查询时已计算并缓存，这里不会再次读取 PDF
+                source_keys = [markdown_store.stat_key_for_file(pdf_path), markdown_store.key_for_file(pdf_path)]
+        if stored_path:
+            print(f"♻️  复用已转换的 Markdown → {stored_path}")
+            return self._copy_to_output(stored_path, output_path), ENGINE_STORE
+        
+        # 文字型 PDF 直接在本地提取（不上传 PDF、不调用 MinerU）
+        source = pdf_url or str(pdf_path)
+        if local_extractor.enabled:
+            markdown_content = self._extract_locally(None if pdf_url else pdf_path, pdf_url, report)
+            if markdown_content:
+                saved_path = self._save_markdown(markdown_content, source_keys, output_path, source)
+                print(f"✅ PDF 本地提取成功 → {saved_path}")
+                return saved_path, ENGINE_LOCAL
+        if not self.api_token:
+            raise ValueError("该 PDF 需要 MinerU 解析，但 MinerU API Token 未配置")
+        
+        if pdf_path and not pdf_url:
             # 上传 PDF 到临时 URL
             print(f"📤 上传 PDF 文件: {pdf_path}")
+            report(0.02, '上传 PDF 文件')
             final_pdf_url = self._upload_pdf_to_temp_url(str(pdf_path))
             
             if not final_pdf_url:
@@ -103,12 +439,10 @@ class PDFConverter:
             
             print(f"✅ PDF 上传成功: {final_pdf_url}")
         
-        else:
-            raise ValueError("必须提供 pdf_path 或 pdf_url 参数之一")
-        
         try:
             # 创建转换任务
             print(f"🔄 创建转换任务...")
+            report(0.05, '提交转换任务')
             task_result = self._create_conversion_task(final_pdf_url)
             
             if not task_result.get("success"):
@@ -125,30 +459,115 @@ class PDFConverter:
             
             # 等待任务完成
             print(f"⏳ 等待转换完成（最长 {self.max_wait_seconds} 秒）...")
-            completion_result = self._wait_for_completion(task_id)
+            report(0.1, '等待解析')
+            completion_result = self._wait_for_completion(task_id, report)
             
             if not completion_result.get("success"):
-                raise Exception(f"转换失败: {completion_result.get('message')}")
+                raise Exception(f"转换失败: {completion_result.get('message') or completion_result.get('error')}")
             
             # 提取 Markdown 内容
             print(f"📄 提取 Markdown 内容...")
-            markdown_content = self._get_markdown_content(completion_result)
-            
-            if not markdown_content:
-                raise Exception("无法获取 Markdown 内容")
-            
-            # 保存 Markdown 文件
-            output_path.parent.mkdir(parents=True, exist_ok=True)
-            with open(output_path, 'w', encoding='utf-8') as f:
-                f.write(markdown_content)
+            report(0.9, '下载转换结果')
+            # 保存到 Markdown 存储（内容相同的结果只保存一份）；附带文件先解压到存储目录下的临时目录
+            if use_store:
+                keep_artifacts = MARKDOWN_STORE_CONFIG.get('keep_artifacts', True)
+                with markdown_store.staging_dir() as staging:
+                    markdown_content = self._get_markdown_content(completion_result,
+                                                                  staging if keep_artifacts else None)
+                    if not markdown_content:
+                        raise Exception("无法获取 Markdown 内容")
+                    saved_path = self._save_markdown(markdown_content, source_keys, output_path, source, staging)
+            else:
+                markdown_content = self._get_markdown_content(completion_result)
+                if not markdown_content:
+                    raise Exception("无法获取 Markdown 内容")
+                saved_path = self._save_markdown(markdown_content, source_keys, output_path, source)
             
-            print(f"✅ PDF 转换成功 → {output_path}")
-            return str(output_path)
+            print(f"✅ PDF 转换成功 → {saved_path}")
+            return saved_path, ENGINE_MINERU
         
         except Exception as e:
             print(f"❌ PDF 转换失败: {e}")
             raise
     
+    def _extract_locally(self, pdf_path: Optional[Path], pdf_url: Optional[str],
+                         report: Callable[[float, str], None]) -> Optional[str]:
+        """
+        先抽样检查文本密度，文字型 PDF 在本地提取 Markdown（URL 先下载到临时文件）
+        
+        Returns:
+            Markdown 内容；需要交给 MinerU（扫描件、公式较多，或下载、解析失败）时返回 None。
+            未配置 MinerU 时所有 PDF 都在本地提取，失败时直接抛出异常
+        """
+        mineru_available = bool(self.api_token)
+        temp_path = None
+        try:
+            local_file = pdf_path
+            if local_file is None:
+                report(0.02, '下载 PDF')
+                with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as f:
+                    temp_path = Path(f.name)
+                    self._download_to(pdf_url, f, local_extractor.max_pdf_bytes, 'PDF')
+                local_file = temp_path
+            
+            report(0.04, '检查 PDF 文本')
+            analysis = local_extractor.analyze(local_file)
+            route = analysis['route'] if mineru_available else ROUTE_LOCAL
+            logger.info('convert.routed', '🧭 选择转换方式', route=route, reason=analysis['reason'],
+                        pages=analysis['pages'], chars_per_page=analysis['chars_per_page'],
+                        formula_ratio=analysis['formula_ratio'])
+            if route != ROUTE_LOCAL:
+                metrics.inc('pdf_conversion_routes_total', route=route, reason=analysis['reason'])
+                return None
+            
+            report(0.1, f"本地提取文本（{analysis['pages']} 页）")
+            markdown_content = local_extractor.extract(local_file, pages=analysis['pages'])
+            if not markdown_content.strip():
+                raise ValueError("未能从 PDF 中提取到文本（可能是扫描件）")
+            metrics.inc('pdf_conversion_routes_total', route=ROUTE_LOCAL, reason=analysis['reason'])
+            return markdown_content
+        except Exception as e:
+            if not mineru_available:
+                raise
+            metrics.inc('pdf_conversion_routes_total', route=ROUTE_MINERU, reason='local_error')
+            logger.warning('convert.local_failed', '⚠️  本地提取失败，改用 MinerU', error=str(e))
+            return None
+        finally:
+            if temp_path is not None:
+                temp_path.unlink(missing_ok=True)
+    
+    def _save_markdown(self, markdown_content: str, source_keys, output_path: Optional[Path], source: str,
+                       artifacts_dir: Optional[Path] = None) -> str:
+        """
+        保存转换结果：启用存储时保存到存储（指定了 output_path 时另外复制一份），否则写入 output_path
+
+        保存后预先生成精简版本（LLM 上下文使用），第一次提问时不必再处理
+        """
+        if markdown_store.enabled:
+            stored_path = markdown_store.put(markdown_content, source_keys, artifacts_dir, source=source)
+            saved_path = self._copy_to_output(stored_path, output_path)
+        else:
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(output_path, 'w', encoding='utf-8') as f:
+                f.write(markdown_content)
+            saved_path = str(output_path)
+        if markdown_compactor.enabled:
+            try:
+                markdown_compactor.compact_file(saved_path)
+            except Exception as e:
+                logger.warning('convert.compaction_failed', '⚠️  Markdown 精简失败（不影响转换结果）',
+                               markdown_path=saved_path, error=str(e))
+        return saved_path
+    
+    @staticmethod
+    def _copy_to_output(stored_path: str, output_path: Optional[Path]) -> str:
+        """调用方指定了输出路径时，把存储中的 Markdown 复制过去"""
+        if output_path is None:
+            return stored_path
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(stored_path, output_path)
+        return str(output_path)
+    
     def _upload_pdf_to_temp_url(self, file_path: str) -> Optional[str]:
         """
         将 PDF 上传到临时公网 URL
@@ -160,13 +579,16 @@ class PDFConverter:
         Returns:
             公网 URL，失败返回 None
         """
+        if self.upload_url:
+            return self._upload_catbox_compatible(file_path, self.upload_url)
+        
         # 尝试使用 catbox.moe
         try:
             print(f"尝试使用 catbox.moe 上传文件...")
             with open(file_path, 'rb') as f:
                 files = {'fileToUpload': f}
                 data = {'reqtype': 'fileupload'}
-                response = requests.post(
+                response = self.http.post(
                     'https://catbox.moe/user/api.php',
                     files=files,
                     data=data,
@@ -186,7 +608,7 @@ class PDFConverter:
             filename = os.path.basename(file_path)
             print(f"尝试使用 transfer.sh 上传文件...")
             with open(file_path, 'rb') as f:
-                response = requests.put(
+                response = self.http.put(
                     f'https://transfer.sh/{filename}',
                     data=f,
                     timeout=60
@@ -202,6 +624,26 @@ class PDFConverter:
         print("❌ 所有上传服务都失败")
         return None
     
+    def _upload_catbox_compatible(self, file_path: str, upload_url: str) -> Optional[str]:
+        """上传到配置的 catbox 兼容接口（表单字段 reqtype=fileupload、fileToUpload，响应正文为文件 URL）"""
+        try:
+            print(f"上传文件到 {upload_url} ...")
+            with open(file_path, 'rb') as f:
+                response = self.http.post(
+                    upload_url,
+                    files={'fileToUpload': f},
+                    data={'reqtype': 'fileupload'},
+                    timeout=60
+                )
+                response.raise_for_status()
+            url = response.text.strip()
+            if url.startswith(('http://', 'https://')):
+                return url
+            print(f"❌ 上传接口返回了无效的 URL: {url[:200]}")
+        except Exception as e:
+            print(f"❌ 上传失败: {e}")
+        return None
+    
     def _create_conversion_task(self, pdf_url: str) -> Dict:
         """创建 PDF 转换任务"""
         url = f"{self.base_url}/task"
@@ -212,7 +654,7 @@ class PDFConverter:
         }
         
         try:
-            response = requests.post(url, headers=self.headers, json=data, timeout=30)
+            response = self.http.post(url, headers=self.headers, json=data, timeout=30)
             response.raise_for_status()
             return {
                 "success": True,
@@ -229,7 +671,7 @@ class PDFConverter:
         url = f"{self.base_url}/task/{task_id}"
         
         try:
-            response = requests.get(url, headers=self.headers, timeout=30)
+            response = self.http.get(url, headers=self.headers, timeout=30)
             response.raise_for_status()
             return {
                 "success": True,
@@ -241,49 +683,13 @@ class PDFConverter:
                 "error": str(e)
             }
     
-    def _wait_for_completion(self, task_id: str) -> Dict:
-        """等待任务完成"""
-        start_time = time.time()
-        
-        while True:
-            elapsed_time = time.time() - start_time
-            if elapsed_time > self.max_wait_seconds:
-                return {
-                    "success": False,
-                    "error": "timeout",
-                    "message": f"任务处理超时（超过 {self.max_wait_seconds} 秒）"
-                }
-            
-            status_result = self._get_task_status(task_id)
-            if not status_result.get("success"):
-                return status_result
-            
-            task_data = status_result.get("data", {}).get("data", {})
-            
-            if not isinstance(task_data, dict):
-                time.sleep(5)
-                continue
-            
-            current_state = task_data.get("state")
-            
-            if current_state in ["done", "success"]:
-                return {"success": True, "data": task_data}
-            elif current_state == "failed":
-                error_message = task_data.get("err_msg", "未知错误")
-                return {
-                    "success": False,
-                    "error": "failed",
-                    "message": f"转换失败: {error_message}"
-                }
-            elif current_state == "pending":
-                remaining = int(self.max_wait_seconds - elapsed_time)
-                print(f"  任务进行中，{remaining}秒后超时...")
-                time.sleep(5)
-            else:
-                time.sleep(5)
+    def _wait_for_completion(self, task_id: str,
+                             report: Optional[Callable[[float, str], None]] = None) -> Dict:
+        """等待任务完成（由共享的轮询线程查询状态，report 接收解析进度）"""
+        return self.poller.wait(task_id, self.max_wait_seconds, report)
     
-    def _get_markdown_content(self, task_result: Dict) -> Optional[str]:
-        """从任务结果中提取 Markdown 内容"""
+    def _get_markdown_content(self, task_result: Dict, artifacts_dir: Optional[Path] = None) -> Optional[str]:
+        """从任务结果中提取 Markdown 内容（提供 artifacts_dir 时同时把 ZIP 中的附带文件解压到该目录）"""
         try:
             if not task_result.get("success"):
                 return None
@@ -294,7 +700,7 @@ class PDFConverter:
             zip_url = data.get("full_zip_url")
             if zip_url:
                 print(f"📦 下载 ZIP 文件: {zip_url}")
-                return self._download_and_extract_markdown(zip_url)
+                return self._download_and_extract_markdown(zip_url, artifacts_dir)
             
             # 尝试直接获取 Markdown 内容
             possible_fields = ["markdown", "content", "result", "text", "output", "md_content"]
@@ -306,44 +712,127 @@ class PDFConverter:
             
             return None
         
+        except ResultTooLargeError:
+            raise
         except Exception as e:
             print(f"提取 Markdown 内容失败: {e}")
             return None
     
-    def _download_and_extract_markdown(self, zip_url: str) -> Optional[str]:
-        """下载 ZIP 文件并提取 Markdown 内容"""
+    def _download_and_extract_markdown(self, zip_url: str, artifacts_dir: Optional[Path] = None) -> Optional[str]:
+        """
+        下载 ZIP 文件并提取 Markdown 内容
+        
+        ZIP 边下载边写入临时文件（小文件留在内存，超过 zip_spool_bytes 后转存磁盘），只解压需要的成员，
+        内存占用与 ZIP 大小无关。超过大小上限时抛出 ResultTooLargeError。
+        
+        Args:
+            artifacts_dir: 提供时把与 Markdown 同目录（及子目录）下的图片等附带文件直接解压到该目录
+        """
         try:
-            response = requests.get(zip_url, timeout=60)
-            response.raise_for_status()
+            with tempfile.SpooledTemporaryFile(max_size=self.zip_spool_bytes) as spool:
+                self._download_to(zip_url, spool)
+                with zipfile.ZipFile(spool) as zip_file:
+                    members = zip_file.infolist()
+                    
+                    # 寻找 Markdown 文件
+                    markdown_files = [m for m in members if m.filename.endswith(('.md', '.markdown'))]
+                    if not markdown_files:
+                        return None
+                    markdown_member = markdown_files[0]
+                    
+                    if artifacts_dir is not None:
+                        self._extract_artifacts(zip_file, members, markdown_member, artifacts_dir)
+                    
+                    raw_content = _read_limited(zip_file, markdown_member, self.max_markdown_bytes)
             
-            with zipfile.ZipFile(io.BytesIO(response.content)) as zip_file:
-                file_list = zip_file.namelist()
-                
-                # 寻找 Markdown 文件
-                markdown_files = [f for f in file_list if f.endswith(('.md', '.markdown'))]
-                
-                if markdown_files:
-                    markdown_file = markdown_files[0]
-                    with zip_file.open(markdown_file) as md_file:
-                        raw_content = md_file.read()
-                        
-                        # 尝试多种编码
-                        for encoding in ['utf-8', 'utf-8-sig', 'gbk', 'gb2312']:
-                            try:
-                                content = raw_content.decode(encoding)
-                                return content
-                            except UnicodeDecodeError:
-                                continue
-                        
-                        # 使用替换模式
-                        content = raw_content.decode('utf-8', errors='replace')
-                        return content
-                
-                return None
+            # 尝试多种编码
+            for encoding in ['utf-8', 'utf-8-sig', 'gbk', 'gb2312']:
+                try:
+                    return raw_content.decode(encoding)
+                except UnicodeDecodeError:
+                    continue
+            
+            # 使用替换模式
+            return raw_content.decode('utf-8', errors='replace')
         
+        except ResultTooLargeError:
+            raise
         except Exception as e:
             print(f"下载和解析 ZIP 文件失败: {e}")
             return None
+    
+    def _download_to(self, url: str, target, limit: Optional[int] = None, label: str = '结果 ZIP'):
+        """分块下载到文件对象（超过 limit 字节时中止，默认为 max_zip_bytes）"""
+        limit = limit or self.max_zip_bytes
+        with self.http.get(url, timeout=60, stream=True) as response:
+            response.raise_for_status()
+            declared = response.headers.get('Content-Length')
+            if declared and declared.isdigit() and int(declared) > limit:
+                raise ResultTooLargeError(f"{label} 过大（{int(declared)} 字节，上限 {limit}）")
+            received = 0
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                received += len(chunk)
+                if received > limit:
+                    raise ResultTooLargeError(f"{label} 超过大小上限（{limit} 字节）")
+                target.write(chunk)
+        target.seek(0)
+    
+    def _extract_artifacts(self, zip_file: zipfile.ZipFile, members, markdown_member: zipfile.ZipInfo,
+                           artifacts_dir: Path):
+        """把附带文件逐个解压到磁盘（只解压允许的类型，单个文件和总量都有上限）"""
+        base = posixpath.dirname(markdown_member.filename)
+        prefix = f"{base}/" if base else ''
+        per_file_limit = self.max_artifact_bytes
+        remaining = self.max_artifacts_total_bytes
+        root = artifacts_dir.resolve()
+        
+        for member in members:
+            name = member.filename
+            if member is markdown_member or member.is_dir() or not name.startswith(prefix):
+                continue
+            if not name.lower().endswith(self.artifact_extensions):
+                continue
+            relative = name[len(prefix):]
+            target = (root / relative).resolve()
+            if root not in target.parents:
+                print(f"⚠️  跳过不安全的文件路径: {name}")
+                continue
+            if member.file_size > per_file_limit:
+                print(f"⚠️  跳过过大的附带文件: {name}（{member.file_size} 字节）")
+                continue
+            if member.file_size > remaining:
+                print(f"⚠️  附带文件总量超过上限，停止解压")
+                break
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with zip_file.open(member) as source, open(target, 'wb') as destination:
+                remaining -= _copy_limited(source, destination, min(per_file_limit, remaining))
+
+
+class ResultTooLargeError(ValueError):
+    """转换结果超过大小上限（重试也不会成功）"""
+
+
+def _copy_limited(source, destination, limit: int) -> int:
+    """分块复制，超过 limit 字节时抛出 ResultTooLargeError（不信任 ZIP 中声明的大小）"""
+    copied = 0
+    while True:
+        chunk = source.read(DOWNLOAD_CHUNK_SIZE)
+        if not chunk:
+            return copied
+        copied += len(chunk)
+        if copied > limit:
+            raise ResultTooLargeError(f"解压后的文件超过大小上限（{limit} 字节）")
+        destination.write(chunk)
+
+
+def _read_limited(zip_file: zipfile.ZipFile, member: zipfile.ZipInfo, limit: int) -> bytes:
+    """读取 ZIP 成员的内容（超过 limit 字节时抛出 ResultTooLargeError）"""
+    if member.file_size > limit:
+        raise ResultTooLargeError(f"Markdown 过大（{member.file_size} 字节，上限 {limit}）")
+    buffer = io.BytesIO()
+    with zip_file.open(member) as source:
+        _copy_limited(source, buffer, limit)
+    return buffer.getvalue()
 
 
 # 创建全局实例
@@ -351,6 +840,8 @@ try:
     pdf_converter = PDFConverter()
     if pdf_converter.api_token:
         print("✅ PDF 转换器初始化成功（MinerU API）")
+    elif local_extractor.enabled:
+        print("⚠️  MinerU API Token 未配置，所有 PDF 都在本地提取（扫描件和公式较多的 PDF 效果较差）")
     else:
         print("⚠️  PDF 转换器初始化成功，但 API Token 未配置")
         pdf_converter = None
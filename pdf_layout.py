@@ -0,0 +1,294 @@
+"""
+PDF 版面解析模块（本地提取进程池中执行的部分）
+把 pypdf 输出的文本片段合并成行，再组织成 Markdown；由 local_extractor 的进程池调用
+
+- 只依赖标准库和 pypdf，不导入 config / metrics / logger 等带全局状态的模块：
+  进程池以 forkserver（不支持时 spawn）启动，子进程中只需导入本模块
+- 阈值由调用方通过 options 传入（键同 LOCAL_EXTRACTION_CONFIG）
+"""
+import logging
+import math
+import re
+import unicodedata
+from collections import Counter
+from typing import Dict, List, Optional
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+# pypdf 对不规范的 PDF 会逐个对象输出警告（重复定义的键、缺少 fontTools 等），不影响文本提取
+logging.getLogger('pypdf').setLevel(logging.ERROR)
+
+# 提取方式（analyze 的 route）
+ROUTE_LOCAL = 'local'
+ROUTE_MINERU = 'mineru'
+
+# 数学字体（TeX 的 CMMI/CMSY/CMEX、AMS 符号字体、STIX 等），其中的字符按公式计
+_MATH_FONT_MARKERS = ('CMMI', 'CMSY', 'CMEX', 'MSBM', 'MSAM', 'EUEX', 'RSFS', 'MATH', 'SYMBOL', 'STIX')
+_BOLD_FONT_MARKERS = ('BOLD', 'BLACK', 'HEAVY', 'SEMIBOLD', 'DEMI')
+
+# 页码等页面装饰（"12"、"- 12 -"、"第 12 页"）
+_PAGE_NUMBER_PATTERN = re.compile(r'^[\-–—\s]*(\d{1,4}|第\s*\d{1,4}\s*页)[\-–—\s]*$')
+# 编号标题："2 Method"、"2.1. Setup"（需加粗）；"一、引言"、"（二）方法"
+_NUMBERED_HEADING_PATTERN = re.compile(r'^(\d{1,2}(?:\.\d{1,2}){0,3})\.?\s+\S')
+_CHINESE_HEADING_PATTERNS = (
+    (re.compile(r'^[一二三四五六七八九十]{1,3}、\S'), 2),
+    (re.compile(r'^[（(]\s*[一二三四五六七八九十]{1,3}\s*[）)]\s*\S'), 3),
+)
+_SENTENCE_END = tuple('.。!！?？;；:：')
+_MAX_HEADING_LEVEL = 4
+
+
+def _open(pdf_path) -> 'PdfReader':
+    reader = PdfReader(str(pdf_path))
+    if reader.is_encrypted:
+        # 只有打开密码为空的 PDF 可以解析（常见于禁止复制但无需密码打开的论文）
+        reader.decrypt('')
+    return reader
+
+
+def _is_cjk(char: str) -> bool:
+    return '⺀' <= char <= '鿿' or '豈' <= char <= '﫿' or '＀' <= char <= '￯'
+
+
+def _is_math_char(char: str) -> bool:
+    code = ord(char)
+    return (unicodedata.category(char) == 'Sm' or 0x0370 <= code <= 0x03ff
+            or 0x2200 <= code <= 0x22ff or 0x1d400 <= code <= 0x1d7ff)
+
+
+def _is_garbled_char(char: str) -> bool:
+    # 替换字符、私用区字符和控制字符通常来自缺少 ToUnicode 映射的字体
+    return char == '�' or unicodedata.category(char) in ('Co', 'Cc')
+
+
+def _join_text(left: str, right: str) -> str:
+    """拼接两行文字：去掉英文断词的连字符，中文不加空格，其余加一个空格"""
+    if not left:
+        return right
+    if not right:
+        return left
+    if left.endswith('-') and len(left) > 1 and left[-2].isalpha() and right[0].islower():
+        return left[:-1] + right
+    if _is_cjk(left[-1]) or _is_cjk(right[0]):
+        return left + right
+    return left + ' ' + right
+
+
+def page_lines(page, page_number: int) -> List[Dict]:
+    """
+    提取一页的文本行（按基线位置把 pypdf 输出的文本片段合并成行）
+
+    Returns:
+        [{'text', 'size', 'bold', 'x', 'y', 'page', 'chars', 'math', 'garbled'}, ...]，
+        size 为该行字符数最多的有效字号，chars / math / garbled 为非空白字符数、公式字符数和乱码字符数
+    """
+    lines = []
+    current = None
+    pending_space = False
+
+    def finish():
+        if current is not None and current['text'].strip():
+            sizes = current.pop('sizes')
+            current['size'] = sizes.most_common(1)[0][0]
+            current['bold'] = current.pop('bold_chars') * 2 > current['chars']
+            current['text'] = current['text'].strip()
+            lines.append(current)
+
+    def visit(text, cm, tm, font_dict, font_size):
+        nonlocal current, pending_space
+        text = text.replace('\r', '').replace('\n', '')
+        if not text.strip():
+            pending_space = pending_space or bool(text)
+            return
+        # 有效字号 = 字号 × 文本矩阵和变换矩阵的纵向缩放
+        size = round(font_size * (math.hypot(tm[2], tm[3]) or 1.0) * (math.hypot(cm[2], cm[3]) or 1.0), 1)
+        x = tm[4] * cm[0] + tm[5] * cm[2] + cm[4]
+        y = tm[4] * cm[1] + tm[5] * cm[3] + cm[5]
+        font = str(font_dict.get('/BaseFont', '')).upper() if font_dict else ''
+
+        if current is not None and abs(y - current['y']) <= max(size, current['size_hint']) * 0.5:
+            current['text'] += (' ' if pending_space and not current['text'].endswith(' ') else '') + text
+        else:
+            finish()
+            current = {'text': text, 'x': x, 'y': y, 'page': page_number, 'size_hint': size,
+                       'sizes': Counter(), 'bold_chars': 0, 'chars': 0, 'math': 0, 'garbled': 0}
+        pending_space = False
+
+        visible = [char for char in text if not char.isspace()]
+        current['sizes'][size] += len(visible)
+        current['chars'] += len(visible)
+        if any(marker in font for marker in _BOLD_FONT_MARKERS):
+            current['bold_chars'] += len(visible)
+        if any(marker in font for marker in _MATH_FONT_MARKERS):
+            current['math'] += len(visible)
+        else:
+            current['math'] += sum(1 for char in visible if _is_math_char(char))
+        current['garbled'] += sum(1 for char in visible if _is_garbled_char(char))
+
+    page.extract_text(visitor_text=visit)
+    finish()
+    for line in lines:
+        del line['size_hint']
+    return lines
+
+
+def extract_page_lines(pdf_path, start: int = 0, stop: Optional[int] = None) -> List[Dict]:
+    """提取 [start, stop) 页的文本行"""
+    reader = _open(pdf_path)
+    pages = reader.pages
+    stop = len(pages) if stop is None else min(stop, len(pages))
+    lines = []
+    for index in range(start, stop):
+        lines.extend(page_lines(pages[index], index))
+    return lines
+
+
+def analyze_pdf(pdf_path, options: Optional[Dict] = None) -> Dict:
+    """
+    抽样检查 PDF 的文本密度，判断能否在本地提取
+
+    Args:
+        options: 阈值（键同 LOCAL_EXTRACTION_CONFIG，缺省的取默认值）
+
+    Returns:
+        {'pages', 'sampled', 'chars_per_page', 'text_page_ratio', 'formula_ratio', 'garbled_ratio',
+         'route': 'local' | 'mineru', 'reason'}
+    """
+    options = options or {}
+    sample_pages = options.get('sample_pages', 6)
+    min_page_chars = options.get('min_chars_per_page', 100)
+
+    reader = _open(pdf_path)
+    total = len(reader.pages)
+    if total <= sample_pages:
+        indices = list(range(total))
+    else:
+        # 均匀抽样（包含首页，首页通常有标题和摘要）
+        step = total / sample_pages
+        indices = sorted({int(i * step) for i in range(sample_pages)})
+
+    chars = math_chars = garbled = text_pages = 0
+    for index in indices:
+        page_chars = 0
+        for line in page_lines(reader.pages[index], index):
+            page_chars += line['chars']
+            math_chars += line['math']
+            garbled += line['garbled']
+        chars += page_chars
+        if page_chars >= min_page_chars:
+            text_pages += 1
+
+    sampled = len(indices)
+    result = {
+        'pages': total,
+        'sampled': sampled,
+        'chars_per_page': round(chars / sampled, 1) if sampled else 0,
+        'text_page_ratio': round(text_pages / sampled, 3) if sampled else 0,
+        'formula_ratio': round(math_chars / chars, 4) if chars else 0,
+        'garbled_ratio': round(garbled / chars, 4) if chars else 0,
+    }
+    if not sampled or not chars:
+        route, reason = ROUTE_MINERU, 'no_text'
+    elif result['text_page_ratio'] < options.get('min_text_page_ratio', 0.75):
+        route, reason = ROUTE_MINERU, 'scanned'
+    elif result['garbled_ratio'] > options.get('max_garbled_ratio', 0.02):
+        route, reason = ROUTE_MINERU, 'garbled'
+    elif result['formula_ratio'] > options.get('max_formula_ratio', 0.03):
+        route, reason = ROUTE_MINERU, 'formula'
+    else:
+        route, reason = ROUTE_LOCAL, 'text'
+    result.update(route=route, reason=reason)
+    return result
+
+
+def build_markdown(lines: List[Dict], options: Optional[Dict] = None) -> str:
+    """
+    把按阅读顺序排列的文本行组织成 Markdown（段落合并、标题识别）
+
+    行来自整份文档（跨页），正文字号和标题层级按全文统计，跨页的段落会接起来
+    """
+    lines = [line for line in lines if not _PAGE_NUMBER_PATTERN.match(line['text'])]
+    if not lines:
+        return ''
+
+    size_chars = Counter()
+    for line in lines:
+        size_chars[round(line['size'] * 2) / 2] += line['chars']
+    body_size = size_chars.most_common(1)[0][0]
+    heading_ratio = (options or {}).get('heading_size_ratio', 1.15)
+
+    # 正文行的典型字符数（明显短于它的行是段落的最后一行）
+    body_chars = sorted(line['chars'] for line in lines if round(line['size'] * 2) / 2 == body_size)
+    typical_chars = body_chars[len(body_chars) // 2]
+
+    # 1. 合并成块：字号、粗细变化，行距变大，首行缩进，上一行是短行，或跨页 / 换栏时上一句已结束，都开始新块
+    blocks = []
+    previous = None
+    for line in lines:
+        if previous is None or _starts_block(previous, line, blocks[-1], typical_chars):
+            blocks.append({'lines': [line], 'size': line['size'], 'bold': line['bold'], 'gap': None})
+        else:
+            block = blocks[-1]
+            if line['page'] == previous['page'] and previous['y'] > line['y']:
+                block['gap'] = previous['y'] - line['y']
+            block['lines'].append(line)
+        previous = line
+
+    # 2. 标题：字号明显大于正文的短块按字号排级；正文字号的编号行按编号排级
+    heading_sizes = sorted({round(block['size'] * 2) / 2 for block in blocks
+                            if block['size'] >= body_size * heading_ratio}, reverse=True)
+    parts = []
+    for block in blocks:
+        text = ''
+        for line in block['lines']:
+            text = _join_text(text, line['text'])
+        level = _heading_level(block, text, body_size * heading_ratio, heading_sizes)
+        parts.append(f"{'#' * level} {text}" if level else text)
+    return '\n\n'.join(parts) + '\n'
+
+
+def _starts_block(previous: Dict, line: Dict, block: Dict, typical_chars: int) -> bool:
+    size = max(previous['size'], line['size'])
+    if abs(previous['size'] - line['size']) > 0.1 * size or previous['bold'] != line['bold']:
+        return True
+    if previous['chars'] < typical_chars * 0.6 or _is_heading_line(line['text']) or _is_heading_line(previous['text']):
+        return True
+    sentence_ended = previous['text'].endswith(_SENTENCE_END)
+    if line['page'] != previous['page']:
+        return sentence_ended
+    gap = previous['y'] - line['y']
+    if gap < -size * 0.5:
+        # 基线上移：换到下一栏时接着上一句，否则（图表、页眉等）开始新块
+        return sentence_ended or line['x'] - previous['x'] < size * 10
+    # 行距明显大于本块已有的行距（或块内第一行时超过 2 倍字号），或首行缩进超过 1.5 个字
+    limit = block['gap'] * 1.4 if block['gap'] else size * 2.0
+    return gap > limit or line['x'] - previous['x'] > size * 1.5
+
+
+def _is_heading_line(text: str) -> bool:
+    """中文编号标题行（如 "一、引言"），标题自成一块"""
+    return len(text) <= 80 and not text.endswith(('，', '。', '；')) and any(pattern.match(text) for pattern, _ in _CHINESE_HEADING_PATTERNS)
+
+
+def _heading_level(block: Dict, text: str, heading_threshold: float, heading_sizes: List[float]) -> int:
+    if len(text) > 200 or len(block['lines']) > 3:
+        return 0
+    if block['size'] >= heading_threshold:
+        return min(heading_sizes.index(round(block['size'] * 2) / 2) + 1, _MAX_HEADING_LEVEL)
+    if len(block['lines']) != 1 or len(text) > 80 or text.endswith(_SENTENCE_END[:2]):
+        return 0
+    for pattern, level in _CHINESE_HEADING_PATTERNS:
+        if pattern.match(text) and not text.endswith(('，', '。', '；')):
+            return level
+    match = _NUMBERED_HEADING_PATTERN.match(text)
+    if match and block['bold']:
+        return min(match.group(1).count('.') + 2, _MAX_HEADING_LEVEL)
+    return 0
+
+
+def extract_markdown(pdf_path, options: Optional[Dict] = None) -> str:
+    """提取整份 PDF 为 Markdown"""
+    return build_markdown(extract_page_lines(pdf_path), options)
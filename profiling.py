@@ -0,0 +1,265 @@
+"""
+按需性能剖析模块
+对单个请求开启 cProfile：请求头 X-Profile（或查询参数 __profile）等于配置的令牌时，
+记录整个请求的函数调用耗时，包括 SSE 生成器的输出过程和通过 profiler.bind 启动的后台生成线程
+
+- 未配置令牌（PROFILING_CONFIG['token'] 为空）时功能关闭，app.py 不挂载中间件，没有任何额外开销
+- 剖析结果写入 profiles_dir/<profile_id>.prof（pstats 格式，可用 snakeviz 等工具查看），
+  附带同名 .json 元数据；文件数超过 max_files 时删除最旧的（环形保留）
+- 每个进程同时最多剖析 max_concurrent 个请求，超出的请求正常处理、不剖析
+- 响应头 X-Profile-Id 返回本次剖析的 ID，用于在管理接口中下载
+
+后台线程需要用 profiler.bind(target) 包装，剖析会等所有参与线程结束后再写入。
+"""
+import contextvars
+import cProfile
+import functools
+import hmac
+import io
+import json
+import os
+import pstats
+import re
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs
+from werkzeug.wsgi import ClosingIterator
+from config import PROFILING_CONFIG
+from logger import get_logger
+
+logger = get_logger('profiling')
+
+_active_session = contextvars.ContextVar('profile_session', default=None)
+
+# 合法的剖析 ID（下载时校验，防止路径穿越）
+PROFILE_ID_PATTERN = re.compile(r'^[0-9]{8}-[0-9]{6}-[0-9]+-[0-9a-f]{8}$')
+
+
+class _Participant:
+    """参与一次剖析的线程（每个线程一个 cProfile.Profile）"""
+
+    def __init__(self, session: 'ProfileSession'):
+        self.session = session
+        self.profile = cProfile.Profile()
+        self.started = False
+        self.finished = False
+
+    def start(self):
+        try:
+            self.profile.enable()
+            self.started = True
+        except ValueError as e:
+            # Python 3.12+ 同一时刻只允许一个 cProfile，其他线程已在剖析时跳过本线程
+            logger.warning('profiling.thread_skipped', '⚠️  无法剖析该线程', profile_id=self.session.profile_id,
+                           error=str(e))
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        if self.started:
+            self.profile.disable()
+        self.session._participant_finished(self)
+
+
+class ProfileSession:
+    """一次请求的剖析：收集所有参与线程的结果，全部结束后写入文件"""
+
+    def __init__(self, profiler: 'Profiler', method: str, path: str):
+        self.profiler = profiler
+        self.profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.method = method
+        self.path = path
+        self.status = None
+        self.started_at = time.time()
+        self._participants: List[_Participant] = []
+        self._open = 0
+        self._lock = threading.Lock()
+
+    def join(self) -> _Participant:
+        """登记一个参与线程（在启动线程前调用，保证剖析不会提前写入）"""
+        participant = _Participant(self)
+        with self._lock:
+            self._participants.append(participant)
+            self._open += 1
+        return participant
+
+    def _participant_finished(self, participant: _Participant):
+        with self._lock:
+            self._open -= 1
+            done = self._open == 0
+        if done:
+            self.profiler._finish(self)
+
+
+class Profiler:
+    """按需剖析器（进程内）"""
+
+    def __init__(self):
+        self.token = PROFILING_CONFIG.get('token', '')
+        self.enabled = bool(self.token)
+        self.profiles_dir = PROFILING_CONFIG['profiles_dir']
+        self.max_files = PROFILING_CONFIG.get('max_files', 50)
+        self.max_concurrent = PROFILING_CONFIG.get('max_concurrent', 1)
+        self._running = 0
+        self._lock = threading.Lock()
+        if self.enabled:
+            self.profiles_dir.mkdir(parents=True, exist_ok=True)
+
+    def authorized(self, token: Optional[str]) -> bool:
+        """令牌是否正确（功能关闭时总是 False）"""
+        return self.enabled and bool(token) and hmac.compare_digest(token, self.token)
+
+    def requested(self, environ: Dict) -> bool:
+        """请求是否要求剖析（X-Profile 请求头或 __profile 查询参数）"""
+        token = environ.get('HTTP_X_PROFILE')
+        if not token:
+            query = environ.get('QUERY_STRING', '')
+            if '__profile' not in query:
+                return False
+            token = (parse_qs(query).get('__profile') or [''])[0]
+        return self.authorized(token)
+
+    def start_session(self, environ: Dict) -> Optional[ProfileSession]:
+        """开始一次剖析（超过并发上限时返回 None）"""
+        with self._lock:
+            if self._running >= self.max_concurrent:
+                logger.warning('profiling.busy', '⚠️  已有请求在剖析，本次请求不剖析', path=environ.get('PATH_INFO'))
+                return None
+            self._running += 1
+        return ProfileSession(self, environ.get('REQUEST_METHOD', ''), environ.get('PATH_INFO', ''))
+
+    def bind(self, func):
+        """
+        包装后台线程的 target：当前请求正在剖析时，该线程也记入同一次剖析
+
+        没有正在进行的剖析时原样返回 func
+        """
+        if not self.enabled:
+            return func
+        session = _active_session.get()
+        if session is None:
+            return func
+        participant = session.join()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            participant.start()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                participant.finish()
+        return wrapper
+
+    # ========== 写入与管理 ==========
+
+    def _finish(self, session: ProfileSession):
+        with self._lock:
+            self._running -= 1
+        try:
+            self._write(session)
+        except Exception as e:
+            logger.exception('profiling.write_failed', '❌ 写入剖析结果失败', profile_id=session.profile_id,
+                             error=str(e))
+
+    def _write(self, session: ProfileSession):
+        profiles = [p.profile for p in session._participants if p.started]
+        if not profiles:
+            return
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+
+        path = self.profiles_dir / f"{session.profile_id}.prof"
+        stats.dump_stats(str(path))
+        metadata = {
+            'profile_id': session.profile_id,
+            'method': session.method,
+            'path': session.path,
+            'status': session.status,
+            'pid': os.getpid(),
+            'started_at': session.started_at,
+            'duration_ms': round((time.time() - session.started_at) * 1000, 1),
+            'threads': len(profiles),
+            'size': path.stat().st_size,
+        }
+        with open(self.profiles_dir / f"{session.profile_id}.json", 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, ensure_ascii=False)
+        logger.info('profiling.saved', '🔬 请求剖析已保存', profile_id=session.profile_id,
+                    path=session.path, duration_ms=metadata['duration_ms'])
+        self._prune()
+
+    def _prune(self):
+        """只保留最近 max_files 个剖析结果"""
+        files = sorted(self.profiles_dir.glob('*.prof'), key=lambda p: p.stat().st_mtime)
+        for path in files[:max(0, len(files) - self.max_files)]:
+            for stale in (path, path.with_suffix('.json')):
+                try:
+                    stale.unlink()
+                except FileNotFoundError:
+                    pass
+
+    def list_profiles(self) -> List[Dict]:
+        """所有 worker 保存的剖析结果（最新的在前）"""
+        results = []
+        for path in self.profiles_dir.glob('*.json'):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    results.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return sorted(results, key=lambda m: m.get('started_at', 0), reverse=True)
+
+    def profile_path(self, profile_id: str):
+        """剖析文件路径（ID 不合法或文件不存在时返回 None）"""
+        if not PROFILE_ID_PATTERN.match(profile_id or ''):
+            return None
+        path = self.profiles_dir / f"{profile_id}.prof"
+        return path if path.exists() else None
+
+    @staticmethod
+    def render_text(path, sort: str = 'cumulative', limit: int = 50) -> str:
+        """剖析结果的文本摘要（pstats 输出）"""
+        buffer = io.StringIO()
+        stats = pstats.Stats(str(path), stream=buffer)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        return buffer.getvalue()
+
+
+class ProfilingMiddleware:
+    """WSGI 中间件：对要求剖析的请求，从进入应用到响应输出结束（连接关闭）全程剖析"""
+
+    def __init__(self, wsgi_app, profiler: 'Profiler'):
+        self.wsgi_app = wsgi_app
+        self.profiler = profiler
+
+    def __call__(self, environ, start_response):
+        if not self.profiler.requested(environ):
+            return self.wsgi_app(environ, start_response)
+        session = self.profiler.start_session(environ)
+        if session is None:
+            return self.wsgi_app(environ, start_response)
+
+        def start_with_profile_id(status, headers, exc_info=None):
+            session.status = status.split(' ', 1)[0]
+            headers = list(headers) + [('X-Profile-Id', session.profile_id)]
+            return start_response(status, headers, exc_info)
+
+        participant = session.join()
+        token = _active_session.set(session)
+        participant.start()
+        try:
+            result = self.wsgi_app(environ, start_with_profile_id)
+        except BaseException:
+            participant.finish()
+            raise
+        finally:
+            _active_session.reset(token)
+        # 流式响应的输出在同一线程中进行，剖析持续到响应关闭
+        return ClosingIterator(result, participant.finish)
+
+
+# 全局剖析器
+profiler = Profiler()
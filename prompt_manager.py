@@ -2,9 +2,15 @@
 Prompt 管理模块
 支持版本化管理和动态加载 Prompt
 """
+import hashlib
 import json
 from pathlib import Path
 from config import PROMPT_CONFIG
+from metrics import metrics
+from tracing import tracer
+from logger import get_logger
+
+logger = get_logger('prompt')
 
 class PromptManager:
     """Prompt 管理器 - 支持版本化管理和动态加载"""
@@ -50,18 +56,52 @@ class PromptManager:
             ValueError: 版本或智能体不存在
             FileNotFoundError: Prompt 文件不存在
         """
+        with tracer.span('prompt.get_prompt', agent=agent_name):
+            return self._load_prompt(agent_name, version)['content']
+
+    def get_prompt_fingerprint(self, agent_name, version=None):
+        """
+        获取指定智能体 prompt 内容的指纹（SHA-256）
+
+        prompt 文件被修改后指纹随之变化，可用于使依赖该 prompt 的缓存失效
+
+        Args:
+            agent_name: 智能体名称或状态名
+            version: prompt 版本，默认使用配置的默认版本
+
+        Returns:
+            str: 十六进制摘要
+        """
+        return self._load_prompt(agent_name, version)['fingerprint']
+
+    def _load_prompt(self, agent_name, version=None):
+        """
+        读取 prompt（带缓存），文件修改时间或大小变化时自动重新加载
+
+        Returns:
+            dict: {'content', 'fingerprint', 'mtime_ns', 'size'}
+        """
         version = version or self.default_version
-        
-        # 从缓存中查找
+
+        # 从缓存中查找（校验文件是否被修改）
         cache_key = f"{version}:{agent_name}"
-        if cache_key in self._cache:
-            return self._cache[cache_key]
-        
+        cached = self._cache.get(cache_key)
+        if cached:
+            try:
+                stat = cached['path'].stat()
+                if stat.st_mtime_ns == cached['mtime_ns'] and stat.st_size == cached['size']:
+                    metrics.inc('cache_requests_total', cache='prompt', result='hit')
+                    return cached
+            except OSError:
+                pass
+            logger.info('prompt.changed', '🔄 Prompt 文件已变更，重新加载', agent=agent_name, version=version)
+        metrics.inc('cache_requests_total', cache='prompt', result='miss')
+
         # 如果 agent_name 是状态名，转换为智能体名
         original_name = agent_name
         if agent_name in self.config.get('agent_mapping', {}):
             agent_name = self.config['agent_mapping'][agent_name]
-            print(f"🔄 状态映射: {original_name} -> {agent_name}")
+            logger.debug('prompt.state_mapped', '🔄 状态映射', state=original_name, agent=agent_name)
         
         # 获取 prompt 文件路径
         version_config = self.config['versions'].get(version)
@@ -78,14 +118,22 @@ class PromptManager:
         if not prompt_path.exists():
             raise FileNotFoundError(f"Prompt 文件不存在: {prompt_path}")
         
+        stat = prompt_path.stat()
         with open(prompt_path, 'r', encoding='utf-8') as f:
             content = f.read()
-        
+
         # 缓存
-        self._cache[cache_key] = content
-        
-        print(f"✅ 加载 Prompt: {agent_name} (版本: {version})")
-        return content
+        entry = {
+            'content': content,
+            'fingerprint': hashlib.sha256(content.encode('utf-8')).hexdigest(),
+            'path': prompt_path,
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+        }
+        self._cache[cache_key] = entry
+
+        logger.info('prompt.loaded', '✅ 加载 Prompt', agent=agent_name, version=version)
+        return entry
     
     def list_versions(self):
         """
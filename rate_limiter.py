@@ -0,0 +1,405 @@
+"""
+LLM 限流与调度模块
+按提供商维护令牌桶（每分钟请求数、每分钟 token 数）和并发上限，
+等待中的调用按优先级排队：交互式对话优先于后台任务（思维导图、导读报告）。
+
+状态保存在 SQLite 中，多个 gunicorn worker 共享同一组令牌桶和队列；
+队列饱和或等待超时时抛出 LLMOverloadedError，由调用方向用户返回明确的错误。
+"""
+import random
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+from config import RATE_LIMIT_CONFIG
+from tracing import tracer
+from logger import get_logger
+
+logger = get_logger('rate_limiter')
+
+# 优先级：数值越小越优先
+PRIORITIES = {
+    'interactive': 0,  # 用户对话
+    'background': 10,  # 思维导图、导读报告等后台生成
+}
+
+
+class LLMOverloadedError(Exception):
+    """LLM 调用队列已饱和或排队超时"""
+
+    def __init__(self, message: str, retry_after: float = 5.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LLMCancelledError(Exception):
+    """调用方已取消（停止生成、客户端断开），排队、退避或生成中的调用提前结束"""
+
+
+class RateLimiter:
+    """跨进程的令牌桶限流器 + 优先级队列"""
+
+    def __init__(self):
+        self.enabled = RATE_LIMIT_CONFIG.get('enabled', True)
+        self.db_path = RATE_LIMIT_CONFIG['db_path']
+        self.max_queue_size = RATE_LIMIT_CONFIG.get('max_queue_size', 50)
+        self.background_queue_share = RATE_LIMIT_CONFIG.get('background_queue_share', 0.5)
+        self.max_wait_seconds = RATE_LIMIT_CONFIG.get('max_wait_seconds', 30)
+        self.chars_per_token = RATE_LIMIT_CONFIG.get('chars_per_token', 2.0)
+        self.expected_completion_tokens = RATE_LIMIT_CONFIG.get('expected_completion_tokens', 1500)
+        self.lease_seconds = RATE_LIMIT_CONFIG.get('lease_seconds', 600)
+        self.poll_interval = 0.05
+        self.ticket_stale_seconds = 10
+
+        if self.enabled:
+            self._init_database()
+
+    @contextmanager
+    def get_connection(self, immediate: bool = False):
+        """获取数据库连接的上下文管理器（immediate=True 时以写事务开始）"""
+        conn = sqlite3.connect(
+            str(self.db_path),
+            timeout=10.0,
+            check_same_thread=False,
+            isolation_level=None
+        )
+        try:
+            conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+            yield conn
+            conn.execute('COMMIT')
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise e
+        finally:
+            conn.close()
+
+    def _init_database(self):
+        """初始化令牌桶、队列和并发占位表"""
+        conn = sqlite3.connect(str(self.db_path), timeout=10.0)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS buckets (
+                    provider TEXT PRIMARY KEY,
+                    request_tokens REAL NOT NULL,
+                    token_tokens REAL NOT NULL,
+                    blocked_until REAL DEFAULT 0,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS wait_queue (
+                    ticket_id TEXT PRIMARY KEY,
+                    provider TEXT NOT NULL,
+                    priority INTEGER NOT NULL,
+                    enqueued_at REAL NOT NULL,
+                    heartbeat REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_wait_queue_order
+                ON wait_queue(provider, priority, enqueued_at)
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS leases (
+                    lease_id TEXT PRIMARY KEY,
+                    provider TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+            conn.commit()
+        finally:
+            conn.close()
+
+    # ========== 公共接口 ==========
+
+    def estimate_tokens(self, messages: List[Dict], max_tokens: int) -> int:
+        """粗略估算一次调用消耗的 token 数（prompt + 预期输出）"""
+        prompt_chars = sum(len(msg.get('content') or '') for msg in messages)
+        completion = min(max_tokens, self.expected_completion_tokens)
+        return int(prompt_chars / self.chars_per_token) + completion
+
+    def limits_for(self, overrides: Optional[Dict] = None) -> Dict:
+        """合并默认限额与提供商级覆盖配置"""
+        limits = {
+            'requests_per_minute': RATE_LIMIT_CONFIG.get('requests_per_minute', 60),
+            'tokens_per_minute': RATE_LIMIT_CONFIG.get('tokens_per_minute', 400000),
+            'max_concurrent': RATE_LIMIT_CONFIG.get('max_concurrent', 10),
+        }
+        limits.update(overrides or {})
+        return limits
+
+    @contextmanager
+    def slot(
+        self,
+        provider: str,
+        limits: Dict,
+        estimated_tokens: int,
+        priority: str = 'interactive',
+        cancelled=None
+    ):
+        """
+        获取一次 LLM 调用的执行许可（上下文管理器，退出时释放并发占位）
+
+        Args:
+            provider: 提供商名称
+            limits: 限额（见 limits_for）
+            estimated_tokens: 预估 token 数
+            priority: 'interactive' 或 'background'
+            cancelled: 取消信号（stream_registry.CancelToken），排队期间取消时立即离开队列
+
+        Raises:
+            LLMOverloadedError: 队列已满或排队超时
+            LLMCancelledError: 排队期间被取消
+        """
+        if not self.enabled:
+            yield
+            return
+
+        with tracer.span('llm.queue_wait', provider=provider, priority=priority):
+            lease_id = self.acquire(provider, limits, estimated_tokens, priority, cancelled)
+        try:
+            yield
+        finally:
+            self.release(lease_id)
+
+    def acquire(
+        self,
+        provider: str,
+        limits: Dict,
+        estimated_tokens: int,
+        priority: str = 'interactive',
+        cancelled=None
+    ) -> Optional[str]:
+        """
+        排队等待执行许可（cancelled 见 slot）
+
+        Returns:
+            str: 并发占位 ID（调用结束后需 release）
+        """
+        priority_value = PRIORITIES.get(priority, PRIORITIES['interactive'])
+        ticket_id = uuid.uuid4().hex
+        self._enqueue(ticket_id, provider, priority, priority_value)
+
+        deadline = time.time() + self.max_wait_seconds
+        last_heartbeat = time.time()
+        try:
+            while True:
+                if cancelled is not None and cancelled.is_set():
+                    raise LLMCancelledError("调用已取消")
+                now = time.time()
+                if now > deadline:
+                    raise LLMOverloadedError(
+                        f"当前使用人数较多，请求排队超过 {self.max_wait_seconds} 秒，请稍后再试",
+                        retry_after=self.max_wait_seconds
+                    )
+
+                if self._queue_head(provider) == ticket_id:
+                    lease_id, wait = self._try_consume(ticket_id, provider, limits, estimated_tokens)
+                    if lease_id:
+                        return lease_id
+                    self.sleep(min(max(wait, self.poll_interval), 1.0), cancelled)
+                else:
+                    # 非队首只做只读检查，定期刷新心跳证明自己仍在等待
+                    if now - last_heartbeat > self.ticket_stale_seconds / 3:
+                        self._heartbeat(ticket_id)
+                        last_heartbeat = now
+                    self.sleep(self.poll_interval * 2, cancelled)
+        except BaseException:
+            self._dequeue(ticket_id)
+            raise
+
+    @staticmethod
+    def sleep(seconds: float, cancelled=None):
+        """
+        等待指定时间（排队轮询、重试退避）；提供取消信号时取消后立即结束
+
+        Raises:
+            LLMCancelledError: 等待期间被取消
+        """
+        if cancelled is None:
+            time.sleep(seconds)
+        elif cancelled.wait(seconds):
+            raise LLMCancelledError("调用已取消")
+
+    def release(self, lease_id: Optional[str]):
+        """释放并发占位"""
+        if not lease_id:
+            return
+        try:
+            with self.get_connection() as conn:
+                conn.execute('DELETE FROM leases WHERE lease_id = ?', (lease_id,))
+        except sqlite3.Error as e:
+            logger.warning('rate_limit.release_failed', '⚠️  释放 LLM 并发占位失败', error=str(e))
+
+    def penalize(self, provider: str, retry_after: float):
+        """
+        提供商返回 429 时暂停该提供商的所有出站请求
+
+        所有 worker 共享暂停时间，避免各自按固定间隔同时重试。
+        """
+        if not self.enabled:
+            return
+        until = time.time() + retry_after
+        try:
+            with self.get_connection(immediate=True) as conn:
+                conn.execute('''
+                    UPDATE buckets SET blocked_until = MAX(blocked_until, ?)
+                    WHERE provider = ?
+                ''', (until, provider))
+            logger.warning('rate_limit.provider_paused', '⏸️  提供商限流，暂停调用', provider=provider,
+                           seconds=round(retry_after, 1))
+        except sqlite3.Error as e:
+            logger.warning('rate_limit.pause_failed', '⚠️  记录提供商限流失败', error=str(e))
+
+    @staticmethod
+    def backoff_delay(attempt: int, base: float = 1.0, cap: float = 30.0) -> float:
+        """指数退避 + 全抖动（full jitter），避免多个 worker 同步重试"""
+        return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+    def queue_stats(self) -> Dict:
+        """队列和并发占用概况（用于监控）"""
+        if not self.enabled:
+            return {}
+        now = time.time()
+        with self.get_connection() as conn:
+            queued = conn.execute('''
+                SELECT provider, priority, COUNT(*) FROM wait_queue
+                WHERE heartbeat >= ? GROUP BY provider, priority
+            ''', (now - self.ticket_stale_seconds,)).fetchall()
+            active = conn.execute('''
+                SELECT provider, COUNT(*) FROM leases
+                WHERE expires_at >= ? GROUP BY provider
+            ''', (now,)).fetchall()
+        stats = {}
+        for provider, priority, count in queued:
+            stats.setdefault(provider, {'queued': {}, 'active': 0})
+            stats[provider]['queued'][priority] = count
+        for provider, count in active:
+            stats.setdefault(provider, {'queued': {}, 'active': 0})
+            stats[provider]['active'] = count
+        return stats
+
+    # ========== 内部实现 ==========
+
+    def _enqueue(self, ticket_id, provider, priority, priority_value):
+        """加入等待队列（队列饱和时拒绝）"""
+        now = time.time()
+        with self.get_connection(immediate=True) as conn:
+            # 清理已退出进程遗留的排队记录和占位
+            conn.execute('DELETE FROM wait_queue WHERE heartbeat < ?',
+                         (now - self.ticket_stale_seconds,))
+            conn.execute('DELETE FROM leases WHERE expires_at < ?', (now,))
+
+            queued = conn.execute(
+                'SELECT COUNT(*) FROM wait_queue WHERE provider = ?', (provider,)
+            ).fetchone()[0]
+
+            capacity = self.max_queue_size
+            if priority_value > PRIORITIES['interactive']:
+                capacity = int(self.max_queue_size * self.background_queue_share)
+            if queued >= capacity:
+                raise LLMOverloadedError(
+                    f"当前使用人数较多（排队 {queued} 个请求），请稍后再试"
+                    if priority == 'interactive'
+                    else "服务繁忙，后台生成任务暂不可用，请稍后再试"
+                )
+
+            conn.execute('''
+                INSERT INTO wait_queue (ticket_id, provider, priority, enqueued_at, heartbeat)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (ticket_id, provider, priority_value, now, now))
+
+    def _dequeue(self, ticket_id):
+        """离开等待队列"""
+        try:
+            with self.get_connection() as conn:
+                conn.execute('DELETE FROM wait_queue WHERE ticket_id = ?', (ticket_id,))
+        except sqlite3.Error as e:
+            logger.warning('rate_limit.dequeue_failed', '⚠️  移出 LLM 等待队列失败', error=str(e))
+
+    def _heartbeat(self, ticket_id):
+        """刷新排队心跳"""
+        with self.get_connection() as conn:
+            conn.execute('UPDATE wait_queue SET heartbeat = ? WHERE ticket_id = ?',
+                         (time.time(), ticket_id))
+
+    def _queue_head(self, provider) -> Optional[str]:
+        """队首（优先级最高、最早排队）的请求"""
+        with self.get_connection() as conn:
+            row = conn.execute('''
+                SELECT ticket_id FROM wait_queue
+                WHERE provider = ? AND heartbeat >= ?
+                ORDER BY priority, enqueued_at
+                LIMIT 1
+            ''', (provider, time.time() - self.ticket_stale_seconds)).fetchone()
+        return row[0] if row else None
+
+    def _try_consume(self, ticket_id, provider, limits, estimated_tokens):
+        """
+        队首请求尝试从令牌桶扣减
+
+        Returns:
+            (lease_id, wait): 成功时 lease_id 非空；失败时 wait 为建议的等待秒数
+        """
+        rpm = float(limits['requests_per_minute'])
+        tpm = float(limits['tokens_per_minute'])
+        # 单次请求超过桶容量时按满桶放行，避免永远无法执行
+        needed_tokens = min(float(estimated_tokens), tpm)
+        now = time.time()
+
+        with self.get_connection(immediate=True) as conn:
+            row = conn.execute('''
+                SELECT request_tokens, token_tokens, blocked_until, updated_at
+                FROM buckets WHERE provider = ?
+            ''', (provider,)).fetchone()
+            if row:
+                request_tokens, token_tokens, blocked_until, updated_at = row
+                elapsed = max(0.0, now - updated_at)
+                request_tokens = min(rpm, request_tokens + elapsed * rpm / 60.0)
+                token_tokens = min(tpm, token_tokens + elapsed * tpm / 60.0)
+            else:
+                request_tokens, token_tokens, blocked_until = rpm, tpm, 0
+
+            conn.execute('UPDATE wait_queue SET heartbeat = ? WHERE ticket_id = ?', (now, ticket_id))
+
+            active = conn.execute(
+                'SELECT COUNT(*) FROM leases WHERE provider = ? AND expires_at >= ?',
+                (provider, now)
+            ).fetchone()[0]
+
+            wait = 0.0
+            if blocked_until and blocked_until > now:
+                wait = blocked_until - now
+            elif active >= int(limits['max_concurrent']):
+                wait = self.poll_interval * 2
+            else:
+                if request_tokens < 1:
+                    wait = max(wait, (1 - request_tokens) * 60.0 / rpm)
+                if token_tokens < needed_tokens:
+                    wait = max(wait, (needed_tokens - token_tokens) * 60.0 / tpm)
+
+            if wait > 0:
+                conn.execute('''
+                    INSERT OR REPLACE INTO buckets
+                    (provider, request_tokens, token_tokens, blocked_until, updated_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (provider, request_tokens, token_tokens, blocked_until or 0, now))
+                return None, wait
+
+            lease_id = uuid.uuid4().hex
+            conn.execute('''
+                INSERT OR REPLACE INTO buckets
+                (provider, request_tokens, token_tokens, blocked_until, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (provider, request_tokens - 1, token_tokens - needed_tokens, blocked_until or 0, now))
+            conn.execute('DELETE FROM wait_queue WHERE ticket_id = ?', (ticket_id,))
+            conn.execute('INSERT INTO leases (lease_id, provider, expires_at) VALUES (?, ?, ?)',
+                         (lease_id, provider, now + self.lease_seconds))
+            return lease_id, 0.0
+
+
+# 全局限流器实例
+rate_limiter = RateLimiter()
@@ -0,0 +1,278 @@
+"""
+响应缓存模块
+按内容寻址缓存确定性的 LLM 生成结果（思维导图大纲、初始导读报告等）
+
+缓存键由（论文内容哈希, 智能体, Prompt 版本, Prompt 指纹, 模型, 生成参数）计算得出，
+数据保存在 SQLite 中，多个 gunicorn worker 共享；支持 TTL 过期和 LRU 淘汰。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+from config import RESPONSE_CACHE_CONFIG
+from metrics import metrics
+from logger import get_logger
+
+logger = get_logger('cache')
+
+
+class ResponseCache:
+    """确定性生成结果的共享缓存"""
+
+    def __init__(self):
+        self.enabled = RESPONSE_CACHE_CONFIG.get('enabled', True)
+        self.db_path = RESPONSE_CACHE_CONFIG['db_path']
+        self.ttl_seconds = RESPONSE_CACHE_CONFIG.get('ttl_seconds', 7 * 24 * 3600)
+        self.max_entries = RESPONSE_CACHE_CONFIG.get('max_entries', 2000)
+
+        # 文件摘要的进程内缓存：path -> (mtime_ns, size, digest)
+        self._digest_cache = {}
+        self._digest_lock = threading.Lock()
+
+        if self.enabled:
+            self._init_database()
+
+    @contextmanager
+    def get_connection(self):
+        """获取数据库连接的上下文管理器"""
+        conn = sqlite3.connect(str(self.db_path), timeout=10.0, check_same_thread=False)
+        try:
+            yield conn
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            conn.close()
+
+    def _init_database(self):
+        """初始化缓存表"""
+        with self.get_connection() as conn:
+            # WAL 模式：读写互不阻塞，适合多 worker 并发读取
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    agent TEXT NOT NULL,
+                    prompt_version TEXT,
+                    prompt_fingerprint TEXT,
+                    paper_hash TEXT,
+                    model TEXT,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_accessed REAL NOT NULL,
+                    hit_count INTEGER DEFAULT 0
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_cache_last_accessed
+                ON response_cache(last_accessed)
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_cache_agent_version
+                ON response_cache(agent, prompt_version)
+            ''')
+
+    # ========== 键计算 ==========
+
+    def file_digest(self, path) -> Optional[str]:
+        """
+        计算文件内容的 SHA-256（按 mtime 和大小在进程内缓存，避免重复读取大文件）
+
+        Args:
+            path: 文件路径
+
+        Returns:
+            str: 十六进制摘要，文件不存在时返回 None
+        """
+        if not path:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        path = str(path)
+        with self._digest_lock:
+            cached = self._digest_cache.get(path)
+            if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+                return cached[2]
+
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(block)
+        digest = sha256.hexdigest()
+
+        with self._digest_lock:
+            self._digest_cache[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    @staticmethod
+    def make_key(
+        paper_hash: str,
+        agent: str,
+        prompt_version: str,
+        prompt_fingerprint: str,
+        model: str,
+        params: Dict
+    ) -> str:
+        """
+        计算缓存键
+
+        Args:
+            paper_hash: 论文内容哈希
+            agent: 智能体名称
+            prompt_version: Prompt 版本
+            prompt_fingerprint: Prompt 内容指纹（文件修改后变化）
+            model: 模型名称
+            params: 生成参数（temperature、max_tokens 等）
+
+        Returns:
+            str: 缓存键
+        """
+        payload = json.dumps({
+            'paper_hash': paper_hash,
+            'agent': agent,
+            'prompt_version': prompt_version,
+            'prompt_fingerprint': prompt_fingerprint,
+            'model': model,
+            'params': params,
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    # ========== 读写 ==========
+
+    def get(self, cache_key: Optional[str]) -> Optional[str]:
+        """
+        读取缓存（命中时刷新最近访问时间）
+
+        Args:
+            cache_key: 缓存键
+
+        Returns:
+            str: 缓存的响应，未命中或已过期返回 None
+        """
+        if not self.enabled or not cache_key:
+            return None
+
+        now = time.time()
+        try:
+            with self.get_connection() as conn:
+                row = conn.execute(
+                    'SELECT response, created_at FROM response_cache WHERE cache_key = ?',
+                    (cache_key,)
+                ).fetchone()
+                if not row:
+                    metrics.inc('cache_requests_total', cache='response', result='miss')
+                    return None
+
+                response, created_at = row
+                if self.ttl_seconds and now - created_at > self.ttl_seconds:
+                    conn.execute('DELETE FROM response_cache WHERE cache_key = ?', (cache_key,))
+                    metrics.inc('cache_requests_total', cache='response', result='expired')
+                    return None
+
+                conn.execute('''
+                    UPDATE response_cache
+                    SET last_accessed = ?, hit_count = hit_count + 1
+                    WHERE cache_key = ?
+                ''', (now, cache_key))
+                metrics.inc('cache_requests_total', cache='response', result='hit')
+                return response
+        except sqlite3.Error as e:
+            logger.warning('cache.read_failed', '⚠️  读取响应缓存失败', error=str(e))
+            metrics.inc('cache_requests_total', cache='response', result='error')
+            return None
+
+    def set(
+        self,
+        cache_key: Optional[str],
+        response: str,
+        agent: str,
+        prompt_version: str = None,
+        prompt_fingerprint: str = None,
+        paper_hash: str = None,
+        model: str = None
+    ):
+        """
+        写入缓存
+
+        同一智能体、同一 Prompt 版本下指纹不同的旧条目（Prompt 文件已修改）会被一并清除，
+        条目总数超过上限时按最近访问时间淘汰。
+        """
+        if not self.enabled or not cache_key or not response:
+            return
+
+        now = time.time()
+        try:
+            with self.get_connection() as conn:
+                conn.execute('''
+                    INSERT OR REPLACE INTO response_cache
+                    (cache_key, agent, prompt_version, prompt_fingerprint, paper_hash,
+                     model, response, created_at, last_accessed, hit_count)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+                ''', (
+                    cache_key, agent, prompt_version, prompt_fingerprint,
+                    paper_hash, model, response, now, now
+                ))
+
+                # Prompt 已变更：清除旧指纹的条目
+                if prompt_fingerprint:
+                    conn.execute('''
+                        DELETE FROM response_cache
+                        WHERE agent = ? AND prompt_version IS ? AND prompt_fingerprint != ?
+                    ''', (agent, prompt_version, prompt_fingerprint))
+
+                self._evict(conn, now)
+        except sqlite3.Error as e:
+            logger.warning('cache.write_failed', '⚠️  写入响应缓存失败', error=str(e))
+
+    def _evict(self, conn, now: float):
+        """清除过期条目，并按 LRU 淘汰超出上限的条目"""
+        if self.ttl_seconds:
+            conn.execute(
+                'DELETE FROM response_cache WHERE created_at < ?',
+                (now - self.ttl_seconds,)
+            )
+
+        if self.max_entries:
+            count = conn.execute('SELECT COUNT(*) FROM response_cache').fetchone()[0]
+            overflow = count - self.max_entries
+            if overflow > 0:
+                conn.execute('''
+                    DELETE FROM response_cache WHERE cache_key IN (
+                        SELECT cache_key FROM response_cache
+                        ORDER BY last_accessed ASC
+                        LIMIT ?
+                    )
+                ''', (overflow,))
+
+    def invalidate(self, agent: Optional[str] = None) -> int:
+        """
+        手动清除缓存
+
+        Args:
+            agent: 只清除指定智能体的条目，为 None 时清除全部
+
+        Returns:
+            int: 清除的条目数
+        """
+        if not self.enabled:
+            return 0
+
+        with self.get_connection() as conn:
+            if agent:
+                cursor = conn.execute('DELETE FROM response_cache WHERE agent = ?', (agent,))
+            else:
+                cursor = conn.execute('DELETE FROM response_cache')
+            logger.info('cache.cleared', '✅ 已清除响应缓存', agent=agent, removed=cursor.rowcount)
+            return cursor.rowcount
+
+
+# 全局响应缓存实例
+response_cache = ResponseCache()
@@ -0,0 +1,457 @@
+"""
+分块上传模块
+PDF 分块上传到服务器（uploads/），网络中断后客户端只需补传缺失的部分
+
+协议：
+1. 创建上传（文件名、大小，可选 SHA-256）：同一用户再次创建相同文件（SHA-256 或客户端指纹相同）的上传时，
+   返回未完成的那次上传，客户端据此续传（刷新页面后也能续传）
+2. 按偏移量写入分块（任意顺序、可并发）：连接中途断开时，已收到的字节仍然记为已接收
+3. 查询状态：返回已接收字节数和缺失的区间（[起点, 终点)），客户端只补传这些区间
+4. 完成上传：所有字节到齐后计算 SHA-256（与客户端声明的不一致时清空已接收的数据，需要重新上传），
+   检查 PDF 文件头，移动到 uploads/<哈希前缀>_<文件名>
+
+未完成的文件预先按大小创建（稀疏文件），各分块直接写入对应偏移；已接收区间保存在 SQLite 中，
+在写事务中合并，多个 gunicorn worker 可以同时接收同一个上传的不同分块。过期的上传在创建新上传时顺带清理。
+
+写入分块时持有未完成文件的共享锁（flock），完成上传时先取得排他锁再计算哈希和移动文件：
+校验通过后不会再有分块改动文件内容；完成后到达的分块返回 409。完成过程中进程崩溃时，
+状态停留在 completing 超过 completing_timeout 后恢复为 uploading。
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional
+from werkzeug.utils import secure_filename
+try:
+    import fcntl
+except ImportError:  # Windows 开发环境：没有跨进程文件锁
+    fcntl = None
+from config import RESUMABLE_UPLOAD_CONFIG, UPLOAD_CONFIG
+from metrics import metrics
+from logger import get_logger
+
+logger = get_logger('resumable_upload')
+
+UPLOADING = 'uploading'
+COMPLETING = 'completing'
+COMPLETED = 'completed'
+
+# 写入分块、计算哈希时每次处理的字节数
+COPY_CHUNK_SIZE = 64 * 1024
+
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+class UploadError(ValueError):
+    """上传请求无效（status 为对应的 HTTP 状态码，details 附加在错误响应中，如缺失的区间）"""
+
+    def __init__(self, message: str, status: int = 400, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+
+def merge_range(ranges: List[List[int]], start: int, end: int) -> List[List[int]]:
+    """把 [start, end) 合并进有序、不重叠的区间列表"""
+    merged = []
+    for range_start, range_end in sorted(ranges + [[start, end]]):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], range_end)
+        else:
+            merged.append([range_start, range_end])
+    return merged
+
+
+def missing_ranges(ranges: List[List[int]], size: int) -> List[List[int]]:
+    """[0, size) 中未被覆盖的区间"""
+    missing, position = [], 0
+    for start, end in ranges:
+        if start > position:
+            missing.append([position, start])
+        position = max(position, end)
+    if position < size:
+        missing.append([position, size])
+    return missing
+
+
+class ResumableUploadStore:
+    """分块上传的状态和数据"""
+
+    def __init__(self):
+        self.enabled = RESUMABLE_UPLOAD_CONFIG.get('enabled', True)
+        self.db_path = RESUMABLE_UPLOAD_CONFIG['db_path']
+        self.partial_folder = Path(RESUMABLE_UPLOAD_CONFIG['partial_folder'])
+        self.upload_folder = Path(UPLOAD_CONFIG['upload_folder'])
+        self.chunk_size = RESUMABLE_UPLOAD_CONFIG.get('chunk_size', 1024 * 1024)
+        self.max_chunk_size = RESUMABLE_UPLOAD_CONFIG.get('max_chunk_size', 8 * 1024 * 1024)
+        self.max_file_size = RESUMABLE_UPLOAD_CONFIG.get('max_file_size', UPLOAD_CONFIG['max_file_size'])
+        self.expire_seconds = RESUMABLE_UPLOAD_CONFIG.get('expire_seconds', 24 * 3600)
+        self.completing_timeout = RESUMABLE_UPLOAD_CONFIG.get('completing_timeout', 300)
+        if self.enabled:
+            self.partial_folder.mkdir(parents=True, exist_ok=True)
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._init_database()
+
+    @contextmanager
+    def get_connection(self, immediate: bool = False):
+        """
+        获取数据库连接的上下文管理器
+
+        Args:
+            immediate: 是否在事务开始时就获取写锁（合并已接收区间等“先读后写”的操作需要）
+        """
+        conn = sqlite3.connect(
+            str(self.db_path),
+            timeout=10.0,
+            check_same_thread=False,
+            isolation_level=None
+        )
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+            yield conn
+            conn.execute('COMMIT')
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise e
+        finally:
+            conn.close()
+
+    def _init_database(self):
+        """初始化上传表"""
+        conn = sqlite3.connect(str(self.db_path), timeout=10.0)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS uploads (
+                    upload_id TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    sha256 TEXT,
+                    fingerprint TEXT,
+                    received TEXT NOT NULL,
+                    received_bytes INTEGER NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL,
+                    path TEXT,
+                    session_id TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_uploads_resume
+                ON uploads(user_id, size, status)
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_uploads_expires
+                ON uploads(expires_at)
+            ''')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _partial_path(self, upload_id: str) -> Path:
+        return self.partial_folder / f"{upload_id}.part"
+
+    def _summary(self, row) -> Dict:
+        """上传状态（接口响应）"""
+        received = json.loads(row['received'])
+        return {
+            'upload_id': row['upload_id'],
+            'user_id': row['user_id'],
+            'filename': row['filename'],
+            'size': row['size'],
+            'sha256': row['sha256'],
+            'status': row['status'],
+            'chunk_size': self.chunk_size,
+            'max_chunk_size': self.max_chunk_size,
+            'received_bytes': row['received_bytes'],
+            'missing': missing_ranges(received, row['size']) if row['status'] != COMPLETED else [],
+            'session_id': row['session_id'],
+            'expires_at': row['expires_at'],
+        }
+
+    def _get_row(self, conn, upload_id: str):
+        row = conn.execute('SELECT * FROM uploads WHERE upload_id = ?', (upload_id,)).fetchone()
+        if row is None or (row['status'] != COMPLETED and row['expires_at'] < time.time()):
+            raise UploadError('上传不存在或已过期', status=404)
+        return row
+
+    # ========== 上传流程 ==========
+
+    def initiate(self, user_id: str, filename: str, size: int, sha256: Optional[str] = None,
+                 fingerprint: Optional[str] = None) -> Dict:
+        """
+        创建上传；同一用户有相同文件的未完成上传时返回该上传（resumed 为 True）
+
+        Args:
+            sha256: 客户端计算的文件 SHA-256（完成时校验；浏览器不支持计算时可省略）
+            fingerprint: 客户端的文件指纹（如 文件名:大小:修改时间），没有 SHA-256 时用来匹配未完成的上传
+        """
+        if not user_id:
+            raise UploadError('缺少 user_id')
+        if not filename or not filename.lower().endswith('.pdf'):
+            raise UploadError('只支持 PDF 文件')
+        if not isinstance(size, int) or size <= 0:
+            raise UploadError('文件大小无效')
+        if size > self.max_file_size:
+            raise UploadError(f"文件过大（上限 {self.max_file_size // (1024 * 1024)} MB）", status=413)
+        sha256 = (sha256 or '').lower() or None
+        if sha256 and not SHA256_PATTERN.match(sha256):
+            raise UploadError('sha256 格式无效')
+
+        self.cleanup()
+        now = time.time()
+        match_column, match_value = ('sha256', sha256) if sha256 else ('fingerprint', fingerprint)
+        with self.get_connection(immediate=True) as conn:
+            if match_value:
+                row = conn.execute(f'''
+                    SELECT * FROM uploads
+                    WHERE user_id = ? AND size = ? AND status = ? AND {match_column} = ? AND expires_at > ?
+                    ORDER BY updated_at DESC LIMIT 1
+                ''', (user_id, size, UPLOADING, match_value, now)).fetchone()
+                if row is not None and self._partial_path(row['upload_id']).exists():
+                    metrics.inc('resumable_uploads_total', event='resumed')
+                    logger.info('upload.resumed', '⏯️  续传未完成的上传', upload_id=row['upload_id'],
+                                received_bytes=row['received_bytes'], size=size)
+                    return {**self._summary(row), 'resumed': True}
+
+            upload_id = uuid.uuid4().hex
+            # 预先按文件大小创建（稀疏文件），分块直接写入各自的偏移
+            with open(self._partial_path(upload_id), 'wb') as f:
+                f.truncate(size)
+            conn.execute('''
+                INSERT INTO uploads (upload_id, user_id, filename, size, sha256, fingerprint, received,
+                                     received_bytes, status, created_at, updated_at, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?, '[]', 0, ?, ?, ?, ?)
+            ''', (upload_id, user_id, filename, size, sha256, fingerprint, UPLOADING,
+                  now, now, now + self.expire_seconds))
+            row = self._get_row(conn, upload_id)
+        metrics.inc('resumable_uploads_total', event='initiated')
+        logger.info('upload.initiated', '📤 创建分块上传', upload_id=upload_id, filename=filename, size=size)
+        return {**self._summary(row), 'resumed': False}
+
+    def status(self, upload_id: str) -> Dict:
+        with self.get_connection() as conn:
+            return self._summary(self._get_row(conn, upload_id))
+
+    def _recover_stale_completion(self, conn, row):
+        """完成上传的进程中途崩溃（completing 状态超过 completing_timeout 未更新）：恢复为 uploading"""
+        if row['status'] != COMPLETING or time.time() - row['updated_at'] < self.completing_timeout:
+            return row
+        upload_id = row['upload_id']
+        partial_path = self._partial_path(upload_id)
+        if partial_path.exists():
+            conn.execute('UPDATE uploads SET status = ?, updated_at = ? WHERE upload_id = ?',
+                         (UPLOADING, time.time(), upload_id))
+        else:
+            # 崩溃发生在移动文件之后：数据已不在未完成文件中，需要重新上传
+            with open(partial_path, 'wb') as f:
+                f.truncate(row['size'])
+            conn.execute('''
+                UPDATE uploads SET status = ?, received = '[]', received_bytes = 0, updated_at = ?
+                WHERE upload_id = ?
+            ''', (UPLOADING, time.time(), upload_id))
+        logger.warning('upload.completion_recovered', '⚠️  恢复中断的完成操作', upload_id=upload_id,
+                       data_kept=partial_path.exists())
+        return self._get_row(conn, upload_id)
+
+    def _get_writable_row(self, conn, upload_id: str):
+        """获取仍在接收分块的上传，已完成或正在完成时返回 409"""
+        row = self._recover_stale_completion(conn, self._get_row(conn, upload_id))
+        if row['status'] != UPLOADING:
+            message = '上传已完成' if row['status'] == COMPLETED else '上传正在完成中'
+            raise UploadError(message, status=409, upload=self._summary(row))
+        return row
+
+    def write_chunk(self, upload_id: str, offset: int, stream: BinaryIO, length: int) -> Dict:
+        """
+        把 stream 中的 length 个字节写入 offset 处
+
+        连接中途断开时，已写入的部分仍记为已接收（客户端续传时只需补传剩余部分）
+        """
+        with self.get_connection(immediate=True) as conn:
+            row = self._get_writable_row(conn, upload_id)
+        if length <= 0 or length > self.max_chunk_size:
+            raise UploadError(f"分块大小无效（上限 {self.max_chunk_size} 字节）", status=413)
+        if offset < 0 or offset + length > row['size']:
+            raise UploadError('分块超出文件范围', status=416, upload=self._summary(row))
+
+        written = 0
+        error = None
+        try:
+            f = open(self._partial_path(upload_id), 'r+b')
+        except FileNotFoundError:
+            # 文件已在完成上传时移走
+            raise UploadError('上传已完成', status=409)
+        with f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_SH)
+            # 等待锁期间上传可能已完成（文件已移到 uploads/，不能再写入）
+            with self.get_connection() as conn:
+                self._get_writable_row(conn, upload_id)
+            f.seek(offset)
+            try:
+                while written < length:
+                    data = stream.read(min(COPY_CHUNK_SIZE, length - written))
+                    if not data:
+                        break
+                    f.write(data)
+                    written += len(data)
+            except Exception as e:
+                # 客户端断开连接（读取请求体失败）：保留已写入的部分
+                error = e
+
+            if written:
+                f.flush()
+                now = time.time()
+                with self.get_connection(immediate=True) as conn:
+                    row = self._get_writable_row(conn, upload_id)
+                    received = merge_range(json.loads(row['received']), offset, offset + written)
+                    conn.execute('''
+                        UPDATE uploads SET received = ?, received_bytes = ?, updated_at = ?, expires_at = ?
+                        WHERE upload_id = ?
+                    ''', (json.dumps(received), sum(end - start for start, end in received), now,
+                          now + self.expire_seconds, upload_id))
+                    row = self._get_row(conn, upload_id)
+                metrics.inc('resumable_upload_bytes_total', written)
+        if error is not None or written < length:
+            logger.warning('upload.chunk_incomplete', '⚠️  分块未完整接收', upload_id=upload_id, offset=offset,
+                           expected=length, written=written, error=str(error) if error else None)
+            raise UploadError('分块未完整接收，请重新发送缺失的部分', status=400, upload=self._summary(row))
+        return self._summary(row)
+
+    def complete(self, upload_id: str) -> Dict:
+        """
+        校验并保存上传的文件（重复调用返回同样的结果）
+
+        Returns:
+            上传状态，包含 path（uploads/ 下的文件路径）和 sha256
+        """
+        with self.get_connection(immediate=True) as conn:
+            row = self._recover_stale_completion(conn, self._get_row(conn, upload_id))
+        if row['status'] == COMPLETED:
+            return {**self._summary(row), 'path': row['path']}
+        if row['status'] == COMPLETING:
+            raise UploadError('上传正在完成中', status=409)
+
+        partial_path = self._partial_path(upload_id)
+        try:
+            f = open(partial_path, 'rb')
+        except FileNotFoundError:
+            # 另一个请求刚完成了上传（文件已移走）
+            with self.get_connection() as conn:
+                row = self._get_row(conn, upload_id)
+            if row['status'] == COMPLETED:
+                return {**self._summary(row), 'path': row['path']}
+            raise UploadError('上传正在完成中', status=409)
+        with f:
+            if fcntl is not None:
+                try:
+                    # 排他锁：等正在写入的分块结束；有分块在写入时不等待，客户端稍后重试
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    raise UploadError('仍有分块正在写入，请稍后再完成上传', status=409)
+            with self.get_connection(immediate=True) as conn:
+                row = self._recover_stale_completion(conn, self._get_row(conn, upload_id))
+                if row['status'] == COMPLETED:
+                    return {**self._summary(row), 'path': row['path']}
+                if row['status'] == COMPLETING:
+                    raise UploadError('上传正在完成中', status=409)
+                missing = missing_ranges(json.loads(row['received']), row['size'])
+                if missing:
+                    raise UploadError('文件尚未上传完整', status=409, upload=self._summary(row))
+                conn.execute('UPDATE uploads SET status = ?, updated_at = ? WHERE upload_id = ?',
+                             (COMPLETING, time.time(), upload_id))
+
+            try:
+                digest = hashlib.sha256()
+                header = f.read(5)
+                digest.update(header)
+                for block in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+                    digest.update(block)
+                sha256 = digest.hexdigest()
+
+                if row['sha256'] and sha256 != row['sha256']:
+                    # 数据在传输中损坏：清空已接收的区间，客户端需要重新上传
+                    self._reset(upload_id)
+                    metrics.inc('resumable_uploads_total', event='hash_mismatch')
+                    logger.warning('upload.hash_mismatch', '⚠️  上传文件的 SHA-256 不一致', upload_id=upload_id,
+                                   expected=row['sha256'], actual=sha256)
+                    raise UploadError('文件校验失败（SHA-256 不一致），请重新上传', status=422,
+                                      upload=self.status(upload_id))
+                if header != b'%PDF-':
+                    self._reset(upload_id)
+                    raise UploadError('文件不是有效的 PDF', status=415)
+
+                # 文件名以哈希前缀区分（secure_filename 会去掉中文，只剩扩展名时只用哈希）
+                filename = secure_filename(row['filename'])
+                if filename.lower().endswith('.pdf') and len(filename) > len('.pdf'):
+                    target = self.upload_folder / f"{sha256[:16]}_{filename}"
+                else:
+                    target = self.upload_folder / f"{sha256[:16]}.pdf"
+                if target.exists():
+                    # 内容相同的文件已上传过
+                    partial_path.unlink(missing_ok=True)
+                else:
+                    os.replace(partial_path, target)
+            except UploadError:
+                raise
+            except Exception:
+                self._set_status(upload_id, UPLOADING)
+                raise
+
+            now = time.time()
+            with self.get_connection() as conn:
+                conn.execute('''
+                    UPDATE uploads SET status = ?, path = ?, sha256 = ?, updated_at = ?, expires_at = ?
+                    WHERE upload_id = ?
+                ''', (COMPLETED, str(target), sha256, now, now + self.expire_seconds, upload_id))
+                row = self._get_row(conn, upload_id)
+        metrics.inc('resumable_uploads_total', event='completed')
+        logger.info('upload.completed', '✅ 分块上传完成', upload_id=upload_id, path=str(target),
+                    size=row['size'], sha256=sha256)
+        return {**self._summary(row), 'path': str(target)}
+
+    def attach_session(self, upload_id: str, session_id: str):
+        """记录上传创建的会话（重复完成上传时返回同一个会话）"""
+        with self.get_connection() as conn:
+            conn.execute('UPDATE uploads SET session_id = ? WHERE upload_id = ?', (session_id, upload_id))
+
+    def _reset(self, upload_id: str):
+        with self.get_connection() as conn:
+            conn.execute('''
+                UPDATE uploads SET status = ?, received = '[]', received_bytes = 0, updated_at = ?
+                WHERE upload_id = ?
+            ''', (UPLOADING, time.time(), upload_id))
+
+    def _set_status(self, upload_id: str, status: str):
+        with self.get_connection() as conn:
+            conn.execute('UPDATE uploads SET status = ?, updated_at = ? WHERE upload_id = ?',
+                         (status, time.time(), upload_id))
+
+    def cleanup(self) -> int:
+        """删除过期的上传记录和未完成的数据，返回删除的记录数"""
+        now = time.time()
+        with self.get_connection() as conn:
+            rows = conn.execute('SELECT upload_id, status FROM uploads WHERE expires_at < ?', (now,)).fetchall()
+            conn.execute('DELETE FROM uploads WHERE expires_at < ?', (now,))
+        for row in rows:
+            if row['status'] != COMPLETED:
+                self._partial_path(row['upload_id']).unlink(missing_ok=True)
+        if rows:
+            logger.info('upload.cleanup', '🧹 清理过期的上传', removed=len(rows))
+        return len(rows)
+
+
+# 创建全局实例
+resumable_uploads = ResumableUploadStore()
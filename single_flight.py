@@ -0,0 +1,558 @@
+"""
+请求合并模块（single-flight）
+并发的相同 LLM 请求只由一个 leader 实际调用模型，其余请求跟随其结果
+
+协调通过 SQLite 租约表完成，因此同样适用于多个 gunicorn worker：
+- leader 持有带过期时间的租约，并定期续约
+- 流式生成时，leader 将已生成的片段写入共享日志，follower 先读取已有片段再跟随实时输出
+- 流式生成在 leader 进程的后台线程中进行，不属于发起它的请求：leader 的请求方取消或断开后，
+  只要还有 follower 在跟随就继续生成；所有请求方都离开后才停止
+- leader 失效（进程退出、调用失败）后，follower 重新竞争成为 leader
+"""
+import contextvars
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional
+from config import SINGLE_FLIGHT_CONFIG
+from logger import get_logger
+from stream_registry import CancelToken
+
+logger = get_logger('single_flight')
+
+
+class SingleFlightError(Exception):
+    """follower 已输出部分内容后 leader 失效，无法无缝继续"""
+
+
+class _LeaderStream:
+    """leader 在后台线程中进行的流式生成（本进程的请求方从这里读取片段）"""
+
+    def __init__(self):
+        self.parts = []
+        self.status = None  # 结束后为 'done' / 'failed' / 'abandoned'
+        self.error = None
+        self.attached = True  # 发起生成的请求方是否仍在读取
+        self.cancelled = CancelToken()  # 所有请求方都离开后置位，停止生成
+        self.cond = threading.Condition()
+
+
+class SingleFlight:
+    """跨进程的 LLM 请求合并器"""
+
+    def __init__(self):
+        self.enabled = SINGLE_FLIGHT_CONFIG.get('enabled', True)
+        self.db_path = SINGLE_FLIGHT_CONFIG['db_path']
+        self.stateless_only = SINGLE_FLIGHT_CONFIG.get('stateless_only', True)
+        self.lease_seconds = SINGLE_FLIGHT_CONFIG.get('lease_seconds', 30)
+        self.poll_interval = SINGLE_FLIGHT_CONFIG.get('poll_interval', 0.1)
+        self.flush_interval = SINGLE_FLIGHT_CONFIG.get('flush_interval', 0.05)
+        self.result_ttl_seconds = SINGLE_FLIGHT_CONFIG.get('result_ttl_seconds', 15)
+        self.member_check_interval = SINGLE_FLIGHT_CONFIG.get('member_check_interval', 1.0)
+        self.retention_seconds = SINGLE_FLIGHT_CONFIG.get('retention_seconds', 3600)
+
+        if self.enabled:
+            self._init_database()
+
+    @contextmanager
+    def get_connection(self, immediate: bool = False):
+        """
+        获取数据库连接的上下文管理器
+
+        Args:
+            immediate: 是否以 BEGIN IMMEDIATE 开启写事务（用于原子地竞争租约）
+        """
+        conn = sqlite3.connect(
+            str(self.db_path),
+            timeout=10.0,
+            check_same_thread=False,
+            isolation_level=None
+        )
+        try:
+            conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+            yield conn
+            conn.execute('COMMIT')
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise e
+        finally:
+            conn.close()
+
+    def _init_database(self):
+        """初始化租约表和片段日志表"""
+        conn = sqlite3.connect(str(self.db_path), timeout=10.0)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS flights (
+                    flight_key TEXT PRIMARY KEY,
+                    flight_id TEXT NOT NULL,
+                    owner TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    result TEXT,
+                    lease_expires REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS flight_chunks (
+                    flight_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    content TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (flight_id, seq)
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_flight_chunks_created_at
+                ON flight_chunks(created_at)
+            ''')
+            # 正在跟随流式生成的 follower（定期刷新 seen_at；leader 据此判断是否还有人在等待）
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS flight_members (
+                    flight_id TEXT NOT NULL,
+                    member_id TEXT NOT NULL,
+                    seen_at REAL NOT NULL,
+                    PRIMARY KEY (flight_id, member_id)
+                )
+            ''')
+            conn.commit()
+        finally:
+            conn.close()
+
+    # ========== 公共接口 ==========
+
+    @staticmethod
+    def make_key(**parts) -> str:
+        """根据请求内容（模型、参数、消息等）计算合并键"""
+        payload = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def should_coalesce(self, chat_history: Optional[List]) -> bool:
+        """判断请求是否参与合并（默认只合并没有历史对话的请求）"""
+        if not self.enabled:
+            return False
+        return not self.stateless_only or not chat_history
+
+    def run(
+        self,
+        key: str,
+        fn: Callable[[], str],
+        is_failure: Optional[Callable[[str], bool]] = None
+    ) -> str:
+        """
+        合并执行非流式调用
+
+        Args:
+            key: 合并键
+            fn: 实际执行调用的函数
+            is_failure: 判断结果是否为失败（失败结果不共享，follower 会自行重试）
+
+        Returns:
+            str: 调用结果
+        """
+        try:
+            role, value = self._acquire(key)
+        except sqlite3.Error as e:
+            logger.warning('single_flight.unavailable', '⚠️  请求合并不可用，直接调用', error=str(e))
+            return fn()
+
+        while True:
+            if role == 'done':
+                logger.info('single_flight.reused', '🔗 复用刚完成的相同请求结果')
+                return value
+            if role == 'leader':
+                return self._lead_call(key, value, fn, is_failure)
+
+            # follower：等待 leader 完成
+            logger.info('single_flight.joined', '🔗 检测到相同的进行中请求，等待其结果')
+            flight_id = value
+            try:
+                while True:
+                    time.sleep(self.poll_interval)
+                    status, result, lease_expires = self._read_flight(key, flight_id)
+                    if status == 'done':
+                        return result
+                    if status != 'running' or lease_expires < time.time():
+                        break
+
+                # leader 失效：重新竞争
+                role, value = self._acquire(key)
+            except sqlite3.Error as e:
+                logger.warning('single_flight.unavailable', '⚠️  请求合并不可用，直接调用', error=str(e))
+                return fn()
+
+    def stream(
+        self,
+        key: str,
+        factory: Callable[[CancelToken], Iterator[str]],
+        cancelled: Optional[CancelToken] = None
+    ) -> Iterator[str]:
+        """
+        合并执行流式调用
+
+        Args:
+            key: 合并键
+            factory: 返回实际流式生成器的函数，参数为生成的取消信号
+                （成为 leader 时是整个合并生成的信号，所有请求方都离开后才置位）
+            cancelled: 本请求的取消信号；取消后本请求的输出立即结束，生成是否停止见 _lead_stream
+
+        Yields:
+            str: 流式输出的文本片段
+
+        Raises:
+            SingleFlightError: 已输出部分内容后 leader 失效
+        """
+        member_id = uuid.uuid4().hex
+        try:
+            role, value = self._acquire(key, member_id)
+        except sqlite3.Error as e:
+            logger.warning('single_flight.unavailable', '⚠️  请求合并不可用，直接调用', error=str(e))
+            yield from factory(cancelled)
+            return
+
+        delivered = 0
+        while True:
+            if delivered:
+                raise SingleFlightError("合并的生成请求中途失效，无法继续输出")
+
+            if role == 'done':
+                logger.info('single_flight.reused', '🔗 复用刚完成的相同请求结果')
+                yield value
+                return
+            if role == 'leader':
+                yield from self._lead_stream(key, value, factory, cancelled)
+                return
+
+            logger.info('single_flight.joined', '🔗 检测到相同的进行中请求，跟随其流式输出')
+            follower = self._follow(key, value, member_id, cancelled)
+            try:
+                while True:
+                    try:
+                        chunk = next(follower)
+                    except StopIteration as stop:
+                        status = stop.value
+                        break
+                    delivered += 1
+                    yield chunk
+            finally:
+                follower.close()
+
+            if status in ('done', 'cancelled'):
+                return
+
+            # leader 失效：重新竞争
+            role, value = self._acquire(key, member_id)
+
+    # ========== leader ==========
+
+    def _lead_call(self, key, flight_id, fn, is_failure) -> str:
+        """以 leader 身份执行非流式调用，并发布结果"""
+        stop = self._start_heartbeat(key, flight_id)
+        try:
+            result = fn()
+        except BaseException:
+            stop.set()
+            self._finish(key, flight_id, 'failed')
+            raise
+        stop.set()
+
+        if is_failure and is_failure(result):
+            self._finish(key, flight_id, 'failed')
+        else:
+            self._finish(key, flight_id, 'done', result)
+        return result
+
+    def _lead_stream(self, key, flight_id, factory, cancelled: Optional[CancelToken] = None) -> Iterator[str]:
+        """
+        以 leader 身份发起流式生成，并读取其输出
+
+        生成在后台线程中进行并写入共享日志。本请求取消或断开后，只要还有 follower 在跟随就继续生成，
+        没有 follower 时（或之后 follower 全部离开）才停止并标记为 abandoned
+        """
+        flight = _LeaderStream()
+
+        def has_members() -> bool:
+            try:
+                return self._count_members(flight_id) > 0
+            except sqlite3.Error as e:
+                logger.warning('single_flight.unavailable', '⚠️  读取请求合并成员失败', error=str(e))
+                return True
+
+        def check_members():
+            # 发起生成的请求方已离开且没有 follower：停止生成
+            if not flight.attached and flight.status is None and not has_members():
+                flight.cancelled.set('abandoned')
+
+        stop = self._start_heartbeat(key, flight_id, check_members)
+
+        def generate():
+            generator = factory(flight.cancelled)
+            pending = []
+            next_seq = 0
+            last_flush = time.monotonic()
+            status, error = 'abandoned', None
+            try:
+                for piece in generator:
+                    with flight.cond:
+                        flight.parts.append(piece)
+                        flight.cond.notify_all()
+                    pending.append(piece)
+                    now = time.monotonic()
+                    if now - last_flush >= self.flush_interval:
+                        next_seq = self._append(flight_id, next_seq, pending)
+                        pending = []
+                        last_flush = now
+                # 取消后提前结束的输出不完整，不能作为结果共享
+                status = 'abandoned' if flight.cancelled.is_set() else 'done'
+            except Exception as e:
+                status = 'abandoned' if flight.cancelled.is_set() else 'failed'
+                error = e
+            finally:
+                stop.set()
+                generator.close()
+                if pending:
+                    self._append(flight_id, next_seq, pending)
+                self._finish(key, flight_id, status, ''.join(flight.parts) if status == 'done' else None)
+                with flight.cond:
+                    flight.status, flight.error = status, error
+                    flight.cond.notify_all()
+
+        def wake():
+            with flight.cond:
+                flight.cond.notify_all()
+
+        # 复制上下文：生成中的 span 挂到 leader 请求的链路下
+        threading.Thread(target=contextvars.copy_context().run, args=(generate,), daemon=True).start()
+        unregister = cancelled.on_cancel(wake) if cancelled is not None else None
+        delivered = 0
+        try:
+            while True:
+                with flight.cond:
+                    while (delivered == len(flight.parts) and flight.status is None
+                           and not (cancelled is not None and cancelled.is_set())):
+                        flight.cond.wait()
+                    if cancelled is not None and cancelled.is_set():
+                        return
+                    pieces = flight.parts[delivered:]
+                    status, error = flight.status, flight.error
+                delivered += len(pieces)
+                for piece in pieces:
+                    yield piece
+                if not pieces and status is not None:
+                    break
+            if error is not None:
+                raise error
+        finally:
+            # 本请求结束（完成、取消或客户端断开）：没有 follower 时立即停止生成
+            if unregister is not None:
+                unregister()
+            with flight.cond:
+                flight.attached = False
+            check_members()
+
+    def _start_heartbeat(self, key, flight_id, check: Optional[Callable[[], None]] = None) -> threading.Event:
+        """
+        启动续约线程，返回用于停止续约的事件
+
+        Args:
+            check: 每隔 member_check_interval 执行一次的检查（流式 leader 检查是否还有请求方）
+        """
+        stop = threading.Event()
+        renew_interval = self.lease_seconds / 3
+        interval = min(renew_interval, self.member_check_interval) if check else renew_interval
+
+        def heartbeat():
+            renewed_at = time.monotonic()
+            while not stop.wait(interval):
+                if check is not None:
+                    check()
+                if time.monotonic() - renewed_at < renew_interval:
+                    continue
+                renewed_at = time.monotonic()
+                try:
+                    with self.get_connection() as conn:
+                        conn.execute('''
+                            UPDATE flights SET lease_expires = ?
+                            WHERE flight_key = ? AND flight_id = ? AND status = 'running'
+                        ''', (time.time() + self.lease_seconds, key, flight_id))
+                except sqlite3.Error as e:
+                    logger.warning('single_flight.renew_failed', '⚠️  请求合并租约续约失败', error=str(e))
+
+        threading.Thread(target=heartbeat, daemon=True).start()
+        return stop
+
+    def _append(self, flight_id, start_seq: int, pieces: List[str]) -> int:
+        """写入一批流式片段，返回下一个序号"""
+        now = time.time()
+        rows = [(flight_id, start_seq + i, piece, now) for i, piece in enumerate(pieces)]
+        try:
+            with self.get_connection() as conn:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO flight_chunks (flight_id, seq, content, created_at)
+                    VALUES (?, ?, ?, ?)
+                ''', rows)
+        except sqlite3.Error as e:
+            logger.warning('single_flight.log_failed', '⚠️  写入请求合并日志失败', error=str(e))
+        return start_seq + len(rows)
+
+    def _finish(self, key, flight_id, status: str, result: Optional[str] = None):
+        """发布 leader 的最终状态"""
+        try:
+            with self.get_connection() as conn:
+                conn.execute('''
+                    UPDATE flights SET status = ?, result = ?, updated_at = ?
+                    WHERE flight_key = ? AND flight_id = ?
+                ''', (status, result, time.time(), key, flight_id))
+        except sqlite3.Error as e:
+            logger.warning('single_flight.update_failed', '⚠️  更新请求合并状态失败', error=str(e))
+
+    # ========== follower ==========
+
+    def _follow(self, key, flight_id, member_id, cancelled=None):
+        """
+        读取 leader 的片段日志（先补发已有片段，再跟随实时输出）
+
+        跟随期间定期刷新成员记录（见 flight_members），结束时删除
+
+        Returns:
+            str: 结束时 leader 的状态（'done' 表示正常完成）；本请求被取消时为 'cancelled'
+        """
+        try:
+            status = yield from self._follow_chunks(key, flight_id, member_id, cancelled)
+            return status
+        finally:
+            self._leave(flight_id, member_id)
+
+    def _follow_chunks(self, key, flight_id, member_id, cancelled=None):
+        next_seq = 0
+        touched_at = time.monotonic()
+        while True:
+            if cancelled is not None and cancelled.is_set():
+                return 'cancelled'
+            if time.monotonic() - touched_at >= self.lease_seconds / 3:
+                self._touch(flight_id, member_id)
+                touched_at = time.monotonic()
+            # 先读状态再读片段：若状态为 done，随后读到的片段一定是完整的
+            status, _, lease_expires = self._read_flight(key, flight_id)
+            chunks = self._read_chunks(flight_id, next_seq)
+            for chunk in chunks:
+                next_seq += 1
+                yield chunk
+
+            if status == 'done':
+                return status
+            if status != 'running' or lease_expires < time.time():
+                return status or 'lost'
+            if not chunks:
+                if cancelled is None:
+                    time.sleep(self.poll_interval)
+                elif cancelled.wait(self.poll_interval):
+                    return 'cancelled'
+
+    def _touch(self, flight_id, member_id):
+        """刷新 follower 的成员记录"""
+        try:
+            with self.get_connection() as conn:
+                conn.execute(
+                    'UPDATE flight_members SET seen_at = ? WHERE flight_id = ? AND member_id = ?',
+                    (time.time(), flight_id, member_id)
+                )
+        except sqlite3.Error as e:
+            logger.warning('single_flight.update_failed', '⚠️  更新请求合并成员失败', error=str(e))
+
+    def _leave(self, flight_id, member_id):
+        """follower 停止跟随（完成、取消或断开）"""
+        try:
+            with self.get_connection() as conn:
+                conn.execute(
+                    'DELETE FROM flight_members WHERE flight_id = ? AND member_id = ?',
+                    (flight_id, member_id)
+                )
+        except sqlite3.Error as e:
+            logger.warning('single_flight.update_failed', '⚠️  更新请求合并成员失败', error=str(e))
+
+    def _count_members(self, flight_id) -> int:
+        """仍在跟随的 follower 数量（超过租约时长未刷新的视为已离开）"""
+        with self.get_connection() as conn:
+            row = conn.execute(
+                'SELECT COUNT(*) FROM flight_members WHERE flight_id = ? AND seen_at > ?',
+                (flight_id, time.time() - self.lease_seconds)
+            ).fetchone()
+        return row[0]
+
+    def _read_flight(self, key, flight_id):
+        """读取 flight 状态，返回 (status, result, lease_expires)；已被替换时 status 为 None"""
+        with self.get_connection() as conn:
+            row = conn.execute('''
+                SELECT status, result, lease_expires FROM flights
+                WHERE flight_key = ? AND flight_id = ?
+            ''', (key, flight_id)).fetchone()
+        return row if row else (None, None, 0)
+
+    def _read_chunks(self, flight_id, from_seq: int) -> List[str]:
+        """读取序号不小于 from_seq 的片段"""
+        with self.get_connection() as conn:
+            rows = conn.execute('''
+                SELECT content FROM flight_chunks
+                WHERE flight_id = ? AND seq >= ?
+                ORDER BY seq
+            ''', (flight_id, from_seq)).fetchall()
+        return [row[0] for row in rows]
+
+    # ========== 租约 ==========
+
+    def _acquire(self, key, member_id: Optional[str] = None):
+        """
+        竞争租约
+
+        Args:
+            member_id: 流式请求的成员 ID；成为 follower 时在同一事务中登记，leader 不会在登记前判定无人跟随
+
+        Returns:
+            ('leader', flight_id) | ('follower', flight_id) | ('done', result)
+        """
+        now = time.time()
+        with self.get_connection(immediate=True) as conn:
+            row = conn.execute('''
+                SELECT flight_id, status, result, lease_expires, updated_at
+                FROM flights WHERE flight_key = ?
+            ''', (key,)).fetchone()
+
+            if row:
+                flight_id, status, result, lease_expires, updated_at = row
+                if status == 'running' and lease_expires > now:
+                    if member_id:
+                        conn.execute('''
+                            INSERT OR REPLACE INTO flight_members (flight_id, member_id, seen_at)
+                            VALUES (?, ?, ?)
+                        ''', (flight_id, member_id, now))
+                    return 'follower', flight_id
+                if status == 'done' and now - updated_at <= self.result_ttl_seconds:
+                    return 'done', result
+
+            flight_id = uuid.uuid4().hex
+            owner = f"{os.getpid()}:{threading.get_ident()}"
+            conn.execute('''
+                INSERT OR REPLACE INTO flights
+                (flight_key, flight_id, owner, status, result, lease_expires, updated_at)
+                VALUES (?, ?, ?, 'running', NULL, ?, ?)
+            ''', (key, flight_id, owner, now + self.lease_seconds, now))
+
+            # 顺带清理过期记录
+            expired_before = now - self.retention_seconds
+            conn.execute('DELETE FROM flights WHERE updated_at < ?', (expired_before,))
+            conn.execute('DELETE FROM flight_chunks WHERE created_at < ?', (expired_before,))
+            conn.execute('DELETE FROM flight_members WHERE seen_at < ?', (expired_before,))
+
+            return 'leader', flight_id
+
+
+# 全局请求合并实例
+single_flight = SingleFlight()
@@ -311,6 +311,16 @@ async function convertPdfToMarkdown(sessionId) {
             throw new Error(data.error || '转换失败');
         }
         
+        // 转换在后台进行，轮询进度直到完成
+        if (!data.has_markdown) {
+            const result = await waitForMarkdownConversion(sessionId, data.poll_interval_ms, (conversion) => {
+                showLoading(true, `正在转换 PDF 为 Markdown... ${formatConversionProgress(conversion)}`);
+            });
+            if (!result.has_markdown) {
+                throw new Error(result.conversion?.error || '转换失败');
+            }
+        }
+        
         console.log('✅ PDF 转换完成');
         
         // 通知 Panel 组件 Markdown 已就绪
@@ -337,6 +347,35 @@ async function convertPdfToMarkdown(sessionId) {
     }
 }
 
+// 转换进度的显示文本，如 "45% 解析中（9/20 页）"
+function formatConversionProgress(conversion) {
+    if (!conversion) return '';
+    const percent = Math.round((conversion.progress || 0) * 100);
+    return `${percent}% ${conversion.message || ''}`.trim();
+}
+
+// 轮询后台 Markdown 转换任务，直到成功 / 失败（返回最后一次查询结果）
+async function waitForMarkdownConversion(sessionId, intervalMs = 2000, onProgress = null, timeoutMs = 10 * 60 * 1000) {
+    const deadline = Date.now() + timeoutMs;
+    while (true) {
+        const response = await fetch(`/api/conversion/${sessionId}`);
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || '获取转换进度失败');
+        }
+        if (onProgress && data.conversion) {
+            onProgress(data.conversion);
+        }
+        if (['succeeded', 'failed', 'none'].includes(data.status)) {
+            return data;
+        }
+        if (Date.now() > deadline) {
+            throw new Error('等待转换超时');
+        }
+        await new Promise(resolve => setTimeout(resolve, intervalMs));
+    }
+}
+
 // 生成导读报告
 async function generateProactiveSummary(sessionId) {
     try {
@@ -422,71 +461,172 @@ function validateFile(file) {
     return true;
 }
 
+// ========== 分块上传（断线续传） ==========
+
+const UPLOAD_MAX_RETRIES = 5;
+
+// 计算文件 SHA-256（crypto.subtle 只在 HTTPS / localhost 下可用，不可用时返回 null，由服务器计算）
+async function computeFileSha256(file) {
+    if (!window.crypto || !window.crypto.subtle) {
+        return null;
+    }
+    try {
+        const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+        return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+    } catch (error) {
+        console.warn('计算 SHA-256 失败，跳过客户端校验:', error);
+        return null;
+    }
+}
+
+async function fetchUploadJson(url, options) {
+    const response = await fetch(url, options);
+    const data = await response.json().catch(() => ({}));
+    if (!response.ok) {
+        const error = new Error(data.error || `请求失败 (${response.status})`);
+        error.status = response.status;
+        error.upload = data.upload;
+        throw error;
+    }
+    return data;
+}
+
+// 分块上传到服务器：只发送服务器缺失的区间，网络错误时重新查询状态后续传
+// 返回与 /api/upload 相同格式的结果；服务器未启用分块上传时返回 null
+async function uploadFileResumable(file, userId) {
+    showLoading(true, '正在校验文件...');
+    const sha256 = await computeFileSha256(file);
+    
+    const initResponse = await fetch('/api/uploads', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+            user_id: userId,
+            filename: file.name,
+            size: file.size,
+            sha256: sha256,
+            fingerprint: `${file.name}:${file.size}:${file.lastModified}`
+        })
+    });
+    if (initResponse.status === 404) {
+        return null;
+    }
+    const initData = await initResponse.json();
+    if (!initResponse.ok) {
+        throw new Error(initData.error || '创建上传失败');
+    }
+    
+    let upload = initData.upload;
+    const uploadUrl = `/api/uploads/${upload.upload_id}`;
+    if (upload.resumed) {
+        console.log('⏯️ 续传未完成的上传:', formatFileSize(upload.received_bytes), '/', formatFileSize(upload.size));
+    }
+    
+    let failures = 0;
+    while (upload.missing.length > 0) {
+        const [start, end] = upload.missing[0];
+        const chunkEnd = Math.min(end, start + upload.chunk_size);
+        const percent = Math.floor(upload.received_bytes / upload.size * 100);
+        showLoading(true, `正在上传文件... ${percent}%`);
+        try {
+            const data = await fetchUploadJson(`${uploadUrl}?offset=${start}`, {
+                method: 'PUT',
+                headers: { 'Content-Type': 'application/octet-stream' },
+                body: file.slice(start, chunkEnd)
+            });
+            upload = data.upload;
+            failures = 0;
+        } catch (error) {
+            failures += 1;
+            if (failures > UPLOAD_MAX_RETRIES || (error.status && error.status < 500 && !error.upload)) {
+                throw error;
+            }
+            console.warn(`⚠️ 分块上传失败（第 ${failures} 次），稍后续传:`, error.message);
+            await new Promise(resolve => setTimeout(resolve, Math.min(1000 * 2 ** (failures - 1), 10000)));
+            // 连接断开时服务器可能已收到部分数据：重新查询缺失的区间
+            upload = error.upload || (await fetchUploadJson(uploadUrl).catch(() => ({ upload }))).upload;
+        }
+    }
+    
+    showLoading(true, '正在处理文件...');
+    return await fetchUploadJson(`${uploadUrl}/complete`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ title: file.name.replace('.pdf', '') })
+    });
+}
+
+// 上传到阿里云 OSS，再把 URL 发送给后端（服务器未启用分块上传时使用）
+async function uploadFileViaOss(file, userId) {
+    showLoading(true, '正在上传文件到OSS...');
+    
+    // 1. 获取 OSS 配置
+    console.log('📡 获取OSS配置...');
+    const ossConfigResponse = await fetch('/api/oss-config');
+    if (!ossConfigResponse.ok) {
+        throw new Error('获取OSS配置失败');
+    }
+    const ossConfigData = await ossConfigResponse.json();
+    const ossConfig = ossConfigData.config;
+    
+    // 2. 使用 OSS SDK 上传文件到阿里云
+    console.log('📤 上传文件到阿里云OSS...');
+    const OSS = window.OSS; // 需要在 HTML 中引入 OSS SDK
+    
+    if (!OSS) {
+        throw new Error('阿里云 OSS SDK 未加载，请检查 index.html 中是否引入了 aliyun-oss-sdk');
+    }
+    
+    const client = new OSS({
+        region: 'oss-cn-shanghai',  // 直接使用 region endpoint
+        accessKeyId: ossConfig.accessKeyId,
+        accessKeySecret: ossConfig.accessKeySecret,
+        bucket: ossConfig.bucket
+    });
+    
+    // 生成唯一文件名
+    const timestamp = Date.now();
+    const randomStr = Math.random().toString(36).substring(2, 8);
+    const fileName = `papers/${timestamp}_${randomStr}_${file.name}`;
+    
+    // 上传到 OSS（Bucket 需要设置为公共读或公共读写）
+    const ossResult = await client.put(fileName, file);
+    const pdfUrl = ossResult.url;
+    
+    console.log('✅ OSS 上传成功:', pdfUrl);
+    
+    // 3. 将 OSS URL 发送给后端
+    showLoading(true, '正在处理文件...');
+    const uploadResponse = await fetch('/api/upload', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({
+            user_id: userId,
+            pdf_url: pdfUrl,
+            title: file.name.replace('.pdf', '')
+        })
+    });
+    
+    if (!uploadResponse.ok) {
+        const errorData = await uploadResponse.json();
+        throw new Error(errorData.error || '文件处理失败');
+    }
+    
+    return await uploadResponse.json();
+}
+
 // 处理文件上传
 async function handleFileUpload(file) {
     console.log('开始处理文件:', file.name, '大小:', formatFileSize(file.size));
     
-    showLoading(true, '正在上传文件到OSS...');
-    
     try {
         // 获取 user_id
         const userId = localStorage.getItem('user_id') || 'default_user';
         
-        // 1. 获取 OSS 配置
-        console.log('📡 获取OSS配置...');
-        const ossConfigResponse = await fetch('/api/oss-config');
-        if (!ossConfigResponse.ok) {
-            throw new Error('获取OSS配置失败');
-        }
-        const ossConfigData = await ossConfigResponse.json();
-        const ossConfig = ossConfigData.config;
-        
-        // 2. 使用 OSS SDK 上传文件到阿里云
-        console.log('📤 上传文件到阿里云OSS...');
-        const OSS = window.OSS; // 需要在 HTML 中引入 OSS SDK
-        
-        if (!OSS) {
-            throw new Error('阿里云 OSS SDK 未加载，请检查 index.html 中是否引入了 aliyun-oss-sdk');
-        }
-        
-        const client = new OSS({
-            region: 'oss-cn-shanghai',  // 直接使用 region endpoint
-            accessKeyId: ossConfig.accessKeyId,
-            accessKeySecret: ossConfig.accessKeySecret,
-            bucket: ossConfig.bucket
-        });
-        
-        // 生成唯一文件名
-        const timestamp = Date.now();
-        const randomStr = Math.random().toString(36).substring(2, 8);
-        const fileName = `papers/${timestamp}_${randomStr}_${file.name}`;
-        
-        // 上传到 OSS（Bucket 需要设置为公共读或公共读写）
-        const ossResult = await client.put(fileName, file);
-        const pdfUrl = ossResult.url;
-        
-        console.log('✅ OSS 上传成功:', pdfUrl);
-        
-        // 3. 将 OSS URL 发送给后端
-        showLoading(true, '正在处理文件...');
-        const uploadResponse = await fetch('/api/upload', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                user_id: userId,
-                pdf_url: pdfUrl,
-                title: file.name.replace('.pdf', '')
-            })
-        });
-        
-        if (!uploadResponse.ok) {
-            const errorData = await uploadResponse.json();
-            throw new Error(errorData.error || '文件处理失败');
-        }
-        
-        const result = await uploadResponse.json();
+        // 优先分块上传到服务器（断线后续传），未启用时上传到 OSS
+        const result = await uploadFileResumable(file, userId) || await uploadFileViaOss(file, userId);
         console.log('文件处理成功:', result);
         
         // 保存 session_id
@@ -1055,12 +1195,14 @@ async function triggerMarkdownConversion(silent = false) {
             showLoading(true, '正在转换文档...');
         }
         
-        // 调用转换API
+        // 调用转换API（转换任务在上传时已提交，这里获取任务状态）
+        const sessionId = window.currentSessionId;
         const response = await fetch('/api/convert-to-markdown', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
-            }
+            },
+            body: JSON.stringify({ session_id: sessionId })
         });
         
         if (!response.ok) {
@@ -1069,6 +1211,16 @@ async function triggerMarkdownConversion(silent = false) {
         }
         
         const data = await response.json();
+        
+        // 转换在后台进行，轮询进度直到完成
+        if (sessionId && data.conversion && !data.has_markdown) {
+            const result = await waitForMarkdownConversion(sessionId, data.poll_interval_ms, (conversion) => {
+                showLoading(true, `正在转换文档格式... ${formatConversionProgress(conversion)}`);
+            });
+            if (!result.has_markdown) {
+                throw new Error(result.conversion?.error || '文档转换失败');
+            }
+        }
         console.log('文档转换完成:', data);
         
         // 转换完成，启用导读报告按钮
@@ -1236,8 +1388,15 @@ async function loadHistorySession(sessionId) {
         // 如果有markdown_path，说明文档已转换，启用mindmap等功能
         if (session.markdown_path) {
             notifyMarkdownReady(true);
+        } else {
+            // 转换仍在后台进行时，完成后再启用（不阻塞会话加载）
+            waitForMarkdownConversion(sessionId).then((result) => {
+                if (result.has_markdown && window.currentSessionId === sessionId) {
+                    notifyMarkdownReady(true);
+                }
+            }).catch((error) => console.warn('等待转换完成失败:', error));
         }
-        
+
         showLoading(false);
         console.log('✅ 历史会话加载完成');
         
@@ -82,7 +82,10 @@ const ChatComponent = {
                     :disabled="!isInputEnabled"
                     v-model="inputText"
                 ></textarea>
-                <button class="btn btn-dark chat-send-btn" type="button" @click="sendMessage" :disabled="!isInputEnabled">
+                <button v-if="isGenerating" class="btn btn-dark chat-send-btn" type="button" @click="stopGenerating" title="停止生成">
+                    <i class="fas fa-stop"></i>
+                </button>
+                <button v-else class="btn btn-dark chat-send-btn" type="button" @click="sendMessage" :disabled="!isInputEnabled">
                     <i class="fas fa-paper-plane"></i>
                 </button>
             </div>
@@ -113,6 +116,7 @@ const ChatComponent = {
             isDocumentLoaded: false,
             isInputEnabled: false, // Controls input and send button
             isGenerating: false, // 是否正在生成回答
+            currentStreamId: null, // 当前流式输出的 ID（停止生成时使用）
             contextMenu: null,
             multiSelectMode: false,
             selectedMessages: new Set(),
@@ -221,79 +225,142 @@ const ChatComponent = {
             } finally {
                 this.isInputEnabled = true; // Re-enable input
                 this.isGenerating = false; // 取消生成状态
+                this.currentStreamId = null;
                 this.scrollToBottom();
             }
         },
         
+        async stopGenerating() {
+            const sessionId = this.sessionId || window.currentSessionId;
+            if (!sessionId || !this.isGenerating) return;
+            
+            try {
+                // 服务端停止生成后会发送 cancelled 事件并结束流
+                await fetch('/api/chat/cancel', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({
+                        session_id: sessionId,
+                        stream_id: this.currentStreamId
+                    })
+                });
+            } catch (error) {
+                console.error('停止生成失败:', error);
+            }
+        },
+        
         async handleStreamResponse(response) {
-            const reader = response.body.getReader();
+            let reader = response.body.getReader();
             const decoder = new TextDecoder();
             let assistantMessageContent = '';
             let messageIndex = this.chatHistory.length; // Index for the new assistant message
+            let lastEventId = 0; // 最后收到的事件序号（断线重连时作为 Last-Event-ID）
+            let finished = false; // 是否已收到 done / cancelled / error
+            let resumeAttempts = 0;
+            const maxResumeAttempts = 3;
 
             this.chatHistory.push({ role: 'assistant', content: '', isStreaming: true }); // Placeholder for streaming message
 
+            const handleEvent = (parsed) => {
+                if (parsed.event === 'start') {
+                    // 记录流 ID，供停止生成和断线重连使用
+                    this.currentStreamId = parsed.stream_id;
+                } else if (parsed.content) {
+                    // 流式内容
+                    assistantMessageContent += parsed.content;
+                    this.chatHistory[messageIndex].content = assistantMessageContent;
+                    this.scrollToBottom();
+                } else if (parsed.event === 'done') {
+                    // 流结束
+                    finished = true;
+                    this.chatHistory[messageIndex].isStreaming = false;
+                    console.log('✅ 流式输出完成，最终状态:', parsed.state);
+                    
+                    // 流式输出完成后，手动触发 Mermaid 渲染
+                    this.$nextTick(() => {
+                        requestAnimationFrame(() => {
+                            setTimeout(() => {
+                                this.renderMermaidDiagrams();
+                            }, 300);
+                        });
+                    });
+                } else if (parsed.event === 'cancelled') {
+                    // 已停止生成：保留已输出的内容
+                    finished = true;
+                    this.chatHistory[messageIndex].content = assistantMessageContent
+                        ? assistantMessageContent + '\n\n（已停止生成）'
+                        : '（已停止生成）';
+                    this.chatHistory[messageIndex].isStreaming = false;
+                } else if (parsed.error) {
+                    // 错误处理（已输出的部分内容保留，错误提示追加在后面）
+                    finished = true;
+                    this.chatHistory[messageIndex].content = assistantMessageContent
+                        ? assistantMessageContent + '\n\n' + parsed.error
+                        : parsed.error;
+                    this.chatHistory[messageIndex].isError = true;
+                    this.chatHistory[messageIndex].isStreaming = false;
+                }
+            };
+
+            const handleLine = (line) => {
+                if (line.startsWith('id: ')) {
+                    lastEventId = parseInt(line.slice(4), 10) || lastEventId;
+                } else if (line.startsWith('data: ')) {
+                    const data = line.slice(6);
+                    if (data === '[DONE]') return;
+
+                    try {
+                        handleEvent(JSON.parse(data));
+                    } catch (e) {
+                        console.warn('解析流数据失败:', e, 'data:', data);
+                    }
+                }
+            };
+
             try {
-                let buffer = '';
                 while (true) {
-                    const { value, done } = await reader.read();
-                    if (done) break;
+                    let buffer = '';
+                    try {
+                        while (true) {
+                            const { value, done } = await reader.read();
+                            if (done) break;
 
-                    buffer += decoder.decode(value, { stream: true });
-                    const lines = buffer.split('\n');
-                    
-                    // 保留最后一个不完整的行
-                    buffer = lines.pop() || '';
+                            buffer += decoder.decode(value, { stream: true });
+                            const lines = buffer.split('\n');
+                            
+                            // 保留最后一个不完整的行
+                            buffer = lines.pop() || '';
+                            lines.forEach(handleLine);
+                        }
+                        
+                        // 处理剩余的 buffer
+                        if (buffer) {
+                            handleLine(buffer);
+                        }
+                    } catch (error) {
+                        console.warn('流连接中断:', error);
+                    }
 
-                    for (const line of lines) {
-                        if (line.startsWith('data: ')) {
-                            const data = line.slice(6);
-                            if (data === '[DONE]') continue;
+                    if (finished) break;
 
-                            try {
-                                const parsed = JSON.parse(data);
-                                
-                                if (parsed.content) {
-                                    // 流式内容
-                                    assistantMessageContent += parsed.content;
-                                    this.chatHistory[messageIndex].content = assistantMessageContent;
-                                    this.scrollToBottom();
-                                } else if (parsed.event === 'done') {
-                                    // 流结束
-                                    this.chatHistory[messageIndex].isStreaming = false;
-                                    console.log('✅ 流式输出完成，最终状态:', parsed.state);
-                                    
-                                    // 流式输出完成后，手动触发 Mermaid 渲染
-                                    this.$nextTick(() => {
-                                        requestAnimationFrame(() => {
-                                            setTimeout(() => {
-                                                this.renderMermaidDiagrams();
-                                            }, 300);
-                                        });
-                                    });
-                                } else if (parsed.error) {
-                                    // 错误处理
-                                    this.chatHistory[messageIndex].content = parsed.error;
-                                    this.chatHistory[messageIndex].isError = true;
-                                    this.chatHistory[messageIndex].isStreaming = false;
-                                }
-                            } catch (e) {
-                                console.warn('解析流数据失败:', e, 'data:', data);
-                            }
-                        }
+                    // 连接在结束事件之前断开：凭流 ID 和最后的事件序号重连，补发缺失的内容
+                    if (!this.currentStreamId || resumeAttempts >= maxResumeAttempts) {
+                        throw new Error('连接已断开');
                     }
-                }
-                
-                // 处理剩余的 buffer
-                if (buffer.startsWith('data: ')) {
-                    const data = buffer.slice(6);
+                    resumeAttempts += 1;
+                    await new Promise(resolve => setTimeout(resolve, 1000 * resumeAttempts));
+                    console.log(`🔁 重连流 ${this.currentStreamId}（第 ${resumeAttempts} 次），从事件 ${lastEventId} 继续`);
                     try {
-                        const parsed = JSON.parse(data);
-                        if (parsed.event === 'done') {
-                            this.chatHistory[messageIndex].isStreaming = false;
+                        const resumed = await fetch(`/api/chat/stream/${this.currentStreamId}`, {
+                            headers: { 'Last-Event-ID': String(lastEventId) }
+                        });
+                        if (!resumed.ok) {
+                            throw new Error('重连失败');
                         }
-                    } catch (e) {
-                        console.warn('解析最后一块数据失败:', e);
+                        reader = resumed.body.getReader();
+                    } catch (error) {
+                        // 旧连接已读完，下一轮会直接进入下一次重连
+                        console.warn('重连失败:', error);
                     }
                 }
                 
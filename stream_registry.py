@@ -0,0 +1,431 @@
+"""
+流式会话登记模块
+记录正在进行的 /api/chat/stream 输出，并把输出事件镜像到短期缓冲区，所有 worker 共享
+
+- 每个流式输出开始时登记一条记录（stream_id），结束时标记 done / cancelled / failed
+- 生成在后台线程中进行（StreamPublisher），与 HTTP 连接解耦：每个事件带递增的序号（SSE 的 id），
+  批量写入缓冲区；断线重连时按 Last-Event-ID 补发缺失的事件，再跟随实时输出，不会触发新的 LLM 调用
+- 读取方（原连接或重连后的连接）定期心跳；所有读取方离开超过宽限期后，生成才会被取消
+- /api/chat/cancel 只写入取消标记；后台线程定期检查标记（watch），置位 CancelToken 并关闭登记的上游连接，
+  排队、退避和首 token 之前的等待也会立即结束
+"""
+import json
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional, Tuple
+from config import STREAM_REGISTRY_CONFIG
+from logger import get_logger
+
+logger = get_logger('stream')
+
+STREAMING = 'streaming'
+DONE = 'done'
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+
+
+class StreamRegistry:
+    """跨进程的流式输出登记表 + 事件缓冲区"""
+
+    def __init__(self):
+        self.db_path = STREAM_REGISTRY_CONFIG['db_path']
+        self.cancel_check_interval = STREAM_REGISTRY_CONFIG.get('cancel_check_interval', 0.25)
+        self.retention_seconds = STREAM_REGISTRY_CONFIG.get('retention_seconds', 3600)
+        self.buffer_ttl_seconds = STREAM_REGISTRY_CONFIG.get('buffer_ttl_seconds', 300)
+        self.flush_interval = STREAM_REGISTRY_CONFIG.get('flush_interval', 0.05)
+        self.poll_interval = STREAM_REGISTRY_CONFIG.get('poll_interval', 0.1)
+        self.heartbeat_interval = STREAM_REGISTRY_CONFIG.get('heartbeat_interval', 1.0)
+        self.producer_stale_seconds = STREAM_REGISTRY_CONFIG.get('producer_stale_seconds', 10)
+        self.disconnect_grace_seconds = STREAM_REGISTRY_CONFIG.get('disconnect_grace_seconds', 20)
+        self._last_checked = {}  # stream_id -> 上次检查取消标记的时间
+        self._init_database()
+
+    @contextmanager
+    def get_connection(self):
+        """获取数据库连接的上下文管理器"""
+        conn = sqlite3.connect(
+            str(self.db_path),
+            timeout=10.0,
+            check_same_thread=False,
+            isolation_level=None
+        )
+        try:
+            conn.execute('BEGIN')
+            yield conn
+            conn.execute('COMMIT')
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise e
+        finally:
+            conn.close()
+
+    def _init_database(self):
+        """初始化登记表和事件缓冲表"""
+        conn = sqlite3.connect(str(self.db_path), timeout=10.0)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(streams)')}
+            if columns and 'reader_seen_at' not in columns:
+                # 旧版登记表（只有短期数据），直接重建
+                conn.execute('DROP TABLE streams')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS streams (
+                    stream_id TEXT PRIMARY KEY,
+                    session_id TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    cancel_requested INTEGER NOT NULL DEFAULT 0,
+                    last_seq INTEGER NOT NULL DEFAULT 0,
+                    reader_seen_at REAL NOT NULL,
+                    producer_seen_at REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_streams_session
+                ON streams(session_id, status)
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS stream_events (
+                    stream_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (stream_id, seq)
+                )
+            ''')
+            conn.commit()
+        finally:
+            conn.close()
+
+    # ========== 登记与取消 ==========
+
+    def start(self, session_id: str) -> str:
+        """
+        登记一个新的流式输出
+
+        Returns:
+            stream_id: 流 ID（返回给前端，用于取消和断线重连）
+        """
+        stream_id = uuid.uuid4().hex
+        now = time.time()
+        with self.get_connection() as conn:
+            conn.execute('''
+                DELETE FROM stream_events WHERE stream_id IN (
+                    SELECT stream_id FROM streams WHERE status != ? AND updated_at < ?
+                )
+            ''', (STREAMING, now - self.buffer_ttl_seconds))
+            conn.execute('DELETE FROM streams WHERE updated_at < ?', (now - self.retention_seconds,))
+            conn.execute('''
+                INSERT INTO streams (stream_id, session_id, status, cancel_requested, last_seq,
+                                     reader_seen_at, producer_seen_at, created_at, updated_at)
+                VALUES (?, ?, ?, 0, 0, ?, ?, ?, ?)
+            ''', (stream_id, session_id, STREAMING, now, now, now, now))
+        self._last_checked[stream_id] = now
+        return stream_id
+
+    def request_cancel(self, session_id: str, stream_id: Optional[str] = None) -> int:
+        """
+        请求取消流式输出
+
+        Args:
+            session_id: 会话 ID
+            stream_id: 流 ID，不提供时取消该会话所有进行中的输出
+
+        Returns:
+            int: 被标记取消的流数量
+        """
+        query = '''
+            UPDATE streams SET cancel_requested = 1, updated_at = ?
+            WHERE session_id = ? AND status = ?
+        '''
+        params = [time.time(), session_id, STREAMING]
+        if stream_id:
+            query += ' AND stream_id = ?'
+            params.append(stream_id)
+        with self.get_connection() as conn:
+            return conn.execute(query, params).rowcount
+
+    def stop_reason(self, stream_id: str, force: bool = False) -> Optional[str]:
+        """
+        检查生成是否应当停止（按 cancel_check_interval 节流，避免每个片段都查库）
+
+        Args:
+            stream_id: 流 ID
+            force: 忽略节流，立即查询
+
+        Returns:
+            'user'：已请求取消；'disconnect'：所有读取方离开超过宽限期；None：继续生成
+        """
+        now = time.time()
+        if not force and now - self._last_checked.get(stream_id, 0) < self.cancel_check_interval:
+            return None
+        self._last_checked[stream_id] = now
+        try:
+            with self.get_connection() as conn:
+                row = conn.execute(
+                    'SELECT cancel_requested, reader_seen_at FROM streams WHERE stream_id = ?',
+                    (stream_id,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning('stream.check_cancel_failed', '⚠️  检查取消标记失败', error=str(e))
+            return None
+        if not row:
+            return None
+        if row[0]:
+            return 'user'
+        if now - row[1] > self.disconnect_grace_seconds:
+            return 'disconnect'
+        return None
+
+    def is_cancelled(self, stream_id: str, force: bool = False) -> bool:
+        """检查是否已请求取消"""
+        return self.stop_reason(stream_id, force) == 'user'
+
+    def touch_reader(self, stream_id: str):
+        """读取方心跳（有读取方在线时生成不会因断线被取消）"""
+        try:
+            with self.get_connection() as conn:
+                conn.execute(
+                    'UPDATE streams SET reader_seen_at = ? WHERE stream_id = ?',
+                    (time.time(), stream_id)
+                )
+        except sqlite3.Error as e:
+            logger.warning('stream.heartbeat_failed', '⚠️  更新读取方心跳失败', error=str(e))
+
+    def finish(self, stream_id: str, status: str = DONE):
+        """标记流式输出结束"""
+        self._last_checked.pop(stream_id, None)
+        now = time.time()
+        try:
+            with self.get_connection() as conn:
+                conn.execute(
+                    'UPDATE streams SET status = ?, producer_seen_at = ?, updated_at = ? WHERE stream_id = ?',
+                    (status, now, now, stream_id)
+                )
+        except sqlite3.Error as e:
+            logger.warning('stream.update_failed', '⚠️  更新流状态失败', error=str(e))
+
+    def watch(self, stream_id: str) -> 'CancelToken':
+        """
+        在后台按 cancel_check_interval 检查停止条件（见 stop_reason），需要停止时置位返回的取消信号
+
+        生成结束后调用 token.stop_watching() 结束检查
+        """
+        token = CancelToken()
+
+        def check():
+            while not token._stopped.wait(self.cancel_check_interval):
+                reason = self.stop_reason(stream_id, force=True)
+                if reason:
+                    token.set(reason)
+                    return
+
+        threading.Thread(target=check, daemon=True).start()
+        return token
+
+    def get_stream(self, stream_id: str) -> Optional[Dict]:
+        """获取流的登记信息"""
+        with self.get_connection() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute('SELECT * FROM streams WHERE stream_id = ?', (stream_id,)).fetchone()
+        return dict(row) if row else None
+
+    # ========== 事件缓冲 ==========
+
+    def publisher(self, stream_id: str) -> 'StreamPublisher':
+        """创建生成方使用的事件发布器"""
+        return StreamPublisher(self, stream_id)
+
+    def _append(self, stream_id: str, events, heartbeat_only: bool = False):
+        """批量写入事件并更新生成方心跳"""
+        now = time.time()
+        with self.get_connection() as conn:
+            if events:
+                conn.executemany(
+                    'INSERT OR IGNORE INTO stream_events (stream_id, seq, data) VALUES (?, ?, ?)',
+                    [(stream_id, seq, json.dumps(event, ensure_ascii=False)) for seq, event in events]
+                )
+                conn.execute(
+                    'UPDATE streams SET last_seq = ?, producer_seen_at = ?, updated_at = ? WHERE stream_id = ?',
+                    (events[-1][0], now, now, stream_id)
+                )
+            elif heartbeat_only:
+                conn.execute(
+                    'UPDATE streams SET producer_seen_at = ? WHERE stream_id = ?', (now, stream_id)
+                )
+
+    def follow(self, stream_id: str, after_seq: int = 0) -> Iterator[Tuple[Optional[int], Optional[Dict]]]:
+        """
+        从缓冲区读取事件：先补发 after_seq 之后的事件，再跟随实时输出直到流结束
+
+        读取期间定期发送读取方心跳；较长时间没有新事件时产出 (None, None)，
+        调用方可借此发送 SSE 保活注释。
+
+        Args:
+            stream_id: 流 ID
+            after_seq: 已收到的最后一个事件序号（Last-Event-ID）
+
+        Yields:
+            (seq, event): 事件序号和内容
+        """
+        last_heartbeat = 0.0
+        last_event_at = time.time()
+        while True:
+            now = time.time()
+            if now - last_heartbeat >= self.heartbeat_interval:
+                self.touch_reader(stream_id)
+                last_heartbeat = now
+
+            with self.get_connection() as conn:
+                rows = conn.execute('''
+                    SELECT seq, data FROM stream_events
+                    WHERE stream_id = ? AND seq > ? ORDER BY seq
+                ''', (stream_id, after_seq)).fetchall()
+                state = conn.execute(
+                    'SELECT status, last_seq, producer_seen_at FROM streams WHERE stream_id = ?',
+                    (stream_id,)
+                ).fetchone()
+
+            for seq, data in rows:
+                after_seq = seq
+                last_event_at = time.time()
+                yield seq, json.loads(data)
+
+            if not state:
+                return
+            status, last_seq, producer_seen_at = state
+            if status != STREAMING and after_seq >= last_seq:
+                return
+            if status == STREAMING and time.time() - producer_seen_at > self.producer_stale_seconds:
+                # 生成方所在进程已退出
+                yield after_seq + 1, {'error': '回复生成已中断，请重新提问'}
+                return
+            if not rows:
+                if time.time() - last_event_at >= self.heartbeat_interval * 10:
+                    last_event_at = time.time()
+                    yield None, None
+                time.sleep(self.poll_interval)
+
+
+class CancelToken:
+    """
+    取消信号（停止生成、客户端断开）
+
+    is_set / wait 与 threading.Event 相同；on_cancel 登记取消时要执行的回调（如关闭上游连接），
+    阻塞在读取上的调用随之立即返回
+    """
+
+    def __init__(self):
+        self.reason = None  # 'user' | 'disconnect'
+        self._event = threading.Event()
+        self._stopped = threading.Event()
+        self._callbacks = {}
+        self._lock = threading.Lock()
+
+    def is_set(self) -> bool:
+        return self._event.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """等待取消，返回是否已取消"""
+        return self._event.wait(timeout)
+
+    def set(self, reason: str = 'user'):
+        """置位取消信号并执行已登记的回调"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = list(self._callbacks.values()), {}
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """
+        登记取消时执行的回调（已取消时立即执行）
+
+        Returns:
+            取消登记的函数（资源释放后调用）
+        """
+        key = object()
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks[key] = callback
+                return lambda: self._callbacks.pop(key, None)
+        try:
+            callback()
+        except Exception:
+            pass
+        return lambda: None
+
+    def stop_watching(self):
+        """结束后台检查（见 StreamRegistry.watch）"""
+        self._stopped.set()
+
+
+class StreamPublisher:
+    """
+    生成方的事件发布器
+
+    事件先交给本进程的读取方（原连接，低延迟），同时由后台线程按 flush_interval 批量写入缓冲区，
+    并在空闲时续写生成方心跳。
+    """
+
+    def __init__(self, registry: StreamRegistry, stream_id: str):
+        self.registry = registry
+        self.stream_id = stream_id
+        self.local = queue.Queue()  # 原连接的读取队列：(seq, event)
+        self.seq = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def publish(self, event: Dict) -> int:
+        """发布一个事件，返回其序号"""
+        with self._lock:
+            self.seq += 1
+            self._pending.append((self.seq, event))
+            seq = self.seq
+        self.local.put((seq, event))
+        return seq
+
+    def close(self, status: str):
+        """写出剩余事件并标记流结束"""
+        self._closed.set()
+        self._flusher.join(timeout=5)
+        self._flush()
+        self.registry.finish(self.stream_id, status)
+        self.local.put((None, None))
+
+    def _flush(self, heartbeat_only: bool = False):
+        with self._lock:
+            events, self._pending = self._pending, []
+        try:
+            self.registry._append(self.stream_id, events, heartbeat_only)
+        except sqlite3.Error as e:
+            logger.warning('stream.buffer_failed', '⚠️  写入流事件缓冲失败', error=str(e))
+            with self._lock:
+                self._pending = events + self._pending
+
+    def _flush_loop(self):
+        last_heartbeat = 0.0
+        while not self._closed.wait(self.registry.flush_interval):
+            now = time.time()
+            heartbeat_due = now - last_heartbeat >= self.registry.heartbeat_interval
+            if self._pending or heartbeat_due:
+                self._flush(heartbeat_only=heartbeat_due)
+                last_heartbeat = now
+
+
+# 全局流登记表
+stream_registry = StreamRegistry()
@@ -0,0 +1,46 @@
+"""
+markdown_compactor 的回归测试
+
+运行：python -m pytest tests/
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from markdown_compactor import collapse_tables, dedupe_furniture  # noqa: E402
+
+RESULTS_TABLE = '''<table><tr><td>Method</td><td>Top-1</td><td>Top-5</td></tr>
+<tr><td>Baseline</td><td>{b1}</td><td>{b5}</td></tr>
+<tr><td>Ours</td><td>{o1}</td><td>{o5}</td></tr></table>'''
+
+
+def test_results_table_rows_survive_dedupe():
+    """多个结果表中重复出现的行（数字不同）不能被当作页眉页脚删除"""
+    tables = [
+        f"Table {index}: results on dataset {index}.\n\n"
+        + RESULTS_TABLE.format(b1=f"9{index}.2", b5=f"7{index}.1", o1=f"9{index}.4", o5=f"7{index}.9")
+        for index in range(1, 4)
+    ]
+    text = collapse_tables('\n\n'.join(tables) + '\n')
+    compacted = dedupe_furniture(text)
+    for index in range(1, 4):
+        assert f"Baseline | 9{index}.2 | 7{index}.1" in compacted
+        assert f"Ours | 9{index}.4 | 7{index}.9" in compacted
+
+
+def test_single_table_rows_survive_dedupe():
+    rows = '\n'.join(f"| ResNet-{depth} | {depth}.0 |" for depth in (18, 34, 50))
+    text = collapse_tables(f"| Model | Params |\n|---|---|\n{rows}\n")
+    compacted = dedupe_furniture(text)
+    for depth in (18, 34, 50):
+        assert f"ResNet-{depth} | {depth}.0" in compacted
+
+
+def test_headers_at_page_breaks_are_removed():
+    pages = [f"Journal of Testing, Vol. 3\n\nBody paragraph of page {page} with the Vol. 3 result.\n\n{page}\n"
+             for page in range(1, 5)]
+    compacted = dedupe_furniture('\n'.join(pages))
+    assert 'Journal of Testing' not in compacted
+    for page in range(1, 5):
+        assert f"Body paragraph of page {page}" in compacted
@@ -0,0 +1,100 @@
+"""
+single_flight 流式合并的回归测试
+
+运行：python -m pytest tests/
+"""
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import config  # noqa: E402
+
+# 数据库放到临时目录，不在仓库的 data/ 下生成文件
+_TMP_DIR = Path(tempfile.mkdtemp(prefix='single_flight_test_'))
+config.SINGLE_FLIGHT_CONFIG.update(
+    db_path=_TMP_DIR / 'single_flight.db',
+    poll_interval=0.01,
+    flush_interval=0.01,
+    member_check_interval=0.05,
+)
+config.STREAM_REGISTRY_CONFIG['db_path'] = _TMP_DIR / 'streams.db'
+
+from single_flight import SingleFlight  # noqa: E402
+from stream_registry import CancelToken  # noqa: E402
+
+PIECES = [f"片段{index} " for index in range(20)]
+
+
+def make_factory(calls):
+    """逐个产出 PIECES 的生成器工厂；记录每次调用收到的取消信号"""
+    def factory(cancelled):
+        calls.append(cancelled)
+        for piece in PIECES:
+            if cancelled is not None and cancelled.wait(0.02):
+                return
+            yield piece
+    return factory
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def flight_status(flight, key):
+    with flight.get_connection() as conn:
+        row = conn.execute('SELECT status FROM flights WHERE flight_key = ?', (key,)).fetchone()
+    return row[0] if row else None
+
+
+def test_follower_completes_after_leader_cancels():
+    """leader 的请求方取消后，已在跟随的 follower 仍能收到完整输出"""
+    flight = SingleFlight()
+    calls = []
+    leader_cancelled = CancelToken()
+    leader = flight.stream('same-request', make_factory(calls), cancelled=leader_cancelled)
+    assert next(leader) == PIECES[0]
+
+    follower_output = []
+    follower_started = threading.Event()
+
+    def follow():
+        for piece in flight.stream('same-request', make_factory(calls)):
+            follower_output.append(piece)
+            follower_started.set()
+
+    thread = threading.Thread(target=follow, daemon=True)
+    thread.start()
+    assert follower_started.wait(5)
+
+    leader_cancelled.set()
+    assert list(leader) == []
+
+    thread.join(10)
+    assert not thread.is_alive()
+    assert ''.join(follower_output) == ''.join(PIECES)
+    # 只生成了一次，且生成没有被 leader 的取消中止
+    assert len(calls) == 1
+    assert not calls[0].is_set()
+
+
+def test_generation_stops_when_leader_cancels_alone():
+    """没有 follower 时，leader 的请求方取消会停止生成"""
+    flight = SingleFlight()
+    calls = []
+    leader_cancelled = CancelToken()
+    leader = flight.stream('lonely-request', make_factory(calls), cancelled=leader_cancelled)
+    assert next(leader) == PIECES[0]
+
+    leader_cancelled.set()
+    assert list(leader) == []
+    assert wait_until(lambda: calls[0].is_set())
+    assert wait_until(lambda: flight_status(flight, 'lonely-request') == 'abandoned')
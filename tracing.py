@@ -0,0 +1,361 @@
+"""
+请求链路追踪模块
+用上下文管理器 / 装饰器记录请求处理各阶段的耗时，每个请求形成一棵 span 树
+
+- 根 span 由 app.py 在请求开始时创建（按 sample_rate 采样），之后的 span 自动挂到当前 span 下
+- 没有根 span（未采样、未启用、后台任务）时 span 都是空操作；关闭追踪时只多一次属性判断
+- 一条链路的所有 span 结束后导出：写入 OTLP/JSON 文件（可由 OpenTelemetry Collector 读取）或写入日志；
+  超过 slow_trace_seconds 的慢链路按 slow_trace_log_rate 采样写入日志（经日志队列输出，不在请求线程上打印）
+
+后台线程需要用 contextvars.copy_context().run 启动才能继承当前 span；比请求本身持续更久的后台任务
+用 tracer.run_in_span 执行（span 在请求线程中先开始，链路等后台任务结束后才导出）。
+生成器中的 span 应使用 activate=False：生成器暂停期间不应让调用方的操作挂到它下面。
+"""
+import contextvars
+import functools
+import json
+import os
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+from config import TRACING_CONFIG
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class _NoopSpan:
+    """未追踪时使用的空 span"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def start(self):
+        return self
+
+    def end(self, error: Optional[BaseException] = None):
+        pass
+
+    def set_attribute(self, key: str, value):
+        pass
+
+    def add_event(self, name: str, **attributes):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class _Trace:
+    """一条链路：收集已结束的 span，所有 span 结束后导出"""
+
+    def __init__(self, tracer: 'Tracer'):
+        self.tracer = tracer
+        self.trace_id = os.urandom(16).hex()
+        self.spans = []
+        self.open_spans = 0
+        self.exported = False
+        self._lock = threading.Lock()
+
+    def opened(self):
+        with self._lock:
+            self.open_spans += 1
+
+    def closed(self, span: 'Span'):
+        with self._lock:
+            if len(self.spans) < self.tracer.max_spans_per_trace:
+                self.spans.append(span)
+            self.open_spans -= 1
+            # 导出后才结束的 span（如被取消的对冲请求）不再单独导出
+            finished = self.open_spans == 0 and not self.exported
+            if finished:
+                self.exported = True
+        if finished:
+            self.tracer._export(self)
+
+
+class Span:
+    """一个阶段的耗时记录"""
+
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'attributes', 'events',
+                 'start_time', 'end_time', 'error', 'activate', '_token')
+
+    def __init__(self, trace: _Trace, name: str, parent_id: Optional[str],
+                 attributes: Dict, activate: bool = True):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.events = []
+        self.start_time = None
+        self.end_time = None
+        self.error = None
+        self.activate = activate
+        self._token = None
+
+    def start(self) -> 'Span':
+        self.start_time = time.time()
+        self.trace.opened()
+        if self.activate:
+            self._token = _current_span.set(self)
+        return self
+
+    def end(self, error: Optional[BaseException] = None):
+        if self.end_time is not None:
+            return
+        self.end_time = time.time()
+        if error is not None and not isinstance(error, GeneratorExit):
+            self.error = f"{type(error).__name__}: {error}"
+        if self._token is not None:
+            try:
+                _current_span.reset(self._token)
+            except ValueError:
+                # 在其他线程 / 上下文中结束（如生成器被另一线程关闭），无需恢复
+                pass
+            self._token = None
+        self.trace.closed(self)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end(exc)
+        return False
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def add_event(self, name: str, **attributes):
+        self.events.append((time.time(), name, attributes))
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_time or time.time()) - self.start_time) * 1000
+
+
+def _get_logger():
+    # logger 模块依赖 tracing（日志带 trace_id），延迟导入
+    from logger import get_logger
+    return get_logger('tracing')
+
+
+class Tracer:
+    """链路追踪器（进程内）"""
+
+    def __init__(self):
+        self.enabled = TRACING_CONFIG.get('enabled', False)
+        self.sample_rate = TRACING_CONFIG.get('sample_rate', 1.0)
+        self.exporter = TRACING_CONFIG.get('exporter', 'file')
+        self.traces_dir = TRACING_CONFIG['traces_dir']
+        self.slow_trace_seconds = TRACING_CONFIG.get('slow_trace_seconds', 5.0)
+        self.slow_trace_log_rate = TRACING_CONFIG.get('slow_trace_log_rate', 0.1)
+        self.service_name = TRACING_CONFIG.get('service_name', 'reading-agent')
+        self.max_spans_per_trace = TRACING_CONFIG.get('max_spans_per_trace', 500)
+        self._write_lock = threading.Lock()
+        if self.enabled and self.exporter == 'file':
+            self.traces_dir.mkdir(parents=True, exist_ok=True)
+
+    def start_trace(self, name: str, **attributes):
+        """
+        创建一条链路的根 span（按 sample_rate 采样，未采样时返回空 span）
+
+        用法：with tracer.start_trace('POST /api/chat'): ...，
+        或手动调用 start() / end()（请求钩子中使用）
+        """
+        if not self.enabled or random.random() >= self.sample_rate:
+            return NOOP_SPAN
+        return Span(_Trace(self), name, None, attributes)
+
+    def span(self, name: str, activate: bool = True, **attributes):
+        """
+        在当前 span 下创建子 span（不在链路中时返回空 span）
+
+        Args:
+            name: 阶段名称，如 'db.get_session'
+            activate: 是否成为当前 span（生成器中使用 False）
+            **attributes: span 属性
+        """
+        if not self.enabled:
+            return NOOP_SPAN
+        parent = _current_span.get()
+        if parent is None:
+            return NOOP_SPAN
+        return Span(parent.trace, name, parent.span_id, attributes, activate)
+
+    def run_in_span(self, span, func, *args, **kwargs):
+        """
+        以 span 为当前 span 执行 func，结束后结束该 span（作为后台线程的 target）
+
+        span 应在启动线程前以 activate=False 开始，保证请求结束时链路不会提前导出。
+        """
+        token = _current_span.set(span) if isinstance(span, Span) else None
+        error = None
+        try:
+            return func(*args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if token is not None:
+                _current_span.reset(token)
+            span.end(error)
+
+    def iterate(self, span, iterable):
+        """
+        逐个取出 iterable 的元素，取值期间以 span 为当前 span
+
+        用于生成器中的 span：上游生成器内部的操作挂到 span 下，而 yield 之后调用方的操作不受影响。
+        结束或被关闭时同时关闭上游生成器。
+        """
+        if not isinstance(span, Span):
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        try:
+            while True:
+                token = _current_span.set(span)
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    _current_span.reset(token)
+                yield item
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    def current_span(self):
+        """当前 span（不在链路中时返回空 span）"""
+        if not self.enabled:
+            return NOOP_SPAN
+        return _current_span.get() or NOOP_SPAN
+
+    # ========== 导出 ==========
+
+    def _export(self, trace: _Trace):
+        spans = sorted(trace.spans, key=lambda s: s.start_time)
+        if not spans:
+            return
+        duration = max(s.end_time for s in spans) - spans[0].start_time
+        try:
+            if self.exporter == 'file':
+                self._write_otlp(trace, spans)
+            if self.exporter == 'log':
+                _get_logger().info('trace.exported', self.format_tree(trace.trace_id, spans),
+                                   duration_ms=round(duration * 1000, 1))
+            elif duration >= self.slow_trace_seconds and random.random() < self.slow_trace_log_rate:
+                _get_logger().warning('trace.slow', '🐢 慢链路\n' + self.format_tree(trace.trace_id, spans),
+                                      duration_ms=round(duration * 1000, 1))
+        except Exception as e:
+            _get_logger().warning('trace.export_failed', '⚠️  导出链路失败', error=str(e))
+
+    def _write_otlp(self, trace: _Trace, spans: List[Span]):
+        """按 OTLP/JSON 格式追加一行到 traces_dir/traces-<日期>.jsonl"""
+        payload = {
+            'resourceSpans': [{
+                'resource': {'attributes': [
+                    _otlp_attribute('service.name', self.service_name),
+                    _otlp_attribute('process.pid', os.getpid()),
+                ]},
+                'scopeSpans': [{
+                    'scope': {'name': 'reading-agent.tracing'},
+                    'spans': [_otlp_span(trace.trace_id, span) for span in spans],
+                }],
+            }],
+        }
+        line = json.dumps(payload, ensure_ascii=False) + '\n'
+        path = self.traces_dir / f"traces-{time.strftime('%Y%m%d')}.jsonl"
+        with self._write_lock:
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(line)
+
+    @staticmethod
+    def format_tree(trace_id: str, spans: List[Span]) -> str:
+        """链路的文本树（耗时 + 相对根 span 的起始偏移）"""
+        children = {}
+        for span in spans:
+            children.setdefault(span.parent_id, []).append(span)
+        known = {span.span_id for span in spans}
+        roots = [s for s in spans if s.parent_id is None or s.parent_id not in known]
+        origin = spans[0].start_time
+
+        lines = []
+
+        def walk(span, depth):
+            attrs = ' '.join(f"{k}={v}" for k, v in span.attributes.items())
+            error = f" ❌ {span.error}" if span.error else ''
+            lines.append(
+                f"   {'  ' * depth}{'└─ ' if depth else ''}{span.name} {span.duration_ms:.1f} ms "
+                f"(+{(span.start_time - origin) * 1000:.1f}){' ' + attrs if attrs else ''}{error}"
+            )
+            for child in children.get(span.span_id, []):
+                walk(child, depth + 1)
+
+        for root in roots:
+            walk(root, 0)
+        total = (max(s.end_time for s in spans) - origin) * 1000
+        return f"🧭 链路 {trace_id[:12]}（{total:.1f} ms，{len(spans)} 个 span）\n" + '\n'.join(lines)
+
+
+def _otlp_attribute(key: str, value) -> Dict:
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+def _otlp_span(trace_id: str, span: Span) -> Dict:
+    data = {
+        'traceId': trace_id,
+        'spanId': span.span_id,
+        'name': span.name,
+        'kind': 2 if span.parent_id is None else 1,  # SERVER / INTERNAL
+        'startTimeUnixNano': str(int(span.start_time * 1e9)),
+        'endTimeUnixNano': str(int(span.end_time * 1e9)),
+        'attributes': [_otlp_attribute(k, v) for k, v in span.attributes.items()],
+        'status': {'code': 2, 'message': span.error} if span.error else {'code': 1},
+    }
+    if span.parent_id:
+        data['parentSpanId'] = span.parent_id
+    if span.events:
+        data['events'] = [
+            {
+                'timeUnixNano': str(int(at * 1e9)),
+                'name': name,
+                'attributes': [_otlp_attribute(k, v) for k, v in attrs.items()],
+            }
+            for at, name, attrs in span.events
+        ]
+    return data
+
+
+# 全局追踪器
+tracer = Tracer()
+
+
+def traced(name: Optional[str] = None):
+    """
+    装饰器：函数调用记录为当前链路中的一个 span
+
+    Args:
+        name: span 名称，默认为 模块名.函数名
+    """
+    def decorator(func):
+        span_name = name or f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
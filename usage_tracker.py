@@ -0,0 +1,268 @@
+"""
+LLM 用量记录模块
+每次 LLM 调用追加一条记录（token 用量、首 token 耗时、总耗时、重试次数），
+并带上智能体、FSM 状态、会话、用户和 Prompt 版本标签，用于按维度汇总成本和延迟
+
+记录只追加不修改；汇总查询按 group_by 维度聚合。
+每条记录同时更新监控指标（耗时直方图和 token 计数，按智能体 / 提供商 / 模型 / 结果区分，
+不含会话和用户这类高基数标签），关闭用量表时指标照常更新
+"""
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence
+from config import USAGE_CONFIG
+from metrics import metrics
+from logger import get_logger
+
+logger = get_logger('usage')
+
+# 允许作为汇总维度的列
+GROUP_COLUMNS = (
+    'agent', 'state', 'session_id', 'user_id', 'prompt_version',
+    'provider', 'model', 'mode', 'outcome',
+)
+
+
+class UsageTracker:
+    """LLM 调用用量记录（SQLite，所有 worker 共享）"""
+
+    def __init__(self):
+        self.enabled = USAGE_CONFIG.get('enabled', True)
+        self.db_path = USAGE_CONFIG['db_path']
+        self.chars_per_token = USAGE_CONFIG.get('chars_per_token', 2.0)
+        if self.enabled:
+            self._init_database()
+
+    @contextmanager
+    def get_connection(self):
+        """获取数据库连接的上下文管理器"""
+        conn = sqlite3.connect(str(self.db_path), timeout=10.0, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            conn.close()
+
+    def _init_database(self):
+        """初始化用量表"""
+        conn = sqlite3.connect(str(self.db_path), timeout=10.0)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS llm_usage (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created_at REAL NOT NULL,
+                    agent TEXT,
+                    state TEXT,
+                    session_id TEXT,
+                    user_id TEXT,
+                    prompt_version TEXT,
+                    provider TEXT,
+                    model TEXT,
+                    mode TEXT NOT NULL,
+                    outcome TEXT NOT NULL,
+                    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                    cached_tokens INTEGER NOT NULL DEFAULT 0,
+                    completion_tokens INTEGER NOT NULL DEFAULT 0,
+                    usage_estimated INTEGER NOT NULL DEFAULT 0,
+                    ttft_ms REAL,
+                    latency_ms REAL NOT NULL,
+                    retries INTEGER NOT NULL DEFAULT 0,
+                    resumes INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_llm_usage_created_at ON llm_usage(created_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_llm_usage_session ON llm_usage(session_id)')
+            conn.commit()
+        finally:
+            conn.close()
+
+    # ========== 记录 ==========
+
+    def estimate_tokens(self, text: str) -> int:
+        """提供商未返回用量时，按字符数粗略估算 token 数"""
+        return int(len(text or '') / self.chars_per_token)
+
+    @staticmethod
+    def parse_usage(usage) -> Optional[Dict]:
+        """
+        解析 OpenAI 格式的 usage 对象
+
+        Returns:
+            dict: prompt_tokens / cached_tokens / completion_tokens，没有用量信息时返回 None
+        """
+        if usage is None:
+            return None
+        details = getattr(usage, 'prompt_tokens_details', None)
+        return {
+            'prompt_tokens': getattr(usage, 'prompt_tokens', 0) or 0,
+            'cached_tokens': (getattr(details, 'cached_tokens', 0) or 0) if details else 0,
+            'completion_tokens': getattr(usage, 'completion_tokens', 0) or 0,
+        }
+
+    def record(
+        self,
+        tags: Optional[Dict],
+        provider: Optional[str],
+        model: Optional[str],
+        mode: str,
+        outcome: str,
+        latency: float,
+        usage: Optional[Dict] = None,
+        ttft: Optional[float] = None,
+        retries: int = 0,
+        resumes: int = 0,
+        prompt_text: str = '',
+        completion_text: str = '',
+        estimated: bool = False
+    ):
+        """
+        追加一条调用记录
+
+        Args:
+            tags: 调用标签（agent / state / session_id / user_id / prompt_version）
+            provider: 实际处理请求的提供商
+            model: 模型
+            mode: 'call'（非流式）或 'stream'
+            outcome: 'success' / 'error' / 'cancelled'
+            latency: 总耗时（秒，含排队和重试）
+            usage: parse_usage 的结果；为 None 时按 prompt_text / completion_text 估算
+            ttft: 首 token 耗时（秒，仅流式）
+            retries: 重试次数（不含首次尝试）
+            resumes: 续写次数
+            estimated: usage 中是否含有估算值
+        """
+        tags = tags or {}
+        estimated = estimated or usage is None
+        if usage is None:
+            usage = {
+                'prompt_tokens': self.estimate_tokens(prompt_text),
+                'cached_tokens': 0,
+                'completion_tokens': self.estimate_tokens(completion_text),
+            }
+        self._observe(tags, provider, model, mode, outcome, latency, usage, ttft)
+        if not self.enabled:
+            return
+        try:
+            with self.get_connection() as conn:
+                conn.execute('''
+                    INSERT INTO llm_usage (
+                        created_at, agent, state, session_id, user_id, prompt_version,
+                        provider, model, mode, outcome, prompt_tokens, cached_tokens,
+                        completion_tokens, usage_estimated, ttft_ms, latency_ms, retries, resumes
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    time.time(), tags.get('agent'), tags.get('state'), tags.get('session_id'),
+                    tags.get('user_id'), tags.get('prompt_version'), provider, model, mode, outcome,
+                    usage['prompt_tokens'], usage['cached_tokens'], usage['completion_tokens'],
+                    1 if estimated else 0,
+                    round(ttft * 1000, 1) if ttft is not None else None,
+                    round(latency * 1000, 1), retries, resumes
+                ))
+        except sqlite3.Error as e:
+            logger.warning('usage.record_failed', '⚠️  记录 LLM 用量失败', error=str(e))
+
+    @staticmethod
+    def _observe(tags, provider, model, mode, outcome, latency, usage, ttft):
+        """更新 LLM 调用的监控指标"""
+        labels = {'agent': tags.get('agent') or '', 'provider': provider or '', 'model': model or ''}
+        metrics.observe('llm_call_duration_seconds', latency, mode=mode, outcome=outcome, **labels)
+        if ttft is not None:
+            metrics.observe('llm_ttft_seconds', ttft, **labels)
+        for kind in ('prompt', 'cached', 'completion'):
+            if usage[f'{kind}_tokens']:
+                metrics.inc('llm_tokens_total', usage[f'{kind}_tokens'], type=kind, **labels)
+
+    # ========== 汇总 ==========
+
+    def rollup(
+        self,
+        group_by: Sequence[str] = ('agent',),
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        filters: Optional[Dict] = None
+    ) -> List[Dict]:
+        """
+        按维度汇总用量和延迟
+
+        Args:
+            group_by: 汇总维度（GROUP_COLUMNS 中的列）
+            since / until: 时间范围（Unix 时间戳）
+            filters: 维度过滤条件，如 {'agent': 'method'}
+
+        Returns:
+            list: 每组的调用数、错误数、token 合计、平均/最大耗时、p50/p95 耗时与首 token 耗时
+        """
+        group_by = [col for col in group_by if col in GROUP_COLUMNS]
+        where, params = self._where(since, until, filters)
+        select_cols = ', '.join(group_by) + ', ' if group_by else ''
+        group_clause = f"GROUP BY {', '.join(group_by)}" if group_by else ''
+
+        with self.get_connection() as conn:
+            rows = conn.execute(f'''
+                SELECT {select_cols}
+                    COUNT(*) AS calls,
+                    SUM(CASE WHEN outcome = 'error' THEN 1 ELSE 0 END) AS errors,
+                    SUM(prompt_tokens) AS prompt_tokens,
+                    SUM(cached_tokens) AS cached_tokens,
+                    SUM(completion_tokens) AS completion_tokens,
+                    SUM(retries) AS retries,
+                    ROUND(AVG(latency_ms), 1) AS avg_latency_ms,
+                    MAX(latency_ms) AS max_latency_ms,
+                    ROUND(AVG(ttft_ms), 1) AS avg_ttft_ms
+                FROM llm_usage {where} {group_clause}
+                ORDER BY calls DESC
+            ''', params).fetchall()
+            results = [dict(row) for row in rows]
+
+            # 分位数在 Python 中计算（按组取出耗时列）
+            for result in results:
+                group_filters = dict(filters or {})
+                group_filters.update({col: result[col] for col in group_by})
+                group_where, group_params = self._where(since, until, group_filters)
+                latencies = [r[0] for r in conn.execute(
+                    f'SELECT latency_ms FROM llm_usage {group_where} ORDER BY latency_ms', group_params
+                )]
+                ttfts = [r[0] for r in conn.execute(
+                    f'SELECT ttft_ms FROM llm_usage {group_where} AND ttft_ms IS NOT NULL ORDER BY ttft_ms',
+                    group_params
+                )]
+                result['p50_latency_ms'] = self._percentile(latencies, 0.5)
+                result['p95_latency_ms'] = self._percentile(latencies, 0.95)
+                result['p95_ttft_ms'] = self._percentile(ttfts, 0.95)
+        return results
+
+    @staticmethod
+    def _where(since, until, filters):
+        clauses, params = ['1 = 1'], []
+        if since is not None:
+            clauses.append('created_at >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append('created_at < ?')
+            params.append(until)
+        for col, value in (filters or {}).items():
+            if col not in GROUP_COLUMNS:
+                continue
+            if value is None:
+                clauses.append(f'{col} IS NULL')
+            else:
+                clauses.append(f'{col} = ?')
+                params.append(value)
+        return 'WHERE ' + ' AND '.join(clauses), params
+
+    @staticmethod
+    def _percentile(sorted_values: List[float], percentile: float) -> Optional[float]:
+        if not sorted_values:
+            return None
+        index = min(len(sorted_values) - 1, int(percentile * len(sorted_values)))
+        return sorted_values[index]
+
+
+# 全局用量记录器
+usage_tracker = UsageTracker()